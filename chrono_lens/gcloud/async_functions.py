@@ -1,4 +1,5 @@
 import asyncio
+import collections
 import json
 import logging
 import time
@@ -11,29 +12,274 @@ from chrono_lens.gcloud.authentication import create_authenticated_cloud_functio
 
 MAXIMUM_NUMBER_OF_ATTEMPTS = 5
 
+# Bounds on the number of requests in flight at once; the limit adapts between these (see AdaptiveConcurrencyLimiter)
+DEFAULT_MAXIMUM_CONCURRENCY = 400
+DEFAULT_INITIAL_CONCURRENCY = 50
+
+# Requests slower than this multiple of the smoothed latency are taken as a sign of overload; callers whose requests
+# naturally vary in duration (e.g. where some find their work already done) should pass None
+DEFAULT_LATENCY_TOLERANCE = 3.0
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limits the number of requests in flight, adapting the limit AIMD-style (additive increase, multiplicative
+    decrease) to how the endpoint copes:
+
+    * each request completing normally raises the limit - by 1 until the first sign of overload ("slow start", so
+      doubling per round of requests), then by 1 / limit (so by 1 per round of requests);
+    * a request answered with 429 (too many requests) or 5xx, failing to connect, or taking more than
+      `latency_tolerance` times the smoothed latency of earlier requests, multiplies the limit by `decrease_ratio`.
+
+    Only requests dispatched after the latest decrease can decrease the limit again, so a burst of failures from one
+    round of requests reduces the limit once.
+    """
+
+    LATENCY_SMOOTHING = 0.1
+
+    def __init__(self, initial_limit=DEFAULT_INITIAL_CONCURRENCY, maximum_limit=DEFAULT_MAXIMUM_CONCURRENCY,
+                 minimum_limit=1, decrease_ratio=0.5, latency_tolerance=DEFAULT_LATENCY_TOLERANCE):
+        """
+        :param initial_limit: number of requests initially allowed in flight; capped at `maximum_limit`
+        :param maximum_limit: largest number of requests ever allowed in flight
+        :param minimum_limit: smallest number of requests always allowed in flight
+        :param decrease_ratio: factor applied to the limit when the endpoint shows signs of overload
+        :param latency_tolerance: multiple of the smoothed latency above which a request is treated as a sign of
+            overload; None to ignore latency
+        """
+        if not 1 <= minimum_limit <= maximum_limit:
+            raise ValueError(f'Concurrency limits must satisfy 1 <= minimum ({minimum_limit})'
+                             f' <= maximum ({maximum_limit})')
+        if not 0 < decrease_ratio < 1:
+            raise ValueError(f'Decrease ratio must be between 0 and 1 exclusive, not {decrease_ratio}')
+
+        self.minimum_limit = minimum_limit
+        self.maximum_limit = maximum_limit
+        self.decrease_ratio = decrease_ratio
+        self.latency_tolerance = latency_tolerance
+
+        self._limit = float(min(max(initial_limit, minimum_limit), maximum_limit))
+        self._slow_start = True
+        self._in_flight = 0
+        self._waiters = collections.deque()
+        self._last_decrease_time = None
+        self._smoothed_latency = None
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    async def acquire(self):
+        """
+        Waits until another request is allowed in flight.
+
+        :return: dispatch time of the request, to be handed to `release`
+        """
+        if self._in_flight < self.limit and not self._waiters:
+            self._in_flight += 1
+            return time.monotonic()
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Slot was handed over just as we were cancelled, so pass it on
+                self._in_flight -= 1
+                self._wake_waiters()
+            raise
+
+        return time.monotonic()
+
+    def release(self, dispatch_time, overloaded=False):
+        """
+        Records a request has completed, adapting the limit to its outcome.
+
+        :param dispatch_time: as returned by `acquire`
+        :param overloaded: True if the response signals the endpoint is overloaded (e.g. status 429 or 503)
+        """
+        self._in_flight -= 1
+        latency = time.monotonic() - dispatch_time
+
+        if overloaded or self._is_slow(latency):
+            self._decrease(dispatch_time)
+        elif self._slow_start:
+            self._limit = min(self._limit + 1, self.maximum_limit)
+        else:
+            self._limit = min(self._limit + 1 / self._limit, self.maximum_limit)
+
+        if not overloaded:
+            if self._smoothed_latency is None:
+                self._smoothed_latency = latency
+            else:
+                self._smoothed_latency += self.LATENCY_SMOOTHING * (latency - self._smoothed_latency)
+
+        self._wake_waiters()
+
+    def _is_slow(self, latency):
+        if self.latency_tolerance is None or self._smoothed_latency is None:
+            return False
+        return latency > self.latency_tolerance * self._smoothed_latency
+
+    def _decrease(self, dispatch_time):
+        self._slow_start = False
+        if self._last_decrease_time is not None and dispatch_time < self._last_decrease_time:
+            return
+
+        self._limit = max(self._limit * self.decrease_ratio, self.minimum_limit)
+        self._last_decrease_time = time.monotonic()
+        logging.debug(f'Concurrency limit reduced to {self.limit}')
+
+    def _wake_waiters(self):
+        while self._waiters and self._in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._in_flight += 1
+                waiter.set_result(None)
+
 
 def run_cloud_function_async_with_parameter_list(json_key, json_values, partial_json, endpoint, headers=None,
-                                                 sleep_base=16, sleep_tuple=(1, 16)):
+                                                 sleep_base=16, sleep_tuple=(1, 16),
+                                                 maximum_concurrency=DEFAULT_MAXIMUM_CONCURRENCY,
+                                                 initial_concurrency=DEFAULT_INITIAL_CONCURRENCY,
+                                                 latency_tolerance=DEFAULT_LATENCY_TOLERANCE):
+    """
+    Calls `endpoint` once per entry of `json_values`, with JSON `{json_key: json_value, **partial_json}`.
+
+    Requests are not all sent at once; the number in flight adapts to the endpoint's responses, up to
+    `maximum_concurrency` (see `AdaptiveConcurrencyLimiter`), so callers need not batch `json_values`. To act on
+    results as they arrive, see `run_cloud_function_async_with_parameter_list_as_completed`.
+
+    `latency_tolerance` is passed to `AdaptiveConcurrencyLimiter`; pass None where requests naturally differ widely
+    in duration, so fast responses do not make slower ones look like overload.
+
+    :return: list of JSON responses (as dictionaries), in the order of `json_values`
+    """
+    json_values = list(json_values)
+    if not json_values:
+        return []
+
     if headers is None:
         headers = create_authenticated_cloud_function_headers(endpoint)
 
     return asyncio.run(
         _run_cloud_function_with_parameters(
-            json_key, json_values, partial_json, endpoint, headers, sleep_base, sleep_tuple))
+            json_key, json_values, partial_json, endpoint, headers, sleep_base, sleep_tuple, maximum_concurrency,
+            initial_concurrency, latency_tolerance))
+
+
+def run_cloud_function_async_with_parameter_list_as_completed(json_key, json_values, partial_json, endpoint,
+                                                              headers=None, sleep_base=16, sleep_tuple=(1, 16),
+                                                              maximum_concurrency=DEFAULT_MAXIMUM_CONCURRENCY,
+                                                              initial_concurrency=DEFAULT_INITIAL_CONCURRENCY,
+                                                              latency_tolerance=DEFAULT_LATENCY_TOLERANCE):
+    """
+    As `run_cloud_function_async_with_parameter_list`, but yields results as each request completes, so callers can
+    act on them while slower requests (or their retries) are still outstanding.
+
+    Requests only progress while the caller is waiting for the next result.
+
+    :return: generator of `(json_value, JSON response)`, in order of completion
+    """
+    event_loop = asyncio.new_event_loop()
+    result_stream = stream_cloud_function_async_with_parameter_list(
+        json_key, json_values, partial_json, endpoint, headers, sleep_base, sleep_tuple, maximum_concurrency,
+        initial_concurrency, latency_tolerance)
+    try:
+        while True:
+            try:
+                yield event_loop.run_until_complete(result_stream.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        event_loop.run_until_complete(result_stream.aclose())
+        event_loop.run_until_complete(event_loop.shutdown_asyncgens())
+        event_loop.close()
+
+
+async def stream_cloud_function_async_with_parameter_list(json_key, json_values, partial_json, endpoint, headers=None,
+                                                          sleep_base=16, sleep_tuple=(1, 16),
+                                                          maximum_concurrency=DEFAULT_MAXIMUM_CONCURRENCY,
+                                                          initial_concurrency=DEFAULT_INITIAL_CONCURRENCY,
+                                                          latency_tolerance=DEFAULT_LATENCY_TOLERANCE):
+    """
+    Asynchronous generator variant of `run_cloud_function_async_with_parameter_list_as_completed`.
+
+    :return: asynchronous generator of `(json_value, JSON response)`, in order of completion
+    """
+    json_values = list(json_values)
+    if not json_values:
+        return
+
+    if headers is None:
+        headers = create_authenticated_cloud_function_headers(endpoint)
+
+    indexed_result_stream = _stream_cloud_function_with_parameters(
+        json_key, json_values, partial_json, endpoint, headers, sleep_base, sleep_tuple, maximum_concurrency,
+        initial_concurrency, latency_tolerance)
+    try:
+        async for index, result in indexed_result_stream:
+            yield json_values[index], result
+    finally:
+        # Close now if the caller stopped early, rather than when garbage collected (possibly without an event loop)
+        await indexed_result_stream.aclose()
 
 
 async def _run_cloud_function_with_parameters(json_key, json_values, partial_json, endpoint, headers, sleep_base,
-                                              sleep_tuple):
-    async with aiohttp.ClientSession(headers=headers) as session:
-        return await asyncio.gather(
-            *(_run_cloud_function_with_parameter(json_key, json_value, partial_json, endpoint, session, sleep_base,
-                                                 sleep_tuple)
-              for json_value in json_values)
-        )
+                                              sleep_tuple, maximum_concurrency, initial_concurrency,
+                                              latency_tolerance):
+    results = [None] * len(json_values)
+    async for index, result in _stream_cloud_function_with_parameters(
+            json_key, json_values, partial_json, endpoint, headers, sleep_base, sleep_tuple, maximum_concurrency,
+            initial_concurrency, latency_tolerance):
+        results[index] = result
+    return results
+
+
+async def _stream_cloud_function_with_parameters(json_key, json_values, partial_json, endpoint, headers, sleep_base,
+                                                 sleep_tuple, maximum_concurrency, initial_concurrency,
+                                                 latency_tolerance):
+    """
+    Yields `(index into json_values, JSON response)` as each request completes.
+    """
+    concurrency_limiter = AdaptiveConcurrencyLimiter(initial_limit=initial_concurrency,
+                                                     maximum_limit=maximum_concurrency,
+                                                     latency_tolerance=latency_tolerance)
+    # The limiter bounds connections; aiohttp's default pool of 100 connections would otherwise queue requests
+    connector = aiohttp.TCPConnector(limit=maximum_concurrency)
+
+    async with aiohttp.ClientSession(headers=headers, connector=connector) as session:
+        tasks = [
+            asyncio.ensure_future(_run_indexed_cloud_function_with_parameter(
+                index, json_key, json_value, partial_json, endpoint, session, sleep_base, sleep_tuple,
+                concurrency_limiter))
+            for index, json_value in enumerate(json_values)
+        ]
+        try:
+            for completed_task in asyncio.as_completed(tasks):
+                yield await completed_task
+        finally:
+            # Only outstanding if the caller stopped early
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _run_indexed_cloud_function_with_parameter(index, *args):
+    return index, await _run_cloud_function_with_parameter(*args)
+
+
+def _is_overload_status(status):
+    return status == 429 or status >= 500
 
 
 async def _run_cloud_function_with_parameter(json_key, json_value, partial_json, endpoint, session, sleep_base,
-                                             sleep_tuple):
+                                             sleep_tuple, concurrency_limiter):
     logging.debug(f'Processing: "{json_key}": "{json_value}" with {partial_json}')
     complete_json_dict = {json_key: json_value}
     complete_json_dict.update(partial_json)
@@ -42,6 +288,9 @@ async def _run_cloud_function_with_parameter(json_key, json_value, partial_json,
 
     for attempt_number in range(MAXIMUM_NUMBER_OF_ATTEMPTS):
 
+        # Only hold a slot while the request is in flight, not while sleeping before a retry
+        dispatch_time = await concurrency_limiter.acquire()
+        overloaded = False
         start_time = time.time()
 
         try:
@@ -51,6 +300,7 @@ async def _run_cloud_function_with_parameter(json_key, json_value, partial_json,
                 text_response = await response.text()
 
                 end_time = time.time()
+                overloaded = _is_overload_status(response.status)
 
                 if response.status == 200:
                     json_response = json.loads(text_response)
@@ -79,10 +329,14 @@ async def _run_cloud_function_with_parameter(json_key, json_value, partial_json,
                     f' elapsed time {end_time - start_time:.2f}s')
 
         except ClientError as ce:
+            overloaded = True
             logging.debug(
                 f'Failed attempt#{attempt_number}: session.post errored with "{ce}"'
             )
 
+        finally:
+            concurrency_limiter.release(dispatch_time, overloaded)
+
         # No need to wait after the last attempt, we've given up now - so don't waste compute cycles
         if attempt_number < MAXIMUM_NUMBER_OF_ATTEMPTS - 1:
             sleep_time = sleep_base + uniform(*sleep_tuple)
@@ -1,4 +1,28 @@
+import logging
+import os
 import re
+import time
+
+import google.api_core.exceptions
+from google.cloud import bigquery
+
+"""
+Model results are written to one BigQuery table per model, with a row per image. Streaming inserts are charged and
+rate limited per request, so `BufferedBigQueryWriter` accumulates rows and inserts each table's rows together.
+
+Each row is inserted with a row ID derived from its image (see `create_row_id`); BigQuery discards rows repeating a
+recently inserted row ID, so retried writes do not duplicate rows.
+See https://cloud.google.com/bigquery/streaming-data-into-bigquery#dataconsistency
+
+Tables known to exist are remembered for a while by `shared_table_cache`, shared by everything in the process, so
+warm cloud function instances need not look tables up on every request. Only existing tables are remembered: a table
+missing now may be created by another instance at any moment.
+"""
+# BigQuery recommends at most 500 rows per streaming insert
+DEFAULT_MAXIMUM_BUFFERED_ROWS = 500
+DEFAULT_MAXIMUM_BUFFER_AGE_SECONDS = 30
+
+DEFAULT_TABLE_CACHE_TTL_SECONDS = 10 * 60
 
 
 def convert_model_name_to_table_name(model_blob_name: str) -> str:
@@ -18,3 +42,262 @@ def convert_model_name_to_table_name(model_blob_name: str) -> str:
     unfiltered_model_name = model_blob_name.split('/')[0]
     table_name = re.sub(r'\W+', '', unfiltered_model_name)
     return table_name
+
+
+def create_model_results_row(image_blob_name, model_results):
+    """
+    :param image_blob_name: name of the image blob, in format "source/YYYYMMDD/HHMM/camera_id.ext"
+    :param model_results: dictionary of results (such as object counts) of the model on the image
+    :return: dictionary of the table row recording `model_results`
+    """
+    source, date, time_of_day, camera_filename = image_blob_name.split('/')
+    camera_id = os.path.splitext(camera_filename)[0]
+
+    row = {
+        'source': source,
+        'camera_id': camera_id,
+        'date': f'{date[0:4]}-{date[4:6]}-{date[6:8]}',
+        'time': f'{time_of_day[0:2]}:{time_of_day[2:4]}:00'
+    }
+    for result_name, result in model_results.items():
+        row[result_name] = result
+    return row
+
+
+def create_row_id(row):
+    """
+    :param row: dictionary of a table row, as created by `create_model_results_row`
+    :return: row ID identifying the image the row records
+    """
+    return row['camera_id'] + '_' + row['source'] + '_' + row['date'] + '_' + row['time']
+
+
+def create_table_schema(model_results):
+    """
+    :param model_results: dictionary of results (such as object counts) of the model on an image
+    :return: dictionary of column name to BigQuery type, for a table of rows of such results
+    """
+    dict_schema = {'source': 'STRING', 'camera_id': 'STRING', 'date': 'DATE', 'time': 'TIME'}  # default schema
+    for result_name in model_results.keys():
+        result_type = type(model_results[result_name])
+        if result_type is int:
+            dict_schema[result_name] = 'INTEGER'
+        elif result_type is bool:
+            dict_schema[result_name] = 'BOOLEAN'
+        else:
+            raise ValueError(f'{result_name} is of unhandled type in results: "{result_type}"')
+    return dict_schema
+
+
+def create_table_definition(table_id, dict_schema):
+    """
+    :param table_id: full ID of the table, in format "project.dataset.table"
+    :param dict_schema: dictionary of column name to BigQuery type, as created by `create_table_schema`
+    :return: `google.cloud.bigquery.Table` of model results, partitioned by date
+    """
+    schema = []
+    for col_name, field_type in dict_schema.items():
+        column = bigquery.SchemaField(col_name, field_type, mode="REQUIRED")
+        schema.append(column)
+
+    table = bigquery.Table(table_id, schema=schema)
+    table.time_partitioning = bigquery.TimePartitioning(field="date")
+    table.require_partition_filter = True
+    return table
+
+
+class TableCache:
+    """
+    Remembers tables known to exist, with their schema, for `ttl_seconds` after they were looked up.
+    """
+
+    def __init__(self, ttl_seconds=DEFAULT_TABLE_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._tables = {}
+
+    def __len__(self):
+        return len(self._tables)
+
+    def __contains__(self, table_id):
+        return self._cached_table(table_id) is not None
+
+    def get_table(self, bigquery_client, table_id):
+        """
+        :param bigquery_client: `google.cloud.bigquery.Client` used to look up the table if not cached
+        :param table_id: full ID of the table, in format "project.dataset.table"
+        :return: `google.cloud.bigquery.Table`, or None if there is no such table
+        """
+        table = self._cached_table(table_id)
+        if table is not None:
+            return table
+
+        try:
+            table = bigquery_client.get_table(table_id)
+        except google.api_core.exceptions.NotFound:
+            return None
+
+        self._add(table_id, table)
+        return table
+
+    def get_or_create_table(self, bigquery_client, table_id, create_table_definition):
+        """
+        :param bigquery_client: `google.cloud.bigquery.Client` used to look up or create the table if not cached
+        :param table_id: full ID of the table, in format "project.dataset.table"
+        :param create_table_definition: function with no arguments returning the `google.cloud.bigquery.Table` to
+            create if there is no such table
+        :return: `google.cloud.bigquery.Table`
+        """
+        table = self.get_table(bigquery_client, table_id)
+        if table is not None:
+            return table
+
+        try:
+            table = bigquery_client.create_table(create_table_definition())
+            logging.warning(f"Created table {table.project}.{table.dataset_id}.{table.table_id}")
+        except google.api_core.exceptions.Conflict:
+            # Another instance created the table since we looked
+            table = bigquery_client.get_table(table_id)
+
+        self._add(table_id, table)
+        return table
+
+    def invalidate(self, table_id):
+        """
+        Forgets `table_id`, such as when the table is found to have been deleted.
+        """
+        self._tables.pop(table_id, None)
+
+    def clear(self):
+        self._tables.clear()
+
+    def _cached_table(self, table_id):
+        table_and_expiry_time = self._tables.get(table_id)
+        if table_and_expiry_time is None:
+            return None
+
+        table, expiry_time = table_and_expiry_time
+        if time.monotonic() >= expiry_time:
+            del self._tables[table_id]
+            return None
+
+        return table
+
+    def _add(self, table_id, table):
+        self._tables[table_id] = (table, time.monotonic() + self.ttl_seconds)
+
+
+shared_table_cache = TableCache()
+
+
+class BufferedBigQueryWriter:
+    """
+    Buffers model results rows by table, inserting them once `maximum_buffered_rows` are buffered, the oldest
+    buffered row is `maximum_buffer_age_seconds` old (checked as rows are added), or on `flush`.
+
+    Tables are created as required, with a schema derived from the first results written to them by this writer;
+    tables found or created are remembered in `table_cache` (`shared_table_cache` by default).
+    """
+
+    def __init__(self, bigquery_client, project, dataset_name, maximum_buffered_rows=DEFAULT_MAXIMUM_BUFFERED_ROWS,
+                 maximum_buffer_age_seconds=DEFAULT_MAXIMUM_BUFFER_AGE_SECONDS, table_cache=None):
+        """
+        :param bigquery_client: `google.cloud.bigquery.Client` used to access the tables
+        :param project: Google Cloud project holding the dataset
+        :param dataset_name: BigQuery dataset holding a table per model
+        :param maximum_buffered_rows: number of buffered rows (over all tables) that triggers insertion
+        :param maximum_buffer_age_seconds: age of the oldest buffered row that triggers insertion
+        :param table_cache: `TableCache` of known tables; defaults to the cache shared by the process
+        """
+        if maximum_buffered_rows < 1:
+            raise ValueError(f'maximum_buffered_rows must be at least 1, not {maximum_buffered_rows}')
+
+        self.bigquery_client = bigquery_client
+        self.project = project
+        self.dataset_name = dataset_name
+        self.maximum_buffered_rows = maximum_buffered_rows
+        self.maximum_buffer_age_seconds = maximum_buffer_age_seconds
+
+        self.table_cache = shared_table_cache if table_cache is None else table_cache
+
+        self._buffered_rows = {}
+        self._first_model_results = {}
+        self._oldest_buffered_row_time = None
+        self._errors = []
+
+    def __len__(self):
+        return sum(len(rows) for rows in self._buffered_rows.values())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def add_model_results(self, model_blob_name, image_blob_name, model_results):
+        """
+        Buffers a row recording `model_results`, in the table of model `model_blob_name`.
+
+        :param model_blob_name: name of the model, such as "NewcastleV0"; its table is named by
+            `convert_model_name_to_table_name`
+        :param image_blob_name: name of the image blob, in format "source/YYYYMMDD/HHMM/camera_id.ext"
+        :param model_results: dictionary of results (such as object counts) of the model on the image
+        """
+        table_name = convert_model_name_to_table_name(model_blob_name)
+        row = create_model_results_row(image_blob_name, model_results)
+
+        # Schema only derived if the table needs creating
+        self._first_model_results.setdefault(table_name, model_results)
+
+        self._buffered_rows.setdefault(table_name, []).append(row)
+        if self._oldest_buffered_row_time is None:
+            self._oldest_buffered_row_time = time.monotonic()
+
+        if len(self) >= self.maximum_buffered_rows \
+                or time.monotonic() - self._oldest_buffered_row_time >= self.maximum_buffer_age_seconds:
+            self._insert_buffered_rows()
+
+    def flush(self):
+        """
+        Inserts all buffered rows.
+
+        :return: list of errors reported inserting rows since the previous `flush`, each as reported by
+            `google.cloud.bigquery.Client.insert_rows_json` plus the "table_name" and "row_id" of the row
+        """
+        self._insert_buffered_rows()
+        errors = self._errors
+        self._errors = []
+        return errors
+
+    def discard(self):
+        """
+        Drops all buffered rows without inserting them, and any errors not yet returned by `flush`.
+        """
+        self._buffered_rows = {}
+        self._oldest_buffered_row_time = None
+        self._errors = []
+
+    def _insert_buffered_rows(self):
+        buffered_rows = self._buffered_rows
+        self._buffered_rows = {}
+        self._oldest_buffered_row_time = None
+
+        for table_name, rows in buffered_rows.items():
+            table_id = ".".join([self.project, self.dataset_name, table_name])
+            row_ids = [create_row_id(row) for row in rows]
+            try:
+                errors = self.bigquery_client.insert_rows_json(self._get_or_create_table(table_name, table_id), rows,
+                                                               row_ids=row_ids)
+            except google.api_core.exceptions.NotFound:
+                # Table deleted since it was cached
+                self.table_cache.invalidate(table_id)
+                errors = self.bigquery_client.insert_rows_json(self._get_or_create_table(table_name, table_id), rows,
+                                                               row_ids=row_ids)
+
+            for error in errors:
+                logging.error(error)
+                self._errors.append(dict(error, table_name=table_name, row_id=row_ids[error['index']]))
+
+    def _get_or_create_table(self, table_name, table_id):
+        return self.table_cache.get_or_create_table(
+            self.bigquery_client, table_id,
+            lambda: create_table_definition(table_id, create_table_schema(self._first_model_results[table_name])))
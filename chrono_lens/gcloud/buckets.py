@@ -3,15 +3,30 @@ import json
 from google.cloud import storage
 
 
-def write_to_bucket(bucket_name, blob_name, data, content_type='text/plain'):
+def write_to_bucket(bucket_name, blob_name, data, content_type='text/plain', metadata=None):
     client = storage.Client()
 
     bucket = client.get_bucket(bucket_name)
     blob = bucket.blob(blob_name)
+    if metadata is not None:
+        blob.metadata = metadata
 
     blob.upload_from_string(data, content_type=content_type)
 
 
+def read_blob_metadata(bucket, blob_name):
+    """
+    :param bucket: `google.cloud.storage.Bucket` holding the blob
+    :param blob_name: name of the blob
+    :return: dictionary of the blob's custom metadata (empty if it has none), or None if the blob is missing
+    """
+    blob = bucket.get_blob(blob_name)
+    if blob is None:
+        return None
+
+    return blob.metadata or {}
+
+
 def read_from_bucket(bucket_name, blob_name, client=None):
     if client is None:
         client = storage.Client()
@@ -1,7 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
 import google
 import numpy
 
+from chrono_lens.gcloud.call_handling import image_blob_name_from_fields
+from chrono_lens.images.download_records import identical_image_marker_name, identical_image_date_time_of
+from chrono_lens.images.image_frame import ImageFrame
+from chrono_lens.images.pipeline import InMemoryImageStore
+
+# Blob downloads are I/O bound, so far more can be in flight than there are CPUs
+DEFAULT_MAXIMUM_DOWNLOAD_WORKERS = 32
+
 
 def load_image_from_blob(image_blob_name, image_bucket):
     image_blob = image_bucket.blob(image_blob_name)
@@ -30,3 +40,128 @@ def load_bgr_image_from_blob_as_rgb(image_blob_name, image_bucket):
 
     image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
     return image_rgb
+
+
+def load_image_frame_from_blob(image_blob_name, image_bucket, greyscale_decoding=False, initial_reduction=1):
+    """
+    :param image_blob_name: name of the (JPEG) image blob in `image_bucket`
+    :param image_bucket: `google.cloud.storage.Bucket` containing the image
+    :param greyscale_decoding: if True, decode straight to greyscale (see `ImageFrame.decode`)
+    :param initial_reduction: size reduction at which the image is first decoded (see `ImageFrame.decode`)
+    :return: `ImageFrame`, empty if the image could not be decoded; None if the blob is missing
+    """
+    image_blob = image_bucket.blob(image_blob_name)
+    try:
+        raw_image = image_blob.download_as_string()
+    except google.api_core.exceptions.NotFound:
+        return None
+
+    return ImageFrame.decode(raw_image, greyscale_decoding, initial_reduction)
+
+
+def load_identical_image_date_time_from_blob(image_blob_name, image_bucket):
+    """
+    :param image_blob_name: name of the (JPEG) image blob in `image_bucket`
+    :param image_bucket: `google.cloud.storage.Bucket` containing the image
+    :return: datetime of the slot holding the image, if an identical image marker is stored in place of the image
+        (see `chrono_lens.images.download_records`); otherwise None
+    """
+    marker_blob = image_bucket.blob(identical_image_marker_name(image_blob_name))
+    try:
+        marker = marker_blob.download_as_string()
+    except google.api_core.exceptions.NotFound:
+        return None
+
+    return identical_image_date_time_of(marker)
+
+
+class BucketImageStore:
+    """
+    Image store (see `chrono_lens.images.pipeline`) of images held in a bucket, as blobs named
+    "source/YYYYMMDD/HHMM/camera_id.jpg".
+    """
+
+    def __init__(self, image_bucket):
+        """
+        :param image_bucket: `google.cloud.storage.Bucket` containing the images
+        """
+        self.image_bucket = image_bucket
+
+    def load_image_frame(self, image_source, image_date_time, camera_id, greyscale_decoding=False,
+                         initial_reduction=1):
+        return load_image_frame_from_blob(image_blob_name_from_fields(image_source, image_date_time, camera_id),
+                                          self.image_bucket, greyscale_decoding, initial_reduction)
+
+    def load_identical_image_date_time(self, image_source, image_date_time, camera_id):
+        return load_identical_image_date_time_from_blob(
+            image_blob_name_from_fields(image_source, image_date_time, camera_id), self.image_bucket)
+
+
+class PrefetchingBucketImageStore(BucketImageStore):
+    """
+    `BucketImageStore` whose images can be downloaded concurrently ahead of processing, with `prefetch`, rather than
+    one at a time as each is needed; images that were not prefetched are read from the bucket when required.
+    """
+
+    def __init__(self, image_bucket, maximum_download_workers=DEFAULT_MAXIMUM_DOWNLOAD_WORKERS):
+        """
+        :param image_bucket: `google.cloud.storage.Bucket` containing the images
+        :param maximum_download_workers: maximum number of blobs downloaded at once by `prefetch`
+        """
+        if maximum_download_workers < 1:
+            raise ValueError(f'maximum_download_workers must be at least 1, not {maximum_download_workers}')
+
+        super().__init__(image_bucket)
+        self.maximum_download_workers = maximum_download_workers
+
+        self._prefetched_images = InMemoryImageStore()
+        self._prefetched_image_keys = set()
+
+    def __contains__(self, image_key):
+        return image_key in self._prefetched_image_keys
+
+    def prefetch(self, image_keys):
+        """
+        Downloads the images concurrently - or, for missing images, their identical image markers (see
+        `chrono_lens.images.download_records`) - so they are read from memory when processed.
+
+        :param image_keys: iterable of (image_source, image_date_time, camera_id) tuples of the images to download
+        """
+        image_keys = [image_key for image_key in dict.fromkeys(image_keys) if image_key not in self]
+        if len(image_keys) == 0:
+            return
+
+        with ThreadPoolExecutor(max_workers=min(self.maximum_download_workers, len(image_keys))) as executor:
+            for image_key, (raw_image, identical_image_date_time) in zip(image_keys,
+                                                                          executor.map(self._download, image_keys)):
+                if raw_image is not None:
+                    self._prefetched_images.raw_images[image_key] = raw_image
+                elif identical_image_date_time is not None:
+                    self._prefetched_images.identical_image_date_times[image_key] = identical_image_date_time
+                self._prefetched_image_keys.add(image_key)
+
+    def load_image_frame(self, image_source, image_date_time, camera_id, greyscale_decoding=False,
+                         initial_reduction=1):
+        if (image_source, image_date_time, camera_id) not in self:
+            return super().load_image_frame(image_source, image_date_time, camera_id, greyscale_decoding,
+                                            initial_reduction)
+
+        return self._prefetched_images.load_image_frame(image_source, image_date_time, camera_id, greyscale_decoding,
+                                                        initial_reduction)
+
+    def load_identical_image_date_time(self, image_source, image_date_time, camera_id):
+        if (image_source, image_date_time, camera_id) not in self:
+            return super().load_identical_image_date_time(image_source, image_date_time, camera_id)
+
+        return self._prefetched_images.load_identical_image_date_time(image_source, image_date_time, camera_id)
+
+    def _download(self, image_key):
+        """
+        :return: tuple of the raw image (None if missing) and, if missing, the datetime of the slot holding the image
+            from its identical image marker (None if there is no marker)
+        """
+        image_blob_name = image_blob_name_from_fields(*image_key)
+        try:
+            return self.image_bucket.blob(image_blob_name).download_as_string(), None
+        except google.api_core.exceptions.NotFound:
+            return None, load_identical_image_date_time_from_blob(image_blob_name, self.image_bucket)
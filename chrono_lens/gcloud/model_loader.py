@@ -0,0 +1,50 @@
+import base64
+import hashlib
+import os
+import tempfile
+
+
+def _md5_as_base64(data):
+    # Same encoding as google.cloud.storage.Blob.md5_hash
+    return base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+
+
+def load_model_blob_with_local_copy(model_blob_name, model_bucket, local_folder):
+    """
+    Returns the contents of a (large) model blob, such as a serialized graph, reusing a local copy when its checksum
+    matches that of the blob; otherwise the blob is downloaded and the local copy replaced.
+
+    Only the blob's metadata is fetched when the local copy is valid, so reloading a model (for example, after its
+    detector was evicted from a cache) avoids downloading it again.
+
+    :param model_blob_name: name of the blob in `model_bucket`, e.g. "NewcastleV0/fig_frcnn_rebuscov-3.pb"
+    :param model_bucket: `google.cloud.storage.Bucket` containing the blob
+    :param local_folder: folder in which local copies are kept; if None, the blob is always downloaded
+    :return: contents of the blob, as bytes
+    """
+    model_blob = model_bucket.blob(model_blob_name)
+
+    if local_folder is None:
+        return model_blob.download_as_string()
+
+    local_file_name = os.path.join(local_folder, model_blob_name)
+
+    if os.path.isfile(local_file_name):
+        model_blob.reload()
+        with open(local_file_name, 'rb') as local_file:
+            model_data = local_file.read()
+
+        if _md5_as_base64(model_data) == model_blob.md5_hash:
+            return model_data
+
+    model_data = model_blob.download_as_string()
+
+    local_file_folder = os.path.dirname(local_file_name)
+    os.makedirs(local_file_folder, exist_ok=True)
+
+    # Write to a temporary file first, so an interrupted write never leaves a partial copy under the final name
+    with tempfile.NamedTemporaryFile(dir=local_file_folder, delete=False) as temporary_file:
+        temporary_file.write(model_data)
+    os.replace(temporary_file.name, local_file_name)
+
+    return model_data
@@ -0,0 +1,207 @@
+import datetime
+import json
+from functools import partial
+
+from opentelemetry import trace
+
+from chrono_lens.gcloud.call_handling import extract_fields_from_image_blob
+from chrono_lens.gcloud.image_loader import BucketImageStore, PrefetchingBucketImageStore
+from chrono_lens.gcloud.model_loader import load_model_blob_with_local_copy
+from chrono_lens.images.detector_cache import DetectorCache
+from chrono_lens.images.fault_detection import FaultyImageDetector
+from chrono_lens.images.image_cache import ImageCache
+from chrono_lens.images.newcastle_detector import NewcastleDetector
+from chrono_lens.images.pipeline import CountingPipeline, ModelStages, split_model_stages, IMAGE_INTERVAL
+from chrono_lens.images.static_filter import StaticObjectFilter
+
+"""
+Counts objects in images held in Google Cloud Storage, using a model built from stages held in the models bucket -
+such as "FaultyImageFilterV0_NewcastleV0_StaticObjectFilterV0" (see `chrono_lens.images.pipeline`). This is the
+pipeline behind the `count_objects` cloud function; `count_objects_and_write` fuses it with writing the results to
+BigQuery, so callers such as `run_model_on_image` can process an image in-process rather than calling
+`count_objects` and `bigquery_write` in turn.
+"""
+
+# Cloud Functions hold the image cache in instance memory alongside the detectors (and, with /tmp in memory, copies of
+# their serialized graphs); a camera's sliding window needs only a few frames, so far less is kept than on localhost
+DEFAULT_CLOUD_IMAGE_CACHE_MAXIMUM_BYTES = 128 * 1024 * 1024
+
+
+def status_of_object_results(object_results):
+    """
+    :param object_results: dictionary of object counts, as returned by `ObjectCounter.count_objects`
+    :return: "Faulty", "Missing" or "Processed", as reported by `run_model_on_image`
+    """
+    if object_results['faulty']:
+        return 'Faulty'
+    elif object_results['missing']:
+        return 'Missing'
+    else:
+        return 'Processed'
+
+
+class ObjectCounter:
+    """
+    Holds the detectors, filters and decoded images reused between images; each image is needed as "next", "current"
+    and "previous" image in turn, so a single `ObjectCounter` should be used for a sequence of images.
+    """
+
+    def __init__(self, detector_cache=None, image_cache=None, model_cache_folder=None):
+        """
+        :param detector_cache: `DetectorCache` of detectors, by model stage name; a default sized cache if None
+        :param image_cache: `ImageCache` of decoded images; a cache of `DEFAULT_CLOUD_IMAGE_CACHE_MAXIMUM_BYTES` if None
+        :param model_cache_folder: local folder in which serialized graphs are kept, so an evicted detector can be
+            rebuilt without downloading its graph again; None to disable
+        """
+        self.detector_cache = DetectorCache() if detector_cache is None else detector_cache
+        self.image_cache = ImageCache(DEFAULT_CLOUD_IMAGE_CACHE_MAXIMUM_BYTES) if image_cache is None else image_cache
+        self.model_cache_folder = model_cache_folder
+
+        # Filters hold no model, so all those requested are kept, by stage name
+        self._filters = {}
+
+    def create_object_detector(self, object_detector_model_stage_name, model_bucket):
+        tracer = trace.get_tracer(__name__)
+
+        if not object_detector_model_stage_name.startswith('Newcastle'):
+            raise ValueError(f'Model object detector stage is unknown: "{object_detector_model_stage_name}"')
+
+        model_configuration_blob = model_bucket.blob(object_detector_model_stage_name + '/configuration.json')
+        model_configuration = json.loads(model_configuration_blob.download_as_string())
+
+        with tracer.start_as_current_span("Loading model from blob"):
+            serialized_graph = load_model_blob_with_local_copy(
+                f'{object_detector_model_stage_name}/{model_configuration["serialized_graph_name"]}', model_bucket,
+                self.model_cache_folder)
+
+        with tracer.start_as_current_span("Constructing detector"):
+            return NewcastleDetector.from_configuration(model_configuration, serialized_graph)
+
+    def get_or_create_object_detector(self, object_detector_model_stage_name, model_bucket):
+        return self.detector_cache.get_or_create(
+            object_detector_model_stage_name,
+            partial(self.create_object_detector, object_detector_model_stage_name, model_bucket))
+
+    def warm_up_detectors(self, model_stage_names, model_bucket):
+        """
+        Creates detectors for the named models and runs a dummy inference through each, so graph initialisation is
+        paid for at cold start rather than within the first request.
+
+        :param model_stage_names: list of object detection model stage names, e.g. ["NewcastleV0"]
+        :param model_bucket: `google.cloud.storage.Bucket` containing the models
+        """
+        for model_stage_name in model_stage_names:
+            self.get_or_create_object_detector(model_stage_name, model_bucket).warm_up()
+
+    def get_or_create_model_stages(self, model_blob_name, model_bucket):
+        """
+        :param model_blob_name: name of the model, as "_" separated stages, e.g. "NewcastleV0_StaticObjectFilterV0"
+        :param model_bucket: `google.cloud.storage.Bucket` containing the model stages
+        :return: `ModelStages` of the model, built from cached filters and detectors where available
+        """
+        model_pre_process_names, object_detector_model_stage_name, model_post_process_names = \
+            split_model_stages(model_blob_name)
+
+        return ModelStages(
+            [self._get_or_create_filter(model_pre_process_name, FaultyImageDetector, model_bucket)
+             for model_pre_process_name in model_pre_process_names],
+            self.get_or_create_object_detector(object_detector_model_stage_name, model_bucket),
+            [self._get_or_create_filter(model_post_process_name, StaticObjectFilter, model_bucket)
+             for model_post_process_name in model_post_process_names])
+
+    def create_counting_pipeline(self, model_blob_name, image_store, model_bucket, detection_batch_size=1):
+        """
+        :param model_blob_name: name of the model, as "_" separated stages, e.g. "NewcastleV0_StaticObjectFilterV0"
+        :param image_store: image store from which images are read, such as a `BucketImageStore`
+        :param model_bucket: `google.cloud.storage.Bucket` containing the model stages
+        :param detection_batch_size: see `CountingPipeline`
+        :return: `CountingPipeline` of the model, reading images from `image_store` through the image cache
+        """
+        tracer = trace.get_tracer(__name__)
+
+        with tracer.start_as_current_span("Initiating model stages"):
+            model_stages = self.get_or_create_model_stages(model_blob_name, model_bucket)
+
+        return CountingPipeline(model_stages, image_store, self.image_cache, detection_batch_size)
+
+    def count_objects(self, image_blob_name, model_blob_name, data_bucket, model_bucket):
+        """
+        :param image_blob_name: name of the image blob, in format "source/YYYYMMDD/HHMM/camera_id.jpg"
+        :param model_blob_name: name of the model, as "_" separated stages, e.g. "NewcastleV0_StaticObjectFilterV0"
+        :param data_bucket: `google.cloud.storage.Bucket` containing the images
+        :param model_bucket: `google.cloud.storage.Bucket` containing the model stages
+        :return: dictionary of the count of each object type detected, plus "faulty" and "missing" flags
+        """
+        tracer = trace.get_tracer(__name__)
+
+        image_source, image_date_time, camera_id = extract_fields_from_image_blob(image_blob_name)
+        counting_pipeline = self.create_counting_pipeline(model_blob_name, BucketImageStore(data_bucket),
+                                                          model_bucket)
+
+        with tracer.start_as_current_span("Counting objects"):
+            return counting_pipeline.count_objects(image_source, image_date_time, camera_id)
+
+    def count_objects_in_batch(self, image_blob_names, model_blob_name, data_bucket, model_bucket,
+                               detection_batch_size=1):
+        """
+        Counts objects in several images - such as a camera's day - as `count_objects` would. The images, and their
+        neighbours used for comparison, are downloaded concurrently up front; each camera's images are then processed
+        in time order, so each image is decoded once (see `CountingPipeline.count_objects_in_batch`).
+
+        :param image_blob_names: names of the image blobs, in format "source/YYYYMMDD/HHMM/camera_id.jpg"
+        :param model_blob_name: name of the model, as "_" separated stages, e.g. "NewcastleV0_StaticObjectFilterV0"
+        :param data_bucket: `google.cloud.storage.Bucket` containing the images
+        :param model_bucket: `google.cloud.storage.Bucket` containing the model stages
+        :param detection_batch_size: see `CountingPipeline`
+        :return: list of dictionaries of object counts (as returned by `count_objects`), in order of
+            `image_blob_names`
+        """
+        tracer = trace.get_tracer(__name__)
+
+        image_keys = [extract_fields_from_image_blob(image_blob_name) for image_blob_name in image_blob_names]
+        counting_pipeline = self.create_counting_pipeline(model_blob_name, PrefetchingBucketImageStore(data_bucket),
+                                                          model_bucket, detection_batch_size)
+
+        with tracer.start_as_current_span("Downloading images"):
+            counting_pipeline.image_store.prefetch(
+                (image_source, image_date_time + image_offset, camera_id)
+                for image_source, image_date_time, camera_id in image_keys
+                for image_offset in [-IMAGE_INTERVAL, datetime.timedelta(0), IMAGE_INTERVAL])
+
+        try:
+            with tracer.start_as_current_span("Counting objects"):
+                return counting_pipeline.count_objects_in_batch(image_keys)
+        finally:
+            # Leave the cache for images still to be requested individually, rather than the last of the batch
+            for image_source, image_date_time, camera_id in image_keys:
+                for image_offset in [datetime.timedelta(0), IMAGE_INTERVAL]:
+                    self.image_cache.discard((image_source, camera_id, image_date_time + image_offset))
+
+    def _get_or_create_filter(self, model_stage_name, filter_class, model_bucket):
+        model_filter = self._filters.get(model_stage_name)
+        if model_filter is None:
+            model_stage_configuration_blob = model_bucket.blob(model_stage_name + '/configuration.json')
+            model_filter = filter_class.from_configuration(
+                json.loads(model_stage_configuration_blob.download_as_string()))
+            self._filters[model_stage_name] = model_filter
+
+        return model_filter
+
+
+def count_objects_and_write(object_counter, bigquery_writer, image_blob_name, model_blob_name, data_bucket,
+                            model_bucket):
+    """
+    Counts objects in the image and buffers the results for BigQuery - the work of calling `count_objects` and then
+    `bigquery_write`, without either network hop. Rows are only inserted once `bigquery_writer` is flushed (or fills).
+
+    :param object_counter: `ObjectCounter` used to count the objects
+    :param bigquery_writer: `chrono_lens.gcloud.bigquery.BufferedBigQueryWriter` to which results are added
+    :param image_blob_name: name of the image blob, in format "source/YYYYMMDD/HHMM/camera_id.jpg"
+    :param model_blob_name: name of the model, as "_" separated stages, e.g. "NewcastleV0_StaticObjectFilterV0"
+    :param data_bucket: `google.cloud.storage.Bucket` containing the images
+    :param model_bucket: `google.cloud.storage.Bucket` containing the model stages
+    :return: tuple of status ("Faulty", "Missing" or "Processed") and the dictionary of object counts
+    """
+    object_results = object_counter.count_objects(image_blob_name, model_blob_name, data_bucket, model_bucket)
+    bigquery_writer.add_model_results(model_blob_name, image_blob_name, object_results)
+    return status_of_object_results(object_results), object_results
@@ -6,9 +6,10 @@ import google.oauth2.service_account
 from dateutil import rrule
 from tqdm import tqdm
 
-from chrono_lens.gcloud.async_functions import run_cloud_function_async_with_parameter_list
+from chrono_lens.gcloud.async_functions import run_cloud_function_async_with_parameter_list_as_completed
 
-CAMERA_BATCH_SIZE = 50
+# Each process_day call fans out a request per image of the day, so keep fewer of them in flight
+MAXIMUM_CAMERA_CONCURRENCY = 50
 
 
 def run_model_on_images(start_date: datetime.date, end_date: datetime.date, cameras_to_analyse: dict,
@@ -29,26 +30,27 @@ def run_model_on_images(start_date: datetime.date, end_date: datetime.date, came
 
         for data_root in tqdm(cameras_to_analyse, desc='Processing image sources', unit='image source', leave=False):
 
-            camera_batches = [cameras_to_analyse[data_root][x:x + CAMERA_BATCH_SIZE]
-                              for x in range(0, len(cameras_to_analyse[data_root]), CAMERA_BATCH_SIZE)]
-            for camera_batch in camera_batches:
-                async_results = run_cloud_function_async_with_parameter_list(
-                    json_key='camera_id', json_values=camera_batch,
-                    partial_json={
-                        'date_to_process': f'{date_to_process:%Y%m%d}',
-                        'data_root': data_root,
-                        'model_blob_name': model_blob_name
-                    },
-                    endpoint=process_day_endpoint,
-                    headers={'Authorization': f'Bearer {credentials.token}'}
-                )
-
-                for result in async_results:
-                    if result['STATUS'] == 'OK':
-                        for count_type in result['Counts']:
-                            results[count_type] = results.get(count_type, 0) + result['Counts'][count_type]
-                    else:
-                        results['Errors'][result['STATUS']] = results['Errors'].get(result['STATUS'], 0) + 1
-                        errors.append(result)
+            async_results = run_cloud_function_async_with_parameter_list_as_completed(
+                json_key='camera_id', json_values=cameras_to_analyse[data_root],
+                partial_json={
+                    'date_to_process': f'{date_to_process:%Y%m%d}',
+                    'data_root': data_root,
+                    'model_blob_name': model_blob_name
+                },
+                endpoint=process_day_endpoint,
+                headers={'Authorization': f'Bearer {credentials.token}'},
+                maximum_concurrency=MAXIMUM_CAMERA_CONCURRENCY,
+                # A camera-day already processed returns in seconds, one to process in minutes; neither is overload
+                latency_tolerance=None
+            )
+
+            for _camera_id, result in tqdm(async_results, total=len(cameras_to_analyse[data_root]),
+                                           desc='Processing cameras', unit='camera', leave=False):
+                if result['STATUS'] == 'OK':
+                    for count_type in result['Counts']:
+                        results[count_type] = results.get(count_type, 0) + result['Counts'][count_type]
+                else:
+                    results['Errors'][result['STATUS']] = results['Errors'].get(result['STATUS'], 0) + 1
+                    errors.append(result)
 
     return results, errors
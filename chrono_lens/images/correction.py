@@ -8,8 +8,79 @@ This is in place of more sophisticated number plate recognition etc.
 """
 IMAGE_MAX_AXIS_THRESHOLD = 440
 
+# Start of frame markers, holding the image dimensions; 0xC4, 0xC8 and 0xCC are other markers in the same range
+_JPEG_START_OF_FRAME_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Markers without a length field
+_JPEG_STANDALONE_MARKERS = frozenset([0x01] + list(range(0xD0, 0xD9)))
+_JPEG_START_OF_SCAN_MARKER = 0xDA
+
+# Largest first; libjpeg scales these down as it decodes, much faster than a full size decode
+_REDUCED_COLOUR_DECODING_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2)
+]
+
+
+def jpeg_image_dimensions(jpeg_raw_data):
+    """
+    Reads the dimensions of a JPEG image from its start of frame header, without decoding the image.
+
+    :param jpeg_raw_data: bytes of the JPEG image
+    :return: (height, width) of the image as stored (i.e. ignoring any EXIF orientation), or None if the data is not
+        a JPEG image or has no start of frame header
+    """
+    jpeg_bytes = bytes(jpeg_raw_data)
+    if jpeg_bytes[:2] != b'\xff\xd8':
+        return None
+
+    offset = 2
+    while offset + 1 < len(jpeg_bytes):
+        if jpeg_bytes[offset] != 0xFF:
+            return None
+
+        marker = jpeg_bytes[offset + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            offset += 1
+            continue
+
+        if marker in _JPEG_STANDALONE_MARKERS:
+            offset += 2
+            continue
+
+        if marker == _JPEG_START_OF_SCAN_MARKER:
+            return None
+
+        if marker in _JPEG_START_OF_FRAME_MARKERS:
+            # Length (2 bytes), sample precision (1 byte), height (2 bytes), width (2 bytes)
+            if offset + 9 > len(jpeg_bytes):
+                return None
+            height = int.from_bytes(jpeg_bytes[offset + 5:offset + 7], 'big')
+            width = int.from_bytes(jpeg_bytes[offset + 7:offset + 9], 'big')
+            if height == 0 or width == 0:
+                return None
+            return height, width
+
+        segment_length = int.from_bytes(jpeg_bytes[offset + 2:offset + 4], 'big')
+        offset += 2 + segment_length
+
+    return None
+
 
 def resize_jpeg_image(jpeg_raw_data, image_max_axis_threshold):
+    """
+    Downsizes the image so neither axis is larger than `image_max_axis_threshold`, preserving its aspect ratio.
+
+    JPEG images have their dimensions read from their header, so images already small enough are returned without
+    being decoded (hence unchecked beyond their header); larger images are decoded at the largest of 1/2, 1/4 or 1/8
+    scale still at least the final size, then resized to the final size with `cv2.INTER_AREA`.
+
+    :param jpeg_raw_data: bytes of the (JPEG) image, or None
+    :param image_max_axis_threshold: maximum size of either axis of the returned image
+    :return: bytes of `jpeg_raw_data` if small enough, else of the downsized image encoded as JPEG; None if the
+        image is empty or cannot be decoded
+    """
     if jpeg_raw_data is None:
         return None
 
@@ -17,22 +88,37 @@ def resize_jpeg_image(jpeg_raw_data, image_max_axis_threshold):
     if jpeg_image_bytes.size == 0:
         return None
 
-    jpeg_image = cv2.imdecode(jpeg_image_bytes, cv2.IMREAD_COLOR)
+    image_dimensions = jpeg_image_dimensions(jpeg_image_bytes)
 
-    if jpeg_image is None:
-        return None
+    if image_dimensions is None:
+        jpeg_image = cv2.imdecode(jpeg_image_bytes, cv2.IMREAD_COLOR)
+
+        if jpeg_image is None:
+            return None
+
+        image_dimensions = jpeg_image.shape[:2]
+
+    else:
+        jpeg_image = None
 
-    major_axis = max(jpeg_image.shape)
+    major_axis = max(image_dimensions)
 
     # If image's largest axis is smaller than threshold, no work required; just
     # return the encoded JPEG data (don't re-encode it)
     if major_axis <= image_max_axis_threshold:
         return jpeg_raw_data
 
+    if jpeg_image is None:
+        jpeg_image, image_dimensions = _decode_reduced_by_at_most(jpeg_image_bytes, image_dimensions,
+                                                                  major_axis / image_max_axis_threshold)
+
+        if jpeg_image is None:
+            return None
+
     new_scale_factor = image_max_axis_threshold / major_axis
 
-    new_image_width = int(jpeg_image.shape[1] * new_scale_factor)
-    new_image_height = int(jpeg_image.shape[0] * new_scale_factor)
+    new_image_width = int(image_dimensions[1] * new_scale_factor)
+    new_image_height = int(image_dimensions[0] * new_scale_factor)
 
     resized_image = cv2.resize(jpeg_image, (new_image_width, new_image_height),
                                interpolation=cv2.INTER_AREA)
@@ -43,3 +129,36 @@ def resize_jpeg_image(jpeg_raw_data, image_max_axis_threshold):
     resized_encoded_bytes = resized_encoded_array.tobytes()
 
     return resized_encoded_bytes
+
+
+def _decode_reduced_by_at_most(jpeg_image_bytes, image_dimensions, maximum_reduction):
+    """
+    Decodes the JPEG image reduced by the largest factor not exceeding `maximum_reduction`.
+
+    :param image_dimensions: (height, width) of the image as read from its header
+    :return: tuple of decoded image (None if it cannot be decoded) and (height, width) of the full size image as
+        decoded, which differs from `image_dimensions` if rotated by its EXIF orientation
+    """
+    height, width = image_dimensions
+    for reduction, decoding_flag in _REDUCED_COLOUR_DECODING_FLAGS:
+        if reduction > maximum_reduction:
+            continue
+
+        jpeg_image = cv2.imdecode(jpeg_image_bytes, decoding_flag)
+        if jpeg_image is None:
+            return None, image_dimensions
+
+        # libjpeg rounds reduced sizes up
+        reduced_dimensions = (-(-height // reduction), -(-width // reduction))
+        if jpeg_image.shape[:2] == reduced_dimensions:
+            return jpeg_image, (height, width)
+        if jpeg_image.shape[:2] == reduced_dimensions[::-1]:
+            return jpeg_image, (width, height)
+
+        # Not the size expected from the header; fall back to a full size decode
+        break
+
+    jpeg_image = cv2.imdecode(jpeg_image_bytes, cv2.IMREAD_COLOR)
+    if jpeg_image is None:
+        return None, image_dimensions
+    return jpeg_image, jpeg_image.shape[:2]
@@ -0,0 +1,56 @@
+from collections import OrderedDict
+
+"""
+Each object detector holds its own TensorFlow session (and graph in memory), so only a few are retained; when
+requests alternate between models (such as backfill and scheduled processing using different models), each model's
+detector is reused rather than rebuilt on every change of model.
+
+Cache keys are expected to be model stage names, such as "NewcastleV0".
+"""
+DEFAULT_MAXIMUM_CACHED_DETECTORS = 2
+
+
+class DetectorCache:
+    """
+    Least recently used cache of object detectors; evicted detectors are closed.
+    """
+
+    def __init__(self, maximum_detectors=DEFAULT_MAXIMUM_CACHED_DETECTORS):
+        if maximum_detectors < 1:
+            raise ValueError(f'maximum_detectors must be at least 1, not {maximum_detectors}')
+
+        self.maximum_detectors = maximum_detectors
+        self._detectors = OrderedDict()
+
+    def __len__(self):
+        return len(self._detectors)
+
+    def __contains__(self, model_stage_name):
+        return model_stage_name in self._detectors
+
+    def get_or_create(self, model_stage_name, create_detector):
+        """
+        Returns the detector for `model_stage_name`, calling `create_detector()` to build it if not already cached.
+
+        :param model_stage_name: name of the object detection model stage, e.g. "NewcastleV0"
+        :param create_detector: function with no arguments returning a new detector
+        :return: detector for the model stage
+        """
+        detector = self._detectors.get(model_stage_name)
+        if detector is not None:
+            self._detectors.move_to_end(model_stage_name)
+            return detector
+
+        detector = create_detector()
+        self._detectors[model_stage_name] = detector
+
+        while len(self._detectors) > self.maximum_detectors:
+            _, evicted_detector = self._detectors.popitem(last=False)
+            evicted_detector.close()
+
+        return detector
+
+    def clear(self):
+        for detector in self._detectors.values():
+            detector.close()
+        self._detectors.clear()
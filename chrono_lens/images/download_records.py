@@ -0,0 +1,132 @@
+import datetime
+import hashlib
+import json
+
+"""
+Many cameras serve an unchanged image for long stretches, which FaultyImageDetector would flag as faulty once
+downloaded, stored and decoded (`FaultyImageDetector.are_images_identical`). Instead, a download record is kept of
+each URL's latest download: its HTTP validators (ETag and Last-Modified), a hash of its content and the time slot
+holding the image. The next slot's download then sends a conditional request; if the server replies 304 (not
+modified), or the content hash is unchanged, an "identical image" marker is stored in place of the image, naming
+the slot that holds the image.
+
+Records only apply to the slot immediately after theirs; if a download is missed, the next one is unconditional,
+so a marker is only ever stored where the image would have been identical to the previous slot's.
+
+Markers are stored alongside images, named as the image with `IDENTICAL_IMAGE_MARKER_EXTENSION` in place of its
+extension (see `identical_image_marker_name`). Records are dictionaries of strings, so they can be stored as JSON or
+as Google Cloud Storage blob metadata.
+"""
+IDENTICAL_IMAGE_MARKER_EXTENSION = '.identical.json'
+
+DOWNLOAD_RECORD_DATE_TIME_FORMAT = '%Y%m%d %H%M'
+
+SLOT_DURATION = datetime.timedelta(minutes=10)
+
+
+def content_hash_of(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def identical_image_marker_name(image_name):
+    """
+    :param image_name: file or blob name of the image, e.g. "source/20200501/0040/camera.jpg"
+    :return: file or blob name of the marker stored in place of the image, e.g.
+        "source/20200501/0040/camera.identical.json"
+    """
+    extension_start = image_name.rfind('.')
+    if extension_start <= max(image_name.rfind('/'), image_name.rfind('\\')):
+        extension_start = len(image_name)
+    return image_name[:extension_start] + IDENTICAL_IMAGE_MARKER_EXTENSION
+
+
+def previous_download_record_if_adjacent(download_record, date_time):
+    """
+    :param download_record: latest download record of a URL, or None
+    :param date_time: time slot about to be downloaded
+    :return: `download_record` if it is of the slot immediately before `date_time`, otherwise None
+    """
+    if download_record is None:
+        return None
+
+    if download_record.get('date_time') != f'{date_time - SLOT_DURATION:{DOWNLOAD_RECORD_DATE_TIME_FORMAT}}':
+        return None
+
+    return download_record
+
+
+def conditional_request_headers(previous_download_record):
+    """
+    :param previous_download_record: download record of the previous slot, or None
+    :return: dictionary of HTTP headers requesting the image only if modified since `previous_download_record`
+    """
+    request_headers = {}
+    if previous_download_record is None:
+        return request_headers
+
+    if previous_download_record.get('etag'):
+        request_headers['If-None-Match'] = previous_download_record['etag']
+    if previous_download_record.get('last_modified'):
+        request_headers['If-Modified-Since'] = previous_download_record['last_modified']
+    return request_headers
+
+
+def is_identical_to_previous(status_code, content, previous_download_record):
+    """
+    :param status_code: HTTP status code of the download
+    :param content: downloaded content; ignored unless `status_code` is 200
+    :param previous_download_record: download record of the previous slot, or None
+    :return: True if the download is known to be identical to the previous slot's image
+    """
+    if previous_download_record is None:
+        return False
+
+    if status_code == 304:
+        return True
+
+    return status_code == 200 and content_hash_of(content) == previous_download_record.get('content_hash')
+
+
+def create_download_record(date_time, response_headers, content=None, previous_download_record=None):
+    """
+    :param date_time: time slot downloaded
+    :param response_headers: HTTP headers of the response, as a case insensitive mapping
+    :param content: downloaded content, or None if identical to the previous slot's image
+    :param previous_download_record: download record of the previous slot, required if `content` is None
+    :return: download record of this slot
+    """
+    if content is None:
+        download_record = {'content_hash': previous_download_record['content_hash'],
+                           'image_date_time': previous_download_record['image_date_time']}
+        # 304 responses need not repeat the validators
+        for field_name in ('etag', 'last_modified'):
+            if field_name in previous_download_record:
+                download_record[field_name] = previous_download_record[field_name]
+    else:
+        download_record = {'content_hash': content_hash_of(content),
+                           'image_date_time': f'{date_time:{DOWNLOAD_RECORD_DATE_TIME_FORMAT}}'}
+
+    download_record['date_time'] = f'{date_time:{DOWNLOAD_RECORD_DATE_TIME_FORMAT}}'
+
+    if response_headers.get('ETag'):
+        download_record['etag'] = response_headers['ETag']
+    if response_headers.get('Last-Modified'):
+        download_record['last_modified'] = response_headers['Last-Modified']
+
+    return download_record
+
+
+def create_identical_image_marker(download_record):
+    """
+    :param download_record: download record of a slot identical to the previous slot
+    :return: JSON content of the marker stored in place of the slot's image
+    """
+    return json.dumps({'identical_to': download_record['image_date_time']})
+
+
+def identical_image_date_time_of(marker):
+    """
+    :param marker: JSON content of an identical image marker
+    :return: datetime of the slot holding the image
+    """
+    return datetime.datetime.strptime(json.loads(marker)['identical_to'], DOWNLOAD_RECORD_DATE_TIME_FORMAT)
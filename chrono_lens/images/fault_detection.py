@@ -1,5 +1,7 @@
 import numpy as np
 
+from chrono_lens.images.image_frame import image_frame_of, IMAGE_REDUCTIONS
+
 
 class FaultyImageDetector:
     @classmethod
@@ -7,11 +9,16 @@ class FaultyImageDetector:
         return cls(
             identical_area_proportion_threshold=configuration['identical_area_proportion_threshold'],
             row_similarity_threshold=configuration['row_similarity_threshold'],
-            consecutive_matching_rows_threshold=configuration['consecutive_matching_rows_threshold']
+            consecutive_matching_rows_threshold=configuration['consecutive_matching_rows_threshold'],
+            colour_sampling_stride=configuration.get('colour_sampling_stride', 4),
+            colour_quantisation_levels=configuration.get('colour_quantisation_levels', 32),
+            quantise_all_colour_channels=configuration.get('quantise_all_colour_channels', False),
+            comparison_image_reduction=configuration.get('comparison_image_reduction', 1)
         )
 
     def __init__(self, identical_area_proportion_threshold=0.33, row_similarity_threshold=0.8,
-                 consecutive_matching_rows_threshold=0.2):
+                 consecutive_matching_rows_threshold=0.2, colour_sampling_stride=4, colour_quantisation_levels=32,
+                 quantise_all_colour_channels=False, comparison_image_reduction=1):
         """
         :param identical_area_proportion_threshold: percentage of image detected as a pure grey (R=G=B), for an image
         to be considered faulty
@@ -21,108 +28,184 @@ class FaultyImageDetector:
 
         :param consecutive_matching_rows_threshold: percentage of height that must have consecutive matching rows
         (taking into account #row_similarity_threshold) for an image to be considered as faulty
+
+        :param colour_sampling_stride: only every n-th pixel in X & Y is sampled when finding the largest proportion of
+        a single colour
+
+        :param colour_quantisation_levels: number of levels each colour component is quantised to; must be a power of
+        two no greater than 256
+
+        :param quantise_all_colour_channels: if False, reproduces historical behaviour where only the first colour
+        component is quantised (and used in place of the other two components); if True, all three components are
+        quantised independently
+
+        :param comparison_image_reduction: previous and next images are examined (and compared with the current
+        image) with their height and width reduced by this factor, one of 1, 2 or 4; the current image's own checks
+        are always made at full size. If greater than 1, results may differ from those at full size
         """
+        if colour_sampling_stride < 1:
+            raise ValueError(f'colour_sampling_stride must be at least 1, not {colour_sampling_stride}')
+
+        if colour_quantisation_levels < 1 or colour_quantisation_levels > 256 or \
+                colour_quantisation_levels & (colour_quantisation_levels - 1) != 0:
+            raise ValueError('colour_quantisation_levels must be a power of two between 1 and 256,'
+                             f' not {colour_quantisation_levels}')
+
+        if comparison_image_reduction not in IMAGE_REDUCTIONS:
+            raise ValueError(f'comparison_image_reduction must be one of {IMAGE_REDUCTIONS},'
+                             f' not {comparison_image_reduction}')
+
         self.identical_area_proportion_threshold = identical_area_proportion_threshold
         self.row_similarity_threshold = row_similarity_threshold
         self.consecutive_matching_rows_threshold = consecutive_matching_rows_threshold
+        self.colour_sampling_stride = colour_sampling_stride
+        self.colour_quantisation_levels = colour_quantisation_levels
+        self.quantise_all_colour_channels = quantise_all_colour_channels
+        self.comparison_image_reduction = comparison_image_reduction
 
-    def check_current_faulty_and_next_previous_comparable(self, previous_rgb_image, current_rgb_image, next_rgb_image):
+    def check_current_faulty_and_next_previous_comparable(self, previous_image, current_image, next_image):
         """
         Examines supplied images and determines if they can be used for further processing.
 
-        :param previous_rgb_image: previous image as RGB numpy array or None
-        :param current_rgb_image: current image as RGB numpy array; assumed not None
-        :param next_rgb_image: next image as RGB numpy array or None
+        Images may be supplied as `ImageFrame`, in which case features derived from them are reused when the same
+        frame is examined again (e.g. as current image, then as previous image), and previous and next images are
+        only decoded at the size they are examined at (see `comparison_image_reduction`).
+
+        :param previous_image: previous image as RGB numpy array or `ImageFrame`, or None
+        :param current_image: current image as RGB numpy array or `ImageFrame`; assumed not None
+        :param next_image: next image as RGB numpy array or `ImageFrame`, or None
         :return: tuple of 3 booleans:
             if previous image is valid and could be used for comparison,
             if current image is valid and can be used for object detection,
             if next image is valid and could be used for comparison
         """
-        previous_comparable = previous_rgb_image is not None
+        previous_image = image_frame_of(previous_image, self.comparison_image_reduction)
+        current_image = image_frame_of(current_image)
+        next_image = image_frame_of(next_image, self.comparison_image_reduction)
+
+        current_rgb_image = current_image.image_rgb
+        # The current image as compared with the previous and next images
+        current_comparison_rgb_image = current_image.reduced(self.comparison_image_reduction).image_rgb
+
+        previous_comparable = previous_image is not None
         current_faulty = False
-        next_comparable = next_rgb_image is not None
+        next_comparable = next_image is not None
 
         if previous_comparable:
-            if previous_rgb_image.shape != current_rgb_image.shape:
+            previous_rgb_image = previous_image.image_rgb
+            if previous_rgb_image.shape != current_comparison_rgb_image.shape:
                 previous_comparable = False
 
-            elif self.are_images_identical(previous_rgb_image, current_rgb_image):
+            elif self.are_images_identical(previous_rgb_image, current_comparison_rgb_image):
                 previous_comparable = False
                 current_faulty = True
 
         if next_comparable:
-            if current_rgb_image.shape != next_rgb_image.shape:
+            next_rgb_image = next_image.image_rgb
+            if current_comparison_rgb_image.shape != next_rgb_image.shape:
                 next_comparable = False
 
-            elif self.are_images_identical(current_rgb_image, next_rgb_image):
+            elif self.are_images_identical(current_comparison_rgb_image, next_rgb_image):
                 next_comparable = False
 
-        if self.largest_proportion_of_a_single_colour(current_rgb_image) > self.identical_area_proportion_threshold:
+        if self._cached_largest_proportion_of_a_single_colour(current_image) > \
+                self.identical_area_proportion_threshold:
             current_faulty = True
 
         if previous_comparable:
-            if self.largest_proportion_of_a_single_colour(
-                    previous_rgb_image) > self.identical_area_proportion_threshold:
+            if self._cached_largest_proportion_of_a_single_colour(previous_image) > \
+                    self.identical_area_proportion_threshold:
                 previous_comparable = False
 
         if next_comparable:
-            if self.largest_proportion_of_a_single_colour(next_rgb_image) > self.identical_area_proportion_threshold:
+            if self._cached_largest_proportion_of_a_single_colour(next_image) > \
+                    self.identical_area_proportion_threshold:
                 next_comparable = False
 
-        if self.maximum_number_of_consecutive_matching_rows(
-                current_rgb_image) > current_rgb_image.shape[0] * self.consecutive_matching_rows_threshold:
+        if self._cached_maximum_number_of_consecutive_matching_rows(current_image) > \
+                current_rgb_image.shape[0] * self.consecutive_matching_rows_threshold:
             current_faulty = True
 
         if previous_comparable:
-            if self.maximum_number_of_consecutive_matching_rows(
-                    previous_rgb_image) > previous_rgb_image.shape[0] * self.consecutive_matching_rows_threshold:
+            if self._cached_maximum_number_of_consecutive_matching_rows(previous_image) > \
+                    previous_image.shape[0] * self.consecutive_matching_rows_threshold:
                 previous_comparable = False
 
         if next_comparable:
-            if self.maximum_number_of_consecutive_matching_rows(
-                    next_rgb_image) > next_rgb_image.shape[0] * self.consecutive_matching_rows_threshold:
+            if self._cached_maximum_number_of_consecutive_matching_rows(next_image) > \
+                    next_image.shape[0] * self.consecutive_matching_rows_threshold:
                 next_comparable = False
 
         return previous_comparable, current_faulty, next_comparable
 
+    def _cached_largest_proportion_of_a_single_colour(self, image):
+        feature_key = ('largest_proportion_of_a_single_colour', self.colour_sampling_stride,
+                       self.colour_quantisation_levels, self.quantise_all_colour_channels)
+        return image.feature(feature_key, self.largest_proportion_of_a_single_colour)
+
+    def _cached_maximum_number_of_consecutive_matching_rows(self, image):
+        feature_key = ('maximum_number_of_consecutive_matching_rows', self.row_similarity_threshold)
+        return image.feature(feature_key, self.maximum_number_of_consecutive_matching_rows)
+
     def maximum_number_of_consecutive_matching_rows(self, current_rgb_image):
+        """
+        Longest run of consecutive row pairs where more than `row_similarity_threshold` of the components match.
 
-        def rows_match(row1, row2):
-            row_diff = row1 - row2
-            number_of_same_component = np.sum(row_diff == 0)
-            return number_of_same_component > row1.shape[0] * 3 * self.row_similarity_threshold
-
-        max_consecutive_row_match_count = 0
-        current_row_match_count = 0
-        for y in range(current_rgb_image.shape[0] - 1):
-            if rows_match(current_rgb_image[y], current_rgb_image[y + 1]):
-                current_row_match_count += 1
-            else:
-                if current_row_match_count > max_consecutive_row_match_count:
-                    max_consecutive_row_match_count = current_row_match_count
-                current_row_match_count = 0
-        if current_row_match_count > max_consecutive_row_match_count:
-            max_consecutive_row_match_count = current_row_match_count
-
-        return max_consecutive_row_match_count
+        All row-to-row comparisons are made in a single (H-1, W*3) array operation, then the longest run of matching
+        rows is found from the boundaries of the runs (rather than walking the rows one at a time).
+
+        :param current_rgb_image: RGB image as numpy array
+        :return: maximum number of consecutive matching row pairs
+        """
+        image_height = current_rgb_image.shape[0]
+        if image_height < 2:
+            return 0
+
+        image_rows = current_rgb_image.reshape(image_height, -1)
+        number_of_same_components = np.count_nonzero(image_rows[1:] == image_rows[:-1], axis=1)
+        rows_match = number_of_same_components > current_rgb_image.shape[1] * 3 * self.row_similarity_threshold
+
+        return self._longest_run_of_true(rows_match)
 
     @staticmethod
-    def largest_proportion_of_a_single_colour(img):
-        quantised_range = 32
-        quantised_fraction = 256 / quantised_range
-
-        quantised_colours = np.zeros((quantised_range, quantised_range, quantised_range))
-        # Sparse sampling will be sufficient - we're sampling every 4th pixel in X & Y,
-        # so 1/16 sampled - to balance this, each count is +16 rather than +1
-        for y in range(0, img.shape[0], 4):
-            for x in range(0, img.shape[1], 4):
-                r, g, b = img[y, x, :]
-                quantised_r = int(r / quantised_fraction)
-                quantised_g = int(r / quantised_fraction)
-                quantised_b = int(r / quantised_fraction)
-                quantised_colours[quantised_r, quantised_g, quantised_b] += 16
-
-        highest_quantised_count = np.amax(quantised_colours)
+    def _longest_run_of_true(flags):
+        # Pad with False either side so every run has a rising and a falling edge; edges then alternate start, end
+        padded_flags = np.concatenate(([0], flags.astype(np.int8), [0]))
+        run_edges = np.flatnonzero(np.diff(padded_flags))
+        if run_edges.size == 0:
+            return 0
+
+        return int(np.max(run_edges[1::2] - run_edges[0::2]))
+
+    def largest_proportion_of_a_single_colour(self, img):
+        """
+        Proportion of the image covered by its most common colour, after colours are quantised.
+
+        Sparse sampling is sufficient - we sample every `colour_sampling_stride` pixel in X & Y, so each sample
+        represents `colour_sampling_stride` squared pixels. The histogram of quantised colours is built in a single
+        `np.bincount` call.
+
+        :param img: RGB image as numpy array
+        :return: largest proportion of the image occupied by a single quantised colour
+        """
+        quantisation_bits = self.colour_quantisation_levels.bit_length() - 1
+        quantisation_shift = 8 - quantisation_bits
+
+        sampled_pixels = img[::self.colour_sampling_stride, ::self.colour_sampling_stride].reshape(-1, img.shape[2])
+        quantised_r = sampled_pixels[:, 0] >> quantisation_shift
+
+        if self.quantise_all_colour_channels:
+            quantised_g = sampled_pixels[:, 1] >> quantisation_shift
+            quantised_b = sampled_pixels[:, 2] >> quantisation_shift
+            quantised_colours = (quantised_r.astype(np.intp) << (2 * quantisation_bits)) \
+                | (quantised_g.astype(np.intp) << quantisation_bits) | quantised_b
+        else:
+            # Historical behaviour: G and B were quantised from R, so only R contributes to the colour
+            quantised_colours = quantised_r
+
+        quantised_colour_counts = np.bincount(quantised_colours, minlength=1)
+
+        highest_quantised_count = quantised_colour_counts.max() * self.colour_sampling_stride ** 2
         largest_proportion = highest_quantised_count / (img.shape[0] * img.shape[1])
 
         return largest_proportion
@@ -0,0 +1,79 @@
+from collections import OrderedDict
+
+"""
+Each camera slot is processed as a previous/current/next triple, so every image is used three times across a day:
+once as "next", once as "current" and once as "previous". The cache below retains decoded images (as `ImageFrame`,
+with their views and derived features) so they are decoded and analysed once, rather than three times.
+
+Cache keys are expected to be (source, camera, timestamp) tuples.
+"""
+DEFAULT_IMAGE_CACHE_MAXIMUM_BYTES = 512 * 1024 * 1024
+
+
+class ImageCache:
+    """
+    Least recently used cache of `ImageFrame`, evicting entries once the total size of cached frames exceeds
+    `maximum_bytes`.
+    """
+
+    def __init__(self, maximum_bytes=DEFAULT_IMAGE_CACHE_MAXIMUM_BYTES, greyscale_decoding=False):
+        """
+        :param maximum_bytes: total size of frames retained
+        :param greyscale_decoding: how frames loaded into this cache are to be decoded (see `ImageFrame.decode`);
+            held by the cache so frames compared with each other are all decoded the same way
+        """
+        self.maximum_bytes = maximum_bytes
+        self.greyscale_decoding = greyscale_decoding
+        self.current_bytes = 0
+        self._cached_images = OrderedDict()
+
+    def __len__(self):
+        return len(self._cached_images)
+
+    def __contains__(self, image_key):
+        return image_key in self._cached_images
+
+    def get_or_load(self, image_key, load_image_frame):
+        """
+        Returns the cached frame for `image_key`, calling `load_image_frame()` to decode it if not already cached.
+
+        Images that fail to load (`load_image_frame` returns None) are not cached, as they may appear later.
+
+        :param image_key: (source, camera, timestamp) tuple identifying the image
+        :param load_image_frame: function with no arguments returning an `ImageFrame`, or None if the image is missing
+        :return: `ImageFrame`, or None if the image is missing
+        """
+        cached_image = self._cached_images.get(image_key)
+        if cached_image is not None:
+            self._cached_images.move_to_end(image_key)
+            return cached_image[0]
+
+        image_frame = load_image_frame()
+        if image_frame is None:
+            return None
+
+        self._add(image_key, image_frame)
+        return image_frame
+
+    def discard(self, image_key):
+        cached_image = self._cached_images.pop(image_key, None)
+        if cached_image is not None:
+            self.current_bytes -= cached_image[1]
+
+    def clear(self):
+        self._cached_images.clear()
+        self.current_bytes = 0
+
+    def _add(self, image_key, image_frame):
+        image_bytes = image_frame.nbytes
+        if image_bytes > self.maximum_bytes:
+            # Too large to ever be retained; still usable by the caller
+            return
+
+        # Size is recorded as added, as frames can grow once cached (e.g. as reduced frames are added)
+        self._cached_images[image_key] = (image_frame, image_bytes)
+        self.current_bytes += image_bytes
+
+        while self.current_bytes > self.maximum_bytes:
+            _, (_, evicted_image_bytes) = self._cached_images.popitem(last=False)
+            self.current_bytes -= evicted_image_bytes
@@ -0,0 +1,239 @@
+import cv2
+import numpy as np
+
+"""
+A camera image as passed between pipeline stages: FaultyImageDetector and the object detector use RGB,
+StaticObjectFilter uses greyscale, and OpenCV decodes to BGR. Each view is computed on demand and at most once, so
+an image is converted once however many stages (and previous/current/next roles) use it, and views no stage asks
+for are never computed.
+
+Greyscale derived from colour matches the conversion historically used by StaticObjectFilter (`cv2.COLOR_BGR2GRAY`
+applied to the RGB image). Frames can instead be decoded straight to greyscale (`cv2.IMREAD_GRAYSCALE`), skipping
+the colour decode for images only used for comparison; libjpeg's luminance differs from the historical conversion
+(by up to 31 levels on the test images), so frames compared with each other must all be decoded the same way.
+
+Frames can also be reduced (see `ImageFrame.reduced`), for comparisons that tolerate a lower resolution. Decoded
+frames are reduced by libjpeg as they are decoded (`cv2.IMREAD_REDUCED_*`), which is much faster than a full size
+decode; other frames are resized with `cv2.INTER_AREA`. As with greyscale decoding, the two differ slightly, so
+frames compared with each other should all be decoded.
+"""
+IMAGE_REDUCTIONS = [1, 2, 4]
+
+_COLOUR_DECODING_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4
+}
+
+_GREYSCALE_DECODING_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4
+}
+
+
+class ImageFrame:
+
+    @classmethod
+    def from_bgr(cls, image_bgr):
+        return cls(image_bgr=image_bgr)
+
+    @classmethod
+    def from_rgb(cls, image_rgb):
+        return cls(image_rgb=image_rgb)
+
+    @classmethod
+    def empty(cls):
+        """
+        Frame of an image that could not be decoded (zero height and width), as used to flag faulty images.
+        """
+        return cls(image_bgr=np.zeros((0, 0, 3), np.uint8), image_rgb=np.zeros((0, 0, 3), np.uint8),
+                   image_greyscale=np.zeros((0, 0), np.uint8))
+
+    @classmethod
+    def decode(cls, encoded_image, greyscale_decoding=False, initial_reduction=1):
+        """
+        :param encoded_image: bytes of an encoded (e.g. JPEG) image
+        :param greyscale_decoding: if True, the greyscale view is decoded directly and the colour views are only
+            decoded if asked for; if False, the image is decoded in colour and greyscale derived from it
+        :param initial_reduction: if greater than 1, only the frame reduced by this factor is decoded up-front (see
+            `reduced`), so images only used for comparison at that reduction are never decoded at full size; full
+            size views are decoded when first used
+        :return: `ImageFrame`, empty if `encoded_image` is empty or cannot be decoded
+        """
+        encoded_image_bytes = np.frombuffer(encoded_image, dtype=np.uint8)
+        if encoded_image_bytes.size == 0:
+            return cls.empty()
+
+        if initial_reduction > 1:
+            reduced_image_frame = cls._decode_reduced(encoded_image_bytes, greyscale_decoding, initial_reduction)
+            if reduced_image_frame.is_empty:
+                return cls.empty()
+
+            image_frame = cls(encoded_image_bytes=encoded_image_bytes, greyscale_decoding=greyscale_decoding)
+            image_frame._reduced_image_frames[initial_reduction] = reduced_image_frame
+            return image_frame
+
+        return cls._decode_reduced(encoded_image_bytes, greyscale_decoding, 1)
+
+    @classmethod
+    def _decode_reduced(cls, encoded_image_bytes, greyscale_decoding, reduction):
+        if greyscale_decoding:
+            image_greyscale = cv2.imdecode(encoded_image_bytes, _GREYSCALE_DECODING_FLAGS[reduction])
+            if image_greyscale is None:
+                return cls.empty()
+            return cls(image_greyscale=image_greyscale, encoded_image_bytes=encoded_image_bytes,
+                       greyscale_decoding=True, decoding_reduction=reduction)
+
+        # 8bpp images are expanded to 24bpp
+        image_bgr = cv2.imdecode(encoded_image_bytes, _COLOUR_DECODING_FLAGS[reduction])
+        if image_bgr is None:
+            return cls.empty()
+        return cls(image_bgr=image_bgr, encoded_image_bytes=encoded_image_bytes, decoding_reduction=reduction)
+
+    def __init__(self, image_bgr=None, image_rgb=None, image_greyscale=None, encoded_image_bytes=None,
+                 greyscale_decoding=False, decoding_reduction=1):
+        """
+        Use `from_bgr`, `from_rgb`, `empty` or `decode` rather than constructing directly.
+        """
+        self._image_bgr = image_bgr
+        self._image_rgb = image_rgb
+        self._image_greyscale = image_greyscale
+        self._encoded_image_bytes = encoded_image_bytes
+        self._greyscale_decoding = greyscale_decoding
+        self._decoding_reduction = decoding_reduction
+        self._reduced_image_frames = {}
+        self._features = {}
+
+    def _decoded_shape(self):
+        for image in (self._image_greyscale, self._image_bgr, self._image_rgb):
+            if image is not None:
+                return image.shape[:2]
+        return None
+
+    @property
+    def shape(self):
+        """
+        :return: (height, width) of the image
+        """
+        decoded_shape = self._decoded_shape()
+        if decoded_shape is not None:
+            return decoded_shape
+
+        # Only decoded at a reduced size so far
+        if self._greyscale_decoding:
+            return self.image_greyscale.shape[:2]
+        return self.image_bgr.shape[:2]
+
+    @property
+    def is_empty(self):
+        decoded_shape = self._decoded_shape()
+        if decoded_shape is None:
+            # Only decoded at a reduced size so far, which succeeded
+            return False
+        return decoded_shape[0] == 0
+
+    def _decode(self, decoding_flags):
+        image = cv2.imdecode(self._encoded_image_bytes, decoding_flags[self._decoding_reduction])
+        if image is None:
+            return np.zeros((0, 0, 3) if decoding_flags is _COLOUR_DECODING_FLAGS else (0, 0), np.uint8)
+        return image
+
+    @property
+    def image_bgr(self):
+        if self._image_bgr is None:
+            if self._image_rgb is not None:
+                self._image_bgr = cv2.cvtColor(self._image_rgb, cv2.COLOR_RGB2BGR)
+            else:
+                self._image_bgr = self._decode(_COLOUR_DECODING_FLAGS)
+        return self._image_bgr
+
+    @property
+    def image_rgb(self):
+        if self._image_rgb is None:
+            self._image_rgb = cv2.cvtColor(self.image_bgr, cv2.COLOR_BGR2RGB)
+        return self._image_rgb
+
+    @property
+    def image_greyscale(self):
+        if self._image_greyscale is None:
+            if self._greyscale_decoding:
+                self._image_greyscale = self._decode(_GREYSCALE_DECODING_FLAGS)
+            # Historical conversion; COLOR_RGB2GRAY applied to BGR is identical to COLOR_BGR2GRAY applied to RGB
+            elif self._image_rgb is not None:
+                self._image_greyscale = cv2.cvtColor(self._image_rgb, cv2.COLOR_BGR2GRAY)
+            else:
+                self._image_greyscale = cv2.cvtColor(self.image_bgr, cv2.COLOR_RGB2GRAY)
+        return self._image_greyscale
+
+    def reduced(self, reduction):
+        """
+        :param reduction: factor to reduce the height and width by, one of `IMAGE_REDUCTIONS`
+        :return: `ImageFrame` of this image with height and width divided by `reduction` (rounded up); this frame
+            if `reduction` is 1 or the frame is empty
+        """
+        if reduction == 1 or self.is_empty:
+            return self
+
+        reduced_image_frame = self._reduced_image_frames.get(reduction)
+        if reduced_image_frame is None:
+            if self._encoded_image_bytes is not None and self._decoding_reduction == 1:
+                reduced_image_frame = self._decode_reduced(self._encoded_image_bytes, self._greyscale_decoding,
+                                                           reduction)
+            else:
+                reduced_image_frame = self._resized(reduction)
+            self._reduced_image_frames[reduction] = reduced_image_frame
+
+        return reduced_image_frame
+
+    def _resized(self, reduction):
+        height, width = self.shape
+        reduced_size = (-(-width // reduction), -(-height // reduction))
+
+        if self._image_rgb is not None:
+            return ImageFrame.from_rgb(cv2.resize(self._image_rgb, reduced_size, interpolation=cv2.INTER_AREA))
+        return ImageFrame.from_bgr(cv2.resize(self.image_bgr, reduced_size, interpolation=cv2.INTER_AREA))
+
+    @property
+    def nbytes(self):
+        encoded_image_size = 0 if self._encoded_image_bytes is None else self._encoded_image_bytes.nbytes
+        return self._views_nbytes() + encoded_image_size + sum(
+            reduced_image_frame._views_nbytes() for reduced_image_frame in self._reduced_image_frames.values())
+
+    def _views_nbytes(self):
+        # All views are accounted for up-front, as they may be generated after the frame has been cached
+        decoded_shape = self._decoded_shape()
+        if decoded_shape is None:
+            # Estimated from a reduced frame, to avoid decoding at full size
+            reduction, reduced_image_frame = next(iter(self._reduced_image_frames.items()))
+            reduced_height, reduced_width = reduced_image_frame.shape
+            height, width = reduced_height * reduction, reduced_width * reduction
+        else:
+            height, width = decoded_shape
+
+        return height * width * (3 + 3 + 1)
+
+    def feature(self, feature_key, compute_feature):
+        """
+        Returns the feature with the given key, calling `compute_feature(image_rgb)` only if not already known.
+
+        :param feature_key: hashable key identifying the feature, including any parameters it depends on
+        :param compute_feature: function taking the RGB image and returning the feature
+        :return: value of the feature
+        """
+        if feature_key not in self._features:
+            self._features[feature_key] = compute_feature(self.image_rgb)
+        return self._features[feature_key]
+
+
+def image_frame_of(image, reduction=1):
+    """
+    :param image: `ImageFrame` or RGB numpy array, possibly None
+    :param reduction: factor to reduce the height and width by, one of `IMAGE_REDUCTIONS`
+    :return: `ImageFrame` of the image reduced by `reduction` (see `ImageFrame.reduced`), or None
+    """
+    if image is None:
+        return None
+    if not isinstance(image, ImageFrame):
+        image = ImageFrame.from_rgb(image)
+    return image.reduced(reduction)
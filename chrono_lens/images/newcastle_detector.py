@@ -1,6 +1,52 @@
 import numpy as np
 import tensorflow as tf
 
+"""
+Detections as a numpy structured array, one element per detected object; equivalent to the
+`[label, [y0, x0, y1, x1, score]]` lists returned by default.
+"""
+DETECTION_DTYPE = np.dtype([('label', 'U16'), ('y0', np.int32), ('x0', np.int32), ('y1', np.int32),
+                            ('x1', np.int32), ('score', np.float64)])
+
+_OUTPUT_NODE_NAMES = ['detection_boxes', 'detection_scores', 'detection_classes', 'num_detections']
+
+_OPTIMISER_LEVELS = {
+    'L0': tf.compat.v1.OptimizerOptions.L0,
+    'L1': tf.compat.v1.OptimizerOptions.L1
+}
+
+
+def create_session_config(session_configuration):
+    """
+    Creates a TensorFlow session configuration from the optional "session_configuration" section of a model's
+    configuration; any setting not present uses the TensorFlow default.
+
+    :param session_configuration: dictionary with optional keys:
+        "intra_op_parallelism_threads": threads used within an individual operation (0 lets TensorFlow decide),
+        "inter_op_parallelism_threads": threads used to run independent operations (0 lets TensorFlow decide),
+        "optimiser_level": "L1" (default; common subexpression elimination and constant folding) or "L0" (none),
+        "grappler_optimisation": False disables TensorFlow's graph rewriting (grappler) meta-optimiser
+    :return: `tf.compat.v1.ConfigProto`
+    """
+    session_config = tf.compat.v1.ConfigProto()
+
+    if 'intra_op_parallelism_threads' in session_configuration:
+        session_config.intra_op_parallelism_threads = session_configuration['intra_op_parallelism_threads']
+
+    if 'inter_op_parallelism_threads' in session_configuration:
+        session_config.inter_op_parallelism_threads = session_configuration['inter_op_parallelism_threads']
+
+    if 'optimiser_level' in session_configuration:
+        optimiser_level = session_configuration['optimiser_level']
+        if optimiser_level not in _OPTIMISER_LEVELS:
+            raise ValueError(f'optimiser_level must be one of {list(_OPTIMISER_LEVELS)}, not "{optimiser_level}"')
+        session_config.graph_options.optimizer_options.opt_level = _OPTIMISER_LEVELS[optimiser_level]
+
+    if not session_configuration.get('grappler_optimisation', True):
+        session_config.graph_options.rewrite_options.disable_meta_optimizer = True
+
+    return session_config
+
 
 class NewcastleDetector:
     """
@@ -8,9 +54,27 @@ class NewcastleDetector:
     https://github.com/TomKomar/uo-object_counting
     """
 
-    def __init__(self, serialized_graph, minimum_confidence=0.33):
+    @classmethod
+    def from_configuration(cls, configuration, serialized_graph):
+        return cls(
+            serialized_graph=serialized_graph,
+            minimum_confidence=configuration['minimum_confidence'],
+            session_configuration=configuration.get('session_configuration')
+        )
+
+    def __init__(self, serialized_graph, minimum_confidence=0.33, session_configuration=None):
+        """
+        :param serialized_graph: frozen TensorFlow graph, as serialized bytes
+        :param minimum_confidence: detections scoring this or lower are discarded
+        :param session_configuration: optional dictionary of TensorFlow session settings, as described by
+            `create_session_config`, plus "strip_unused_nodes": if True, nodes not required to compute the detections
+            are removed from the graph when it is loaded
+        """
         self.minimum_confidence = minimum_confidence
 
+        if session_configuration is None:
+            session_configuration = {}
+
         # temporally hard-coded
         self.categoryIdx = {1: {'name': 'bus'}, 2: {'name': 'car'}, 3: {'name': 'cyclist'}, 4: {'name': 'motorcyclist'},
                             5: {'name': 'person'}, 6: {'name': 'truck'}, 7: {'name': 'van'}}
@@ -20,9 +84,11 @@ class NewcastleDetector:
             graph_def = tf.compat.v1.GraphDef()
 
             graph_def.ParseFromString(serialized_graph)
+            if session_configuration.get('strip_unused_nodes', False):
+                graph_def = tf.compat.v1.graph_util.extract_sub_graph(graph_def, _OUTPUT_NODE_NAMES)
             tf.import_graph_def(graph_def, name="")
 
-            self.sess = tf.compat.v1.Session(graph=model)
+            self.sess = tf.compat.v1.Session(graph=model, config=create_session_config(session_configuration))
 
             self.imageTensor = model.get_tensor_by_name("image_tensor:0")
             self.boxesTensor = model.get_tensor_by_name("detection_boxes:0")
@@ -31,7 +97,15 @@ class NewcastleDetector:
             self.classesTensor = model.get_tensor_by_name("detection_classes:0")
             self.numDetections = model.get_tensor_by_name("num_detections:0")
 
-    def detect(self, img_color_rgb):
+    def detect(self, img_color_rgb, as_structured_array=False):
+        """
+        Detects objects in an image.
+
+        :param img_color_rgb: RGB image as numpy array
+        :param as_structured_array: if True, detections are returned as a numpy structured array of `DETECTION_DTYPE`
+        :return: list of `[label, [y0, x0, y1, x1, score]]` per detected object with a score above
+            `minimum_confidence`, or equivalent structured array
+        """
         img_tensor = np.expand_dims(img_color_rgb, axis=0)
 
         (boxes_ndims, scores_ndims, labels_ndims, _N) = self.sess.run(
@@ -42,22 +116,89 @@ class NewcastleDetector:
         scores = np.squeeze(scores_ndims)
         label_ids = np.squeeze(labels_ndims)
 
-        image_height = img_color_rgb.shape[0]
-        image_width = img_color_rgb.shape[1]
-
-        scaled_boxes = []
-        for box in boxes:
-            scaled_boxes.append([
-                int(box[0] * image_height), int(box[1] * image_width),
-                int(box[2] * image_height), int(box[3] * image_width)
-            ])
-
-        labels = [str(self.categoryIdx[label]["name"]) for label in label_ids]
-        labelled_scored_boxes_above_threshold = [[label, [box[0], box[1], box[2], box[3], round(float(score), 4)]]
-                                                 for box, score, label in zip(scaled_boxes, scores, labels)
-                                                 if score > self.minimum_confidence]
-
-        return labelled_scored_boxes_above_threshold
+        return self._labelled_scored_boxes_above_threshold(boxes, scores, label_ids, img_color_rgb.shape,
+                                                           as_structured_array=as_structured_array)
+
+    def detect_batch(self, images_rgb, maximum_batch_size=8, as_structured_array=False):
+        """
+        Detects objects in a list of images, running images with the same shape through the model together.
+
+        Images are grouped by shape (cameras from the same supplier commonly share a resolution) and each group is
+        stacked into a single tensor, so the graph is invoked once per group rather than once per image. Images with a
+        shape shared with no other image are passed to `detect` individually.
+
+        :param images_rgb: list of RGB images as numpy arrays
+        :param maximum_batch_size: largest number of images stacked into a single tensor, to bound memory usage
+        :param as_structured_array: if True, detections per image are returned as structured arrays, as with `detect`
+        :return: list of detections per image, in the same order as `images_rgb`; each is in the same format as
+            returned by `detect`
+        """
+        image_indices_per_shape = {}
+        for image_index, image_rgb in enumerate(images_rgb):
+            image_indices_per_shape.setdefault(image_rgb.shape, []).append(image_index)
+
+        detections_per_image = [None] * len(images_rgb)
+        for image_shape, image_indices in image_indices_per_shape.items():
+            for batch_start in range(0, len(image_indices), maximum_batch_size):
+                batch_indices = image_indices[batch_start:batch_start + maximum_batch_size]
+
+                if len(batch_indices) == 1:
+                    detections_per_image[batch_indices[0]] = self.detect(
+                        images_rgb[batch_indices[0]], as_structured_array=as_structured_array)
+                    continue
+
+                img_tensor = np.stack([images_rgb[image_index] for image_index in batch_indices])
+
+                (boxes_ndims, scores_ndims, labels_ndims, _N) = self.sess.run(
+                    [self.boxesTensor, self.scoresTensor, self.classesTensor, self.numDetections],
+                    feed_dict={self.imageTensor: img_tensor})
+
+                for batch_offset, image_index in enumerate(batch_indices):
+                    detections_per_image[image_index] = self._labelled_scored_boxes_above_threshold(
+                        boxes_ndims[batch_offset], scores_ndims[batch_offset], labels_ndims[batch_offset], image_shape,
+                        as_structured_array=as_structured_array)
+
+        return detections_per_image
+
+    def _labelled_scored_boxes_above_threshold(self, boxes, scores, label_ids, image_shape,
+                                               as_structured_array=False):
+        # Typically 100 or more boxes are returned irrespective of confidence, so discard low scoring boxes before
+        # scaling them or looking up their labels
+        above_threshold = scores > self.minimum_confidence
+        boxes = boxes[above_threshold]
+        scores = scores[above_threshold]
+        label_ids = label_ids[above_threshold]
+
+        image_height = image_shape[0]
+        image_width = image_shape[1]
+
+        # Scaled in the boxes' own precision, then truncated towards zero as int() would
+        box_scale = np.array([image_height, image_width, image_height, image_width], dtype=boxes.dtype)
+        scaled_boxes = (boxes * box_scale).astype(np.int64)
+        rounded_scores = [round(float(score), 4) for score in scores]
+        labels = [str(self.categoryIdx[label]["name"]) for label in label_ids.tolist()]
+
+        if as_structured_array:
+            detections = np.empty(len(labels), dtype=DETECTION_DTYPE)
+            detections['label'] = labels
+            detections['y0'] = scaled_boxes[:, 0]
+            detections['x0'] = scaled_boxes[:, 1]
+            detections['y1'] = scaled_boxes[:, 2]
+            detections['x1'] = scaled_boxes[:, 3]
+            detections['score'] = rounded_scores
+            return detections
+
+        return [[label, box + [score]] for label, box, score in zip(labels, scaled_boxes.tolist(), rounded_scores)]
+
+    def warm_up(self, image_height=288, image_width=352):
+        """
+        Runs a single inference on a blank image, so one-off graph initialisation is not paid for by the first image
+        that is actually processed.
+
+        :param image_height: height of blank image, in pixels
+        :param image_width: width of blank image, in pixels
+        """
+        self.detect(np.zeros((image_height, image_width, 3), dtype=np.uint8))
 
     def detected_object_types(self):
         return [self.categoryIdx[label_number]["name"] for label_number in self.categoryIdx]
@@ -0,0 +1,334 @@
+import datetime
+from itertools import groupby
+
+from chrono_lens.images.fault_detection import FaultyImageDetector
+from chrono_lens.images.image_frame import ImageFrame
+from chrono_lens.images.image_cache import ImageCache
+from chrono_lens.images.static_filter import StaticObjectFilter
+
+"""
+Counts objects in camera images with a model of "_" separated stages, such as
+"FaultyImageFilterV0_NewcastleV0_StaticObjectFilterV0": any number of faulty image filters (pre-process stages), an
+object detector, then any number of static object filters (post-process stages). Filters compare each image with the
+previous and next images from the same camera (10 minutes either side).
+
+This is shared by every deployment - localhost and Google Cloud differ only in where images and model configurations
+are read from. Images are read through an image store, which provides:
+
+* `load_image_frame(image_source, image_date_time, camera_id, greyscale_decoding, initial_reduction)` returning an
+  `ImageFrame` (empty if the image cannot be decoded), or None if the image is missing
+* `load_identical_image_date_time(image_source, image_date_time, camera_id)` returning the datetime of the slot
+  holding the image if an identical image marker is stored in its place (see `chrono_lens.images.download_records`),
+  otherwise None
+
+`InMemoryImageStore` holds images in memory; see also `chrono_lens.localhost.file_io.FileImageStore` and
+`chrono_lens.gcloud.image_loader.BucketImageStore`.
+"""
+IMAGE_INTERVAL = datetime.timedelta(minutes=10)
+
+
+def split_model_stages(model_blob_name):
+    """
+    :param model_blob_name: name of the model, as "_" separated stages, e.g. "NewcastleV0_StaticObjectFilterV0"
+    :return: tuple of list of pre-process stage names, object detector stage name and list of post-process stage names
+    """
+    model_stages = model_blob_name.split('_')
+
+    object_detector_model_stage_index = 0
+    for model_pre_process_index, model_pre_process_name in enumerate(model_stages):
+        if not model_pre_process_name.startswith('FaultyImageFilter'):
+            # Not a pre-process stage, so assume it's the object detector
+            object_detector_model_stage_index = model_pre_process_index
+            break
+
+    model_post_process_names = model_stages[object_detector_model_stage_index + 1:]
+    for model_post_process_name in model_post_process_names:
+        if not model_post_process_name.startswith('StaticObjectFilter'):
+            raise ValueError(f'Model post-process stage is unknown: "{model_post_process_name}"')
+
+    return (model_stages[:object_detector_model_stage_index], model_stages[object_detector_model_stage_index],
+            model_post_process_names)
+
+
+class ModelStages:
+    """
+    The filters and object detector of a model, each built once from its configuration.
+    """
+
+    def __init__(self, faulty_image_filters, object_detector, static_object_filters):
+        """
+        :param faulty_image_filters: list of `FaultyImageDetector`, applied before detection
+        :param object_detector: detector (such as `NewcastleDetector`) providing `detect` and `detected_object_types`
+        :param static_object_filters: list of `StaticObjectFilter`, applied to the detected objects
+        """
+        self.faulty_image_filters = faulty_image_filters
+        self.object_detector = object_detector
+        self.static_object_filters = static_object_filters
+
+    @classmethod
+    def from_model_name(cls, model_blob_name, load_stage_configuration, create_object_detector):
+        """
+        :param model_blob_name: name of the model, as "_" separated stages, e.g. "NewcastleV0_StaticObjectFilterV0"
+        :param load_stage_configuration: function returning the configuration dictionary of a named filter stage
+        :param create_object_detector: function returning the detector of a named object detector stage
+        :return: `ModelStages` of the model
+        """
+        model_pre_process_names, object_detector_model_stage_name, model_post_process_names = \
+            split_model_stages(model_blob_name)
+
+        return cls([FaultyImageDetector.from_configuration(load_stage_configuration(model_pre_process_name))
+                    for model_pre_process_name in model_pre_process_names],
+                   create_object_detector(object_detector_model_stage_name),
+                   [StaticObjectFilter.from_configuration(load_stage_configuration(model_post_process_name))
+                    for model_post_process_name in model_post_process_names])
+
+    def detected_object_types(self):
+        return self.object_detector.detected_object_types()
+
+
+class InMemoryImageStore:
+    """
+    Image store of raw (JPEG) images and identical image markers held in memory; useful for tests and benchmarks,
+    and for images downloaded ahead of processing.
+    """
+
+    def __init__(self, raw_images=None, identical_image_date_times=None):
+        """
+        :param raw_images: dictionary of (image_source, image_date_time, camera_id) to raw image bytes
+        :param identical_image_date_times: dictionary of (image_source, image_date_time, camera_id) to datetime of
+            the slot holding the image, for slots with an identical image marker in place of their image
+        """
+        self.raw_images = {} if raw_images is None else raw_images
+        self.identical_image_date_times = {} if identical_image_date_times is None else identical_image_date_times
+
+    def load_image_frame(self, image_source, image_date_time, camera_id, greyscale_decoding=False,
+                         initial_reduction=1):
+        raw_image = self.raw_images.get((image_source, image_date_time, camera_id))
+        if raw_image is None:
+            return None
+
+        return ImageFrame.decode(raw_image, greyscale_decoding, initial_reduction)
+
+    def load_identical_image_date_time(self, image_source, image_date_time, camera_id):
+        return self.identical_image_date_times.get((image_source, image_date_time, camera_id))
+
+
+class CountingPipeline:
+    """
+    Counts objects in images read from an image store, with the stages of a single model. Decoded images are held in
+    `image_cache`, so an image used as "next", "current" and "previous" image in turn is only decoded once.
+    """
+
+    def __init__(self, model_stages, image_store, image_cache=None, detection_batch_size=1):
+        """
+        :param model_stages: `ModelStages` of the model to run
+        :param image_store: image store from which images are read (see module description)
+        :param image_cache: `ImageCache` of decoded images, which may be shared between pipelines; if None, images are
+            only reused within each call (and decoded in colour)
+        :param detection_batch_size: number of a camera's images passed to the object detector's `detect_batch`
+            together by `count_objects_in_batch`; if 1, images are passed to `detect` individually
+        """
+        if detection_batch_size < 1:
+            raise ValueError(f'detection_batch_size must be at least 1, not {detection_batch_size}')
+
+        self.model_stages = model_stages
+        self.image_store = image_store
+        self.image_cache = ImageCache(maximum_bytes=0) if image_cache is None else image_cache
+        self.detection_batch_size = detection_batch_size
+
+    def detected_object_types(self):
+        return self.model_stages.detected_object_types()
+
+    def count_objects(self, image_source, image_date_time, camera_id):
+        """
+        :param image_source: source of the image, such as "TfL-images"
+        :param image_date_time: datetime of the image slot
+        :param camera_id: camera that took the image
+        :return: dictionary of the count of each object type detected, plus "faulty" and "missing" flags
+        """
+        image_slot = self._pre_process(image_source, image_date_time, camera_id)
+        if image_slot.detection_required:
+            detected_objects = self.model_stages.object_detector.detect(image_slot.image_frame.image_rgb)
+        else:
+            detected_objects = None
+        return self._post_process(image_slot, detected_objects)
+
+    def count_objects_in_batch(self, image_keys):
+        """
+        Counts objects in several images, processing each camera's images in time order; images are discarded from
+        the image cache once they have been used as "previous" image, so each image is read and decoded once without
+        the cache growing with the batch.
+
+        :param image_keys: list of (image_source, image_date_time, camera_id) tuples of the images to process
+        :return: list of the results of `count_objects` for each image, in the order of `image_keys`
+        """
+        object_results_per_image = [None] * len(image_keys)
+
+        def camera_of(image_index):
+            image_source, _, camera_id = image_keys[image_index]
+            return image_source, camera_id
+
+        image_indices = sorted(range(len(image_keys)), key=lambda image_index: (camera_of(image_index),
+                                                                                image_keys[image_index][1]))
+        for (image_source, camera_id), camera_image_indices in groupby(image_indices, key=camera_of):
+            camera_image_indices = list(camera_image_indices)
+
+            for batch_start in range(0, len(camera_image_indices), self.detection_batch_size):
+                batch_image_indices = camera_image_indices[batch_start:batch_start + self.detection_batch_size]
+                image_slots = [self._pre_process(image_source, image_keys[image_index][1], camera_id)
+                               for image_index in batch_image_indices]
+
+                for image_index, object_results in zip(batch_image_indices, self._detect_and_post_process(image_slots)):
+                    object_results_per_image[image_index] = object_results
+
+                for image_slot in image_slots:
+                    # Previous image has now been used as "previous", "current" and "next"; slide the window on
+                    self.image_cache.discard((image_source, camera_id, image_slot.image_date_time - IMAGE_INTERVAL))
+
+        return object_results_per_image
+
+    def _detect_and_post_process(self, image_slots):
+        images_rgb = [image_slot.image_frame.image_rgb for image_slot in image_slots
+                      if image_slot.detection_required]
+
+        if self.detection_batch_size > 1 and len(images_rgb) > 1:
+            detected_objects_per_image = iter(self.model_stages.object_detector.detect_batch(
+                images_rgb, maximum_batch_size=self.detection_batch_size))
+        else:
+            detected_objects_per_image = (self.model_stages.object_detector.detect(image_rgb)
+                                          for image_rgb in images_rgb)
+
+        return [self._post_process(image_slot,
+                                   next(detected_objects_per_image) if image_slot.detection_required else None)
+                for image_slot in image_slots]
+
+    def _pre_process(self, image_source, image_date_time, camera_id):
+        """
+        Loads the image and applies the faulty image filters.
+
+        :return: `_ImageSlot` of the image
+        """
+        faulty_image_filters = self.model_stages.faulty_image_filters
+        image_slot = _ImageSlot(image_source, image_date_time, camera_id)
+
+        # Images identical to the previous image are found faulty by the pre-filters, so are not loaded
+        image_slot.image_frame = self.load_cached_image_frame(image_source, image_date_time, camera_id,
+                                                              resolve_identical_image=not faulty_image_filters)
+        image_slot.missing = image_slot.image_frame is None
+
+        if image_slot.missing and faulty_image_filters:
+            image_slot.faulty = self.image_store.load_identical_image_date_time(
+                image_source, image_date_time, camera_id) is not None
+            image_slot.missing = not image_slot.faulty
+        elif not image_slot.missing:
+            image_slot.faulty = image_slot.image_frame.is_empty
+
+        for faulty_image_filter in faulty_image_filters:
+            if not image_slot.missing and not image_slot.faulty:
+                self._load_comparison_image_frames(image_slot, faulty_image_filter.comparison_image_reduction)
+
+                image_slot.previous_comparable, image_slot.faulty, image_slot.next_comparable = \
+                    faulty_image_filter.check_current_faulty_and_next_previous_comparable(
+                        image_slot.previous_image_frame, image_slot.image_frame, image_slot.next_image_frame)
+
+        return image_slot
+
+    def _post_process(self, image_slot, detected_objects):
+        """
+        Applies the static object filters to the objects detected in the image, and counts them.
+
+        :param detected_objects: objects detected in the image; ignored if the image was not to be detected
+        :return: dictionary of the count of each object type detected, plus "faulty" and "missing" flags
+        """
+        # Ensure all object types are initialised to 0 - so if not present, we still report
+        object_results = {object_type: 0 for object_type in self.detected_object_types()}
+        object_results['faulty'] = image_slot.faulty
+        object_results['missing'] = image_slot.missing
+
+        if image_slot.detection_required:
+            for static_object_filter in self.model_stages.static_object_filters:
+                self._load_comparison_image_frames(image_slot, static_object_filter.comparison_image_reduction)
+
+                detected_objects = static_object_filter.filter_static_objects(
+                    detected_objects, image_slot.previous_image_frame, image_slot.image_frame,
+                    image_slot.next_image_frame, image_slot.previous_comparable, image_slot.next_comparable)
+
+            if detected_objects is None:
+                object_results['faulty'] = True
+            else:
+                for detected_object in detected_objects:
+                    label = detected_object[0].lower().strip()
+                    object_results[label] += 1
+
+        return object_results
+
+    def _load_comparison_image_frames(self, image_slot, initial_reduction):
+        image_slot.previous_image_frame = self.load_cached_comparison_image_frame_if_not_loaded(
+            image_slot.previous_image_frame, image_slot.image_source, image_slot.image_date_time - IMAGE_INTERVAL,
+            image_slot.camera_id, initial_reduction)
+
+        image_slot.next_image_frame = self.load_cached_comparison_image_frame_if_not_loaded(
+            image_slot.next_image_frame, image_slot.image_source, image_slot.image_date_time + IMAGE_INTERVAL,
+            image_slot.camera_id, initial_reduction)
+
+    def load_cached_image_frame(self, image_source, image_date_time, camera_id, initial_reduction=1,
+                                resolve_identical_image=True):
+        """
+        :param resolve_identical_image: if True and an identical image marker is stored in place of the image (see
+            `chrono_lens.images.download_records`), the image it is identical to is returned; otherwise None is
+            returned
+        :return: `ImageFrame`, or None if the image is missing
+        """
+        image_frame = self.image_cache.get_or_load(
+            (image_source, camera_id, image_date_time),
+            lambda: self.image_store.load_image_frame(image_source, image_date_time, camera_id,
+                                                      self.image_cache.greyscale_decoding, initial_reduction))
+
+        if image_frame is None and resolve_identical_image:
+            identical_image_date_time = self.image_store.load_identical_image_date_time(image_source, image_date_time,
+                                                                                        camera_id)
+            if identical_image_date_time is not None:
+                # Cached under the slot holding the image, so it is only decoded once
+                image_frame = self.load_cached_image_frame(image_source, identical_image_date_time, camera_id,
+                                                           initial_reduction, resolve_identical_image=False)
+
+        return image_frame
+
+    def load_cached_comparison_image_frame_if_not_loaded(self, image_frame, image_source, image_date_time, camera_id,
+                                                         initial_reduction=1):
+        if image_frame is not None:
+            return image_frame
+
+        image_frame = self.load_cached_image_frame(image_source, image_date_time, camera_id, initial_reduction)
+        if image_frame is None:
+            return None
+
+        if image_frame.is_empty:
+            return None
+
+        return image_frame
+
+
+class _ImageSlot:
+    """
+    State of an image between pre-processing and post-processing: its frame, those of its neighbours, and the
+    findings of the faulty image filters.
+    """
+
+    def __init__(self, image_source, image_date_time, camera_id):
+        self.image_source = image_source
+        self.image_date_time = image_date_time
+        self.camera_id = camera_id
+
+        self.image_frame = None
+        self.previous_image_frame = None
+        self.next_image_frame = None
+
+        self.missing = False
+        self.faulty = False
+        self.previous_comparable = True
+        self.next_comparable = True
+
+    @property
+    def detection_required(self):
+        return not self.faulty and not self.missing
@@ -1,6 +1,8 @@
 import cv2
 import numpy as np
-from skimage.metrics import structural_similarity
+
+from chrono_lens.images.image_frame import image_frame_of, IMAGE_REDUCTIONS
+from chrono_lens.images.structural_similarity import STRUCTURAL_SIMILARITY_BACKENDS
 
 """
 Example JSON configuration:
@@ -9,10 +11,21 @@ Example JSON configuration:
     "minimum_mask_area": 0.25,
     "minimum_mask_area_person": 0.10,
     "confidence_person": 0.80,
-    "contour_area_threshold": 50
+    "contour_area_threshold": 50,
+    "structural_similarity_backend": "skimage",
+    "restrict_mask_to_detections": false,
+    "duplicate_removal_backend": "sequential",
+    "comparison_image_reduction": 1
 }
 """
 
+DUPLICATE_REMOVAL_BACKENDS = ['sequential', 'opencv']
+
+# Largest proportion of detected objects whose outcome changes when images are compared at a reduced size
+# (comparison_image_reduction), as measured with objects tiled over the time series test images; objects smaller
+# than a few reduced pixels are the most affected
+COMPARISON_IMAGE_REDUCTION_TOLERANCES = {1: 0.0, 2: 0.25, 4: 0.65}
+
 
 class StaticObjectFilter:
 
@@ -23,11 +36,28 @@ class StaticObjectFilter:
             minimum_mask_proportion=configuration['minimum_mask_proportion'],
             minimum_mask_proportion_person=configuration['minimum_mask_proportion_person'],
             confidence_person=configuration['confidence_person'],
-            contour_area_threshold=configuration['contour_area_threshold']
+            contour_area_threshold=configuration['contour_area_threshold'],
+            structural_similarity_backend=configuration.get('structural_similarity_backend', 'skimage'),
+            restrict_mask_to_detections=configuration.get('restrict_mask_to_detections', False),
+            duplicate_removal_backend=configuration.get('duplicate_removal_backend', 'sequential'),
+            comparison_image_reduction=configuration.get('comparison_image_reduction', 1)
         )
 
     def __init__(self, scenecut_threshold=0.4, minimum_mask_proportion=0.25, minimum_mask_proportion_person=0.10,
-                 confidence_person=0.80, contour_area_threshold=50):
+                 confidence_person=0.80, contour_area_threshold=50, structural_similarity_backend='skimage',
+                 restrict_mask_to_detections=False, duplicate_removal_backend='sequential',
+                 comparison_image_reduction=1):
+        if structural_similarity_backend not in STRUCTURAL_SIMILARITY_BACKENDS:
+            raise ValueError(f'structural_similarity_backend must be one of {list(STRUCTURAL_SIMILARITY_BACKENDS)},'
+                             f' not "{structural_similarity_backend}"')
+
+        if duplicate_removal_backend not in DUPLICATE_REMOVAL_BACKENDS:
+            raise ValueError(f'duplicate_removal_backend must be one of {DUPLICATE_REMOVAL_BACKENDS},'
+                             f' not "{duplicate_removal_backend}"')
+
+        if comparison_image_reduction not in IMAGE_REDUCTIONS:
+            raise ValueError(f'comparison_image_reduction must be one of {IMAGE_REDUCTIONS},'
+                             f' not {comparison_image_reduction}')
 
         # the ssim value is between [0,1], the higher, the more similar to the previous image.
         self.scenecut_threshold = scenecut_threshold
@@ -43,7 +73,25 @@ class StaticObjectFilter:
         # ANY CONTOUR SMALLER THAN THIS VALUE will be treated as noise.
         self.contour_area_threshold = contour_area_threshold
 
-    def filter_static_objects(self, detected_objects, previous_image_rgb, current_image_rgb, next_image_rgb,
+        # "skimage" (reference) or "opencv" (faster, matches "skimage" within a documented tolerance); see
+        # chrono_lens.images.structural_similarity
+        self.structural_similarity_backend = structural_similarity_backend
+        self._structural_similarity = STRUCTURAL_SIMILARITY_BACKENDS[structural_similarity_backend]
+
+        # if True, noise is only removed from the static mask around the detected objects (the only place the mask
+        # is used); results are unchanged
+        self.restrict_mask_to_detections = restrict_mask_to_detections
+
+        # "sequential" removes duplicates in list order, as originally implemented; "opencv" uses non-maximum
+        # suppression (cv2.dnn.NMSBoxes), which does not depend on the order of detections
+        self.duplicate_removal_backend = duplicate_removal_backend
+
+        # images are compared with their height and width reduced by this factor (1, 2 or 4), and the static mask
+        # scaled back up to the current image; faster, but results may differ from those at full size (see
+        # COMPARISON_IMAGE_REDUCTION_TOLERANCES)
+        self.comparison_image_reduction = comparison_image_reduction
+
+    def filter_static_objects(self, detected_objects, previous_image, current_image, next_image,
                               previous_comparable=True, next_comparable=True):
         """
         Given a list of detected objects (bounding box, label), compares against next and previous image;
@@ -55,10 +103,14 @@ class StaticObjectFilter:
         Current image is deemed "faulty" if we cannot apply a static filter to it; this is skipped if
         "self.ignore_comparable" is True.
 
+        Images may be supplied as `ImageFrame`, in which case their greyscale views are used (and reused), and no
+        RGB conversion is needed; previous and next images are only decoded at the size they are compared at (see
+        `comparison_image_reduction`).
+
         :param detected_objects: list of labelled bounding boxes representing detected objects
-        :param previous_image_rgb: numpy array of previous image in sequence, possibly None
-        :param current_image_rgb: numpy array of current image in sequence
-        :param next_image_rgb: numpy array of next image in sequence, possibly None
+        :param previous_image: RGB numpy array or `ImageFrame` of previous image in sequence, possibly None
+        :param current_image: RGB numpy array or `ImageFrame` of current image in sequence
+        :param next_image: RGB numpy array or `ImageFrame` of next image in sequence, possibly None
         :param previous_comparable: True if previous image is valid for comparison (and should be used), False otherwise
         :param next_comparable: True if previous image is valid for comparison (and should be used), False otherwise
         :return: list of labelled bounding boxes, a copy of `detected_objects` with static objects removed; None if
@@ -73,73 +125,134 @@ class StaticObjectFilter:
 
         # Need to filter for incomparable image sizes
         if not previous_comparable:
-            previous_image_rgb = None
+            previous_image = None
 
         if not next_comparable:
-            next_image_rgb = None
+            next_image = None
 
         # If we can't compare against both previous and next, we can't perform a static object test
         # So assume 0 counts and flag faulty, we'll defer to imputation - to avoid unusually high counts
-        if previous_image_rgb is None and next_image_rgb is None:
+        if previous_image is None and next_image is None:
             return None
 
-        current_image_greyscale = cv2.cvtColor(current_image_rgb, cv2.COLOR_BGR2GRAY)
+        # Nothing to filter, so no need to compare images
+        if len(detected_objects_no_duplicates) == 0:
+            return []
+
+        reduction = self.comparison_image_reduction
+        if self.restrict_mask_to_detections:
+            region_of_interest = self._get_bounding_rectangle(detected_objects_no_duplicates, reduction)
+        else:
+            region_of_interest = None
+
+        # Prepared once, as the current image is compared against both previous and next images
+        current_image_prepared = self._structural_similarity.prepare(
+            image_frame_of(current_image, reduction).image_greyscale)
 
         # Generate previous filename, get previous image
-        if previous_image_rgb is None:
+        if previous_image is None:
             previous_image_ssim_score = 0
             previous_image_ssim_full_image = None
         else:
-            previous_image_greyscale = cv2.cvtColor(previous_image_rgb, cv2.COLOR_BGR2GRAY)
-            (previous_image_ssim_score, previous_image_ssim_full_image) = structural_similarity(
-                previous_image_greyscale, current_image_greyscale, full=True)
+            previous_image_prepared = self._structural_similarity.prepare(
+                image_frame_of(previous_image, reduction).image_greyscale)
+            (previous_image_ssim_score, previous_image_ssim_full_image) = self._structural_similarity.compare(
+                previous_image_prepared, current_image_prepared)
 
-        if next_image_rgb is None:
+        if next_image is None:
             # if no next image, use mask = get_static_mask(previous_mask)
-            # previous_image_rgb cannot be None, already checked
-            mask = self._get_static_mask(previous_image_ssim_full_image)
+            # previous_image cannot be None, already checked
+            mask = self._get_static_mask(previous_image_ssim_full_image, region_of_interest, reduction)
         else:
-            next_image_greyscale = cv2.cvtColor(next_image_rgb, cv2.COLOR_BGR2GRAY)
-            (next_image_ssim_score, next_image_ssim_full_image) = structural_similarity(
-                next_image_greyscale, current_image_greyscale, full=True)
+            next_image_prepared = self._structural_similarity.prepare(
+                image_frame_of(next_image, reduction).image_greyscale)
+            (next_image_ssim_score, next_image_ssim_full_image) = self._structural_similarity.compare(
+                next_image_prepared, current_image_prepared)
 
             # if previous score and next score > SCENECUT:
-            if (previous_image_rgb is not None) and (previous_image_ssim_score > self.scenecut_threshold) and (
+            if (previous_image is not None) and (previous_image_ssim_score > self.scenecut_threshold) and (
                     next_image_ssim_score > self.scenecut_threshold):
                 #   create previous mask
                 #   create next mask
-                previous_mask = self._get_static_mask(previous_image_ssim_full_image)
-                next_mask = self._get_static_mask(next_image_ssim_full_image)
+                previous_mask = self._get_static_mask(previous_image_ssim_full_image, region_of_interest, reduction)
+                next_mask = self._get_static_mask(next_image_ssim_full_image, region_of_interest, reduction)
 
                 #   mask = previous mask and next mask
                 mask = cv2.bitwise_and(previous_mask, next_mask)
 
             else:
                 #   mask = create next mask
-                mask = self._get_static_mask(next_image_ssim_full_image)
-
-        filtered_detected_objects = []
-
-        # Extract bounding boxes for each result
-        for detected_object in detected_objects_no_duplicates:
-            #   If proportion of non-zero mask pixels within bounding box > minimum_mask_area
-            #   OR label=="person" & score > confidence_person & proportion of ... > minimum_mask_area_person
-            #     filtered_detected_objects.append(object)
-            # ['van', [141, 241, 180, 285, 0.9964]],
-            label = detected_object[0]
-            y0, x0, y1, x1, score = detected_object[1]
-            num_non_masked_pixels = np.sum(mask[y0:y1, x0:x1] > 0)
-            proportion_masked_pixels = num_non_masked_pixels / ((y1 - y0 + 1) * (x1 - x0 + 1))
-
-            if proportion_masked_pixels >= self.minimum_mask_proportion or (
-                    label.find('person') >= 0 and
-                    proportion_masked_pixels >= self.minimum_mask_proportion_person and
-                    score > self.confidence_person):
-                filtered_detected_objects.append(detected_object)
+                mask = self._get_static_mask(next_image_ssim_full_image, region_of_interest, reduction)
+
+        if reduction > 1:
+            # Each mask pixel covers reduction x reduction pixels of the current image
+            image_height, image_width = current_image.shape[:2]
+            mask = mask.repeat(reduction, axis=0).repeat(reduction, axis=1)[:image_height, :image_width]
+
+        #   If proportion of non-zero mask pixels within bounding box > minimum_mask_area
+        #   OR label=="person" & score > confidence_person & proportion of ... > minimum_mask_area_person
+        #     keep object
+        proportions_masked_pixels = self._get_masked_proportions(mask, detected_objects_no_duplicates)
+        is_person = np.array([detected_object[0].find('person') >= 0
+                              for detected_object in detected_objects_no_duplicates])
+        scores = np.array([detected_object[1][4] for detected_object in detected_objects_no_duplicates])
+
+        retained = (proportions_masked_pixels >= self.minimum_mask_proportion) | (
+                is_person &
+                (proportions_masked_pixels >= self.minimum_mask_proportion_person) &
+                (scores > self.confidence_person))
+
+        filtered_detected_objects = [detected_objects_no_duplicates[index] for index in np.flatnonzero(retained)]
 
         return filtered_detected_objects
 
-    def _get_static_mask(self, structural_similarity_image):
+    @staticmethod
+    def _get_masked_proportions(mask, detected_objects):
+        """
+        Proportion of each detected object's bounding box covered by non-zero mask pixels, from a summed-area table
+        of the mask, so each box costs four lookups however large or overlapping the boxes are.
+
+        :param mask: uint8 numpy array, non-zero where pixels changed
+        :param detected_objects: non-empty list of labelled bounding boxes, e.g. ['van', [141, 241, 180, 285, 0.9964]]
+        :return: numpy array of proportions, one per detected object
+        """
+        image_height, image_width = mask.shape
+
+        # Summed-area table is one larger than the mask in each dimension; [y, x] sums mask[:y, :x]
+        summed_area_table = cv2.integral((mask > 0).view(np.uint8), sdepth=cv2.CV_32S)
+
+        boxes = np.array([detected_object[1][:4] for detected_object in detected_objects], dtype=np.int64)
+        y0s = np.clip(boxes[:, 0], 0, image_height)
+        x0s = np.clip(boxes[:, 1], 0, image_width)
+        y1s = np.clip(boxes[:, 2], y0s, image_height)
+        x1s = np.clip(boxes[:, 3], x0s, image_width)
+
+        num_non_masked_pixels = (summed_area_table[y1s, x1s] - summed_area_table[y0s, x1s]
+                                 - summed_area_table[y1s, x0s] + summed_area_table[y0s, x0s])
+
+        # Area includes the final row and column, as originally calculated
+        return num_non_masked_pixels / ((boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1))
+
+    @staticmethod
+    def _get_bounding_rectangle(detected_objects, reduction=1):
+        """
+        :return: (y0, x0, y1, x1) rectangle bounding all detected objects, in an image reduced by `reduction`
+        """
+        boxes = np.array([detected_object[1][:4] for detected_object in detected_objects])
+        return (boxes[:, 0].min() // reduction, boxes[:, 1].min() // reduction,
+                -(-boxes[:, 2].max() // reduction), -(-boxes[:, 3].max() // reduction))
+
+    def _get_static_mask(self, structural_similarity_image, region_of_interest=None, reduction=1):
+        """
+        Mask of pixels that changed between images (non-zero), from the SSIM image comparing them.
+
+        :param structural_similarity_image: SSIM image, values in [0,1] where the higher, the more similar
+        :param region_of_interest: optional (y0, x0, y1, x1) rectangle (y1, x1 exclusive); if supplied, the mask is
+            only evaluated within it and is zero elsewhere. Within the rectangle, the mask is identical to that
+            evaluated over the whole image
+        :param reduction: factor the compared images were reduced by; the contour area threshold is scaled to match
+        :return: mask as uint8 numpy array, same size as `structural_similarity_image`
+        """
         # check SSIM, note ssimimg value is between [0,1] where the higher, the more similar
         structural_similarity_image = (structural_similarity_image * 255).astype("uint8")
         structural_similarity_image = 255 - structural_similarity_image
@@ -152,74 +265,170 @@ class StaticObjectFilter:
         structural_similarity_binary = cv2.dilate(structural_similarity_binary, kernel=kernel)
         structural_similarity_binary = cv2.erode(structural_similarity_binary, kernel=kernel)
 
-        # use contour to filter out small noise area
-        contours, hierarchy = cv2.findContours(structural_similarity_binary, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        if len(contours) > 0:
-            hierarchy = hierarchy[0]  # get the actual inner list of hierarchy descriptions
-
-            # For each contour, filter small area
-            for component in zip(contours, hierarchy):
-                current_contour = component[0]
-                current_hierarchy = component[1]
-                if current_hierarchy[3] < 0:  # outer contour
-                    area_contour = cv2.contourArea(current_contour)
-                    if area_contour < self.contour_area_threshold:
-                        cv2.drawContours(structural_similarity_binary, [current_contour], 0, color=0,
-                                         thickness=cv2.FILLED)
-
-        # fill small hole again
-        structural_similarity_binary = cv2.dilate(structural_similarity_binary, kernel=kernel)
-        structural_similarity_binary = cv2.erode(structural_similarity_binary, kernel=kernel)
+        # The final closing reads up to this many pixels beyond the region of interest
+        closing_margin = 2
+        if region_of_interest is not None:
+            image_height, image_width = structural_similarity_binary.shape
+            y0, x0, y1, x1 = region_of_interest
+            region_of_interest = (max(0, y0), max(0, x0), min(image_height, y1), min(image_width, x1))
+            margin_region = (max(0, y0 - closing_margin), max(0, x0 - closing_margin),
+                             min(image_height, y1 + closing_margin), min(image_width, x1 + closing_margin))
+        else:
+            margin_region = None
+
+        # use contour to filter out small noise area; only outer contours are considered, so inner contours (holes)
+        # are not retrieved
+        contours, _ = cv2.findContours(structural_similarity_binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if margin_region is not None and len(contours) > 0:
+            # Removing a region only affects pixels within its bounding rectangle
+            contours = [contours[index] for index in np.flatnonzero(
+                self._contours_intersect_region(contours, margin_region))]
+
+        # For each outer contour, filter small area
+        for current_contour in contours:
+            area_contour = cv2.contourArea(current_contour)
+            if area_contour < self.contour_area_threshold / reduction ** 2:
+                cv2.drawContours(structural_similarity_binary, [current_contour], 0, color=0, thickness=cv2.FILLED)
+
+        if margin_region is None:
+            # fill small hole again
+            structural_similarity_binary = cv2.dilate(structural_similarity_binary, kernel=kernel)
+            structural_similarity_binary = cv2.erode(structural_similarity_binary, kernel=kernel)
+
+            return structural_similarity_binary
+
+        # fill small hole again, only around the region of interest; pixels within the margin are discarded as they
+        # depend on pixels outside the crop
+        margin_y0, margin_x0, margin_y1, margin_x1 = margin_region
+        cropped_binary = structural_similarity_binary[margin_y0:margin_y1, margin_x0:margin_x1]
+        cropped_binary = cv2.dilate(cropped_binary, kernel=kernel)
+        cropped_binary = cv2.erode(cropped_binary, kernel=kernel)
+
+        static_mask = np.zeros_like(structural_similarity_binary)
+        y0, x0, y1, x1 = region_of_interest
+        if y1 > y0 and x1 > x0:
+            static_mask[y0:y1, x0:x1] = cropped_binary[y0 - margin_y0:y1 - margin_y0, x0 - margin_x0:x1 - margin_x0]
+
+        return static_mask
 
-        return structural_similarity_binary
+    @staticmethod
+    def _contours_intersect_region(contours, region):
+        """
+        :return: boolean numpy array, True where the bounding rectangle of a contour intersects the (y0, x0, y1, x1)
+            region (y1, x1 exclusive)
+        """
+        contour_points = np.concatenate(contours).reshape(-1, 2)
+        contour_starts = np.cumsum([0] + [len(contour) for contour in contours[:-1]])
+
+        minimum_xs = np.minimum.reduceat(contour_points[:, 0], contour_starts)
+        minimum_ys = np.minimum.reduceat(contour_points[:, 1], contour_starts)
+        maximum_xs = np.maximum.reduceat(contour_points[:, 0], contour_starts)
+        maximum_ys = np.maximum.reduceat(contour_points[:, 1], contour_starts)
+
+        y0, x0, y1, x1 = region
+        return (minimum_ys < y1) & (maximum_ys >= y0) & (minimum_xs < x1) & (maximum_xs >= x0)
 
     def _remove_duplicated_labels(self, detected_objects, maxratio=0.90):
-        for index, object_ in enumerate(detected_objects):
-            # label = object_[0]
-            y0, x0, y1, x1, score = object_[1]
-            source_bbox = (x0, y0, x1, y1)
-
-            total_objects = len(detected_objects)
-            test_index = index + 1
-            while test_index < total_objects:
-                # templabel = img_objects[tempindex][0]
-                test_y0, test_x0, test_y1, test_x1, test_score = detected_objects[test_index][1]
-                test_bbox = (test_x0, test_y0, test_x1, test_y1)
-                ratio = self._calculate_intersection_over_union(source_bbox, test_bbox)
-
-                # print(ratio)
-                if ratio > maxratio:
-                    # print(ratio)
-                    if score > test_score:
-                        # remove
-                        # print(f'duplicated: keep {object_}  remove {detected_objects[tempindex]}')
-                        detected_objects.pop(test_index)
-                    else:
-                        # print(f'duplicated: keep {detected_objects[tempindex]}  remove {object_}')
-                        detected_objects.pop(index)
-                    total_objects -= 1
-                test_index += 1
-
-        return detected_objects
+        """
+        Removes detected objects whose bounding boxes overlap with intersection over union above `maxratio`.
 
-    @staticmethod
-    def _calculate_intersection_over_union(bbox1, bbox2):
-        intersect_bbox = []
-        if bbox2[0] >= bbox1[2] or bbox2[2] <= bbox1[0] or bbox2[1] >= bbox1[3] or bbox2[3] <= bbox1[1]:
-            return 0
-        else:
-            intersect_bbox.append([max(bbox1[0], bbox2[0]), max(bbox1[1], bbox2[1]),
-                                   min(bbox1[2], bbox2[2]), min(bbox1[3], bbox2[3])])
+        :param detected_objects: list of labelled bounding boxes; not modified
+        :param maxratio: intersection over union above which two detected objects are duplicates
+        :return: new list of the detected objects retained, in their original order
+        """
+        if len(detected_objects) < 2:
+            return list(detected_objects)
 
-        if len(intersect_bbox) == 0:
-            return 0
+        boxes = np.array([detected_object[1][:4] for detected_object in detected_objects], dtype=np.int64)
+        scores = np.array([detected_object[1][4] for detected_object in detected_objects], dtype=np.float64)
+
+        if self.duplicate_removal_backend == 'opencv':
+            retained_indices = self._retain_non_maximum_suppressed(boxes, scores, maxratio)
         else:
-            intersect_width = int(intersect_bbox[0][2]) - int(intersect_bbox[0][0])
-            intersect_height = int(intersect_bbox[0][3]) - int(intersect_bbox[0][1])
-            if (intersect_width > 0) and (intersect_height > 0):
-                intersect_size = float(intersect_width) * float(intersect_height)
-                bbox1_size = float(bbox1[3] - bbox1[1]) * float(bbox1[2] - bbox1[0])
-                bbox2_size = float(bbox2[3] - bbox2[1]) * float(bbox2[2] - bbox2[0])
-                return float(intersect_size / float(bbox1_size + bbox2_size - intersect_size))
-            else:
-                return 0
+            retained_indices = self._retain_sequentially(boxes, scores, maxratio)
+
+        return [detected_objects[index] for index in retained_indices]
+
+    @classmethod
+    def _retain_sequentially(cls, boxes, scores, maxratio):
+        """
+        Each detected object in turn is compared with those after it; of a duplicated pair, the one with the lower
+        score is removed (the earlier object if scores are equal). The outcome depends on the order of the objects
+        and matches the original list-based implementation exactly, including its quirks: the object after each
+        removed duplicate is not compared, and once the earlier object has been removed, the following duplicates
+        found remove the next remaining object instead.
+
+        :return: numpy array of the indices retained, ascending
+        """
+        duplicated = cls._calculate_intersection_over_union_matrix(boxes) > maxratio
+
+        # Indices of the objects remaining, in order
+        remaining_indices = np.arange(len(boxes))
+
+        source_position = 0
+        while True:
+            # Objects with no later duplicates remove nothing, so skip to the next one with any
+            later_duplicated = np.triu(duplicated[np.ix_(remaining_indices, remaining_indices)], k=1)
+            source_positions_with_duplicates = np.flatnonzero(later_duplicated[source_position:].any(axis=1))
+            if len(source_positions_with_duplicates) == 0:
+                break
+
+            source_position += source_positions_with_duplicates[0]
+            source_index = remaining_indices[source_position]
+
+            removed_positions = set()
+            next_position = source_position + 1
+            for duplicate_position in np.flatnonzero(later_duplicated[source_position]):
+                if duplicate_position < next_position:
+                    continue
+
+                if scores[source_index] > scores[remaining_indices[duplicate_position]]:
+                    removed_positions.add(duplicate_position)
+                else:
+                    removed_position = source_position
+                    while removed_position in removed_positions:
+                        removed_position += 1
+                    removed_positions.add(removed_position)
+
+                next_position = duplicate_position + 2
+
+            remaining_indices = np.delete(remaining_indices, list(removed_positions))
+            source_position += 1
+
+        return remaining_indices
+
+    @staticmethod
+    def _retain_non_maximum_suppressed(boxes, scores, maxratio):
+        """
+        Standard non-maximum suppression with `cv2.dnn.NMSBoxes`: the highest scoring objects are retained, removing
+        any lower scoring duplicates of them. Independent of the order of the objects, so may differ from
+        `_retain_sequentially`.
+
+        :return: numpy array of the indices retained, ascending
+        """
+        # NMSBoxes expects [x, y, width, height]
+        rectangles = np.stack([boxes[:, 1], boxes[:, 0], boxes[:, 3] - boxes[:, 1], boxes[:, 2] - boxes[:, 0]], axis=1)
+        # NMSBoxes discards scores not above score_threshold, which cannot be negative; offset so none are discarded
+        retained_indices = cv2.dnn.NMSBoxes(rectangles.tolist(), (scores + 1).tolist(), score_threshold=0,
+                                            nms_threshold=maxratio)
+
+        return np.sort(np.array(retained_indices, dtype=np.int64).reshape(-1))
+
+    @staticmethod
+    def _calculate_intersection_over_union_matrix(boxes):
+        """
+        :param boxes: numpy array of [y0, x0, y1, x1] rows
+        :return: square numpy array of intersection over union between each pair of boxes; 0 where they do not
+            overlap
+        """
+        y0s, x0s, y1s, x1s = (boxes[:, column].astype(np.float64) for column in range(4))
+
+        intersect_widths = np.minimum(x1s[:, None], x1s[None, :]) - np.maximum(x0s[:, None], x0s[None, :])
+        intersect_heights = np.minimum(y1s[:, None], y1s[None, :]) - np.maximum(y0s[:, None], y0s[None, :])
+        overlapping = (intersect_widths > 0) & (intersect_heights > 0)
+
+        intersect_sizes = np.where(overlapping, intersect_widths * intersect_heights, 0.0)
+        sizes = (y1s - y0s) * (x1s - x0s)
+        union_sizes = sizes[:, None] + sizes[None, :] - intersect_sizes
+
+        return np.divide(intersect_sizes, union_sizes, out=np.zeros_like(intersect_sizes), where=overlapping)
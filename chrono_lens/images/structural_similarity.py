@@ -0,0 +1,103 @@
+import cv2
+import numpy as np
+from skimage.metrics import structural_similarity
+
+"""
+Structural similarity (SSIM) backends used by StaticObjectFilter to compare the current image against the previous
+and next images.
+
+Each backend first prepares an image (once) and then compares prepared images; the current image is compared twice,
+so anything derived from it alone is only computed once.
+
+"skimage" is the reference implementation (`skimage.metrics.structural_similarity`, with its default 7x7 uniform
+window and sample covariance). "opencv" reproduces the same calculation with `cv2.boxFilter` on float32 images,
+precomputing each image's local mean and mean of squares so only the cross term is filtered per comparison. On the
+time series test images, its SSIM image differs from skimage by less than OPENCV_SSIM_IMAGE_TOLERANCE per pixel and
+its mean SSIM score by less than OPENCV_SSIM_SCORE_TOLERANCE.
+"""
+OPENCV_SSIM_IMAGE_TOLERANCE = 1e-4
+OPENCV_SSIM_SCORE_TOLERANCE = 1e-6
+
+_WINDOW_SIZE = 7
+_K1 = 0.01
+_K2 = 0.03
+_DATA_RANGE = 255  # greyscale images are uint8
+
+# Moments are calculated on images offset to be centred on zero, which reduces float32 cancellation error when
+# variances are calculated as E[x^2] - E[x]^2
+_CENTRE_OFFSET = 128
+
+
+class SkimageStructuralSimilarity:
+    @staticmethod
+    def prepare(image_greyscale):
+        return image_greyscale
+
+    @staticmethod
+    def compare(prepared_image_0, prepared_image_1):
+        """
+        :param prepared_image_0: image as returned by `prepare`
+        :param prepared_image_1: image as returned by `prepare`
+        :return: tuple of mean SSIM score and SSIM image (same shape as the images)
+        """
+        return structural_similarity(prepared_image_0, prepared_image_1, full=True)
+
+
+class _ImageMoments:
+    def __init__(self, centred_image, centred_mean, centred_mean_of_squares):
+        self.centred_image = centred_image
+        self.centred_mean = centred_mean
+        self.centred_mean_of_squares = centred_mean_of_squares
+
+
+class OpenCVStructuralSimilarity:
+    @staticmethod
+    def _uniform_filter(image):
+        # BORDER_REFLECT matches the "reflect" mode of scipy.ndimage.uniform_filter, as used by skimage
+        return cv2.boxFilter(image, ddepth=-1, ksize=(_WINDOW_SIZE, _WINDOW_SIZE), normalize=True,
+                             borderType=cv2.BORDER_REFLECT)
+
+    @classmethod
+    def prepare(cls, image_greyscale):
+        centred_image = image_greyscale.astype(np.float32) - _CENTRE_OFFSET
+        return _ImageMoments(centred_image, cls._uniform_filter(centred_image),
+                             cls._uniform_filter(centred_image * centred_image))
+
+    @classmethod
+    def compare(cls, prepared_image_0, prepared_image_1):
+        """
+        :param prepared_image_0: `_ImageMoments` as returned by `prepare`
+        :param prepared_image_1: `_ImageMoments` as returned by `prepare`
+        :return: tuple of mean SSIM score and SSIM image (same shape as the images, float32)
+        """
+        covariance_normalisation = _WINDOW_SIZE ** 2 / (_WINDOW_SIZE ** 2 - 1)  # sample covariance, as skimage
+        c1 = (_K1 * _DATA_RANGE) ** 2
+        c2 = (_K2 * _DATA_RANGE) ** 2
+
+        centred_mean_0 = prepared_image_0.centred_mean
+        centred_mean_1 = prepared_image_1.centred_mean
+
+        # (Co)variances are unaffected by the offset; means are restored for the luminance term
+        centred_mean_of_products = cls._uniform_filter(prepared_image_0.centred_image * prepared_image_1.centred_image)
+        covariance = covariance_normalisation * (centred_mean_of_products - centred_mean_0 * centred_mean_1)
+        variance_sum = covariance_normalisation * (
+                prepared_image_0.centred_mean_of_squares - centred_mean_0 * centred_mean_0 +
+                prepared_image_1.centred_mean_of_squares - centred_mean_1 * centred_mean_1)
+
+        mean_0 = centred_mean_0 + _CENTRE_OFFSET
+        mean_1 = centred_mean_1 + _CENTRE_OFFSET
+
+        ssim_image = ((2 * mean_0 * mean_1 + c1) * (2 * covariance + c2)) / \
+                     ((mean_0 * mean_0 + mean_1 * mean_1 + c1) * (variance_sum + c2))
+
+        # As skimage, ignore the filter radius strip around the edges when averaging
+        pad = (_WINDOW_SIZE - 1) // 2
+        ssim_score = ssim_image[pad:-pad, pad:-pad].mean(dtype=np.float64)
+
+        return ssim_score, ssim_image
+
+
+STRUCTURAL_SIMILARITY_BACKENDS = {
+    'skimage': SkimageStructuralSimilarity,
+    'opencv': OpenCVStructuralSimilarity
+}
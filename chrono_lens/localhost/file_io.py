@@ -1,8 +1,12 @@
 import json
+import os
 
 import cv2
 import numpy
 
+from chrono_lens.images.download_records import identical_image_marker_name, identical_image_date_time_of
+from chrono_lens.images.image_frame import ImageFrame
+
 
 def load_from_json(json_file_name):
     with open(json_file_name, 'r') as json_file:
@@ -32,27 +36,65 @@ def load_binary_image(image_file_name):
     return image
 
 
-def load_bgr_image_as_rgb(image_file_name):
-    image_bgr = load_binary_image(image_file_name)
-    if image_bgr is None:
+def load_image_frame(image_file_name, greyscale_decoding=False, initial_reduction=1):
+    """
+    :param image_file_name: name of the (JPEG) image file
+    :param greyscale_decoding: if True, decode straight to greyscale (see `ImageFrame.decode`)
+    :param initial_reduction: size reduction at which the image is first decoded (see `ImageFrame.decode`)
+    :return: `ImageFrame`, empty if the image could not be decoded; None if the file is missing
+    """
+    try:
+        raw_image = load_from_binary(image_file_name)
+    except FileNotFoundError:
         return None
 
-    if image_bgr.shape[0] == 0:
-        return image_bgr
+    return ImageFrame.decode(raw_image, greyscale_decoding, initial_reduction)
 
-    image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
-    return image_rgb
+
+def load_identical_image_date_time(image_file_name):
+    """
+    :param image_file_name: name of the (JPEG) image file
+    :return: datetime of the slot holding the image, if an identical image marker is stored in place of the image
+        (see `chrono_lens.images.download_records`); otherwise None
+    """
+    try:
+        with open(identical_image_marker_name(image_file_name), 'r') as marker_file:
+            return identical_image_date_time_of(marker_file.read())
+    except FileNotFoundError:
+        return None
 
 
-def load_bgr_image_as_rgb_if_not_already_loaded(image_rgb, image_file_name):
-    if image_rgb is not None:
-        return image_rgb
+def image_file_name_from_fields(download_path, image_source, image_date_time, camera_id):
+    return os.path.join(download_path, image_source, f"{image_date_time:%Y%m%d}", f"{image_date_time:%H%M}",
+                        f"{camera_id}.jpg")
+
+
+class FileImageStore:
+    """
+    Image store (see `chrono_lens.images.pipeline`) of images downloaded to `download_path`, in the folders
+    "source/YYYYMMDD/HHMM/camera_id.jpg".
+    """
+
+    def __init__(self, download_path):
+        self.download_path = download_path
+
+    def load_image_frame(self, image_source, image_date_time, camera_id, greyscale_decoding=False,
+                         initial_reduction=1):
+        return load_image_frame(image_file_name_from_fields(self.download_path, image_source, image_date_time,
+                                                            camera_id), greyscale_decoding, initial_reduction)
+
+    def load_identical_image_date_time(self, image_source, image_date_time, camera_id):
+        return load_identical_image_date_time(image_file_name_from_fields(self.download_path, image_source,
+                                                                          image_date_time, camera_id))
 
-    image_rgb = load_bgr_image_as_rgb(image_file_name)
-    if image_rgb is None:
-        return None
 
-    if image_rgb.shape[0] == 0:
+def load_bgr_image_as_rgb(image_file_name):
+    image_bgr = load_binary_image(image_file_name)
+    if image_bgr is None:
         return None
 
+    if image_bgr.shape[0] == 0:
+        return image_bgr
+
+    image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
     return image_rgb
@@ -1,26 +1,101 @@
+import asyncio
 import glob
+import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from random import uniform
 from time import sleep
 from urllib.parse import urlparse
 
+import aiohttp
 import requests
 from tqdm import tqdm
 
 import chrono_lens.localhost
 from chrono_lens.images.correction import resize_jpeg_image, IMAGE_MAX_AXIS_THRESHOLD
+from chrono_lens.images.download_records import conditional_request_headers, is_identical_to_previous, \
+    create_download_record, create_identical_image_marker, identical_image_marker_name, \
+    previous_download_record_if_adjacent
 from chrono_lens.localhost.file_io import load_from_json
 
+"""
+Download records of the latest download of each URL (see `chrono_lens.images.download_records`), stored in the
+download folder, so the next download of an unchanged image can be skipped.
+"""
+DOWNLOAD_INDEX_FILE_NAME = 'download_index.json'
 
-def download_image_to_disc(image_url, target_file_name, maximum_number_of_download_attempts):
+
+def _download_retry_sleep_duration():
+    return (chrono_lens.localhost.DOWNLOAD_RETRY_SLEEP_MINIMUM
+            + uniform(1,
+                      chrono_lens.localhost.DOWNLOAD_RETRY_SLEEP_MAXIMUM
+                      - chrono_lens.localhost.DOWNLOAD_RETRY_SLEEP_MINIMUM))
+
+
+def _log_failed_download(image_url, status_code):
+    if status_code == 404:
+        logging.warning(f'Failed to access URL="{image_url}" with error code #404 (file not found)')
+    else:
+        logging.error(f'Failed to access URL="{image_url}" with error code #{status_code}')
+
+
+def _store_downloaded_image(image_url, status_code, content, response_headers, target_file_name, date_time,
+                            previous_download_record):
+    if is_identical_to_previous(status_code, content, previous_download_record):
+        logging.debug(f'Image at URL="{image_url}" identical to previous image; recording in place of image')
+        download_record = create_download_record(date_time, response_headers,
+                                                 previous_download_record=previous_download_record)
+        with open(identical_image_marker_name(target_file_name), 'w') as marker_file:
+            marker_file.write(create_identical_image_marker(download_record))
+        return download_record
+
+    if status_code != 200:
+        _log_failed_download(image_url, status_code)
+        return None
+
+    resized_jpeg_image = resize_jpeg_image(content, IMAGE_MAX_AXIS_THRESHOLD)
+
+    if resized_jpeg_image is None:
+        logging.error(f'Failed to decode URL="{image_url}"  - empty bitmap generated')
+        return None
+
+    with open(target_file_name, 'wb') as binary_image_file:
+        binary_image_file.write(resized_jpeg_image)
+
+    # Left by an earlier download of the same slot
+    try:
+        os.remove(identical_image_marker_name(target_file_name))
+    except FileNotFoundError:
+        pass
+
+    if date_time is None:
+        return None
+
+    return create_download_record(date_time, response_headers, content)
+
+
+def download_image_to_disc(image_url, target_file_name, maximum_number_of_download_attempts, date_time=None,
+                           previous_download_record=None):
+    """
+    Downloads the image, resizing it (see `resize_jpeg_image`) and saving it to `target_file_name`; if the image is
+    identical to the previous slot's, an identical image marker is saved instead (see
+    `chrono_lens.images.download_records`).
+
+    :param image_url: URL of the (JPEG) image
+    :param target_file_name: file name to save the image to
+    :param maximum_number_of_download_attempts: maximum number of attempts to download the image
+    :param date_time: time slot being downloaded; if None, no download record is returned
+    :param previous_download_record: download record of the previous slot, or None
+    :return: download record of this slot, or None if the image was not saved
+    """
     response = None
     for attempt_number in range(maximum_number_of_download_attempts):
         try:
-            response = requests.get(image_url)
+            response = requests.get(image_url, headers=conditional_request_headers(previous_download_record))
 
-            if response.status_code == 200 or response.status_code == 404:
+            if response.status_code in (200, 304, 404):
                 break
 
             logging.debug(
@@ -31,30 +106,116 @@ def download_image_to_disc(image_url, target_file_name, maximum_number_of_downlo
 
         # No need to wait after the last attempt, we've given up now - so don't waste compute cycles
         if attempt_number < maximum_number_of_download_attempts - 1:
-            sleep(chrono_lens.localhost.DOWNLOAD_RETRY_SLEEP_MINIMUM
-                  + uniform(1,
-                            chrono_lens.localhost.DOWNLOAD_RETRY_SLEEP_MAXIMUM
-                            - chrono_lens.localhost.DOWNLOAD_RETRY_SLEEP_MINIMUM))
+            sleep(_download_retry_sleep_duration())
 
-    if response.status_code == 404:
-        logging.warning(f'Failed to access URL="{image_url}" with error code #404 (file not found)')
-        return
+    return _store_downloaded_image(image_url, response.status_code, response.content, response.headers,
+                                   target_file_name, date_time, previous_download_record)
 
-    elif response.status_code != 200:
-        logging.error(f'Failed to access URL="{image_url}" with error code #{response.status_code}')
-        return
 
-    resized_jpeg_image = resize_jpeg_image(response.content, IMAGE_MAX_AXIS_THRESHOLD)
+async def _download_image_to_disc_async(image_url, target_file_name, maximum_number_of_download_attempts, date_time,
+                                        previous_download_record, session, download_semaphore, resize_executor):
+    logging.debug(f'Downloading {image_url} to {target_file_name}')
+    request_headers = conditional_request_headers(previous_download_record)
+    status_code = None
+    response_headers = None
+    jpeg_raw_data = None
+    for attempt_number in range(maximum_number_of_download_attempts):
+        try:
+            # Only hold a download slot whilst downloading, so images waiting to retry don't hold up the others
+            async with download_semaphore:
+                async with session.get(image_url, headers=request_headers) as response:
+                    status_code = response.status
+                    response_headers = response.headers.copy()
+                    if status_code == 200:
+                        jpeg_raw_data = await response.read()
 
-    if resized_jpeg_image is None:
-        logging.error(f'Failed to decode URL="{image_url}"  - empty bitmap generated')
+            if status_code in (200, 304, 404):
+                break
 
-    else:
-        with open(target_file_name, 'wb') as binary_image_file:
-            binary_image_file.write(resized_jpeg_image)
+            logging.debug(f'Failed attempt#{attempt_number}: code={status_code} with URL="{image_url}";')
 
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ce:
+            logging.debug(f'Failed attempt#{attempt_number}: session.get errored with "{ce}"')
+
+        # No need to wait after the last attempt, we've given up now - so don't waste compute cycles
+        if attempt_number < maximum_number_of_download_attempts - 1:
+            await asyncio.sleep(_download_retry_sleep_duration())
+
+    if status_code is None:
+        logging.error(f'Failed to access URL="{image_url}" after {maximum_number_of_download_attempts} attempts')
+        return image_url, None
+
+    # Decoding and resizing is CPU bound, so is kept off the event loop to not stall the other downloads
+    download_record = await asyncio.get_running_loop().run_in_executor(
+        resize_executor, _store_downloaded_image, image_url, status_code, jpeg_raw_data, response_headers,
+        target_file_name, date_time, previous_download_record)
+    return image_url, download_record
+
+
+async def _download_images_to_disc_async(downloads, maximum_number_of_download_attempts, concurrency, date_time):
+    download_semaphore = asyncio.Semaphore(concurrency)
+    # Connections are kept alive and reused per host, rather than reconnecting for each image
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency)
+
+    download_records = {}
+    with ThreadPoolExecutor() as resize_executor:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            image_downloads = [
+                _download_image_to_disc_async(image_url, target_file_name, maximum_number_of_download_attempts,
+                                              date_time, previous_download_record, session, download_semaphore,
+                                              resize_executor)
+                for image_url, target_file_name, previous_download_record in downloads
+            ]
+
+            for image_download in tqdm(asyncio.as_completed(image_downloads), total=len(image_downloads),
+                                       desc='Downloading images', unit='images'):
+                image_url, download_record = await image_download
+                download_records[image_url] = download_record
+
+    return download_records
+
+
+def download_images_to_disc_concurrently(downloads, maximum_number_of_download_attempts, concurrency,
+                                         date_time=None):
+    """
+    Downloads images as `download_image_to_disc`, but with up to `concurrency` downloads in flight at once over
+    re-used connections; retries wait without holding up other downloads.
+
+    :param downloads: list of (image URL, file name to save the image to, download record of the previous slot or
+        None) tuples
+    :param maximum_number_of_download_attempts: maximum number of attempts to download each image
+    :param concurrency: maximum number of images downloaded at the same time
+    :param date_time: time slot being downloaded; if None, no download records are returned
+    :return: dictionary of image URL to its download record, or None if the image was not saved
+    """
+    return asyncio.run(_download_images_to_disc_async(downloads, maximum_number_of_download_attempts, concurrency,
+                                                      date_time))
+
+
+def load_download_index(download_index_file_name):
+    """
+    :param download_index_file_name: JSON file of image URL to its latest download record
+    :return: dictionary of image URL to its latest download record; empty if the file is missing or unreadable
+    """
+    try:
+        return load_from_json(download_index_file_name)
+    except FileNotFoundError:
+        return {}
+    except ValueError as ve:
+        logging.warning(f'Ignoring unreadable download index "{download_index_file_name}": {ve}')
+        return {}
+
+
+def save_download_index(download_index_file_name, download_index):
+    with open(download_index_file_name, 'w') as download_index_file:
+        json.dump(download_index, download_index_file)
+
+
+def download_all_images(config_folder_name, download_folder_name, maximum_number_of_download_attempts,
+                        concurrency=chrono_lens.localhost.DEFAULT_DOWNLOAD_CONCURRENCY):
+    if concurrency < 1:
+        raise ValueError(f'Download concurrency must be at least 1; {concurrency} requested')
 
-def download_all_images(config_folder_name, download_folder_name, maximum_number_of_download_attempts):
     now = datetime.now()
     now = now - timedelta(minutes=now.minute % 10, seconds=now.second, microseconds=now.microsecond)
     date_time_folder = os.path.join(f'{now:%Y%m%d}', f'{now:%H%M}')
@@ -81,12 +242,11 @@ def download_all_images(config_folder_name, download_folder_name, maximum_number
     logging.info(f'...search in folder {sources_folder_name} for JSON files complete;'
                  f' read in {number_of_urls_read} image URLs across {number_of_files_read} files.')
 
-    destination_folder_message = os.path.join(download_folder_name, "IMAGE_PROVIDER", date_time_folder, "...")
-    logging.info(f'Downloading images to {destination_folder_message}')
-    for image_tuple_to_download in tqdm(images_tuples_to_download, desc='Downloading images', unit='images'):
-        base_name = image_tuple_to_download[0]
-        image_url = image_tuple_to_download[1]
+    download_index_file_name = os.path.join(download_folder_name, DOWNLOAD_INDEX_FILE_NAME)
+    download_index = load_download_index(download_index_file_name)
 
+    downloads = []
+    for base_name, image_url in images_tuples_to_download:
         parsed_file_url = urlparse(image_url)
         base_file_name = os.path.basename(parsed_file_url.path[1:])
         base_file_name_no_extension = os.path.splitext(base_file_name)[0]
@@ -94,7 +254,30 @@ def download_all_images(config_folder_name, download_folder_name, maximum_number
         os.makedirs(target_folder_name, exist_ok=True)
         target_file_name = os.path.join(target_folder_name, base_file_name_no_extension + '.jpg')
 
-        logging.debug(f'Downloading {image_url} to {target_file_name}')
-        download_image_to_disc(image_url, target_file_name, maximum_number_of_download_attempts)
+        previous_download_record = previous_download_record_if_adjacent(download_index.get(image_url), now)
+        downloads.append((image_url, target_file_name, previous_download_record))
+
+    destination_folder_message = os.path.join(download_folder_name, "IMAGE_PROVIDER", date_time_folder, "...")
+    logging.info(f'Downloading images to {destination_folder_message}')
+    if concurrency > 1:
+        download_records = download_images_to_disc_concurrently(downloads, maximum_number_of_download_attempts,
+                                                                concurrency, now)
+
+    else:
+        download_records = {}
+        for image_url, target_file_name, previous_download_record in tqdm(downloads, desc='Downloading images',
+                                                                          unit='images'):
+            logging.debug(f'Downloading {image_url} to {target_file_name}')
+            download_records[image_url] = download_image_to_disc(
+                image_url, target_file_name, maximum_number_of_download_attempts, now, previous_download_record)
+
+    # Only this slot's records are of use to the next download
+    save_download_index(download_index_file_name,
+                        {image_url: download_record for image_url, download_record in download_records.items()
+                         if download_record is not None})
 
-    logging.info(f'...downloaded {len(images_tuples_to_download)} images to {destination_folder_message}')
+    number_of_identical_images = sum(
+        1 for download_record in download_records.values()
+        if download_record is not None and download_record['image_date_time'] != download_record['date_time'])
+    logging.info(f'...downloaded {len(images_tuples_to_download)} images to {destination_folder_message}'
+                 f' ({number_of_identical_images} identical to previous images)')
@@ -3,6 +3,7 @@
 import csv
 import glob
 import logging
+import multiprocessing
 import os
 import pathlib
 from collections import defaultdict
@@ -13,11 +14,10 @@ import cv2
 from dateutil import rrule
 from tqdm import tqdm
 
-from chrono_lens.images.fault_detection import FaultyImageDetector
+from chrono_lens.images.image_cache import ImageCache
 from chrono_lens.images.newcastle_detector import NewcastleDetector
-from chrono_lens.images.static_filter import StaticObjectFilter
-from chrono_lens.localhost.file_io import load_from_json, load_from_binary, load_bgr_image_as_rgb, \
-    load_bgr_image_as_rgb_if_not_already_loaded
+from chrono_lens.images.pipeline import CountingPipeline, ModelStages
+from chrono_lens.localhost.file_io import load_from_json, load_from_binary, load_bgr_image_as_rgb, FileImageStore
 
 
 def discover_cameras(config_path):
@@ -42,148 +42,31 @@ def discover_cameras(config_path):
     return camera_tuples_to_process
 
 
-def generate_counts(base_name, sample_date_time, camera_name, download_path,
-                    pre_filter_tuples, model_tuple, post_filter_tuples):
-    sample_image_file_name = os.path.join(download_path, base_name, f"{sample_date_time:%Y%m%d}",
-                                          f"{sample_date_time:%H%M}", f"{camera_name}.jpg")
-
-    previous_date_time = sample_date_time + timedelta(minutes=-10)
-    previous_image_file_name = os.path.join(download_path, base_name, f"{previous_date_time:%Y%m%d}",
-                                            f"{previous_date_time:%H%M}", f"{camera_name}.jpg")
-
-    next_date_time = sample_date_time + timedelta(minutes=+10)
-    next_image_file_name = os.path.join(download_path, base_name, f"{next_date_time:%Y%m%d}",
-                                        f"{next_date_time:%H%M}", f"{camera_name}.jpg")
-
-    image_rgb = load_bgr_image_as_rgb(sample_image_file_name)
-    missing_image = image_rgb is None
-
-    previous_comparable = True
-    next_comparable = True
-
-    current_faulty = False
-    if not missing_image:
-        current_faulty = image_rgb.shape[0] == 0
-
-    previous_image_rgb = None
-    next_image_rgb = None
-
-    for pre_filter_tuple in pre_filter_tuples:
-        if not missing_image and not current_faulty:
-            faulty_image_filter = pre_filter_tuple[1]
-
-            previous_image_rgb = load_bgr_image_as_rgb_if_not_already_loaded(
-                previous_image_rgb, previous_image_file_name)
-
-            next_image_rgb = load_bgr_image_as_rgb_if_not_already_loaded(
-                next_image_rgb, next_image_file_name)
-
-            previous_comparable, current_faulty, next_comparable = \
-                faulty_image_filter.check_current_faulty_and_next_previous_comparable(
-                    previous_image_rgb, image_rgb, next_image_rgb)
-
-    # Now we have a detector, we can create our "schema"
-    # Ensure all object types are initialised to 0 - so if not present, we still report
-    object_detector = model_tuple[1]
-
-    object_results = {object_type: 0 for object_type in object_detector.detected_object_types()}
-    object_results['faulty'] = current_faulty
-    object_results['missing'] = missing_image
-
-    if not current_faulty and not missing_image:
-        detected_objects = object_detector.detect(image_rgb)
-
-        for post_filter_tuple in post_filter_tuples:
-            static_object_filter = post_filter_tuple[1]
-
-            previous_image_rgb = load_bgr_image_as_rgb_if_not_already_loaded(
-                previous_image_rgb, previous_image_file_name)
-
-            next_image_rgb = load_bgr_image_as_rgb_if_not_already_loaded(
-                next_image_rgb, next_image_file_name)
-
-            detected_objects = static_object_filter.filter_static_objects(
-                detected_objects, previous_image_rgb, image_rgb, next_image_rgb,
-                previous_comparable, next_comparable)
-
-        if detected_objects is None:
-            object_results['faulty'] = True
-        else:
-            for detected_object in detected_objects:
-                label = detected_object[0].lower().strip()
-                object_results[label] += 1
-
-    return object_results
-
-
 def load_models(model_blob_name, config_path):
-    pre_filter_tuples = []
-    post_filter_tuples = []
-
-    model_stages = model_blob_name.split('_')
-
-    object_detector_model_stage_index = 0
+    """
+    :return: `ModelStages` of the model, with stage configurations read from the "models" folder of `config_path`
+    """
+    return ModelStages.from_model_name(model_blob_name, partial(load_stage_configuration, config_path),
+                                       partial(load_detection_model, config_path))
 
-    for model_pre_process_index, model_pre_process_name in enumerate(model_stages):
-        if model_pre_process_name.startswith('FaultyImageFilter'):
-            model_pre_process_configuration_file_name = os.path.join(config_path, "models", model_pre_process_name,
-                                                                     "configuration.json")
 
-            model_pre_process_configuration = load_from_json(model_pre_process_configuration_file_name)
-
-            faulty_image_filter = FaultyImageDetector.from_configuration(model_pre_process_configuration)
-
-            pre_filter_tuples.append((model_pre_process_name, faulty_image_filter))
-        else:
-            # Unknown pre-process stage, assume its the main object counting model;
-            # so make a note of the stage and finish
-            object_detector_model_stage_index = model_pre_process_index
-            break
-
-    object_detector_model_stage_name = model_stages[object_detector_model_stage_index]
-
-    model_tuple = load_detection_model(config_path, object_detector_model_stage_name)
-
-    for model_post_process_name in model_stages[object_detector_model_stage_index + 1:]:
-        if model_post_process_name.startswith('StaticObjectFilter'):
-            model_post_process_configuration_file_name = os.path.join(config_path, "models", model_post_process_name,
-                                                                      "configuration.json")
-
-            model_post_process_configuration = load_from_json(model_post_process_configuration_file_name)
-
-            static_object_filter = StaticObjectFilter.from_configuration(model_post_process_configuration)
-
-            post_filter_tuples.append((model_post_process_name, static_object_filter))
-
-        else:
-            raise ValueError(f'Model post-process stage is unknown: "{model_post_process_name}"')
-
-    return pre_filter_tuples, model_tuple, post_filter_tuples
+def load_stage_configuration(config_path, model_stage_name):
+    return load_from_json(os.path.join(config_path, "models", model_stage_name, "configuration.json"))
 
 
 def load_detection_model(config_path, object_detector_model_stage_name):
-    if object_detector_model_stage_name.startswith('Newcastle'):
-
-        model_configuration_file_name = os.path.join(config_path, "models", object_detector_model_stage_name,
-                                                     "configuration.json")
-        model_configuration = load_from_json(model_configuration_file_name)
+    if not object_detector_model_stage_name.startswith('Newcastle'):
+        raise ValueError(
+            f'Model object detector stage is unknown: "{object_detector_model_stage_name}"')
 
-        serialized_graph_file_name = os.path.join(config_path, "models", object_detector_model_stage_name,
-                                                  model_configuration["serialized_graph_name"])
+    model_configuration = load_stage_configuration(config_path, object_detector_model_stage_name)
 
-        serialized_graph = load_from_binary(serialized_graph_file_name)
-        minimum_confidence = model_configuration["minimum_confidence"]
+    serialized_graph_file_name = os.path.join(config_path, "models", object_detector_model_stage_name,
+                                              model_configuration["serialized_graph_name"])
 
-        object_detector = NewcastleDetector(serialized_graph=serialized_graph,
-                                            minimum_confidence=minimum_confidence)
+    serialized_graph = load_from_binary(serialized_graph_file_name)
 
-        model_tuple = (object_detector_model_stage_name, object_detector)
-
-    else:
-        raise ValueError(
-            f'Model object detector stage is unknown: "{object_detector_model_stage_name}"')
-
-    return model_tuple
+    return NewcastleDetector.from_configuration(model_configuration, serialized_graph)
 
 
 def process_scheduled(config_path, download_path, counts_path):
@@ -205,12 +88,11 @@ def process_scheduled(config_path, download_path, counts_path):
     camera_tuples_to_process = discover_cameras(config_path)
 
     logging.info('Loading models...')
-    pre_filter_tuples, model_tuple, post_filter_tuples = load_models(model_configuration["model_blob_name"],
-                                                                     config_path)
+    model_stages = load_models(model_configuration["model_blob_name"], config_path)
     logging.info('...loaded models')
 
     logging.info('Preparing CSV...')
-    object_count_keys = model_tuple[1].detected_object_types() + ['faulty', 'missing']
+    object_count_keys = model_stages.detected_object_types() + ['faulty', 'missing']
     sorted_object_count_keys = sorted(object_count_keys)
     column_names = ['date', 'time', 'supplier', 'camera_id'] + sorted_object_count_keys
 
@@ -227,6 +109,10 @@ def process_scheduled(config_path, download_path, counts_path):
 
     logging.info('...prepared CSV')
 
+    # Nothing is retained between cameras, so the cache only sets how images are decoded
+    image_cache = ImageCache(maximum_bytes=0, greyscale_decoding=model_configuration.get('greyscale_decoding', False))
+    counting_pipeline = CountingPipeline(model_stages, FileImageStore(download_path), image_cache)
+
     logging.info("Processing images...")
     with open(csv_file_name, 'a') as csv_file:
         writer = csv.writer(csv_file)
@@ -235,8 +121,7 @@ def process_scheduled(config_path, download_path, counts_path):
             base_name = image_tuple_to_download[0]
             camera_name = image_tuple_to_download[1]
 
-            object_counts = generate_counts(base_name, twenty_minutes_ago, camera_name, download_path,
-                                            pre_filter_tuples, model_tuple, post_filter_tuples)
+            object_counts = counting_pipeline.count_objects(base_name, twenty_minutes_ago, camera_name)
 
             field_values = [f"{twenty_minutes_ago:%Y%m%d}", f"{twenty_minutes_ago:%H%M}", base_name, camera_name]
             field_values += [object_counts[key] for key in sorted_object_count_keys]
@@ -245,7 +130,15 @@ def process_scheduled(config_path, download_path, counts_path):
     logging.info("...processed images.")
 
 
-def batch_process(config_path, download_path, counts_path, start_date, end_date):
+def batch_process(config_path, download_path, counts_path, start_date, end_date, camera_major=False, workers=1):
+    """
+    Processes all configured cameras over the given date range, generating a CSV file per day.
+
+    :param camera_major: if True, each camera's day of images is processed in time order (so each image is read
+        and decoded once) rather than processing every camera for each time slot in turn; CSV output is unchanged
+    :param workers: number of processes to share cameras across, each loading its own copy of the models;
+        if more than 1, cameras are always processed camera-major. CSV output is unchanged
+    """
     os.makedirs(counts_path, exist_ok=True)
 
     model_configuration_file_name = os.path.join(config_path, 'analyse-configuration.json')
@@ -255,16 +148,50 @@ def batch_process(config_path, download_path, counts_path, start_date, end_date)
 
     camera_tuples_to_process = discover_cameras(config_path)
 
-    logging.info('Loading models...')
-    pre_filter_tuples, model_tuple, post_filter_tuples = load_models(model_configuration["model_blob_name"],
-                                                                     config_path)
-    logging.info('...loaded models')
+    greyscale_decoding = model_configuration.get('greyscale_decoding', False)
+    detection_batch_size = model_configuration.get('detection_batch_size', 1)
+
+    worker_pool = None
+    if workers > 1:
+        logging.info(f'Starting {workers} workers and loading models...')
+        worker_pool = create_worker_pool(workers, model_configuration["model_blob_name"], config_path,
+                                         greyscale_decoding)
+        detected_object_types = worker_pool.apply(detected_object_types_in_worker)
+        logging.info('...started workers and loaded models')
+
+        try:
+            batch_process_days(counts_path, start_date, end_date, model_configuration, camera_tuples_to_process,
+                               detected_object_types,
+                               partial(process_day_with_workers, download_path=download_path,
+                                       detection_batch_size=detection_batch_size, worker_pool=worker_pool))
+        finally:
+            worker_pool.close()
+            worker_pool.join()
+
+    else:
+        logging.info('Loading models...')
+        model_stages = load_models(model_configuration["model_blob_name"], config_path)
+        logging.info('...loaded models')
+
+        # Detection is only batched camera-major, as time-major processing counts images individually
+        counting_pipeline = CountingPipeline(model_stages, FileImageStore(download_path),
+                                             ImageCache(greyscale_decoding=greyscale_decoding),
+                                             detection_batch_size)
+
+        process_day = process_day_camera_major if camera_major else process_day_time_major
+
+        batch_process_days(counts_path, start_date, end_date, model_configuration, camera_tuples_to_process,
+                           model_stages.detected_object_types(),
+                           partial(process_day, counting_pipeline=counting_pipeline))
 
+
+def batch_process_days(counts_path, start_date, end_date, model_configuration, camera_tuples_to_process,
+                       detected_object_types, process_day):
     dates_to_process = list(rrule.rrule(rrule.DAILY, dtstart=start_date, until=end_date))
     for image_date in tqdm(dates_to_process, desc='Processing images per day', unit='days'):
 
         logging.debug('Preparing CSV...')
-        object_count_keys = sorted(model_tuple[1].detected_object_types()) + ['faulty', 'missing']
+        object_count_keys = sorted(detected_object_types) + ['faulty', 'missing']
         sorted_object_count_keys = sorted(object_count_keys)
         column_names = ['date', 'time', 'supplier', 'camera_id'] + sorted_object_count_keys
 
@@ -303,37 +230,172 @@ def batch_process(config_path, download_path, counts_path, start_date, end_date)
 
         logging.debug('...prepared CSV')
 
+        datetimes_to_process = list(rrule.rrule(rrule.MINUTELY, interval=10, dtstart=image_date,
+                                                until=image_date + timedelta(hours=23, minutes=50)))
+
         with open(csv_file_name, 'a') as csv_file:
             writer = csv.writer(csv_file)
 
-            datetimes_to_process = list(rrule.rrule(rrule.MINUTELY, interval=10, dtstart=image_date,
-                                                    until=image_date + timedelta(hours=23, minutes=50)))
+            process_day(datetimes_to_process=datetimes_to_process, camera_tuples_to_process=camera_tuples_to_process,
+                        cameras_per_time_per_provider=cameras_per_time_per_provider,
+                        sorted_object_count_keys=sorted_object_count_keys, writer=writer)
+
+
+def process_day_time_major(datetimes_to_process, camera_tuples_to_process, cameras_per_time_per_provider,
+                           counting_pipeline, sorted_object_count_keys, writer):
+    """
+    Processes a day of images one time slot at a time, processing every camera for each time slot; rows are
+    written as they are generated.
+    """
+    for image_datetime in datetimes_to_process:
+
+        for image_tuple_to_download in tqdm(camera_tuples_to_process,
+                                            f'Processing images for {image_datetime:%Y%m%d %H%M}',
+                                            unit='images', leave=False):
+
+            base_name = image_tuple_to_download[0]
+            camera_name = image_tuple_to_download[1]
+
+            if camera_name in cameras_per_time_per_provider[base_name][f'{image_datetime:%H%M}']:
+                # Already present, so skip - don't reprocess & create a duplicate
+                continue
+
+            object_counts = counting_pipeline.count_objects(base_name, image_datetime, camera_name)
+
+            field_values = [f"{image_datetime:%Y%m%d}", f"{image_datetime:%H%M}", base_name, camera_name]
+            field_values += [object_counts[key] for key in sorted_object_count_keys]
+            writer.writerow(field_values)
+
+
+def process_day_camera_major(datetimes_to_process, camera_tuples_to_process, cameras_per_time_per_provider,
+                             counting_pipeline, sorted_object_count_keys, writer):
+    """
+    Processes a day of images one camera at a time, walking each camera's images in time order. Images are held in
+    the pipeline's image cache as a sliding window of previous, current and next image, so each image is read and
+    decoded once.
+
+    Rows are buffered and written once the day is complete, in the same (time, then camera) order as
+    `process_day_time_major`, so the CSV output is identical.
+    """
+    field_values_per_time_and_camera = {}
+
+    for camera_index, image_tuple_to_download in enumerate(tqdm(camera_tuples_to_process,
+                                                                'Processing cameras', unit='cameras', leave=False)):
+        base_name = image_tuple_to_download[0]
+        camera_name = image_tuple_to_download[1]
+
+        for time_index, field_values in process_camera_day(
+                base_name, camera_name, datetimes_to_process,
+                processed_times_of_camera(cameras_per_time_per_provider[base_name], camera_name),
+                counting_pipeline, sorted_object_count_keys):
+            field_values_per_time_and_camera[(time_index, camera_index)] = field_values
+
+    write_rows_in_time_major_order(field_values_per_time_and_camera, writer)
+
+
+def processed_times_of_camera(cameras_per_time, camera_name):
+    """
+    :param cameras_per_time: dictionary of time ("HHMM") to the cameras already processed at that time
+    :return: set of times ("HHMM") at which `camera_name` has already been processed
+    """
+    return {image_time for image_time, cameras in cameras_per_time.items() if camera_name in cameras}
+
+
+def process_camera_day(base_name, camera_name, datetimes_to_process, processed_times, counting_pipeline,
+                       sorted_object_count_keys):
+    """
+    Processes a single camera's images in time order, skipping times where the camera has already been processed.
+
+    :param processed_times: times ("HHMM") at which the camera has already been processed, as returned by
+        `processed_times_of_camera`
+    :return: list of (index into `datetimes_to_process`, CSV field values) tuples
+    """
+    # Already present times are skipped - don't reprocess & create a duplicate
+    time_indices_to_process = [time_index for time_index, image_datetime in enumerate(datetimes_to_process)
+                               if f'{image_datetime:%H%M}' not in processed_times]
+
+    object_counts_per_time = counting_pipeline.count_objects_in_batch(
+        [(base_name, datetimes_to_process[time_index], camera_name) for time_index in time_indices_to_process])
+
+    time_indexed_field_values = []
+    for time_index, object_counts in zip(time_indices_to_process, object_counts_per_time):
+        image_datetime = datetimes_to_process[time_index]
+        field_values = [f"{image_datetime:%Y%m%d}", f"{image_datetime:%H%M}", base_name, camera_name]
+        field_values += [object_counts[key] for key in sorted_object_count_keys]
+        time_indexed_field_values.append((time_index, field_values))
+
+    # Current and next images of the last slot are not needed by the next camera
+    counting_pipeline.image_cache.clear()
+
+    return time_indexed_field_values
+
+
+def write_rows_in_time_major_order(field_values_per_time_and_camera, writer):
+    for time_and_camera in sorted(field_values_per_time_and_camera):
+        writer.writerow(field_values_per_time_and_camera[time_and_camera])
+
+
+def process_day_with_workers(datetimes_to_process, camera_tuples_to_process, cameras_per_time_per_provider,
+                             download_path, detection_batch_size, sorted_object_count_keys, worker_pool, writer):
+    """
+    As `process_day_camera_major`, but with cameras shared out across the processes in `worker_pool` (created with
+    `create_worker_pool`); each camera is processed by a single worker, so no rows are duplicated.
+    """
+    # Only the camera's own processed times are sent, rather than those of every camera of its provider
+    worker_tasks = [
+        (camera_index, base_name, camera_name, datetimes_to_process,
+         processed_times_of_camera(cameras_per_time_per_provider[base_name], camera_name), download_path,
+         detection_batch_size, sorted_object_count_keys)
+        for camera_index, (base_name, camera_name) in enumerate(camera_tuples_to_process)
+    ]
+
+    field_values_per_time_and_camera = {}
+    for camera_index, time_indexed_field_values in tqdm(
+            worker_pool.imap_unordered(process_camera_day_in_worker, worker_tasks),
+            'Processing cameras', total=len(worker_tasks), unit='cameras', leave=False):
+        for time_index, field_values in time_indexed_field_values:
+            field_values_per_time_and_camera[(time_index, camera_index)] = field_values
+
+    write_rows_in_time_major_order(field_values_per_time_and_camera, writer)
+
+
+# Models loaded by each worker process, so they are loaded once per worker rather than once per task
+worker_model_stages = None
+worker_greyscale_decoding = False
+
+
+def create_worker_pool(number_of_workers, model_blob_name, config_path, greyscale_decoding=False):
+    # TensorFlow is not fork-safe, so workers are started afresh
+    return multiprocessing.get_context('spawn').Pool(
+        number_of_workers, initializer=initialise_worker, initargs=(model_blob_name, config_path, greyscale_decoding))
+
+
+def initialise_worker(model_blob_name, config_path, greyscale_decoding=False):
+    global worker_model_stages, worker_greyscale_decoding
+    worker_model_stages = load_models(model_blob_name, config_path)
+    worker_greyscale_decoding = greyscale_decoding
 
-            for image_datetime in datetimes_to_process:
 
-                for image_tuple_to_download in tqdm(camera_tuples_to_process,
-                                                    f'Processing images for {image_datetime:%Y%m%d %H%M}',
-                                                    unit='images', leave=False):
+def detected_object_types_in_worker():
+    return worker_model_stages.detected_object_types()
 
-                    base_name = image_tuple_to_download[0]
-                    camera_name = image_tuple_to_download[1]
 
-                    if camera_name in cameras_per_time_per_provider[base_name][f'{image_datetime:%H%M}']:
-                        # Already present, so skip - don't reprocess & create a duplicate
-                        continue
+def process_camera_day_in_worker(worker_task):
+    camera_index, base_name, camera_name, datetimes_to_process, processed_times, download_path, \
+        detection_batch_size, sorted_object_count_keys = worker_task
+    counting_pipeline = CountingPipeline(worker_model_stages, FileImageStore(download_path),
+                                         ImageCache(greyscale_decoding=worker_greyscale_decoding), detection_batch_size)
 
-                    object_counts = generate_counts(base_name, image_datetime, camera_name, download_path,
-                                                    pre_filter_tuples, model_tuple, post_filter_tuples)
+    time_indexed_field_values = process_camera_day(base_name, camera_name, datetimes_to_process, processed_times,
+                                                   counting_pipeline, sorted_object_count_keys)
 
-                    field_values = [f"{image_datetime:%Y%m%d}", f"{image_datetime:%H%M}", base_name, camera_name]
-                    field_values += [object_counts[key] for key in sorted_object_count_keys]
-                    writer.writerow(field_values)
+    return camera_index, time_indexed_field_values
 
 
 def markup_image_with_detected_objects(image_filename, model_name, config_folder_path, output_folder):
     image_rgb = load_bgr_image_as_rgb(image_filename)
 
-    _, object_detector = load_detection_model(config_folder_path, model_name)
+    object_detector = load_detection_model(config_folder_path, model_name)
 
     detected_objects = object_detector.detect(image_rgb)
 
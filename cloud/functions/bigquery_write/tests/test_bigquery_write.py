@@ -244,6 +244,53 @@ class TestBigQueryWrite(TestCase):
             # Remove table if it exists, ensure we tidy up after ourselves and don't leave detritus...
             self.remove_table(model_blob_name)
 
+    @skipIf(os.environ.get("HOME", "") == "/builder/home",
+            "Skipping on google cloud as tests are unreliable with BigQuery showing inconsistent results due to delays")
+    @skipIf(os.environ.get('BUILD_ID') == 'Travis',
+            "Can't test BigQuery integration from Travis, only from within GCP - skipping")
+    def test_list_of_rows_adds_rows(self):
+
+        model_blob_name = 'test_list_of_rows_adds_rows'
+        expected_source = 'someplace'
+        expected_date = datetime.date.today()
+        expected_time = datetime.time(4, 5)
+        expected_camera_ids = ['example_camera1', 'example_camera2']
+        mock_request = create_mock_request({
+            'model_blob_name': model_blob_name,
+            'rows': [
+                {
+                    'image_blob_name': f'{expected_source}/{expected_date:%Y%m%d}/{expected_time:%H%M}/{camera_id}.jpg',
+                    'model_results_json': f'{{ "person": {person_count}, "car": 0 }}'
+                }
+                for person_count, camera_id in enumerate(expected_camera_ids)
+            ]
+        })
+
+        # Remove table if it exists, so we won't get a collision from a previous test
+        self.remove_table(model_blob_name)
+        try:
+            result = bigquery_write(mock_request)
+            self.assertEqual('{"STATUS": "Processed"}', result)
+
+            sleep(15)
+
+            table_id = self.make_table_id(model_blob_name)
+            query_results = self.bigquery_client.query(
+                f"SELECT * FROM `{table_id}` WHERE date='{expected_date:%Y-%m-%d}' ORDER BY camera_id").result()
+
+            rows = list(query_results)
+
+            self.assertEqual(2, len(rows))
+            for person_count, camera_id in enumerate(expected_camera_ids):
+                self.assertEqual(expected_source, rows[person_count]['source'])
+                self.assertEqual(camera_id, rows[person_count]['camera_id'])
+                self.assertEqual(expected_time, rows[person_count]['time'])
+                self.assertEqual(person_count, rows[person_count]['person'])
+
+        finally:
+            # Remove table if it exists, ensure we tidy up after ourselves and don't leave detritus...
+            self.remove_table(model_blob_name)
+
     @skipIf(os.environ.get('BUILD_ID') == 'Travis',
             "Can't test BigQuery integration from Travis, only from within GCP - skipping")
     def test_table_name_is_model_name_with_non_alphanumeric_replaced_with_underscores(self):
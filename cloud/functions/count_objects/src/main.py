@@ -1,18 +1,17 @@
-import datetime
 import json
+import logging
 import os
+import tempfile
 
 import google.cloud.storage
 from opentelemetry import trace
 
-from chrono_lens.gcloud.call_handling import extract_request_field, extract_fields_from_image_blob, \
-    image_blob_name_from_fields
+from chrono_lens.gcloud.call_handling import extract_request_field
 from chrono_lens.gcloud.error_handling import report_exception
-from chrono_lens.gcloud.image_loader import load_bgr_image_from_blob_as_rgb
 from chrono_lens.gcloud.logging import setup_logging_and_trace
-from chrono_lens.images.fault_detection import FaultyImageDetector
-from chrono_lens.images.newcastle_detector import NewcastleDetector
-from chrono_lens.images.static_filter import StaticObjectFilter
+from chrono_lens.gcloud.object_counting import ObjectCounter, DEFAULT_CLOUD_IMAGE_CACHE_MAXIMUM_BYTES
+from chrono_lens.images.detector_cache import DetectorCache, DEFAULT_MAXIMUM_CACHED_DETECTORS
+from chrono_lens.images.image_cache import ImageCache
 
 """
 Example JSON call:
@@ -35,15 +34,25 @@ Example JSON call:
 
 setup_logging_and_trace()
 
-# Objects we can reuse between calls
-object_detector = None
-object_detector_model_name = None
+# Objects we can reuse between calls; detectors are retained per model, so requests alternating between models
+# (e.g. backfill and scheduled processing) do not rebuild them each time
+detector_cache = DetectorCache(
+    maximum_detectors=int(os.environ.get('MAXIMUM_CACHED_DETECTORS', DEFAULT_MAXIMUM_CACHED_DETECTORS)))
 
-static_object_filter = None
-static_object_filter_name = None
+# Serialized graphs are kept on local disc (in-memory on Cloud Functions) so a detector evicted from the cache can be
+# rebuilt without downloading its graph again; set to empty to disable
+model_cache_folder = os.environ.get('MODEL_CACHE_FOLDER', os.path.join(tempfile.gettempdir(), 'models')) or None
 
-faulty_image_filter = None
-faulty_image_filter_name = None
+# Decoded images (and their features) are reused between calls, as each image is requested as "next", "current"
+# and "previous" image in turn; images can be decoded straight to greyscale, which is faster when they are only
+# used for comparison by StaticObjectFilter (no FaultyImageFilter stage). Requests for a single image never discard
+# from the cache, so a warm instance fills it - it shares the function's memory with the detectors
+image_cache = ImageCache(
+    maximum_bytes=int(os.environ.get('IMAGE_CACHE_MAXIMUM_BYTES', DEFAULT_CLOUD_IMAGE_CACHE_MAXIMUM_BYTES)),
+    greyscale_decoding=os.environ.get('GREYSCALE_DECODING', 'false').lower() == 'true')
+
+# Holds the filters of every model stage requested (only a few numeric settings each), alongside the caches above
+object_counter = ObjectCounter(detector_cache, image_cache, model_cache_folder)
 
 # Use same google client each time - save boot-up overhead per call
 client = google.cloud.storage.Client()
@@ -60,6 +69,16 @@ try:
 except google.cloud.exceptions.NotFound:
     model_bucket = None
 
+# Comma separated list of object detection model stages, e.g. "NewcastleV0"
+warm_up_model_stage_names = os.environ.get('WARM_UP_MODEL_STAGE_NAMES')
+if warm_up_model_stage_names and model_bucket is not None:
+    try:
+        object_counter.warm_up_detectors(
+            [model_stage_name.strip() for model_stage_name in warm_up_model_stage_names.split(',')], model_bucket)
+    except Exception:
+        # Not fatal: the detector is created when first requested, reporting any error then
+        logging.exception(f'Failed to warm up detectors "{warm_up_model_stage_names}"')
+
 
 def count_objects(request):
     """Responds to any HTTP request.
@@ -94,135 +113,7 @@ def count_objects(request):
             image_blob_name = extract_request_field(request, 'image_blob_name')
             model_blob_name = extract_request_field(request, 'model_blob_name')
 
-            image_source, current_date_time, camera_id = extract_fields_from_image_blob(image_blob_name)
-
-            previous_date_time = current_date_time + datetime.timedelta(minutes=-10)
-            previous_image_blob_name = image_blob_name_from_fields(image_source, previous_date_time, camera_id)
-
-            next_date_time = current_date_time + datetime.timedelta(minutes=+10)
-            next_image_blob_name = image_blob_name_from_fields(image_source, next_date_time, camera_id)
-
-            with tracer.start_as_current_span("Loading current image from blob"):
-                image_rgb = load_bgr_image_from_blob_as_rgb(image_blob_name, data_bucket)
-                missing_image = image_rgb is None
-
-            previous_comparable = True
-            next_comparable = True
-
-            current_faulty = False
-            if not missing_image:
-                current_faulty = image_rgb.shape[0] == 0
-
-            previous_image_rgb = None
-            next_image_rgb = None
-
-            global object_detector, object_detector_model_name
-            global static_object_filter, static_object_filter_name
-            global faulty_image_filter, faulty_image_filter_name
-
-            model_stages = model_blob_name.split('_')
-
-            object_detector_model_stage_index = 0
-
-            with tracer.start_as_current_span("Pre-processing filter"):
-                for model_pre_process_index, model_pre_process_name in enumerate(model_stages):
-                    if model_pre_process_name.startswith('FaultyImageFilter'):
-                        if faulty_image_filter_name != model_pre_process_name:
-                            model_pre_process_configuration_blob = model_bucket.blob(
-                                model_pre_process_name + '/configuration.json')
-                            model_pre_process_configuration = json.loads(
-                                model_pre_process_configuration_blob.download_as_string())
-                            faulty_image_filter = FaultyImageDetector.from_configuration(
-                                model_pre_process_configuration)
-                            faulty_image_filter_name = model_pre_process_name
-
-                        if not missing_image and not current_faulty:
-                            with tracer.start_as_current_span("Loading previous image from blob"):
-                                previous_image_rgb = load_bgr_image_from_blob_as_rgb_if_not_already_loaded(
-                                    previous_image_rgb, previous_image_blob_name, data_bucket)
-
-                            with tracer.start_as_current_span("Loading next image from blob"):
-                                next_image_rgb = load_bgr_image_from_blob_as_rgb_if_not_already_loaded(
-                                    next_image_rgb, next_image_blob_name, data_bucket)
-
-                            previous_comparable, current_faulty, next_comparable = \
-                                faulty_image_filter.check_current_faulty_and_next_previous_comparable(
-                                    previous_image_rgb, image_rgb, next_image_rgb)
-                    else:
-                        object_detector_model_stage_index = model_pre_process_index
-                        break
-
-            object_detector_model_stage_name = model_stages[object_detector_model_stage_index]
-
-            with tracer.start_as_current_span("Initiating detector"):
-                if object_detector_model_name != object_detector_model_stage_name:
-                    if object_detector_model_stage_name.startswith('Newcastle'):
-
-                        if object_detector is not None:
-                            object_detector.close()
-
-                        model_configuration_blob = model_bucket.blob(
-                            object_detector_model_stage_name + '/configuration.json')
-                        model_configuration_json = model_configuration_blob.download_as_string()
-                        model_configuration = json.loads(model_configuration_json)
-                        serialized_graph_blob = model_bucket.blob(
-                            f'{object_detector_model_stage_name}/{model_configuration["serialized_graph_name"]}')
-                        with tracer.start_as_current_span("Loading model from blob"):
-                            serialized_graph = serialized_graph_blob.download_as_string()
-                        minimum_confidence = model_configuration["minimum_confidence"]
-
-                        with tracer.start_as_current_span("Constructing detector"):
-                            object_detector = NewcastleDetector(serialized_graph=serialized_graph,
-                                                                minimum_confidence=minimum_confidence)
-
-                        object_detector_model_name = object_detector_model_stage_name
-                    else:
-                        raise ValueError(
-                            f'Model object detector stage is unknown: "{object_detector_model_stage_name}"')
-
-            # Now we have a detector, we can create our "schema"
-            # Ensure all object types are initialised to 0 - so if not present, we still report
-            object_results = {object_type: 0 for object_type in object_detector.detected_object_types()}
-            object_results['faulty'] = current_faulty
-            object_results['missing'] = missing_image
-
-            if not current_faulty and not missing_image:
-                with tracer.start_as_current_span("Detecting objects"):
-                    detected_objects = object_detector.detect(image_rgb)
-
-                with tracer.start_as_current_span("`Post-processing filter"):
-                    for model_post_process_name in model_stages[object_detector_model_stage_index + 1:]:
-                        if model_post_process_name.startswith('StaticObjectFilter'):
-                            if static_object_filter_name != model_post_process_name:
-                                model_post_process_configuration_blob = model_bucket.blob(
-                                    model_post_process_name + '/configuration.json')
-                                model_post_process_configuration = json.loads(
-                                    model_post_process_configuration_blob.download_as_string())
-                                static_object_filter = StaticObjectFilter.from_configuration(
-                                    model_post_process_configuration)
-                                static_object_filter_name = model_post_process_name
-
-                            with tracer.start_as_current_span("Loading previous image from blob"):
-                                previous_image_rgb = load_bgr_image_from_blob_as_rgb_if_not_already_loaded(
-                                    previous_image_rgb, previous_image_blob_name, data_bucket)
-
-                            with tracer.start_as_current_span("Loading next image from blob"):
-                                next_image_rgb = load_bgr_image_from_blob_as_rgb_if_not_already_loaded(
-                                    next_image_rgb, next_image_blob_name, data_bucket)
-
-                            detected_objects = static_object_filter.filter_static_objects(
-                                detected_objects, previous_image_rgb, image_rgb, next_image_rgb,
-                                previous_comparable, next_comparable
-                            )
-                        else:
-                            raise ValueError(f'Model post-process stage is unknown: "{model_post_process_name}"')
-
-                if detected_objects is None:
-                    object_results['faulty'] = True
-                else:
-                    for detected_object in detected_objects:
-                        label = detected_object[0].lower().strip()
-                        object_results[label] += 1
+            object_results = object_counter.count_objects(image_blob_name, model_blob_name, data_bucket, model_bucket)
 
             return_json = {'STATUS': 'Processed', 'results': object_results}
             return json.dumps(return_json)
@@ -235,16 +126,3 @@ def count_objects(request):
                                  'model_blob_name': model_blob_name},
                                 request=request)
 
-
-def load_bgr_image_from_blob_as_rgb_if_not_already_loaded(image_rgb, image_blob_name, image_bucket):
-    if image_rgb is not None:
-        return image_rgb
-
-    image_rgb = load_bgr_image_from_blob_as_rgb(image_blob_name, image_bucket)
-    if image_rgb is None:
-        return None
-
-    if image_rgb.shape[0] == 0:
-        return None
-
-    return image_rgb
@@ -9,7 +9,8 @@ data_bucket_name = 'data_bucket'
 models_bucket_name = 'model_bucket'
 with mock.patch.dict(os.environ, {
     'DATA_BUCKET_NAME': data_bucket_name,
-    'MODELS_BUCKET_NAME': models_bucket_name
+    'MODELS_BUCKET_NAME': models_bucket_name,
+    'MODEL_CACHE_FOLDER': ''
 }):
     with mock.patch('google.cloud.storage.Client'):
         with mock.patch('chrono_lens.gcloud.logging.setup_logging_and_trace'):
@@ -23,6 +24,9 @@ def create_mock_request(request_json):
 
 
 def create_mock_bucket(bucket_blob_data_maps):
+    # Blobs not listed are missing
+    missing_blob = MagicMock()
+    missing_blob.download_as_string.side_effect = google.api_core.exceptions.NotFound('')
     blob_name_to_blob = {}
 
     for blob_name, blob_data in bucket_blob_data_maps:
@@ -35,7 +39,7 @@ def create_mock_bucket(bucket_blob_data_maps):
         blob_name_to_blob[blob_name] = mock_blob
 
     mock_bucket = MagicMock()
-    mock_bucket.blob.side_effect = blob_name_to_blob.get
+    mock_bucket.blob.side_effect = lambda blob_name: blob_name_to_blob.get(blob_name, missing_blob)
 
     return mock_bucket
 
@@ -78,6 +82,10 @@ class TestCountObjects(TestCase):
         with open(os.path.join(test_detector_folder, rcnn_serialised_model_filename), 'rb') as fp:
             cls.rcnn_serialised_model = fp.read()
 
+    def setUp(self):
+        # Decoded images are cached between calls; tests reuse blob names with different contents, so start afresh
+        main.image_cache.clear()
+
     def test_missing_image_blob_name(self):
         mock_request = create_mock_request({
         })
@@ -322,6 +330,48 @@ class TestCountObjects(TestCase):
         self.assertEqual(f'ValueError: Model post-process stage is unknown: "{fake_post_process_name}"',
                          response['Message'])
 
+    def test_alternating_models_reuse_cached_detectors(self):
+        image_blob_name = 'test/20200501/0040/small.jpg'
+
+        first_model_blob_name = 'Newcastle-alternating-0'
+        second_model_blob_name = 'Newcastle-alternating-1'
+        model_serialised_graph_name = 'magic-3.pb'
+
+        model_configuration_json = f"""
+        {{
+            "serialized_graph_name": "{model_serialised_graph_name}",
+            "minimum_confidence": 0.33
+        }}
+        """
+
+        main.data_bucket = create_mock_bucket([
+            (image_blob_name, self.raw_small_sample_image)
+        ])
+
+        main.model_bucket = create_mock_bucket([
+            (f'{first_model_blob_name}/configuration.json', model_configuration_json),
+            (f'{first_model_blob_name}/{model_serialised_graph_name}', self.rcnn_serialised_model),
+            (f'{second_model_blob_name}/configuration.json', model_configuration_json),
+            (f'{second_model_blob_name}/{model_serialised_graph_name}', self.rcnn_serialised_model)
+        ])
+
+        for model_blob_name in [first_model_blob_name, second_model_blob_name, first_model_blob_name,
+                                second_model_blob_name]:
+            mock_request = create_mock_request({
+                'image_blob_name': image_blob_name,
+                'model_blob_name': model_blob_name,
+            })
+
+            response_json = main.count_objects(mock_request)
+            response = json.loads(response_json)
+
+            self.assertEqual('Processed', response['STATUS'])
+            self.assertEqual(12, response['results']['car'])
+
+        for model_blob_name in [first_model_blob_name, second_model_blob_name]:
+            serialised_graph_blob = main.model_bucket.blob(f'{model_blob_name}/{model_serialised_graph_name}')
+            serialised_graph_blob.download_as_string.assert_called_once()
+
     def test_raises_error_on_unknown_object_detector(self):
         image_blob_name = 'test/19990101/0040/fish.jpg'
         fake_object_detector_name = 'rhubarb'
@@ -1218,3 +1268,131 @@ class TestCountObjects(TestCase):
         self.assertEqual(0, results['van'])  # correct - as faulty
         self.assertEqual(False, results['missing'])
         self.assertEqual(True, results['faulty'])  # As can't static filter, we'd better leave it to imputation
+
+    def test_preprocess_rejects_image_recorded_as_identical_to_previous_image_as_faulty(self):
+        image_blob_0040_name = 'TfL-images/20200501/0040/00001.08859.jpg'
+        image_blob_0050_name = 'TfL-images/20200501/0050/00001.08859.jpg'
+        image_blob_0100_name = 'TfL-images/20200501/0100/00001.08859.jpg'
+
+        fault_filter_blob_name = 'FaultyImageFilter-test-identical-1'
+        fault_filter_configuration_json = f"""
+        {{
+            "identical_area_proportion_threshold": 0.33,
+            "row_similarity_threshold": 0.8,
+            "consecutive_matching_rows_threshold": 0.2,
+            "stuff to ignore": "warned you"
+        }}
+        """
+
+        object_detector_blob_name = 'Newcastle-test-identical-1'
+        object_detector_serialised_graph_name = 'magic-3.pb'
+        object_detector_configuration_json = f"""
+        {{
+            "serialized_graph_name": "{object_detector_serialised_graph_name}",
+            "minimum_confidence": 0.33,
+            "stuff to ignore": "warned you"
+        }}
+        """
+
+        main.data_bucket = create_mock_bucket([
+            (image_blob_0040_name, self.raw_static_object_test_image_0040),
+            (image_blob_0050_name, None),
+            ('TfL-images/20200501/0050/00001.08859.identical.json', b'{"identical_to": "20200501 0040"}'),
+            (image_blob_0100_name, self.raw_static_object_test_image_0100)
+        ])
+
+        main.model_bucket = create_mock_bucket([
+            (f'{fault_filter_blob_name}/configuration.json', fault_filter_configuration_json),
+            (f'{object_detector_blob_name}/configuration.json', object_detector_configuration_json),
+            (f'{object_detector_blob_name}/{object_detector_serialised_graph_name}', self.rcnn_serialised_model)
+        ])
+
+        mock_request = create_mock_request({
+            'image_blob_name': image_blob_0050_name,
+            'model_blob_name': f'{fault_filter_blob_name}_{object_detector_blob_name}'
+        })
+
+        response_json = main.count_objects(mock_request)
+        response = json.loads(response_json)
+        results = response['results']
+
+        self.assertEqual(0, results['person'])
+        self.assertEqual(0, results['car'])
+        self.assertEqual(False, results['missing'])
+        self.assertEqual(True, results['faulty'])
+        # Known to be faulty, so the image recorded as identical is not loaded
+        main.data_bucket.blob(image_blob_0040_name).download_as_string.assert_not_called()
+
+    def test_preprocess_and_object_count_and_postprocess_compares_with_image_previous_image_is_identical_to(self):
+        image_blob_0030_name = 'TfL-images/20200501/0030/00001.08859.jpg'
+        image_blob_0040_name = 'TfL-images/20200501/0040/00001.08859.jpg'
+        image_blob_0050_name = 'TfL-images/20200501/0050/00001.08859.jpg'
+        image_blob_0100_name = 'TfL-images/20200501/0100/00001.08859.jpg'
+
+        fault_filter_blob_name = 'FaultyImageFilter-test-identical-2'
+        fault_filter_configuration_json = f"""
+        {{
+            "identical_area_proportion_threshold": 0.33,
+            "row_similarity_threshold": 0.8,
+            "consecutive_matching_rows_threshold": 0.2,
+            "stuff to ignore": "warned you"
+        }}
+        """
+
+        object_detector_blob_name = 'Newcastle-test-identical-2'
+        object_detector_serialised_graph_name = 'magic-3.pb'
+        object_detector_configuration_json = f"""
+        {{
+            "serialized_graph_name": "{object_detector_serialised_graph_name}",
+            "minimum_confidence": 0.33,
+            "stuff to ignore": "warned you"
+        }}
+        """
+
+        filter_blob_name = 'StaticObjectFilter-test-identical-2'
+        static_filter_configuration_json = """
+        {
+            "scenecut_threshold": 0.4,
+            "minimum_mask_proportion": 0.25,
+            "minimum_mask_proportion_person": 0.10,
+            "confidence_person": 0.80,
+            "contour_area_threshold": 50
+        }
+        """
+
+        # As test_preprocess_and_object_count_and_postprocess, with the previous image recorded as identical to
+        # the image before it
+        main.data_bucket = create_mock_bucket([
+            (image_blob_0030_name, self.raw_static_object_test_image_0040),
+            (image_blob_0040_name, None),
+            ('TfL-images/20200501/0040/00001.08859.identical.json', b'{"identical_to": "20200501 0030"}'),
+            (image_blob_0050_name, self.raw_static_object_test_image_0050),
+            (image_blob_0100_name, self.raw_static_object_test_image_0100)
+        ])
+
+        main.model_bucket = create_mock_bucket([
+            (f'{fault_filter_blob_name}/configuration.json', fault_filter_configuration_json),
+            (f'{object_detector_blob_name}/configuration.json', object_detector_configuration_json),
+            (f'{object_detector_blob_name}/{object_detector_serialised_graph_name}', self.rcnn_serialised_model),
+            (filter_blob_name + '/configuration.json', static_filter_configuration_json)
+        ])
+
+        mock_request = create_mock_request({
+            'image_blob_name': image_blob_0050_name,
+            'model_blob_name': f'{fault_filter_blob_name}_{object_detector_blob_name}_{filter_blob_name}'
+        })
+
+        response_json = main.count_objects(mock_request)
+        response = json.loads(response_json)
+        results = response['results']
+
+        # reference "TfL-images-20200501-0050-00001.08859_filtered.png"
+        self.assertEqual(1, results['person'])
+        self.assertEqual(0, results['car'])
+        self.assertEqual(0, results['truck'])
+        self.assertEqual(0, results['bus'])
+        self.assertEqual(0, results['cyclist'])
+        self.assertEqual(0, results['motorcyclist'])
+        self.assertEqual(0, results['van'])
+        self.assertEqual(False, results['missing'])
+        self.assertEqual(False, results['faulty'])
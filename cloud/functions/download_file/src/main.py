@@ -5,15 +5,20 @@ from random import uniform
 from time import sleep
 from urllib.parse import urlparse
 
+import google.api_core.exceptions
+import google.cloud.storage
 import requests
 from opentelemetry import trace
 from requests.exceptions import ConnectionError
 
-from chrono_lens.gcloud.buckets import write_to_bucket
-from chrono_lens.gcloud.call_handling import extract_request_field
+from chrono_lens.gcloud.buckets import write_to_bucket, read_blob_metadata
+from chrono_lens.gcloud.call_handling import extract_request_field, extract_fields_from_image_blob
 from chrono_lens.gcloud.error_handling import report_exception
 from chrono_lens.gcloud.logging import setup_logging_and_trace
 from chrono_lens.images.correction import resize_jpeg_image, IMAGE_MAX_AXIS_THRESHOLD
+from chrono_lens.images.download_records import SLOT_DURATION, conditional_request_headers, \
+    is_identical_to_previous, create_download_record, create_identical_image_marker, identical_image_marker_name, \
+    previous_download_record_if_adjacent
 
 #
 # Example triggering JSON:
@@ -30,6 +35,14 @@ MAXIMUM_NUMBER_OF_ATTEMPTS = 5
 SLEEP_BASE = 16
 SLEEP_TUPLE = (1, 16)
 
+# Use same google client and bucket each time - save boot-up overhead per call
+storage_client = google.cloud.storage.Client()
+data_bucket_name = os.environ.get('DATA_BUCKET_NAME')  # Built-in env var
+try:
+    data_bucket = storage_client.get_bucket(data_bucket_name)
+except google.cloud.exceptions.NotFound:
+    data_bucket = None
+
 
 def download_file(request):
     """Downloads the given file, downsamples it and stores it in the named data bucket; assumes JPEG format image
@@ -37,6 +50,11 @@ def download_file(request):
     Enforces images downsampling at source, by downloading full resolution image, downsampling it if larger than
     threshold size defined in chrono_lens.images.correction.IMAGE_MAX_AXIS_THRESHOLD
 
+    If the destination is a time slot ("source/YYYYMMDD/HHMM") and the image is identical to the previous slot's
+    (the server replies 304 to a conditional request, or the content is unchanged), an identical image marker is
+    stored in place of the image; see chrono_lens.images.download_records. Download records are stored as the blobs'
+    metadata.
+
     Args:
         request (flask.Request): HTTP request object.
     Returns:
@@ -48,11 +66,15 @@ def download_file(request):
 
     file_url = None
     destination_blob_name = None
-    data_bucket_name = None
 
     try:
         with tracer.start_as_current_span("download_file"):
-            data_bucket_name = os.environ.get('DATA_BUCKET_NAME')
+            if data_bucket_name is None:
+                raise RuntimeError('"DATA_BUCKET_NAME" not defined as an environment variable')
+
+            if data_bucket is None:
+                raise RuntimeError(f'Google bucket name "{data_bucket_name}" (used for "data_bucket_name")'
+                                   ' failed to open a bucket')
 
             file_url = extract_request_field(request, 'file_url')
             destination_blob_name = extract_request_field(request, 'destination_blob_name')
@@ -62,14 +84,27 @@ def download_file(request):
             full_blob_name = destination_blob_name + '/' + base_file_name
             logging.info(f'Downloading "{file_url}" into gs://{data_bucket_name}/{full_blob_name}')
 
+            download_date_time = None
+            previous_download_record = None
+            try:
+                image_source, download_date_time, _ = extract_fields_from_image_blob(full_blob_name)
+            except ValueError:
+                # Not stored in a time slot, so there is no previous slot to compare with
+                pass
+            else:
+                with tracer.start_as_current_span("Reading previous download record"):
+                    previous_download_record = read_previous_download_record(
+                        data_bucket, image_source, download_date_time, base_file_name)
+
             response = None
 
             with tracer.start_as_current_span("Downloading file"):
                 for attempt_number in range(MAXIMUM_NUMBER_OF_ATTEMPTS):
                     try:
-                        response = requests.get(file_url)
+                        response = requests.get(file_url,
+                                                headers=conditional_request_headers(previous_download_record))
 
-                        if response.status_code == 200 or response.status_code == 404:
+                        if response.status_code in (200, 304, 404):
                             break
 
                         logging.debug(
@@ -82,6 +117,16 @@ def download_file(request):
                     if attempt_number < MAXIMUM_NUMBER_OF_ATTEMPTS - 1:
                         sleep(SLEEP_BASE + uniform(*SLEEP_TUPLE))
 
+                if is_identical_to_previous(response.status_code, response.content, previous_download_record):
+                    logging.info(f'"{file_url}" identical to previous image; recording in place of image')
+                    download_record = create_download_record(download_date_time, response.headers,
+                                                             previous_download_record=previous_download_record)
+                    with tracer.start_as_current_span("Storing identical image marker"):
+                        write_to_bucket(data_bucket_name, identical_image_marker_name(full_blob_name),
+                                        create_identical_image_marker(download_record),
+                                        content_type='application/json', metadata=download_record)
+                    return json.dumps({'STATUS': 'OK'})
+
                 if response.status_code == 404:
                     file_missing_message = f'Failed to access URL="{file_url}" with error code #404 (file not found)'
                     logging.warning(file_missing_message)
@@ -111,7 +156,20 @@ def download_file(request):
 
             else:
                 with tracer.start_as_current_span("Storing file"):
-                    write_to_bucket(data_bucket_name, full_blob_name, resized_jpeg_image, content_type='image/jpeg')
+                    if download_date_time is None:
+                        write_to_bucket(data_bucket_name, full_blob_name, resized_jpeg_image,
+                                        content_type='image/jpeg')
+                    else:
+                        write_to_bucket(data_bucket_name, full_blob_name, resized_jpeg_image,
+                                        content_type='image/jpeg',
+                                        metadata=create_download_record(download_date_time, response.headers,
+                                                                        response.content))
+
+                        # Left by an earlier download of the same slot
+                        try:
+                            data_bucket.blob(identical_image_marker_name(full_blob_name)).delete()
+                        except google.api_core.exceptions.NotFound:
+                            pass
 
                 return json.dumps({'STATUS': 'OK'})
 
@@ -121,3 +179,21 @@ def download_file(request):
                                  'destination_blob_name': destination_blob_name,
                                  'data_bucket_name': data_bucket_name},
                                 request=request)
+
+
+def read_previous_download_record(data_bucket, image_source, date_time, base_file_name):
+    """
+    :param data_bucket: `google.cloud.storage.Bucket` holding the images
+    :return: download record of the same image in the previous time slot, stored as the metadata of its image or
+        identical image marker blob; None if there is no such record
+    """
+    previous_date_time = date_time - SLOT_DURATION
+    previous_blob_name = f'{image_source}/{previous_date_time:%Y%m%d}/{previous_date_time:%H%M}/{base_file_name}'
+
+    for blob_name in (previous_blob_name, identical_image_marker_name(previous_blob_name)):
+        download_record = read_blob_metadata(data_bucket, blob_name)
+        if download_record is not None:
+            # Images stored before download records were introduced have none
+            return previous_download_record_if_adjacent(download_record, date_time)
+
+    return None
@@ -4,10 +4,21 @@ from unittest import TestCase, mock
 
 import cv2
 import numpy as np
+from google.api_core.exceptions import NotFound
 from requests.exceptions import ConnectionError
 
-with mock.patch('chrono_lens.gcloud.logging.setup_logging_and_trace'):
-    import main
+from chrono_lens.images.download_records import content_hash_of
+
+data_bucket_name = 'mybucket'
+
+# We mock "os" and the storage client before importing "main", as the bucket is opened on import
+with mock.patch.dict(os.environ, {'DATA_BUCKET_NAME': data_bucket_name}):
+    with mock.patch('google.cloud.storage.Client') as mock_storage_client_constructor:
+        mock_storage_client = mock.MagicMock()
+        mock_storage_client_constructor.return_value = mock_storage_client
+
+        with mock.patch('chrono_lens.gcloud.logging.setup_logging_and_trace'):
+            import main
 
 mocked_requests_get_call_count = 0
 
@@ -35,9 +46,6 @@ fifth_time_lucky_otherwise_exceptions_content = valid_url_content
 
 missing_resource_url = 'http://another.site.com/missing_file.ext'
 
-data_bucket_name = 'mybucket'
-environment_variables = {'DATA_BUCKET_NAME': data_bucket_name}
-
 
 class MockResponse:
     def __init__(self, status_code, json_result, content, content_type=None):
@@ -89,12 +97,11 @@ def create_mock_request(request_json):
     return mock_request
 
 
-@mock.patch('main.os.environ.get', side_effect=environment_variables.get)
 @mock.patch('main.requests.get', side_effect=mocked_requests_get)
 @mock.patch('main.write_to_bucket')
 class TestMain(TestCase):
 
-    def test_missing_file_url_raises_error(self, _mocked_write_to_bucket, _mocked_requests_get, _mocked_os_environ_get):
+    def test_missing_file_url_raises_error(self, _mocked_write_to_bucket, _mocked_requests_get):
         mock_request = create_mock_request({})
 
         response_json = main.download_file(mock_request)
@@ -104,8 +111,7 @@ class TestMain(TestCase):
         self.assertEqual('RuntimeError: "file_url" not defined via JSON or arguments in http header',
                          response['Message'])
 
-    def test_missing_destination_blob_name_raises_error(self, _mocked_write_to_bucket, _mocked_requests_get,
-                                                        _mocked_os_environ_get):
+    def test_missing_destination_blob_name_raises_error(self, _mocked_write_to_bucket, _mocked_requests_get):
         mock_request = create_mock_request({
             'file_url': valid_url
         })
@@ -117,8 +123,7 @@ class TestMain(TestCase):
         self.assertEqual('RuntimeError: "destination_blob_name" not defined via JSON or arguments in http header',
                          response['Message'])
 
-    def test_request_succeeds_sends_to_bucket_and_reports_ok(self, mocked_write_to_bucket, _mocked_requests_get,
-                                                             _mocked_os_environ_get):
+    def test_request_succeeds_sends_to_bucket_and_reports_ok(self, mocked_write_to_bucket, _mocked_requests_get):
         mock_request = create_mock_request({
             'file_url': valid_url,
             'destination_blob_name': 'afolder'
@@ -132,7 +137,7 @@ class TestMain(TestCase):
         self.assertEqual('OK', response['STATUS'])
 
     def test_request_with_large_image_succeeds_sends_resize_image_to_bucket_and_reports_ok(
-            self, mocked_write_to_bucket, _mocked_requests_get, _mocked_os_environ_get):
+            self, mocked_write_to_bucket, _mocked_requests_get):
 
         mock_request = create_mock_request({
             'file_url': valid_url_large_image_url,
@@ -163,7 +168,7 @@ class TestMain(TestCase):
         self.assertEqual(actual_image.shape[0], int(480 / 640 * image_max_axis_threshold))
 
     def test_request_succeeds_with_url_ending_in_jpg_ignores_content_type_sends_to_bucket_as_jpeg_and_reports_ok(
-            self, mocked_write_to_bucket, local_mocked_requests_get, _mocked_os_environ_get):
+            self, mocked_write_to_bucket, local_mocked_requests_get):
         mock_request = create_mock_request({
             'file_url': 'http://site.com/some/file.jpg',
             'destination_blob_name': 'afolder'
@@ -181,8 +186,7 @@ class TestMain(TestCase):
         self.assertEqual('OK', response['STATUS'])
 
     def test_request_succeeds_with_content_type_sends_to_bucket_and_reports_ok(self, mocked_write_to_bucket,
-                                                                               mocked_requests_get,
-                                                                               _mocked_os_environ_get):
+                                                                               mocked_requests_get):
         mock_request = create_mock_request({
             'file_url': valid_url,
             'destination_blob_name': 'afolder'
@@ -201,8 +205,7 @@ class TestMain(TestCase):
     @mock.patch('main.sleep')
     def test_request_fails_retries_4_times_with_sleep_and_reports_error_but_does_not_use_bucket(self, mocked_sleep,
                                                                                                 mocked_write_to_bucket,
-                                                                                                _mocked_requests_get,
-                                                                                                _mocked_os_environ_get):
+                                                                                                _mocked_requests_get):
         mock_request = create_mock_request({
             'file_url': 'http://site.com/some/missing-file.ext',
             'destination_blob_name': 'afolder'
@@ -221,8 +224,7 @@ class TestMain(TestCase):
     @mock.patch('main.sleep')
     def test_request_fails_with_missing_file_reports_error_but_does_not_use_bucket_or_retry(self, mocked_sleep,
                                                                                             mocked_write_to_bucket,
-                                                                                            _mocked_requests_get,
-                                                                                            _mocked_os_environ_get):
+                                                                                            _mocked_requests_get):
         mock_request = create_mock_request({
             'file_url': missing_resource_url,
             'destination_blob_name': 'afolder'
@@ -243,8 +245,7 @@ class TestMain(TestCase):
     def test_request_succeeds_but_faulty_file_reports_error_but_does_not_use_bucket_or_retry(self, mocked_warning,
                                                                                              mocked_sleep,
                                                                                              mocked_write_to_bucket,
-                                                                                             _mocked_requests_get,
-                                                                                             _mocked_os_environ_get):
+                                                                                             _mocked_requests_get):
         mock_request = create_mock_request({
             'file_url': valid_url_broken_image_url,
             'destination_blob_name': 'afolder'
@@ -265,8 +266,7 @@ class TestMain(TestCase):
     @mock.patch('main.sleep')
     def test_request_succeeds_on_fifth_attempt_sends_to_bucket_and_reports_ok(self, mocked_sleep,
                                                                                mocked_write_to_bucket,
-                                                                               _mocked_requests_get,
-                                                                               _mocked_os_environ_get):
+                                                                               _mocked_requests_get):
         mock_request = create_mock_request({
             'file_url': fifth_time_lucky_url,
             'destination_blob_name': 'afolder'
@@ -285,7 +285,7 @@ class TestMain(TestCase):
 
     @mock.patch('main.sleep')
     def test_request_succeeds_on_fifth_attempt_after_exceptions_raised_sends_to_bucket_and_reports_ok(
-            self, mocked_sleep, mocked_write_to_bucket, _mocked_requests_get, _mocked_os_environ_get):
+            self, mocked_sleep, mocked_write_to_bucket, _mocked_requests_get):
         mock_request = create_mock_request({
             'file_url': fifth_time_lucky_otherwise_exceptions_url,
             'destination_blob_name': 'somefolder'
@@ -302,3 +302,150 @@ class TestMain(TestCase):
         self.assertEqual(4, mocked_sleep.call_count)
         self.assertEqual(5, mocked_requests_get_call_count)
         self.assertEqual('OK', response['STATUS'])
+
+
+@mock.patch('main.requests.get')
+@mock.patch('main.write_to_bucket')
+@mock.patch('main.read_blob_metadata')
+class TestIdenticalImages(TestCase):
+
+    def test_image_without_previous_download_record_stored_with_download_record(
+            self, mocked_read_blob_metadata, mocked_write_to_bucket, mocked_requests_get):
+        mocked_read_blob_metadata.return_value = None
+        mocked_requests_get.return_value = MockResponse(200, 'image', valid_url_content)
+        mock_request = create_mock_request({
+            'file_url': valid_url,
+            'destination_blob_name': 'TfL-images/20200501/0050'
+        })
+
+        response = json.loads(main.download_file(mock_request))
+
+        self.assertEqual('OK', response['STATUS'])
+        mocked_requests_get.assert_called_once_with(valid_url, headers={})
+        mocked_write_to_bucket.assert_called_once_with(
+            data_bucket_name, 'TfL-images/20200501/0050/file.ext', valid_url_content, content_type='image/jpeg',
+            metadata={'content_hash': content_hash_of(valid_url_content), 'image_date_time': '20200501 0050',
+                      'date_time': '20200501 0050'})
+        mocked_read_blob_metadata.assert_any_call(main.data_bucket, 'TfL-images/20200501/0040/file.ext')
+        mocked_read_blob_metadata.assert_any_call(main.data_bucket, 'TfL-images/20200501/0040/file.identical.json')
+
+    def test_not_modified_image_recorded_as_identical_to_previous_image(
+            self, mocked_read_blob_metadata, mocked_write_to_bucket, mocked_requests_get):
+        mocked_read_blob_metadata.return_value = {
+            'content_hash': content_hash_of(valid_url_content), 'image_date_time': '20200501 0030',
+            'date_time': '20200501 0040', 'etag': '"abc"', 'last_modified': 'Fri, 01 May 2020 00:30:00 GMT'}
+        mocked_requests_get.return_value = MockResponse(304, None, b'')
+        mock_request = create_mock_request({
+            'file_url': valid_url,
+            'destination_blob_name': 'TfL-images/20200501/0050'
+        })
+
+        response = json.loads(main.download_file(mock_request))
+
+        self.assertEqual('OK', response['STATUS'])
+        mocked_requests_get.assert_called_once_with(
+            valid_url, headers={'If-None-Match': '"abc"', 'If-Modified-Since': 'Fri, 01 May 2020 00:30:00 GMT'})
+        expected_download_record = {
+            'content_hash': content_hash_of(valid_url_content), 'image_date_time': '20200501 0030',
+            'date_time': '20200501 0050', 'etag': '"abc"', 'last_modified': 'Fri, 01 May 2020 00:30:00 GMT'}
+        mocked_write_to_bucket.assert_called_once_with(
+            data_bucket_name, 'TfL-images/20200501/0050/file.identical.json', '{"identical_to": "20200501 0030"}',
+            content_type='application/json', metadata=expected_download_record)
+
+    def test_unchanged_image_recorded_as_identical_to_previous_image(
+            self, mocked_read_blob_metadata, mocked_write_to_bucket, mocked_requests_get):
+        mocked_read_blob_metadata.return_value = {
+            'content_hash': content_hash_of(valid_url_content), 'image_date_time': '20200501 0040',
+            'date_time': '20200501 0040'}
+        mocked_requests_get.return_value = MockResponse(200, 'image', valid_url_content)
+        mock_request = create_mock_request({
+            'file_url': valid_url,
+            'destination_blob_name': 'TfL-images/20200501/0050'
+        })
+
+        response = json.loads(main.download_file(mock_request))
+
+        self.assertEqual('OK', response['STATUS'])
+        mocked_write_to_bucket.assert_called_once_with(
+            data_bucket_name, 'TfL-images/20200501/0050/file.identical.json', '{"identical_to": "20200501 0040"}',
+            content_type='application/json',
+            metadata={'content_hash': content_hash_of(valid_url_content), 'image_date_time': '20200501 0040',
+                      'date_time': '20200501 0050'})
+
+    def test_download_record_of_earlier_slot_ignored(
+            self, mocked_read_blob_metadata, mocked_write_to_bucket, mocked_requests_get):
+        mocked_read_blob_metadata.return_value = {
+            'content_hash': content_hash_of(valid_url_content), 'image_date_time': '20200501 0030',
+            'date_time': '20200501 0030', 'etag': '"abc"'}
+        mocked_requests_get.return_value = MockResponse(200, 'image', valid_url_content)
+        mock_request = create_mock_request({
+            'file_url': valid_url,
+            'destination_blob_name': 'TfL-images/20200501/0050'
+        })
+
+        response = json.loads(main.download_file(mock_request))
+
+        self.assertEqual('OK', response['STATUS'])
+        mocked_requests_get.assert_called_once_with(valid_url, headers={})
+        (_, actual_blob_name, actual_data), _ = mocked_write_to_bucket.call_args
+        self.assertEqual('TfL-images/20200501/0050/file.ext', actual_blob_name)
+        self.assertEqual(valid_url_content, actual_data)
+
+
+@mock.patch('main.requests.get')
+@mock.patch('main.write_to_bucket')
+class TestPreviousDownloadRecordReads(TestCase):
+
+    def setUp(self):
+        mock_storage_client.reset_mock()
+        main.data_bucket.reset_mock(return_value=True)
+
+    def test_missing_previous_image_read_as_two_blob_lookups_on_open_bucket(self, _mocked_write_to_bucket,
+                                                                            mocked_requests_get):
+        main.data_bucket.get_blob.return_value = None
+        mocked_requests_get.return_value = MockResponse(200, 'image', valid_url_content)
+
+        response = json.loads(main.download_file(create_mock_request({
+            'file_url': valid_url,
+            'destination_blob_name': 'TfL-images/20200501/0050'
+        })))
+
+        self.assertEqual('OK', response['STATUS'])
+        self.assertEqual([mock.call.get_blob('TfL-images/20200501/0040/file.ext'),
+                          mock.call.get_blob('TfL-images/20200501/0040/file.identical.json'),
+                          mock.call.blob('TfL-images/20200501/0050/file.identical.json'),
+                          mock.call.blob().delete()],
+                         main.data_bucket.mock_calls)
+        self.assertEqual([], mock_storage_client.method_calls)
+
+    def test_previous_image_read_as_one_blob_lookup(self, _mocked_write_to_bucket, mocked_requests_get):
+        main.data_bucket.get_blob.return_value = mock.MagicMock(metadata={
+            'content_hash': 'different', 'image_date_time': '20200501 0040', 'date_time': '20200501 0040'})
+        mocked_requests_get.return_value = MockResponse(200, 'image', valid_url_content)
+
+        response = json.loads(main.download_file(create_mock_request({
+            'file_url': valid_url,
+            'destination_blob_name': 'TfL-images/20200501/0050'
+        })))
+
+        self.assertEqual('OK', response['STATUS'])
+        self.assertEqual([mock.call.get_blob('TfL-images/20200501/0040/file.ext'),
+                          mock.call.blob('TfL-images/20200501/0050/file.identical.json'),
+                          mock.call.blob().delete()],
+                         main.data_bucket.mock_calls)
+
+    def test_identical_image_marker_of_earlier_download_removed_when_image_stored(self, _mocked_write_to_bucket,
+                                                                                 mocked_requests_get):
+        main.data_bucket.get_blob.return_value = None
+        main.data_bucket.blob.return_value.delete.side_effect = NotFound('no marker')
+        mocked_requests_get.return_value = MockResponse(200, 'image', valid_url_content)
+
+        response = json.loads(main.download_file(create_mock_request({
+            'file_url': valid_url,
+            'destination_blob_name': 'TfL-images/20200501/0050'
+        })))
+
+        # Missing marker (the usual case) is not an error
+        self.assertEqual('OK', response['STATUS'])
+        main.data_bucket.blob.assert_called_once_with('TfL-images/20200501/0050/file.identical.json')
+        main.data_bucket.blob.return_value.delete.assert_called_once_with()
@@ -2,15 +2,17 @@ import datetime
 import json
 import logging
 import os
+import tempfile
 from typing import List
 
+import google.api_core.exceptions
 import google.cloud.storage
 from dateutil.rrule import rrule, MINUTELY
 from google.cloud import bigquery
 from opentelemetry import trace
 
 from chrono_lens.gcloud.async_functions import run_cloud_function_async_with_parameter_list
-from chrono_lens.gcloud.bigquery import convert_model_name_to_table_name
+from chrono_lens.gcloud.bigquery import BufferedBigQueryWriter, convert_model_name_to_table_name, shared_table_cache
 from chrono_lens.gcloud.call_handling import extract_request_field
 from chrono_lens.gcloud.error_handling import report_exception
 from chrono_lens.gcloud.logging import setup_logging_and_trace
@@ -44,6 +46,23 @@ try:
 except google.cloud.exceptions.NotFound:
     data_bucket = None
 
+# If "true", the camera's day is processed within this function - its images downloaded together, counted in time
+# order so each is decoded once, and all results inserted into BigQuery at once - rather than calling
+# run_model_on_image per image; this needs the requirements (TensorFlow etc.) and memory of count_objects
+count_objects_in_process = os.environ.get('COUNT_OBJECTS_IN_PROCESS', 'false').lower() == 'true'
+if count_objects_in_process:
+    # Only imported when needed, as object counting depends on TensorFlow
+    from chrono_lens.gcloud.object_counting import ObjectCounter, status_of_object_results
+
+    # Reused between calls, as in count_objects
+    object_counter = ObjectCounter(
+        model_cache_folder=os.environ.get('MODEL_CACHE_FOLDER', os.path.join(tempfile.gettempdir(), 'models')) or None)
+    model_bucket = storage_client.bucket(os.environ.get('MODELS_BUCKET_NAME'))  # Built-in env var
+
+    # Number of images passed to the object detector together; 1 to detect objects an image at a time
+    detection_batch_size = int(os.environ.get('DETECTION_BATCH_SIZE', '1'))
+    logging.info('Counting objects in process')
+
 
 def process_day(request):
     """Responds to any HTTP request.
@@ -118,22 +137,13 @@ def process_day(request):
             }
 
             if len(data_urls) > 0:
-                with tracer.start_as_current_span('CF call: run_model_on_image'):
-                    asyncio_results = run_cloud_function_async_with_parameter_list(
-                        'data_blob_name', data_urls,
-                        {'model_blob_name': model_blob_name},
-                        run_model_on_image_endpoint)
-
-                    for result, data_url in zip(asyncio_results, data_urls):
-                        result_type = result['STATUS']
-                        results['Counts'][result_type] = results['Counts'].get(result_type, 0) + 1
+                if count_objects_in_process:
+                    statuses = count_and_write_in_process(data_urls, model_blob_name)
+                else:
+                    statuses = count_and_write_via_cloud_functions(data_urls, model_blob_name)
 
-                        if result['STATUS'] == 'Errored':
-                            logging.critical(f'Incomplete execution - possible outage; "{data_url}" result: {result}')
-
-                        elif result['STATUS'] not in ['Processed', 'Faulty', 'Missing']:
-                            logging.error(f'Unexpected STATUS type: "{result["STATUS"]}"')
-                            logging.info(f'Full received result: "{result}"')
+                for status in statuses:
+                    results['Counts'][status] = results['Counts'].get(status, 0) + 1
 
             return json.dumps(results)
 
@@ -146,16 +156,65 @@ def process_day(request):
                                 request=request)
 
 
+def count_and_write_via_cloud_functions(data_urls, model_blob_name):
+    """
+    :return: list of the "STATUS" reported by run_model_on_image for each image, in order of `data_urls`
+    """
+    tracer = trace.get_tracer(__name__)
+
+    with tracer.start_as_current_span('CF call: run_model_on_image'):
+        asyncio_results = run_cloud_function_async_with_parameter_list(
+            'data_blob_name', data_urls,
+            {'model_blob_name': model_blob_name},
+            run_model_on_image_endpoint)
+
+    statuses = []
+    for result, data_url in zip(asyncio_results, data_urls):
+        statuses.append(result['STATUS'])
+
+        if result['STATUS'] == 'Errored':
+            logging.critical(f'Incomplete execution - possible outage; "{data_url}" result: {result}')
+
+        elif result['STATUS'] not in ['Processed', 'Faulty', 'Missing']:
+            logging.error(f'Unexpected STATUS type: "{result["STATUS"]}"')
+            logging.info(f'Full received result: "{result}"')
+
+    return statuses
+
+
+def count_and_write_in_process(data_urls, model_blob_name):
+    """
+    :return: list of the status of each image - "Faulty", "Missing" or "Processed" - in order of `data_urls`
+    """
+    tracer = trace.get_tracer(__name__)
+
+    with tracer.start_as_current_span('Counting objects'):
+        object_results_per_image = object_counter.count_objects_in_batch(
+            data_urls, model_blob_name, data_bucket, model_bucket, detection_batch_size)
+
+    # Sized so the whole day is inserted at once
+    bigquery_writer = BufferedBigQueryWriter(bigquery_client, gcp_project, DATASET_NAME,
+                                             maximum_buffered_rows=len(data_urls))
+    for data_url, object_results in zip(data_urls, object_results_per_image):
+        bigquery_writer.add_model_results(model_blob_name, data_url, object_results)
+
+    with tracer.start_as_current_span('Writing to BigQuery'):
+        errors = bigquery_writer.flush()
+
+    if errors:
+        raise RuntimeError(f'BigQuery insert reported errors: {errors}')
+
+    return [status_of_object_results(object_results) for object_results in object_results_per_image]
+
+
 def identify_processed_times(model_blob_name: str, date_to_process: datetime, camera_id: str,
                              data_root: str) -> List[str]:
     model_name = convert_model_name_to_table_name(model_blob_name)
+    table_id = ".".join([gcp_project, DATASET_NAME, model_name])
 
-    table_names_list = [table_obj.table_id for table_obj in bigquery_client.list_tables(DATASET_NAME)]
-    if model_name not in table_names_list:
+    if shared_table_cache.get_table(bigquery_client, table_id) is None:
         return []
 
-    table_id = ".".join([gcp_project, DATASET_NAME, model_name])
-
     query = f"""
         SELECT time
         FROM `{table_id}`
@@ -163,9 +222,14 @@ def identify_processed_times(model_blob_name: str, date_to_process: datetime, ca
             AND camera_id="{camera_id}"
             AND date="{date_to_process:%Y-%m-%d}"
     """
-    query_job = bigquery_client.query(query)  # Make an API request.
+    try:
+        query_job = bigquery_client.query(query)  # Make an API request.
 
-    rows = query_job.result()
+        rows = query_job.result()
+    except google.api_core.exceptions.NotFound:
+        # Table deleted since it was cached
+        shared_table_cache.invalidate(table_id)
+        return []
     logging.debug(f'Processed {query_job.total_bytes_processed} bytes')
 
     processed_times = []
@@ -4,6 +4,10 @@ import os
 from unittest import TestCase, mock
 from unittest.mock import MagicMock
 
+from google.api_core.exceptions import NotFound
+
+from chrono_lens.gcloud.bigquery import shared_table_cache
+
 function_region = 'somewhere-safe'
 gcp_project = 'our-project'
 data_bucket_name = 'dummy-data-bucket'
@@ -23,7 +27,8 @@ with mock.patch.dict(os.environ, {
             mock_storage_client_constructor.return_value = mock_storage_client
 
             with mock.patch('chrono_lens.gcloud.logging.setup_logging_and_trace'):
-                from main import process_day
+                import main
+                from main import process_day, identify_processed_times
 
 
 """
@@ -250,7 +255,7 @@ class TestProcessDay(TestCase):
             {'time': expected_preprocessed_time}
         ]
 
-        mock_big_query_client.list_tables.return_value = [mock_table]
+        mock_big_query_client.get_table.return_value = mock_table
         mock_big_query_client.query.return_value = mock_query_job
 
         mock_storage_client.list_blobs.return_value = [expected_data_source]
@@ -316,7 +321,7 @@ class TestProcessDay(TestCase):
             {'time': expected_preprocessed_time}
         ]
 
-        mock_big_query_client.list_tables.return_value = [mock_table]
+        mock_big_query_client.get_table.return_value = mock_table
         mock_big_query_client.query.return_value = mock_query_job
 
         mock_storage_client.list_blobs.return_value = [expected_data_source]
@@ -362,3 +367,113 @@ class TestProcessDay(TestCase):
                                               ' \'TextResponse\': \'\','
                                               ' \'JsonResponse\': \'\'}')
         mock_logging.error.assert_any_call('Unexpected STATUS type: "uh oh how weird"')
+
+
+# Object counting of the in-process mode is only imported when enabled (as it needs TensorFlow), so is mocked
+@mock.patch('main.run_cloud_function_async_with_parameter_list')
+@mock.patch.multiple('main', create=True, count_objects_in_process=True, object_counter=mock.DEFAULT,
+                     model_bucket=mock.DEFAULT, detection_batch_size=4, BufferedBigQueryWriter=mock.DEFAULT,
+                     status_of_object_results=mock.DEFAULT)
+class TestProcessDayInProcess(TestCase):
+
+    def setUp(self):
+        shared_table_cache.clear()
+        mock_storage_client.list_blobs.side_effect = None
+        mock_storage_client.list_blobs.return_value = ['data-source']
+
+    def tearDown(self):
+        shared_table_cache.clear()
+
+    def process_day_with_one_time_already_processed(self):
+        mock_query_job = MagicMock()
+        mock_query_job.result.return_value = [{'time': datetime.time(10, 20)}]
+
+        with mock.patch.object(mock_big_query_client, 'get_table'), \
+                mock.patch.object(mock_big_query_client, 'query', return_value=mock_query_job):
+            return json.loads(process_day(create_mock_request({
+                "date_to_process": "20200304",
+                "camera_id": "sample_image",
+                "data_root": "data-source",
+                "model_blob_name": "a-model"
+            })))
+
+    def test_day_counted_and_written_at_once_without_calling_cloud_functions(
+            self, mocked_cloud_func, object_counter, model_bucket, BufferedBigQueryWriter, status_of_object_results,
+            **_kwargs):
+        object_counter.count_objects_in_batch.side_effect = \
+            lambda data_urls, *_args: [{'cars': index % 2, 'faulty': False, 'missing': False}
+                                       for index in range(len(data_urls))]
+        status_of_object_results.side_effect = \
+            lambda object_results: 'Processed' if object_results['cars'] else 'Missing'
+        bigquery_writer = BufferedBigQueryWriter.return_value
+        bigquery_writer.flush.return_value = []
+
+        response = self.process_day_with_one_time_already_processed()
+
+        self.assertEqual({'STATUS': 'OK', 'Counts': {'Already Processed': 1, 'Missing': 72, 'Processed': 71}},
+                         response)
+        mocked_cloud_func.assert_not_called()
+
+        data_urls = [f'data-source/20200304/{hour:02}{minute:02}/sample_image.jpg'
+                     for hour in range(0, 24) for minute in range(0, 60, 10) if (hour, minute) != (10, 20)]
+        object_counter.count_objects_in_batch.assert_called_once_with(data_urls, 'a-model', main.data_bucket,
+                                                                      model_bucket, 4)
+
+        BufferedBigQueryWriter.assert_called_once_with(mock_big_query_client, gcp_project, 'detected_objects',
+                                                       maximum_buffered_rows=len(data_urls))
+        self.assertEqual(len(data_urls), bigquery_writer.add_model_results.call_count)
+        bigquery_writer.add_model_results.assert_any_call(
+            'a-model', 'data-source/20200304/0010/sample_image.jpg', {'cars': 1, 'faulty': False, 'missing': False})
+        bigquery_writer.flush.assert_called_once_with()
+
+    def test_bigquery_insert_errors_reported(self, _mocked_cloud_func, object_counter, BufferedBigQueryWriter,
+                                             **_kwargs):
+        object_counter.count_objects_in_batch.side_effect = \
+            lambda data_urls, *_args: [{'cars': 0, 'faulty': False, 'missing': False}] * len(data_urls)
+        BufferedBigQueryWriter.return_value.flush.return_value = [{'index': 0, 'errors': ['oops']}]
+
+        response = self.process_day_with_one_time_already_processed()
+
+        self.assertEqual('Errored', response['STATUS'])
+        self.assertEqual("RuntimeError: BigQuery insert reported errors: [{'index': 0, 'errors': ['oops']}]",
+                         response['Message'])
+
+
+class TestIdentifyProcessedTimes(TestCase):
+
+    def setUp(self):
+        shared_table_cache.clear()
+
+    def tearDown(self):
+        shared_table_cache.clear()
+
+    def test_no_processed_times_if_table_missing(self):
+        with mock.patch.object(mock_big_query_client, 'get_table', side_effect=NotFound('no table')), \
+                mock.patch.object(mock_big_query_client, 'query') as mock_query:
+            processed_times = identify_processed_times('a-model', datetime.date(2020, 3, 4), 'sample_image',
+                                                       'data-source')
+
+        self.assertEqual([], processed_times)
+        mock_query.assert_not_called()
+
+    def test_table_looked_up_once(self):
+        mock_query_job = MagicMock()
+        mock_query_job.result.return_value = [{'time': datetime.time(10, 20)}]
+
+        with mock.patch.object(mock_big_query_client, 'get_table') as mock_get_table, \
+                mock.patch.object(mock_big_query_client, 'query', return_value=mock_query_job):
+            for _ in range(2):
+                processed_times = identify_processed_times('a-model', datetime.date(2020, 3, 4), 'sample_image',
+                                                           'data-source')
+                self.assertEqual(['1020'], processed_times)
+
+        mock_get_table.assert_called_once_with(f'{gcp_project}.detected_objects.amodel')
+
+    def test_deleted_table_forgotten(self):
+        with mock.patch.object(mock_big_query_client, 'get_table'), \
+                mock.patch.object(mock_big_query_client, 'query', side_effect=NotFound('no table')):
+            processed_times = identify_processed_times('a-model', datetime.date(2020, 3, 4), 'sample_image',
+                                                       'data-source')
+
+        self.assertEqual([], processed_times)
+        self.assertNotIn(f'{gcp_project}.detected_objects.amodel', shared_table_cache)
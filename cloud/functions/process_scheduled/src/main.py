@@ -6,7 +6,7 @@ from datetime import datetime, timedelta
 import google.cloud.storage
 from opentelemetry import trace
 
-from chrono_lens.gcloud.async_functions import run_cloud_function_async_with_parameter_list
+from chrono_lens.gcloud.async_functions import run_cloud_function_async_with_parameter_list_as_completed
 from chrono_lens.gcloud.buckets import read_from_bucket
 from chrono_lens.gcloud.error_handling import report_exception
 from chrono_lens.gcloud.logging import setup_logging_and_trace
@@ -20,7 +20,6 @@ run_model_on_image_endpoint = f'https://{gcp_region}-{gcp_project}.cloudfunction
 logging.info(f'Using run_model_on_image_endpoint: "{run_model_on_image_endpoint}"')
 
 BLOB_PREFIX = 'analyse'
-DATA_BATCH_SIZE = 400
 
 
 def process_scheduled(event, context):
@@ -86,25 +85,22 @@ def process_scheduled(event, context):
             }
 
             with tracer.start_as_current_span("CF call run_model_on_image"):
-                data_blob_batches = [data_blob_names[x:x + DATA_BATCH_SIZE]
-                                     for x in range(0, len(data_blob_names), DATA_BATCH_SIZE)]
-                for data_blob_batch in data_blob_batches:
-                    asyncio_results = run_cloud_function_async_with_parameter_list(
-                        json_key='data_blob_name', json_values=data_blob_batch,
-                        partial_json={'model_blob_name': model_configuration['model_blob_name']},
-                        endpoint=run_model_on_image_endpoint
-                    )
-
-                    for result, json_value in zip(asyncio_results, data_blob_batch):
-                        result_type = result['STATUS']
-                        results['Counts'][result_type] = results['Counts'].get(result_type, 0) + 1
-
-                        if result['STATUS'] == 'Errored':
-                            logging.critical(f'Incomplete execution - possible outage: "{json_value}" result: {result}')
-
-                        elif result['STATUS'] not in ['Processed', 'Faulty', 'Missing']:
-                            logging.error(f'Unexpected STATUS type: "{result["STATUS"]}"')
-                            logging.info(f'Full received result: "{result}"')
+                asyncio_results = run_cloud_function_async_with_parameter_list_as_completed(
+                    json_key='data_blob_name', json_values=data_blob_names,
+                    partial_json={'model_blob_name': model_configuration['model_blob_name']},
+                    endpoint=run_model_on_image_endpoint
+                )
+
+                for json_value, result in asyncio_results:
+                    result_type = result['STATUS']
+                    results['Counts'][result_type] = results['Counts'].get(result_type, 0) + 1
+
+                    if result['STATUS'] == 'Errored':
+                        logging.critical(f'Incomplete execution - possible outage: "{json_value}" result: {result}')
+
+                    elif result['STATUS'] not in ['Processed', 'Faulty', 'Missing']:
+                        logging.error(f'Unexpected STATUS type: "{result["STATUS"]}"')
+                        logging.info(f'Full received result: "{result}"')
 
             logging.info(f'Results: {results}')
 
@@ -16,6 +16,17 @@ def create_mock_request(request_json):
     return mock_request
 
 
+def results_as_completed(results):
+    """
+    :return: side effect for a mocked `run_cloud_function_async_with_parameter_list_as_completed`, yielding each JSON
+        value with the matching entry of `results`
+    """
+    def run_cloud_function_as_completed(json_key, json_values, partial_json, endpoint):
+        return zip(json_values, results)
+
+    return run_cloud_function_as_completed
+
+
 def create_mock_bucket(bucket_blob_data_maps):
     blob_name_to_blob = {}
 
@@ -99,7 +110,7 @@ class TestProcessScheduled(TestCase):
         self.assertEqual('OK', response['STATUS'])
         self.assertEqual({}, response['Counts'])
 
-    @mock.patch('main.run_cloud_function_async_with_parameter_list')
+    @mock.patch('main.run_cloud_function_async_with_parameter_list_as_completed')
     @mock.patch('google.cloud.storage.Client')
     @mock.patch('main.datetime')
     def test_each_data_blob_processed(self, mock_datetime, mock_client, mock_run_async):
@@ -122,7 +133,7 @@ class TestProcessScheduled(TestCase):
 
         mock_client.return_value = mock_client_instance
 
-        mock_run_async.return_value = [{"STATUS": "Processed"}]
+        mock_run_async.side_effect = results_as_completed([{"STATUS": "Processed"}])
 
         mock_event = MagicMock()
         mock_context = MagicMock()
@@ -139,7 +150,7 @@ class TestProcessScheduled(TestCase):
         self.assertEqual([f"{data_root}/{twenty_minutes_ago:%Y%m%d}/{twenty_minutes_ago:%H%M}/{camera_id}.jpg"], mock_run_async.call_args_list[0][1]['json_values'])
         self.assertEqual(model_blob_name, mock_run_async.call_args_list[0][1]['partial_json']['model_blob_name'])
 
-    @mock.patch('main.run_cloud_function_async_with_parameter_list')
+    @mock.patch('main.run_cloud_function_async_with_parameter_list_as_completed')
     @mock.patch('google.cloud.storage.Client')
     @mock.patch('main.datetime')
     @mock.patch('main.logging')
@@ -163,7 +174,7 @@ class TestProcessScheduled(TestCase):
 
         mock_client.return_value = mock_client_instance
 
-        mock_run_async.return_value = [
+        mock_run_async.side_effect = results_as_completed([
             {"STATUS": "Processed"},
                                        {"STATUS": "uh oh how weird"},
                                        {"STATUS": "Faulty"},
@@ -182,7 +193,7 @@ class TestProcessScheduled(TestCase):
                                            'JsonResponse': ''
                                        },
                                        {"STATUS": "Processed"}
-                                       ]
+                                       ])
 
         mock_event = MagicMock()
         mock_context = MagicMock()
@@ -210,7 +221,7 @@ class TestProcessScheduled(TestCase):
                                               ' \'JsonResponse\': \'\'}')
         mock_logging.error.assert_any_call('Unexpected STATUS type: "uh oh how weird"')
 
-    @mock.patch('main.run_cloud_function_async_with_parameter_list')
+    @mock.patch('main.run_cloud_function_async_with_parameter_list_as_completed')
     @mock.patch('google.cloud.storage.Client')
     @mock.patch('main.datetime')
     def test_latest_newer_than_datetime_rounds_down_to_nearest_10_mins(self, mock_datetime, mock_client, mock_run_async):
@@ -233,7 +244,7 @@ class TestProcessScheduled(TestCase):
 
         mock_client.return_value = mock_client_instance
 
-        mock_run_async.return_value = [{"STATUS": "Processed"}]
+        mock_run_async.side_effect = results_as_completed([{"STATUS": "Processed"}])
 
         mock_event = MagicMock()
         mock_context = MagicMock()
@@ -251,7 +262,7 @@ class TestProcessScheduled(TestCase):
                          mock_run_async.call_args_list[0][1]['json_values'])
         self.assertEqual(model_blob_name, mock_run_async.call_args_list[0][1]['partial_json']['model_blob_name'])
 
-    @mock.patch('main.run_cloud_function_async_with_parameter_list')
+    @mock.patch('main.run_cloud_function_async_with_parameter_list_as_completed')
     @mock.patch('google.cloud.storage.Client')
     @mock.patch('main.datetime')
     def test_latest_newer_than_datetime_rounds_down_to_nearest_10_mins_given_current_time_already_at_10_minute_floor(
@@ -276,7 +287,7 @@ class TestProcessScheduled(TestCase):
 
         mock_client.return_value = mock_client_instance
 
-        mock_run_async.return_value = [{"STATUS": "Processed"}]
+        mock_run_async.side_effect = results_as_completed([{"STATUS": "Processed"}])
 
         mock_event = MagicMock()
         mock_context = MagicMock()
@@ -1,10 +1,14 @@
 import json
 import logging
 import os
+import tempfile
 
+import google.cloud.bigquery
+import google.cloud.storage
 from opentelemetry import trace
 
 from chrono_lens.gcloud.async_functions import run_cloud_function_async_with_parameter_list
+from chrono_lens.gcloud.bigquery import BufferedBigQueryWriter
 from chrono_lens.gcloud.call_handling import extract_request_field
 from chrono_lens.gcloud.error_handling import report_exception
 from chrono_lens.gcloud.logging import setup_logging_and_trace
@@ -20,6 +24,27 @@ logging.info(f'Using count_objects_endpoint: "{count_objects_endpoint}"')
 bigquery_write_endpoint = f'https://{gcp_region}-{gcp_project}.cloudfunctions.net/bigquery_write'
 logging.info(f'Using bigquery_write_endpoint: "{bigquery_write_endpoint}"')
 
+DATASET_NAME = 'detected_objects'  # As defined in gcp-setup.sh (BigQuery dataset creation)
+
+# If "true", objects are counted and their results written within this function, rather than by calling the
+# count_objects and bigquery_write cloud functions - saving two network hops per image, but needing the requirements
+# (TensorFlow etc.) and memory of count_objects
+count_objects_in_process = os.environ.get('COUNT_OBJECTS_IN_PROCESS', 'false').lower() == 'true'
+if count_objects_in_process:
+    # Only imported when needed, as object counting depends on TensorFlow
+    from chrono_lens.gcloud.object_counting import ObjectCounter, count_objects_and_write
+
+    # Reused between calls, as in count_objects
+    object_counter = ObjectCounter(
+        model_cache_folder=os.environ.get('MODEL_CACHE_FOLDER', os.path.join(tempfile.gettempdir(), 'models')) or None)
+
+    storage_client = google.cloud.storage.Client()
+    data_bucket = storage_client.bucket(os.environ.get('DATA_BUCKET_NAME'))  # Built-in env var
+    model_bucket = storage_client.bucket(os.environ.get('MODELS_BUCKET_NAME'))  # Built-in env var
+
+    bigquery_writer = BufferedBigQueryWriter(google.cloud.bigquery.Client(), gcp_project, DATASET_NAME)
+    logging.info('Counting objects in process')
+
 
 def run_model_on_image(request):
     """
@@ -41,62 +66,105 @@ def run_model_on_image(request):
             data_blob_name = extract_request_field(request, 'data_blob_name')
             model_blob_name = extract_request_field(request, 'model_blob_name')
 
-            count_objects_args = {
-                "model_blob_name": model_blob_name
-            }
-
-            with tracer.start_as_current_span('CF call: count_objects'):
-                object_count_response_dict_list = run_cloud_function_async_with_parameter_list(
-                    json_key='image_blob_name', json_values=[data_blob_name], partial_json=count_objects_args,
-                    endpoint=count_objects_endpoint)
-
-            object_count_response_dict = object_count_response_dict_list[0]
-            logging.info(f'count_objects completed',
-                         {
-                             "data_blob_name": data_blob_name,
-                             "model_blob_name": model_blob_name,
-                             "count_objects_results": object_count_response_dict
-                         })
-            if object_count_response_dict['STATUS'] != 'Processed':
-                message = f'object_count request reported "{object_count_response_dict["STATUS"]}":' \
-                    f' "{object_count_response_dict}"'
-                logging.error(f'ERROR: {message}')
-                if object_count_response_dict['Message'].startswith('Failed after'):
-                    raise ConnectionError(message)
-                else:
-                    raise RuntimeError(message)
-
-            bigquery_write_args = {
-                "model_blob_name": model_blob_name,
-                "model_results_json": json.dumps(object_count_response_dict['results'])
-            }
-
-            with tracer.start_as_current_span('CF call: bigquery_write'):
-                bigquery_write_response_dict_list = run_cloud_function_async_with_parameter_list(
-                    json_key='image_blob_name', json_values=[data_blob_name], partial_json=bigquery_write_args,
-                    endpoint=bigquery_write_endpoint)
-
-            bigquery_write_response_dict = bigquery_write_response_dict_list[0]
-
-            logging.info(f'bigquery_write completed', bigquery_write_response_dict)
-            if bigquery_write_response_dict['STATUS'] != 'Processed':
-                message = f'bigquery_write request reported "{bigquery_write_response_dict["STATUS"]}":' \
-                    f' "{bigquery_write_response_dict}"'
-                logging.error(f'ERROR: {message}')
-                if bigquery_write_response_dict['Message'].startswith('Failed after'):
-                    raise ConnectionError(message)
-                else:
-                    raise RuntimeError(message)
-
-            if object_count_response_dict['results']['faulty']:
-                return json.dumps({'STATUS': 'Faulty'})
-            elif object_count_response_dict['results']['missing']:
-                return json.dumps({'STATUS': 'Missing'})
+            if count_objects_in_process:
+                return json.dumps({'STATUS': count_and_write_in_process(data_blob_name, model_blob_name)})
             else:
-                return json.dumps({'STATUS': 'Processed'})
+                return json.dumps({'STATUS': count_and_write_via_cloud_functions(data_blob_name, model_blob_name)})
 
     except Exception as e:
         return report_exception(e,
                                 {'data_blob_name': data_blob_name,
                                  'model_blob_name': model_blob_name},
                                 request=request)
+
+
+def count_and_write_via_cloud_functions(data_blob_name, model_blob_name):
+    """
+    :return: status of the image - "Faulty", "Missing" or "Processed"
+    """
+    tracer = trace.get_tracer(__name__)
+
+    count_objects_args = {
+        "model_blob_name": model_blob_name
+    }
+
+    with tracer.start_as_current_span('CF call: count_objects'):
+        object_count_response_dict_list = run_cloud_function_async_with_parameter_list(
+            json_key='image_blob_name', json_values=[data_blob_name], partial_json=count_objects_args,
+            endpoint=count_objects_endpoint)
+
+    object_count_response_dict = object_count_response_dict_list[0]
+    logging.info(f'count_objects completed',
+                 {
+                     "data_blob_name": data_blob_name,
+                     "model_blob_name": model_blob_name,
+                     "count_objects_results": object_count_response_dict
+                 })
+    if object_count_response_dict['STATUS'] != 'Processed':
+        message = f'object_count request reported "{object_count_response_dict["STATUS"]}":' \
+            f' "{object_count_response_dict}"'
+        logging.error(f'ERROR: {message}')
+        if object_count_response_dict['Message'].startswith('Failed after'):
+            raise ConnectionError(message)
+        else:
+            raise RuntimeError(message)
+
+    bigquery_write_args = {
+        "model_blob_name": model_blob_name,
+        "model_results_json": json.dumps(object_count_response_dict['results'])
+    }
+
+    with tracer.start_as_current_span('CF call: bigquery_write'):
+        bigquery_write_response_dict_list = run_cloud_function_async_with_parameter_list(
+            json_key='image_blob_name', json_values=[data_blob_name], partial_json=bigquery_write_args,
+            endpoint=bigquery_write_endpoint)
+
+    bigquery_write_response_dict = bigquery_write_response_dict_list[0]
+
+    logging.info(f'bigquery_write completed', bigquery_write_response_dict)
+    if bigquery_write_response_dict['STATUS'] != 'Processed':
+        message = f'bigquery_write request reported "{bigquery_write_response_dict["STATUS"]}":' \
+            f' "{bigquery_write_response_dict}"'
+        logging.error(f'ERROR: {message}')
+        if bigquery_write_response_dict['Message'].startswith('Failed after'):
+            raise ConnectionError(message)
+        else:
+            raise RuntimeError(message)
+
+    if object_count_response_dict['results']['faulty']:
+        return 'Faulty'
+    elif object_count_response_dict['results']['missing']:
+        return 'Missing'
+    else:
+        return 'Processed'
+
+
+def count_and_write_in_process(data_blob_name, model_blob_name):
+    """
+    :return: status of the image - "Faulty", "Missing" or "Processed"
+    """
+    tracer = trace.get_tracer(__name__)
+
+    try:
+        with tracer.start_as_current_span('Counting objects'):
+            status, object_results = count_objects_and_write(object_counter, bigquery_writer, data_blob_name,
+                                                             model_blob_name, data_bucket, model_bucket)
+
+        logging.info('count_objects completed',
+                     {
+                         "data_blob_name": data_blob_name,
+                         "model_blob_name": model_blob_name,
+                         "count_objects_results": object_results
+                     })
+
+        with tracer.start_as_current_span('Writing to BigQuery'):
+            errors = bigquery_writer.flush()
+    except Exception:
+        # Not left to be inserted with a later request's results
+        bigquery_writer.discard()
+        raise
+
+    if errors:
+        raise RuntimeError(f'BigQuery insert reported errors: {errors}')
+
+    return status
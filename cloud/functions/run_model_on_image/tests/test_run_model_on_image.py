@@ -253,3 +253,54 @@ class TestRunModelOnImage(TestCase):
                          f' "{{\'STATUS\': \'{error_status}\', \'Message\': \'{error_message}\','
                          ' \'TextResponse\': \'oh dear\', \'JsonResponse\': {3: 4}}"',
                          response['Message'])
+
+
+# Object counting of the in-process mode is only imported when enabled (as it needs TensorFlow), so is mocked
+@mock.patch('main.run_cloud_function_async_with_parameter_list')
+@mock.patch.multiple('main', create=True, count_objects_in_process=True, object_counter=mock.DEFAULT,
+                     bigquery_writer=mock.DEFAULT, data_bucket=mock.DEFAULT, model_bucket=mock.DEFAULT,
+                     count_objects_and_write=mock.DEFAULT)
+class TestRunModelOnImageInProcess(TestCase):
+    valid_params = {
+        'data_blob_name': valid_data_blob_name,
+        'model_blob_name': valid_model_blob_name
+    }
+
+    def test_counted_and_written_without_calling_cloud_functions(self, mocked_cloud_func, object_counter,
+                                                                 bigquery_writer, data_bucket, model_bucket,
+                                                                 count_objects_and_write, **_kwargs):
+        count_objects_and_write.return_value = ('Faulty', {'cars': 0, 'faulty': True, 'missing': False})
+        bigquery_writer.flush.return_value = []
+
+        response_json = main.run_model_on_image(create_mock_request(self.valid_params))
+        response = json.loads(response_json)
+
+        self.assertEqual('Faulty', response['STATUS'])
+        count_objects_and_write.assert_called_once_with(object_counter, bigquery_writer, valid_data_blob_name,
+                                                        valid_model_blob_name, data_bucket, model_bucket)
+        bigquery_writer.flush.assert_called_once_with()
+        mocked_cloud_func.assert_not_called()
+
+    def test_bigquery_insert_errors_reported(self, _mocked_cloud_func, bigquery_writer, count_objects_and_write,
+                                             **_kwargs):
+        count_objects_and_write.return_value = ('Processed', {'cars': 2, 'faulty': False, 'missing': False})
+        bigquery_writer.flush.return_value = [{'index': 0, 'errors': ['oops']}]
+
+        response_json = main.run_model_on_image(create_mock_request(self.valid_params))
+        response = json.loads(response_json)
+
+        self.assertEqual('Errored', response['STATUS'])
+        self.assertEqual("RuntimeError: BigQuery insert reported errors: [{'index': 0, 'errors': ['oops']}]",
+                         response['Message'])
+
+    def test_buffered_results_discarded_if_counting_fails(self, _mocked_cloud_func, bigquery_writer,
+                                                          count_objects_and_write, **_kwargs):
+        count_objects_and_write.side_effect = ValueError('Model post-process stage is unknown: "UnknownV0"')
+
+        response_json = main.run_model_on_image(create_mock_request(self.valid_params))
+        response = json.loads(response_json)
+
+        self.assertEqual('Errored', response['STATUS'])
+        self.assertEqual('ValueError: Model post-process stage is unknown: "UnknownV0"', response['Message'])
+        bigquery_writer.discard.assert_called_once_with()
+        bigquery_writer.flush.assert_not_called()
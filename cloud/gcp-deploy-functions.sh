@@ -50,6 +50,7 @@ do
             --set-env-vars=SOURCES_BUCKET_NAME=sources-${PROJECT_ID} \
             --set-env-vars=DATA_BUCKET_NAME=data-${PROJECT_ID} \
             --set-env-vars=MODELS_BUCKET_NAME=models-${PROJECT_ID} \
+            --set-env-vars=WARM_UP_MODEL_STAGE_NAMES=NewcastleV0 \
             --set-env-vars=VM_INSTANCE_NAME=impute-seats \
             --set-env-vars=VM_ZONE_NAME=europe-west2-a \
             --set-env-vars=GCP_PROJECT=${PROJECT_ID} \
@@ -40,6 +40,14 @@ def get_args(command_line_arguments):
     parser.add_argument("-cp", "--counts-path", default=chrono_lens.localhost.COUNTS_FOLDER,
                         help="Folder where image counts are stored")
 
+    parser.add_argument("-cm", "--camera-major", default=False, action='store_true',
+                        help="Process each camera's day of images in time order, so each image is read and decoded"
+                             " once; CSV output is unchanged")
+
+    parser.add_argument("-w", "--workers", default=1, type=int,
+                        help="Number of processes to share cameras across; each process loads its own copy of the"
+                             " models")
+
     parser.add_argument("-ll", "--log-level",
                         default=chrono_lens.localhost.DEFAULT_LOG_LEVEL,
                         choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
@@ -72,6 +80,9 @@ def get_args(command_line_arguments):
     if args.start_date > args.end_date:
         raise ProcessImagesException("Start date after end date")
 
+    if args.workers < 1:
+        raise ProcessImagesException("Number of workers must be at least 1")
+
     return args
 
 
@@ -86,7 +97,9 @@ def main(command_line_args):
         download_path=args.download_folder,
         counts_path=args.counts_path,
         start_date=args.start_date,
-        end_date=args.end_date
+        end_date=args.end_date,
+        camera_major=args.camera_major,
+        workers=args.workers
     )
 
 
@@ -0,0 +1,141 @@
+import argparse
+import glob
+import logging
+import os
+import sys
+import time
+
+import chrono_lens.localhost
+from chrono_lens.exceptions import ProcessImagesException
+from chrono_lens.images.newcastle_detector import NewcastleDetector
+from chrono_lens.localhost.file_io import load_from_json, load_from_binary, load_bgr_image_as_rgb
+
+"""
+Alternative TensorFlow session settings benchmarked, each applied on top of the model's own
+"session_configuration"; the final setting also runs images through the model in batches.
+"""
+BENCHMARK_SETTINGS = [
+    ('as configured', {}, False),
+    ('single thread', {'intra_op_parallelism_threads': 1, 'inter_op_parallelism_threads': 1}, False),
+    ('all cores intra-op', {'intra_op_parallelism_threads': os.cpu_count(), 'inter_op_parallelism_threads': 1},
+     False),
+    ('optimiser L0', {'optimiser_level': 'L0'}, False),
+    ('grappler disabled', {'grappler_optimisation': False}, False),
+    ('unused nodes stripped', {'strip_unused_nodes': True}, False),
+    ('as configured, batched', {}, True),
+]
+
+
+def get_args(command_line_arguments):
+    parser = argparse.ArgumentParser(description="Report images per second processed by an object detection model"
+                                                 " with alternative TensorFlow session settings.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-cf", "--config-folder", default=chrono_lens.localhost.CONFIG_FOLDER,
+                        help="Folder where configuration data is stored")
+
+    parser.add_argument("-mn", "--model-name", default='NewcastleV0',
+                        help="Object detection model stage to benchmark, as found in the models configuration folder")
+
+    parser.add_argument("-if", "--image-folder", required=True,
+                        help="Folder searched (recursively) for JPEG images to process")
+
+    parser.add_argument("-mi", "--maximum-images", default=20, type=int,
+                        help="Maximum number of images to process per setting")
+
+    parser.add_argument("-r", "--repeats", default=3, type=int,
+                        help="Number of times the images are processed per setting")
+
+    parser.add_argument("-ll", "--log-level",
+                        default=chrono_lens.localhost.DEFAULT_LOG_LEVEL,
+                        choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
+                        help="Level of detail to report in logs")
+
+    args = parser.parse_args(command_line_arguments)
+
+    if args.maximum_images < 1:
+        raise ProcessImagesException("Maximum number of images must be at least 1")
+
+    if args.repeats < 1:
+        raise ProcessImagesException("Number of repeats must be at least 1")
+
+    return args
+
+
+def load_images_rgb(image_folder, maximum_images):
+    image_file_names = sorted(glob.glob(os.path.join(image_folder, '**', '*.jpg'), recursive=True))
+
+    images_rgb = []
+    for image_file_name in image_file_names:
+        image_rgb = load_bgr_image_as_rgb(image_file_name)
+        if image_rgb is not None:
+            images_rgb.append(image_rgb)
+            if len(images_rgb) >= maximum_images:
+                break
+
+    if not images_rgb:
+        raise ProcessImagesException(f'No JPEG images found in "{image_folder}"')
+
+    return images_rgb
+
+
+def images_per_second(object_detector, images_rgb, repeats, batched):
+    # First inference includes one-off graph initialisation, so is excluded from timing
+    object_detector.detect(images_rgb[0])
+
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        if batched:
+            object_detector.detect_batch(images_rgb)
+        else:
+            for image_rgb in images_rgb:
+                object_detector.detect(image_rgb)
+    elapsed_seconds = time.perf_counter() - start_time
+
+    return len(images_rgb) * repeats / elapsed_seconds
+
+
+def benchmark(config_path, model_name, images_rgb, repeats):
+    model_folder = os.path.join(config_path, "models", model_name)
+    model_configuration = load_from_json(os.path.join(model_folder, "configuration.json"))
+    serialized_graph = load_from_binary(os.path.join(model_folder, model_configuration["serialized_graph_name"]))
+
+    results = []
+    for setting_name, session_configuration_overrides, batched in BENCHMARK_SETTINGS:
+        session_configuration = {**model_configuration.get('session_configuration', {}),
+                                 **session_configuration_overrides}
+
+        object_detector = NewcastleDetector(serialized_graph=serialized_graph,
+                                            minimum_confidence=model_configuration["minimum_confidence"],
+                                            session_configuration=session_configuration)
+        try:
+            results.append((setting_name, images_per_second(object_detector, images_rgb, repeats, batched)))
+        finally:
+            object_detector.close()
+
+        logging.info(f'{setting_name}: {results[-1][1]:.2f} images/s')
+
+    return results
+
+
+def main(command_line_args):
+    args = get_args(command_line_args)
+
+    handler = logging.StreamHandler(sys.stdout)
+    logging.basicConfig(handlers=[handler], level=logging.getLevelName(args.log_level))
+
+    images_rgb = load_images_rgb(args.image_folder, args.maximum_images)
+
+    results = benchmark(args.config_folder, args.model_name, images_rgb, args.repeats)
+
+    print(f'{len(images_rgb)} images, {args.repeats} repeats, {os.cpu_count()} cores')
+    for setting_name, setting_images_per_second in results:
+        print(f'{setting_name:>25}: {setting_images_per_second:8.2f} images/s')
+
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv[1:])
+
+    except ProcessImagesException as err:
+        print(f"Benchmark error: {err.message}")
@@ -22,6 +22,12 @@ def get_args(command_line_arguments):
                         type=int,
                         help="Maximum number of download attempts per image")
 
+    parser.add_argument("-c", "--concurrency",
+                        default=chrono_lens.localhost.DEFAULT_DOWNLOAD_CONCURRENCY,
+                        type=int,
+                        help="Maximum number of images downloaded at the same time; above 1, connections are re-used"
+                             " and images are resized in parallel")
+
     parser.add_argument("-ll", "--log-level",
                         default=chrono_lens.localhost.DEFAULT_LOG_LEVEL,
                         choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
@@ -38,7 +44,8 @@ def main(command_line_args):
     handler = logging.StreamHandler(sys.stdout)
     logging.basicConfig(handlers=[handler], level=logging.getLevelName(args.log_level))
 
-    download_all_images(args.config_folder, args.download_folder, args.maximum_download_attempts)
+    download_all_images(args.config_folder, args.download_folder, args.maximum_download_attempts,
+                        args.concurrency)
 
 
 if __name__ == '__main__':
@@ -1,10 +1,14 @@
 import asyncio
+import threading
+import time
 from unittest import TestCase, mock
 
-from aiohttp import ServerDisconnectedError
+from aiohttp import ServerDisconnectedError, web
 from testfixtures import LogCapture
 
-from chrono_lens.gcloud.async_functions import run_cloud_function_async_with_parameter_list, MAXIMUM_NUMBER_OF_ATTEMPTS
+from chrono_lens.gcloud.async_functions import run_cloud_function_async_with_parameter_list, \
+    MAXIMUM_NUMBER_OF_ATTEMPTS, AdaptiveConcurrencyLimiter, run_cloud_function_async_with_parameter_list_as_completed, \
+    stream_cloud_function_async_with_parameter_list
 
 
 class MockResponse:
@@ -90,14 +94,9 @@ class TestRunCloudFunctionAsyncWithParameterList(TestCase):
         )
 
     @mock.patch('chrono_lens.gcloud.async_functions.aiohttp')
-    @mock.patch('chrono_lens.gcloud.async_functions.asyncio')
+    @mock.patch('chrono_lens.gcloud.async_functions.asyncio.sleep', new=mock_sleep)
     @mock.patch('chrono_lens.gcloud.authentication.requests')
-    def test_requests_triggered_for_every_entry_maximum_system_failures(self, _mock_requests, mock_asyncio,
-                                                                        mock_aiohttp):
-        mock_asyncio.run.side_effect = asyncio.run
-        mock_asyncio.gather.side_effect = asyncio.gather
-        mock_asyncio.sleep.side_effect = mock_sleep
-
+    def test_requests_triggered_for_every_entry_maximum_system_failures(self, _mock_requests, mock_aiohttp):
         expected_end_point = f'https://fake-function.com/test'
         expected_json_key = 'iterated_key'
         expected_json_values = ['A', 'B']
@@ -142,14 +141,9 @@ class TestRunCloudFunctionAsyncWithParameterList(TestCase):
         self.assertEqual(1 + MAXIMUM_NUMBER_OF_ATTEMPTS, len(mock_session.calls_made))
 
     @mock.patch('chrono_lens.gcloud.async_functions.aiohttp')
-    @mock.patch('chrono_lens.gcloud.async_functions.asyncio')
+    @mock.patch('chrono_lens.gcloud.async_functions.asyncio.sleep', new=mock_sleep)
     @mock.patch('chrono_lens.gcloud.authentication.requests')
-    def test_requests_triggered_for_every_entry_do_not_retry_authorisation_failures(self, _mock_requests, mock_asyncio,
-                                                                                    mock_aiohttp):
-        mock_asyncio.run.side_effect = asyncio.run
-        mock_asyncio.gather.side_effect = asyncio.gather
-        mock_asyncio.sleep.side_effect = mock_sleep
-
+    def test_requests_triggered_for_every_entry_do_not_retry_authorisation_failures(self, _mock_requests, mock_aiohttp):
         expected_end_point = f'https://fake-function.com/test'
         expected_json_key = 'iterated_key'
         expected_json_values = ['A', 'B']
@@ -186,13 +180,9 @@ class TestRunCloudFunctionAsyncWithParameterList(TestCase):
             self.assertEqual(error_message, results[index]['TextResponse'])
 
     @mock.patch('chrono_lens.gcloud.async_functions.aiohttp')
-    @mock.patch('chrono_lens.gcloud.async_functions.asyncio')
+    @mock.patch('chrono_lens.gcloud.async_functions.asyncio.sleep', new=mock_sleep)
     @mock.patch('chrono_lens.gcloud.authentication.requests')
-    def test_requests_triggered_for_every_entry_maximum_soft_errors(self, _mock_requests, mock_asyncio, mock_aiohttp):
-        mock_asyncio.run.side_effect = asyncio.run
-        mock_asyncio.gather.side_effect = asyncio.gather
-        mock_asyncio.sleep.side_effect = mock_sleep
-
+    def test_requests_triggered_for_every_entry_maximum_soft_errors(self, _mock_requests, mock_aiohttp):
         expected_end_point = f'https://fake-function.com/test'
         expected_json_key = 'iterated_key'
         expected_json_values = ['A', 'B']
@@ -235,14 +225,10 @@ class TestRunCloudFunctionAsyncWithParameterList(TestCase):
         self.assertEqual(2, len(mock_session.calls_made))
 
     @mock.patch('chrono_lens.gcloud.async_functions.aiohttp')
-    @mock.patch('chrono_lens.gcloud.async_functions.asyncio')
+    @mock.patch('chrono_lens.gcloud.async_functions.asyncio.sleep', new=mock_sleep)
     @mock.patch('chrono_lens.gcloud.authentication.requests')
     def test_requests_triggered_for_every_entry_less_than_maximum_soft_and_system_errors(self, _mock_requests,
-                                                                                         mock_asyncio, mock_aiohttp):
-        mock_asyncio.run.side_effect = asyncio.run
-        mock_asyncio.gather.side_effect = asyncio.gather
-        mock_asyncio.sleep.side_effect = mock_sleep
-
+                                                                                         mock_aiohttp):
         expected_end_point = f'https://fake-function.com/test'
         expected_json_key = 'iterated_key'
         expected_json_values = ['A', 'B']
@@ -294,14 +280,10 @@ class TestRunCloudFunctionAsyncWithParameterList(TestCase):
         self.assertEqual(1 + MAXIMUM_NUMBER_OF_ATTEMPTS, len(mock_session.calls_made))
 
     @mock.patch('chrono_lens.gcloud.async_functions.aiohttp')
-    @mock.patch('chrono_lens.gcloud.async_functions.asyncio')
+    @mock.patch('chrono_lens.gcloud.async_functions.asyncio.sleep', new=mock_sleep)
     @mock.patch('chrono_lens.gcloud.authentication.requests')
     def test_requests_triggered_for_every_entry_less_than_maximum_retries_socket_errors(self, _mock_requests,
-                                                                                        mock_asyncio, mock_aiohttp):
-        mock_asyncio.run.side_effect = asyncio.run
-        mock_asyncio.gather.side_effect = asyncio.gather
-        mock_asyncio.sleep.side_effect = mock_sleep
-
+                                                                                        mock_aiohttp):
         expected_end_point = f'https://fake-function.com/test'
         expected_json_key = 'iterated_key'
         expected_json_values = ['A', 'B']
@@ -353,14 +335,10 @@ class TestRunCloudFunctionAsyncWithParameterList(TestCase):
         self.assertEqual(1 + MAXIMUM_NUMBER_OF_ATTEMPTS, len(mock_session.calls_made))
 
     @mock.patch('chrono_lens.gcloud.async_functions.aiohttp')
-    @mock.patch('chrono_lens.gcloud.async_functions.asyncio')
+    @mock.patch('chrono_lens.gcloud.async_functions.asyncio.sleep', new=mock_sleep)
     @mock.patch('chrono_lens.gcloud.authentication.requests')
     def test_requests_retries_if_request_raised_errors(self, _mock_requests,
-                                                       mock_asyncio, mock_aiohttp):
-        mock_asyncio.run.side_effect = asyncio.run
-        mock_asyncio.gather.side_effect = asyncio.gather
-        mock_asyncio.sleep.side_effect = mock_sleep
-
+                                                       mock_aiohttp):
         expected_end_point = f'https://fake-function.com/test'
         expected_json_key = 'iterated_key'
         expected_json_values = ['A', 'B']
@@ -410,3 +388,258 @@ class TestRunCloudFunctionAsyncWithParameterList(TestCase):
 
         # 1st call succeeded, 2nd call had MAXIMUM_NUMBER_OF_RETRIES-1 failures and then finally a success
         self.assertEqual(1 + MAXIMUM_NUMBER_OF_ATTEMPTS, len(mock_session.calls_made))
+
+
+class StubCloudFunctionServer:
+    """
+    Serves `handler` on localhost in a background thread, standing in for a cloud function.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+        self.thread = None
+        self.endpoint = None
+
+    def __enter__(self):
+        application = web.Application()
+        application.router.add_post('/function', self.handler)
+        self.runner = web.AppRunner(application)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        self.loop.run_until_complete(site.start())
+        self.endpoint = f'http://127.0.0.1:{self.runner.addresses[0][1]}/function'
+
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.run_until_complete(self.runner.cleanup())
+        self.loop.close()
+
+
+class TestRunCloudFunctionAsyncWithStubServer(TestCase):
+
+    @mock.patch('chrono_lens.gcloud.async_functions.create_authenticated_cloud_function_headers')
+    def test_no_values_makes_no_requests(self, mock_create_headers):
+        self.assertEqual([], run_cloud_function_async_with_parameter_list('iterated_key', [], {},
+                                                                          'http://127.0.0.1:1/function'))
+        mock_create_headers.assert_not_called()
+
+    def test_requests_in_flight_bounded_and_results_in_order(self):
+        in_flight = {'current': 0, 'maximum': 0}
+
+        async def handler(request):
+            request_json = await request.json()
+            in_flight['current'] += 1
+            in_flight['maximum'] = max(in_flight['maximum'], in_flight['current'])
+            await asyncio.sleep(0.02)
+            in_flight['current'] -= 1
+            return web.json_response({'STATUS': 'OK', 'Echo': request_json['iterated_key'],
+                                      'Other': request_json['otherThings']})
+
+        json_values = [f'value{index}' for index in range(30)]
+        with StubCloudFunctionServer(handler) as server:
+            results = run_cloud_function_async_with_parameter_list('iterated_key', json_values,
+                                                                   {'otherThings': 'stuff'}, server.endpoint,
+                                                                   headers={}, maximum_concurrency=4,
+                                                                   initial_concurrency=2)
+
+        self.assertEqual([{'STATUS': 'OK', 'Echo': json_value, 'Other': 'stuff'} for json_value in json_values],
+                         results)
+        self.assertGreater(in_flight['maximum'], 1)
+        self.assertLessEqual(in_flight['maximum'], 4)
+
+    def test_overloaded_responses_retried(self):
+        statuses = [429, 503, 500]
+        request_count = {'count': 0}
+
+        async def handler(request):
+            request_json = await request.json()
+            request_count['count'] += 1
+            if statuses:
+                return web.Response(status=statuses.pop(0), text='busy')
+            return web.json_response({'STATUS': 'OK', 'Echo': request_json['iterated_key']})
+
+        with StubCloudFunctionServer(handler) as server:
+            results = run_cloud_function_async_with_parameter_list('iterated_key', ['A', 'B'], {}, server.endpoint,
+                                                                   headers={}, sleep_base=0, sleep_tuple=(0, 0))
+
+        self.assertEqual([{'STATUS': 'OK', 'Echo': 'A'}, {'STATUS': 'OK', 'Echo': 'B'}], results)
+        self.assertEqual(5, request_count['count'])
+
+    def test_unreachable_endpoint_fails_after_maximum_attempts(self):
+        async def handler(_request):
+            return web.json_response({'STATUS': 'OK'})
+
+        with StubCloudFunctionServer(handler) as server:
+            endpoint = server.endpoint
+
+        results = run_cloud_function_async_with_parameter_list('iterated_key', ['A'], {}, endpoint, headers={},
+                                                               sleep_base=0, sleep_tuple=(0, 0))
+
+        self.assertEqual('Errored', results[0]['STATUS'])
+        self.assertEqual(f'Failed after {MAXIMUM_NUMBER_OF_ATTEMPTS} attempts with "A"', results[0]['Message'])
+
+
+    def test_latency_tolerance_passed_to_limiter(self):
+        async def handler(request):
+            request_json = await request.json()
+            await asyncio.sleep(request_json['delay'])
+            return web.json_response({'STATUS': 'OK', 'Echo': request_json['delay']})
+
+        delays = [0.0] * 4 + [0.2] * 4
+        with StubCloudFunctionServer(handler) as server, \
+                mock.patch('chrono_lens.gcloud.async_functions.AdaptiveConcurrencyLimiter',
+                           wraps=AdaptiveConcurrencyLimiter) as mock_limiter_class:
+            results = run_cloud_function_async_with_parameter_list('delay', delays, {}, server.endpoint, headers={},
+                                                                   initial_concurrency=4, latency_tolerance=None)
+
+        self.assertEqual([{'STATUS': 'OK', 'Echo': delay} for delay in delays], results)
+        self.assertIsNone(mock_limiter_class.call_args[1]['latency_tolerance'])
+
+
+class TestRunCloudFunctionAsCompletedWithStubServer(TestCase):
+
+    @staticmethod
+    async def delayed_echo_handler(request):
+        request_json = await request.json()
+        await asyncio.sleep(request_json['delay'])
+        return web.json_response({'STATUS': 'OK', 'Echo': request_json['delay']})
+
+    def test_results_yielded_in_completion_order(self):
+        with StubCloudFunctionServer(self.delayed_echo_handler) as server:
+            results = list(run_cloud_function_async_with_parameter_list_as_completed(
+                'delay', [0.3, 0.0, 0.1], {}, server.endpoint, headers={}))
+
+        self.assertEqual([(0.0, {'STATUS': 'OK', 'Echo': 0.0}),
+                          (0.1, {'STATUS': 'OK', 'Echo': 0.1}),
+                          (0.3, {'STATUS': 'OK', 'Echo': 0.3})], results)
+
+    def test_asynchronous_results_yielded_in_completion_order(self):
+        async def collect_results(endpoint):
+            return [json_value async for json_value, _ in stream_cloud_function_async_with_parameter_list(
+                'delay', [0.2, 0.0], {}, endpoint, headers={})]
+
+        with StubCloudFunctionServer(self.delayed_echo_handler) as server:
+            self.assertEqual([0.0, 0.2], asyncio.run(collect_results(server.endpoint)))
+
+    def test_stopping_early_cancels_outstanding_requests(self):
+        with StubCloudFunctionServer(self.delayed_echo_handler) as server:
+            results = run_cloud_function_async_with_parameter_list_as_completed(
+                'delay', [0.0, 2.0], {}, server.endpoint, headers={})
+            first_result = next(results)
+
+            start_time = time.time()
+            results.close()
+            close_duration = time.time() - start_time
+
+        self.assertEqual((0.0, {'STATUS': 'OK', 'Echo': 0.0}), first_result)
+        self.assertLess(close_duration, 1)
+
+    @mock.patch('chrono_lens.gcloud.async_functions.create_authenticated_cloud_function_headers')
+    def test_no_values_yields_nothing(self, mock_create_headers):
+        self.assertEqual([], list(run_cloud_function_async_with_parameter_list_as_completed(
+            'iterated_key', [], {}, 'http://127.0.0.1:1/function')))
+        mock_create_headers.assert_not_called()
+
+
+class TestAdaptiveConcurrencyLimiter(TestCase):
+
+    def test_limits_validated(self):
+        with self.assertRaises(ValueError):
+            AdaptiveConcurrencyLimiter(minimum_limit=0)
+        with self.assertRaises(ValueError):
+            AdaptiveConcurrencyLimiter(minimum_limit=5, maximum_limit=4)
+        with self.assertRaises(ValueError):
+            AdaptiveConcurrencyLimiter(decrease_ratio=1)
+
+    def test_initial_limit_capped_at_maximum(self):
+        self.assertEqual(10, AdaptiveConcurrencyLimiter(initial_limit=50, maximum_limit=10).limit)
+
+    def test_limit_doubles_per_round_until_overloaded_then_increases_additively(self):
+        async def run_rounds():
+            limiter = AdaptiveConcurrencyLimiter(initial_limit=2, maximum_limit=100, latency_tolerance=None)
+            limits = []
+            for _ in range(3):
+                dispatch_times = [await limiter.acquire() for _ in range(limiter.limit)]
+                for dispatch_time in dispatch_times:
+                    limiter.release(dispatch_time)
+                limits.append(limiter.limit)
+
+            limiter.release(await limiter.acquire(), overloaded=True)
+            limits.append(limiter.limit)
+
+            for _ in range(2):
+                dispatch_times = [await limiter.acquire() for _ in range(limiter.limit)]
+                for dispatch_time in dispatch_times:
+                    limiter.release(dispatch_time)
+                limits.append(limiter.limit)
+            return limits
+
+        # Each round after the decrease adds just under 1, as the limit grows during the round
+        self.assertEqual([4, 8, 16, 8, 8, 9], asyncio.run(run_rounds()))
+
+    def test_overloaded_round_decreases_limit_once(self):
+        async def run_round():
+            limiter = AdaptiveConcurrencyLimiter(initial_limit=8, maximum_limit=100)
+            dispatch_times = [await limiter.acquire() for _ in range(8)]
+            for dispatch_time in dispatch_times:
+                limiter.release(dispatch_time, overloaded=True)
+            return limiter.limit
+
+        self.assertEqual(4, asyncio.run(run_round()))
+
+    def test_limit_never_below_minimum(self):
+        async def run_rounds():
+            limiter = AdaptiveConcurrencyLimiter(initial_limit=2, maximum_limit=100, minimum_limit=2)
+            for _ in range(3):
+                limiter.release(await limiter.acquire(), overloaded=True)
+            return limiter.limit
+
+        self.assertEqual(2, asyncio.run(run_rounds()))
+
+    def test_slow_request_decreases_limit(self):
+        async def run_requests():
+            limiter = AdaptiveConcurrencyLimiter(initial_limit=8, maximum_limit=8, latency_tolerance=3.0)
+            # Backdate dispatch times to simulate requests taking 1s, then one taking 10s
+            for _ in range(4):
+                limiter.release(await limiter.acquire() - 1)
+            limiter.release(await limiter.acquire() - 10)
+            return limiter.limit
+
+        self.assertEqual(4, asyncio.run(run_requests()))
+
+    def test_mixed_fast_and_slow_requests_only_decrease_limit_if_latency_tolerated(self):
+        async def run_rounds(latency_tolerance):
+            limiter = AdaptiveConcurrencyLimiter(initial_limit=4, maximum_limit=100,
+                                                 latency_tolerance=latency_tolerance)
+            # Backdate dispatch times to simulate rounds of requests taking 1s then 60s, e.g. work found already done
+            # then work to do
+            for round_latency in [1, 60, 1, 60]:
+                dispatch_times = [await limiter.acquire() - round_latency for _ in range(limiter.limit)]
+                for dispatch_time in dispatch_times:
+                    limiter.release(dispatch_time)
+            return limiter.limit
+
+        self.assertEqual(64, asyncio.run(run_rounds(None)))
+        self.assertLess(asyncio.run(run_rounds(3.0)), 16)
+
+    def test_requests_wait_for_a_slot(self):
+        async def run_requests():
+            limiter = AdaptiveConcurrencyLimiter(initial_limit=1, maximum_limit=1)
+            first_dispatch_time = await limiter.acquire()
+
+            second_request = asyncio.ensure_future(limiter.acquire())
+            await asyncio.sleep(0)
+            self.assertFalse(second_request.done())
+
+            limiter.release(first_dispatch_time)
+            await second_request
+            return limiter.in_flight
+
+        self.assertEqual(1, asyncio.run(run_requests()))
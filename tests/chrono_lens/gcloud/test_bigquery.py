@@ -1,6 +1,10 @@
-from unittest import TestCase
+from unittest import TestCase, mock
+from unittest.mock import MagicMock
 
-from chrono_lens.gcloud.bigquery import convert_model_name_to_table_name
+from google.api_core.exceptions import NotFound, Conflict
+
+from chrono_lens.gcloud.bigquery import convert_model_name_to_table_name, create_model_results_row, create_row_id, \
+    create_table_schema, BufferedBigQueryWriter, TableCache
 
 
 class TestBigQuery(TestCase):
@@ -22,3 +26,200 @@ class TestBigQuery(TestCase):
         actual_table_name = convert_model_name_to_table_name(model_blob_name)
 
         self.assertEqual(expected_table_name, actual_table_name)
+
+
+class TestModelResultsRows(TestCase):
+
+    def test_row_created_from_image_blob_name_and_results(self):
+        row = create_model_results_row('Durham-images/20200510/0010/sd_durhamcouncil09.jpg',
+                                       {'car': 3, 'faulty': False})
+
+        self.assertEqual({'source': 'Durham-images', 'camera_id': 'sd_durhamcouncil09', 'date': '2020-05-10',
+                          'time': '00:10:00', 'car': 3, 'faulty': False}, row)
+        self.assertEqual('sd_durhamcouncil09_Durham-images_2020-05-10_00:10:00', create_row_id(row))
+
+    def test_schema_created_from_result_types(self):
+        self.assertEqual({'source': 'STRING', 'camera_id': 'STRING', 'date': 'DATE', 'time': 'TIME',
+                          'car': 'INTEGER', 'faulty': 'BOOLEAN'},
+                         create_table_schema({'car': 3, 'faulty': False}))
+
+        with self.assertRaises(ValueError):
+            create_table_schema({'car': 3.5})
+
+
+class TestBufferedBigQueryWriter(TestCase):
+
+    def setUp(self):
+        self.bigquery_client = MagicMock()
+        self.bigquery_client.insert_rows_json.return_value = []
+        self.table_cache = TableCache()
+        self.writer = BufferedBigQueryWriter(self.bigquery_client, 'project', 'dataset', maximum_buffered_rows=3,
+                                             table_cache=self.table_cache)
+
+    def add_model_results(self, camera_id, model_blob_name='NewcastleV0'):
+        self.writer.add_model_results(model_blob_name, f'Durham-images/20200510/0010/{camera_id}.jpg',
+                                      {'car': 3, 'faulty': False})
+
+    def test_rows_buffered_until_flushed(self):
+        self.add_model_results('camera1')
+        self.add_model_results('camera2')
+
+        self.bigquery_client.insert_rows_json.assert_not_called()
+        self.assertEqual(2, len(self.writer))
+
+        self.assertEqual([], self.writer.flush())
+
+        self.bigquery_client.get_table.assert_called_once_with('project.dataset.NewcastleV0')
+        table = self.bigquery_client.get_table.return_value
+        rows = [create_model_results_row(f'Durham-images/20200510/0010/{camera_id}.jpg', {'car': 3, 'faulty': False})
+                for camera_id in ['camera1', 'camera2']]
+        self.bigquery_client.insert_rows_json.assert_called_once_with(
+            table, rows, row_ids=[create_row_id(row) for row in rows])
+        self.assertEqual(0, len(self.writer))
+
+    def test_rows_inserted_when_maximum_buffered(self):
+        for camera_id in ['camera1', 'camera2', 'camera3', 'camera4']:
+            self.add_model_results(camera_id)
+
+        self.assertEqual(1, self.bigquery_client.insert_rows_json.call_count)
+        self.assertEqual(3, len(self.bigquery_client.insert_rows_json.call_args[0][1]))
+        self.assertEqual(1, len(self.writer))
+
+    @mock.patch('chrono_lens.gcloud.bigquery.time')
+    def test_rows_inserted_when_oldest_too_old(self, mock_time):
+        mock_time.monotonic.side_effect = [100, 100, 129, 130, 131]
+        writer = BufferedBigQueryWriter(self.bigquery_client, 'project', 'dataset', maximum_buffer_age_seconds=30,
+                                        table_cache=self.table_cache)
+
+        for camera_id in ['camera1', 'camera2', 'camera3']:
+            writer.add_model_results('NewcastleV0', f'Durham-images/20200510/0010/{camera_id}.jpg', {'car': 1})
+            if camera_id == 'camera2':
+                self.bigquery_client.insert_rows_json.assert_not_called()
+
+        self.assertEqual(1, self.bigquery_client.insert_rows_json.call_count)
+        self.assertEqual(3, len(self.bigquery_client.insert_rows_json.call_args[0][1]))
+
+    def test_rows_inserted_per_table(self):
+        self.add_model_results('camera1', model_blob_name='NewcastleV0')
+        self.add_model_results('camera1', model_blob_name='NewcastleV0_StaticMaskFilterV0')
+        self.writer.flush()
+
+        self.assertCountEqual([mock.call('project.dataset.NewcastleV0'),
+                               mock.call('project.dataset.NewcastleV0_StaticMaskFilterV0')],
+                              self.bigquery_client.get_table.call_args_list)
+        self.assertEqual(2, self.bigquery_client.insert_rows_json.call_count)
+
+    def test_table_looked_up_once(self):
+        self.add_model_results('camera1')
+        self.writer.flush()
+        self.add_model_results('camera2')
+        self.writer.flush()
+
+        self.bigquery_client.get_table.assert_called_once()
+        self.assertEqual(2, self.bigquery_client.insert_rows_json.call_count)
+
+    def test_missing_table_created_with_schema_of_results(self):
+        self.bigquery_client.get_table.side_effect = NotFound('no table')
+
+        with self.writer:
+            self.add_model_results('camera1')
+
+        created_table = self.bigquery_client.create_table.call_args[0][0]
+        self.assertEqual('NewcastleV0', created_table.table_id)
+        self.assertEqual([('source', 'STRING'), ('camera_id', 'STRING'), ('date', 'DATE'), ('time', 'TIME'),
+                          ('car', 'INTEGER'), ('faulty', 'BOOLEAN')],
+                         [(field.name, field.field_type) for field in created_table.schema])
+        self.assertEqual('date', created_table.time_partitioning.field)
+        self.bigquery_client.insert_rows_json.assert_called_once()
+        self.assertIs(self.bigquery_client.create_table.return_value,
+                      self.bigquery_client.insert_rows_json.call_args[0][0])
+
+    def test_insertion_errors_returned_once_with_row_ids(self):
+        error = {'index': 1, 'errors': [{'reason': 'invalid', 'message': 'no such field.'}]}
+        self.bigquery_client.insert_rows_json.return_value = [error]
+        for camera_id in ['camera1', 'camera2', 'camera3']:
+            self.add_model_results(camera_id)
+
+        self.bigquery_client.insert_rows_json.return_value = []
+        self.assertEqual([dict(error, table_name='NewcastleV0', row_id='camera2_Durham-images_2020-05-10_00:10:00')],
+                         self.writer.flush())
+        self.assertEqual([], self.writer.flush())
+
+    def test_rows_inserted_into_recreated_table_if_table_deleted(self):
+        self.add_model_results('camera1')
+        self.writer.flush()
+
+        self.bigquery_client.get_table.side_effect = NotFound('no table')
+        self.bigquery_client.insert_rows_json.side_effect = [NotFound('no table'), []]
+        self.add_model_results('camera2')
+
+        self.assertEqual([], self.writer.flush())
+        self.bigquery_client.create_table.assert_called_once()
+        self.assertIs(self.bigquery_client.create_table.return_value,
+                      self.bigquery_client.insert_rows_json.call_args[0][0])
+
+    def test_discarded_rows_not_inserted(self):
+        self.add_model_results('camera1')
+        self.writer.discard()
+
+        self.assertEqual([], self.writer.flush())
+        self.bigquery_client.insert_rows_json.assert_not_called()
+
+
+class TestTableCache(TestCase):
+
+    def setUp(self):
+        self.bigquery_client = MagicMock()
+        self.table_cache = TableCache(ttl_seconds=60)
+
+    def test_existing_table_cached(self):
+        table = self.table_cache.get_table(self.bigquery_client, 'project.dataset.table')
+
+        self.assertIs(self.bigquery_client.get_table.return_value, table)
+        self.assertIs(table, self.table_cache.get_table(self.bigquery_client, 'project.dataset.table'))
+        self.bigquery_client.get_table.assert_called_once_with('project.dataset.table')
+        self.assertIn('project.dataset.table', self.table_cache)
+
+    def test_missing_table_not_cached(self):
+        self.bigquery_client.get_table.side_effect = NotFound('no table')
+
+        self.assertIsNone(self.table_cache.get_table(self.bigquery_client, 'project.dataset.table'))
+        self.assertIsNone(self.table_cache.get_table(self.bigquery_client, 'project.dataset.table'))
+        self.assertEqual(2, self.bigquery_client.get_table.call_count)
+        self.assertEqual(0, len(self.table_cache))
+
+    @mock.patch('chrono_lens.gcloud.bigquery.time')
+    def test_table_looked_up_again_once_expired(self, mock_time):
+        mock_time.monotonic.side_effect = [0, 59, 60, 60]
+
+        for _ in range(3):
+            self.table_cache.get_table(self.bigquery_client, 'project.dataset.table')
+
+        self.assertEqual(2, self.bigquery_client.get_table.call_count)
+
+    def test_invalidated_table_looked_up_again(self):
+        self.table_cache.get_table(self.bigquery_client, 'project.dataset.table')
+        self.table_cache.invalidate('project.dataset.table')
+        self.table_cache.get_table(self.bigquery_client, 'project.dataset.table')
+
+        self.assertEqual(2, self.bigquery_client.get_table.call_count)
+
+    def test_missing_table_created(self):
+        self.bigquery_client.get_table.side_effect = NotFound('no table')
+        table_definition = MagicMock()
+
+        table = self.table_cache.get_or_create_table(self.bigquery_client, 'project.dataset.table',
+                                                     lambda: table_definition)
+
+        self.bigquery_client.create_table.assert_called_once_with(table_definition)
+        self.assertIs(self.bigquery_client.create_table.return_value, table)
+        self.assertIs(table, self.table_cache.get_table(self.bigquery_client, 'project.dataset.table'))
+
+    def test_table_created_by_another_instance_looked_up(self):
+        table = MagicMock()
+        self.bigquery_client.get_table.side_effect = [NotFound('no table'), table]
+        self.bigquery_client.create_table.side_effect = Conflict('Already Exists: Table project:dataset.table')
+
+        self.assertIs(table, self.table_cache.get_or_create_table(self.bigquery_client, 'project.dataset.table',
+                                                                  MagicMock))
+        self.assertIn('project.dataset.table', self.table_cache)
@@ -16,7 +16,7 @@ class TestProcessImages(unittest.TestCase):
 
     @patch('chrono_lens.gcloud.process_images.google.oauth2.service_account')
     @patch('chrono_lens.gcloud.process_images.google.auth.transport.requests')
-    @patch('chrono_lens.gcloud.process_images.run_cloud_function_async_with_parameter_list')
+    @patch('chrono_lens.gcloud.process_images.run_cloud_function_async_with_parameter_list_as_completed')
     def test_all_args_correct(self, mock_run_cloud, _mock_requests, _mock_service_account):
         number_of_days = 3
         start_date = datetime.date(year=2020, month=10, day=1)
@@ -42,7 +42,7 @@ class TestProcessImages(unittest.TestCase):
         # ]
         responses = [[{'STATUS': 'OK', 'Counts': {'Processed': 142, 'Faulty': 2}}] * (total_num_images - 1)
                      + [{'STATUS': 'Errored', 'Message': "Sorry about that"}]] * number_of_days
-        mock_run_cloud.side_effect = responses
+        mock_run_cloud.side_effect = [zip(camera_ids_to_analyse['test'], response) for response in responses]
 
         results, errors = process_images.run_model_on_images(
             start_date=start_date,
@@ -68,3 +68,5 @@ class TestProcessImages(unittest.TestCase):
 
         self.assertListEqual([{'STATUS': 'Errored', 'Message': "Sorry about that"}] * 3,
                              errors)
+        # Already processed camera-days return far faster than those processed, so latency is not taken as overload
+        self.assertIsNone(mock_run_cloud.call_args[1]['latency_tolerance'])
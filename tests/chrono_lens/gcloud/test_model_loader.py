@@ -0,0 +1,69 @@
+import base64
+import hashlib
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from chrono_lens.gcloud.model_loader import load_model_blob_with_local_copy
+
+
+def create_mock_model_bucket(model_data):
+    mock_blob = MagicMock()
+    mock_blob.download_as_string.return_value = model_data
+    mock_blob.md5_hash = base64.b64encode(hashlib.md5(model_data).digest()).decode('ascii')
+
+    mock_bucket = MagicMock()
+    mock_bucket.blob.return_value = mock_blob
+
+    return mock_bucket, mock_blob
+
+
+class TestModelLoader(TestCase):
+    def setUp(self):
+        self.temporary_folder = tempfile.TemporaryDirectory()
+        self.local_folder = self.temporary_folder.name
+
+    def tearDown(self):
+        self.temporary_folder.cleanup()
+
+    def test_blob_downloaded_and_local_copy_written(self):
+        mock_bucket, mock_blob = create_mock_model_bucket(b'serialized graph')
+
+        model_data = load_model_blob_with_local_copy('NewcastleV0/model.pb', mock_bucket, self.local_folder)
+
+        self.assertEqual(b'serialized graph', model_data)
+        mock_blob.download_as_string.assert_called_once()
+        with open(os.path.join(self.local_folder, 'NewcastleV0', 'model.pb'), 'rb') as local_file:
+            self.assertEqual(b'serialized graph', local_file.read())
+
+    def test_valid_local_copy_reused(self):
+        mock_bucket, mock_blob = create_mock_model_bucket(b'serialized graph')
+        load_model_blob_with_local_copy('NewcastleV0/model.pb', mock_bucket, self.local_folder)
+
+        model_data = load_model_blob_with_local_copy('NewcastleV0/model.pb', mock_bucket, self.local_folder)
+
+        self.assertEqual(b'serialized graph', model_data)
+        mock_blob.download_as_string.assert_called_once()
+
+    def test_local_copy_replaced_when_checksum_differs(self):
+        os.makedirs(os.path.join(self.local_folder, 'NewcastleV0'))
+        with open(os.path.join(self.local_folder, 'NewcastleV0', 'model.pb'), 'wb') as local_file:
+            local_file.write(b'corrupt or out of date graph')
+        mock_bucket, mock_blob = create_mock_model_bucket(b'serialized graph')
+
+        model_data = load_model_blob_with_local_copy('NewcastleV0/model.pb', mock_bucket, self.local_folder)
+
+        self.assertEqual(b'serialized graph', model_data)
+        mock_blob.download_as_string.assert_called_once()
+        with open(os.path.join(self.local_folder, 'NewcastleV0', 'model.pb'), 'rb') as local_file:
+            self.assertEqual(b'serialized graph', local_file.read())
+
+    def test_no_local_folder_always_downloads(self):
+        mock_bucket, mock_blob = create_mock_model_bucket(b'serialized graph')
+
+        load_model_blob_with_local_copy('NewcastleV0/model.pb', mock_bucket, None)
+        model_data = load_model_blob_with_local_copy('NewcastleV0/model.pb', mock_bucket, None)
+
+        self.assertEqual(b'serialized graph', model_data)
+        self.assertEqual(2, mock_blob.download_as_string.call_count)
@@ -0,0 +1,188 @@
+import datetime
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+import google
+
+from chrono_lens.gcloud.bigquery import BufferedBigQueryWriter, TableCache, create_model_results_row
+from chrono_lens.gcloud.image_loader import PrefetchingBucketImageStore
+from chrono_lens.gcloud.object_counting import ObjectCounter, count_objects_and_write, status_of_object_results
+from chrono_lens.images.download_records import create_identical_image_marker
+from tests.chrono_lens.images.image_reader import create_jpeg
+
+image_blob_name = 'Durham-images/20200510/0010/camera1.jpg'
+
+
+def create_mock_bucket(blob_name_to_data):
+    # Blobs not listed are missing
+    def create_mock_blob(blob_name):
+        mock_blob = MagicMock()
+        if blob_name in blob_name_to_data:
+            mock_blob.download_as_string.return_value = blob_name_to_data[blob_name]
+        else:
+            mock_blob.download_as_string.side_effect = google.api_core.exceptions.NotFound('')
+        return mock_blob
+
+    mock_bucket = MagicMock()
+    mock_bucket.blob.side_effect = create_mock_blob
+    return mock_bucket
+
+
+class FakeDetector:
+    def __init__(self, detected_objects):
+        self.detected_objects = detected_objects
+        self.detected_image_shapes = []
+
+    def detected_object_types(self):
+        return ['car', 'person']
+
+    def detect(self, img_color_rgb):
+        self.detected_image_shapes.append(img_color_rgb.shape)
+        return self.detected_objects
+
+
+class TestObjectCounter(TestCase):
+
+    def setUp(self):
+        self.detector = FakeDetector([('car', 0.9), ('Car ', 0.8), ('person', 0.7)])
+        self.object_counter = ObjectCounter()
+        self.object_counter.detector_cache.get_or_create('NewcastleV0', lambda: self.detector)
+        self.model_bucket = create_mock_bucket({})
+
+    def test_objects_counted_by_type(self):
+        data_bucket = create_mock_bucket({image_blob_name: create_jpeg()})
+
+        object_results = self.object_counter.count_objects(image_blob_name, 'NewcastleV0', data_bucket,
+                                                           self.model_bucket)
+
+        self.assertEqual({'car': 2, 'person': 1, 'faulty': False, 'missing': False}, object_results)
+        self.assertEqual([(32, 32, 3)], self.detector.detected_image_shapes)
+
+    def test_missing_image_reported_without_detection(self):
+        object_results = self.object_counter.count_objects(image_blob_name, 'NewcastleV0', create_mock_bucket({}),
+                                                           self.model_bucket)
+
+        self.assertEqual({'car': 0, 'person': 0, 'faulty': False, 'missing': True}, object_results)
+        self.assertEqual([], self.detector.detected_image_shapes)
+
+    def test_undecodable_image_reported_faulty(self):
+        data_bucket = create_mock_bucket({image_blob_name: b'not a jpeg'})
+
+        object_results = self.object_counter.count_objects(image_blob_name, 'NewcastleV0', data_bucket,
+                                                           self.model_bucket)
+
+        self.assertEqual({'car': 0, 'person': 0, 'faulty': True, 'missing': False}, object_results)
+
+    def test_identical_image_counted_from_slot_holding_image(self):
+        data_bucket = create_mock_bucket({
+            'Durham-images/20200510/0000/camera1.jpg': create_jpeg(),
+            'Durham-images/20200510/0010/camera1.identical.json': create_identical_image_marker(
+                {'image_date_time': '20200510 0000'})
+        })
+
+        object_results = self.object_counter.count_objects(image_blob_name, 'NewcastleV0', data_bucket,
+                                                           self.model_bucket)
+
+        self.assertEqual({'car': 2, 'person': 1, 'faulty': False, 'missing': False}, object_results)
+
+    def test_decoded_images_reused(self):
+        data_bucket = create_mock_bucket({image_blob_name: create_jpeg()})
+
+        self.object_counter.count_objects(image_blob_name, 'NewcastleV0', data_bucket, self.model_bucket)
+        self.object_counter.count_objects(image_blob_name, 'NewcastleV0', data_bucket, self.model_bucket)
+
+        data_bucket.blob.assert_called_once_with(image_blob_name)
+
+    def test_unknown_stages_raise_errors(self):
+        data_bucket = create_mock_bucket({image_blob_name: create_jpeg()})
+
+        with self.assertRaisesRegex(ValueError, 'Model post-process stage is unknown: "UnknownV0"'):
+            self.object_counter.count_objects(image_blob_name, 'NewcastleV0_UnknownV0', data_bucket,
+                                              self.model_bucket)
+
+        with self.assertRaisesRegex(ValueError, 'Model object detector stage is unknown: "UnknownV0"'):
+            self.object_counter.count_objects(image_blob_name, 'UnknownV0', data_bucket, self.model_bucket)
+
+    def test_batch_downloads_images_and_neighbours_once_and_returns_results_in_order(self):
+        image_blob_names = [f'Durham-images/20200510/{time}/camera1.jpg' for time in ['0020', '0010']]
+        data_bucket = create_mock_bucket({
+            'Durham-images/20200510/0000/camera1.jpg': create_jpeg(),
+            'Durham-images/20200510/0010/camera1.jpg': create_jpeg()
+        })
+
+        object_results_per_image = self.object_counter.count_objects_in_batch(
+            image_blob_names + [image_blob_name], 'NewcastleV0', data_bucket, self.model_bucket)
+
+        self.assertEqual([{'car': 0, 'person': 0, 'faulty': False, 'missing': True},
+                          {'car': 2, 'person': 1, 'faulty': False, 'missing': False},
+                          {'car': 2, 'person': 1, 'faulty': False, 'missing': False}], object_results_per_image)
+        # Each image slot (and the identical image marker of each missing image) downloaded once, from 0000 to 0030
+        expected_blob_names = [f'Durham-images/20200510/{time}/camera1.jpg'
+                               for time in ['0000', '0010', '0020', '0030']]
+        expected_blob_names += [f'Durham-images/20200510/{time}/camera1.identical.json' for time in ['0020', '0030']]
+        self.assertCountEqual(expected_blob_names, [call_args[0][0] for call_args in data_bucket.blob.call_args_list])
+        self.assertEqual(0, len(self.object_counter.image_cache))
+
+
+class TestPrefetchingBucketImageStore(TestCase):
+
+    def test_prefetched_images_and_markers_read_from_memory(self):
+        image_date_time = datetime.datetime(2020, 5, 10, 0, 10)
+        previous_date_time = datetime.datetime(2020, 5, 10, 0, 0)
+        data_bucket = create_mock_bucket({
+            'Durham-images/20200510/0000/camera1.jpg': create_jpeg(),
+            'Durham-images/20200510/0010/camera1.identical.json': create_identical_image_marker(
+                {'image_date_time': '20200510 0000'})
+        })
+        image_store = PrefetchingBucketImageStore(data_bucket)
+
+        image_store.prefetch([('Durham-images', image_date_time, 'camera1'),
+                              ('Durham-images', previous_date_time, 'camera1')])
+        data_bucket.blob.reset_mock()
+
+        self.assertIsNone(image_store.load_image_frame('Durham-images', image_date_time, 'camera1'))
+        self.assertEqual(previous_date_time,
+                         image_store.load_identical_image_date_time('Durham-images', image_date_time, 'camera1'))
+        self.assertEqual((32, 32, 3),
+                         image_store.load_image_frame('Durham-images', previous_date_time, 'camera1').image_rgb.shape)
+        data_bucket.blob.assert_not_called()
+
+        # Images not prefetched are read from the bucket
+        self.assertIsNone(image_store.load_image_frame('Durham-images', previous_date_time, 'camera2'))
+        data_bucket.blob.assert_called_once_with('Durham-images/20200510/0000/camera2.jpg')
+
+    def test_maximum_download_workers_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            PrefetchingBucketImageStore(create_mock_bucket({}), maximum_download_workers=0)
+
+
+class TestCountObjectsAndWrite(TestCase):
+
+    def setUp(self):
+        self.object_counter = ObjectCounter()
+        self.object_counter.detector_cache.get_or_create('NewcastleV0', lambda: FakeDetector([('car', 0.9)]))
+
+        self.bigquery_client = MagicMock()
+        self.bigquery_client.insert_rows_json.return_value = []
+        self.bigquery_writer = BufferedBigQueryWriter(self.bigquery_client, 'project', 'dataset',
+                                                      table_cache=TableCache())
+
+    def test_results_buffered_for_bigquery(self):
+        data_bucket = create_mock_bucket({image_blob_name: create_jpeg()})
+
+        status, object_results = count_objects_and_write(self.object_counter, self.bigquery_writer, image_blob_name,
+                                                         'NewcastleV0', data_bucket, create_mock_bucket({}))
+
+        self.assertEqual('Processed', status)
+        self.assertEqual({'car': 1, 'person': 0, 'faulty': False, 'missing': False}, object_results)
+        self.bigquery_client.insert_rows_json.assert_not_called()
+
+        self.assertEqual([], self.bigquery_writer.flush())
+        self.bigquery_client.get_table.assert_called_once_with('project.dataset.NewcastleV0')
+        self.assertEqual([create_model_results_row(image_blob_name, object_results)],
+                         self.bigquery_client.insert_rows_json.call_args[0][1])
+
+    def test_status_of_results(self):
+        self.assertEqual('Faulty', status_of_object_results({'faulty': True, 'missing': False}))
+        self.assertEqual('Missing', status_of_object_results({'faulty': False, 'missing': True}))
+        self.assertEqual('Processed', status_of_object_results({'faulty': False, 'missing': False}))
@@ -1,6 +1,7 @@
 import os.path
 
 import cv2
+import numpy
 
 
 def read_test_image(filename, sub_folder_name='time_series', parent_folder='.'):
@@ -19,3 +20,7 @@ def read_test_image_as_raw_bytes(filename, sub_folder_name='time_series', parent
 
     assert image is not None, f'Failed to load image "{filename}"'
     return image
+
+
+def create_jpeg(grey_level=128):
+    return cv2.imencode('.jpg', numpy.full((32, 32, 3), grey_level, numpy.uint8))[1].tobytes()
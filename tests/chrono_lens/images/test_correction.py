@@ -1,9 +1,11 @@
 from unittest import TestCase
+from unittest.mock import patch
 
 import cv2
 import numpy as np
 
-from chrono_lens.images.correction import resize_jpeg_image
+from chrono_lens.images.correction import resize_jpeg_image, jpeg_image_dimensions
+from tests.chrono_lens.images.image_reader import read_test_image, read_test_image_as_raw_bytes
 
 
 class TestCorrection(TestCase):
@@ -52,3 +54,56 @@ class TestCorrection(TestCase):
         actual_image_bytes = np.asarray(bytearray(actual_bytes), dtype="uint8")
         actual_image = cv2.imdecode(actual_image_bytes, cv2.IMREAD_COLOR)
         self.assertEqual(actual_image.shape, (30, 60, 3))
+
+    def test_jpeg_image_dimensions_read_from_header(self):
+        for image_file_name in ['TfL-images-20200501-0040-00001.08859.jpg',
+                                'NETravelData-images_20200508_1040_CM_A69A1-View_02.jpg']:
+            with self.subTest(image_file_name=image_file_name):
+                self.assertEqual(read_test_image(image_file_name).shape[:2],
+                                 jpeg_image_dimensions(read_test_image_as_raw_bytes(image_file_name)))
+
+    def test_jpeg_image_dimensions_of_other_data_is_none(self):
+        _, png_encoded_array = cv2.imencode('.png', np.zeros((10, 20, 3), dtype=np.uint8))
+
+        self.assertIsNone(jpeg_image_dimensions(png_encoded_array.tobytes()))
+        self.assertIsNone(jpeg_image_dimensions(b'not an image'))
+        self.assertIsNone(jpeg_image_dimensions(b'\xff\xd8\xff\xe0\x00'))
+        self.assertIsNone(jpeg_image_dimensions(b''))
+
+    def test_small_image_returned_without_decoding(self):
+        raw_image = read_test_image_as_raw_bytes('TfL-images-20200501-0040-00001.08859.jpg')
+
+        with patch('chrono_lens.images.correction.cv2.imdecode') as mock_imdecode:
+            actual_bytes = resize_jpeg_image(raw_image, 440)
+
+        self.assertEqual(raw_image, actual_bytes)
+        mock_imdecode.assert_not_called()
+
+    def test_much_larger_image_decoded_reduced_and_matches_full_size_resize(self):
+        image = cv2.resize(read_test_image('NETravelData-images_20200508_1040_CM_A69A1-View_02.jpg'), (1920, 1080))
+        _, encoded_array = cv2.imencode('.jpg', image)
+        encoded_bytes = encoded_array.tobytes()
+        expected_image = cv2.resize(cv2.imdecode(encoded_array, cv2.IMREAD_COLOR), (440, 247),
+                                    interpolation=cv2.INTER_AREA)
+
+        actual_bytes = resize_jpeg_image(encoded_bytes, 440)
+
+        actual_image = cv2.imdecode(np.frombuffer(actual_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        self.assertEqual((247, 440, 3), actual_image.shape)
+        # Reduced decoding and JPEG re-encoding differ slightly from a full size decode and resize
+        self.assertLess(np.abs(actual_image.astype(int) - expected_image).mean(), 4)
+
+    def test_large_image_of_other_format_decoded_to_find_size(self):
+        _, encoded_array = cv2.imencode('.png', np.full((100, 50, 3), 128, dtype=np.uint8))
+
+        actual_bytes = resize_jpeg_image(encoded_array.tobytes(), 50)
+
+        actual_image = cv2.imdecode(np.frombuffer(actual_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        self.assertEqual((50, 25, 3), actual_image.shape)
+
+    def test_large_image_with_corrupt_data_returns_none(self):
+        _, encoded_array = cv2.imencode('.jpg', np.full((100, 50, 3), 128, dtype=np.uint8))
+        encoded_bytes = encoded_array.tobytes()
+
+        with patch('chrono_lens.images.correction.cv2.imdecode', return_value=None):
+            self.assertIsNone(resize_jpeg_image(encoded_bytes, 20))
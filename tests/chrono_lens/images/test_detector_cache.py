@@ -0,0 +1,70 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from chrono_lens.images.detector_cache import DetectorCache
+
+
+class TestDetectorCache(TestCase):
+
+    def test_detector_created_once(self):
+        detector_cache = DetectorCache()
+        create_detector = MagicMock(return_value=MagicMock())
+
+        first_detector = detector_cache.get_or_create('NewcastleV0', create_detector)
+        second_detector = detector_cache.get_or_create('NewcastleV0', create_detector)
+
+        self.assertIs(first_detector, second_detector)
+        create_detector.assert_called_once()
+
+    def test_alternating_models_within_limit_are_not_recreated(self):
+        detector_cache = DetectorCache(maximum_detectors=2)
+        create_detector_v0 = MagicMock(return_value=MagicMock())
+        create_detector_v1 = MagicMock(return_value=MagicMock())
+
+        for _ in range(3):
+            detector_cache.get_or_create('NewcastleV0', create_detector_v0)
+            detector_cache.get_or_create('NewcastleV1', create_detector_v1)
+
+        create_detector_v0.assert_called_once()
+        create_detector_v1.assert_called_once()
+        self.assertEqual(2, len(detector_cache))
+
+    def test_least_recently_used_detector_evicted_and_closed(self):
+        detector_cache = DetectorCache(maximum_detectors=2)
+        detector_v0 = MagicMock()
+        detector_v1 = MagicMock()
+        detector_v2 = MagicMock()
+
+        detector_cache.get_or_create('NewcastleV0', lambda: detector_v0)
+        detector_cache.get_or_create('NewcastleV1', lambda: detector_v1)
+        detector_cache.get_or_create('NewcastleV0', lambda: None)  # NewcastleV0 now most recently used
+        detector_cache.get_or_create('NewcastleV2', lambda: detector_v2)
+
+        self.assertIn('NewcastleV0', detector_cache)
+        self.assertNotIn('NewcastleV1', detector_cache)
+        self.assertIn('NewcastleV2', detector_cache)
+        detector_v1.close.assert_called_once()
+        detector_v0.close.assert_not_called()
+        detector_v2.close.assert_not_called()
+
+    def test_failed_creation_not_cached(self):
+        detector_cache = DetectorCache()
+
+        def fail_to_create_detector():
+            raise ValueError('Model object detector stage is unknown: "rhubarb"')
+
+        self.assertRaises(ValueError, detector_cache.get_or_create, 'rhubarb', fail_to_create_detector)
+        self.assertNotIn('rhubarb', detector_cache)
+
+    def test_clear_closes_detectors(self):
+        detector_cache = DetectorCache()
+        detector = MagicMock()
+        detector_cache.get_or_create('NewcastleV0', lambda: detector)
+
+        detector_cache.clear()
+
+        self.assertEqual(0, len(detector_cache))
+        detector.close.assert_called_once()
+
+    def test_maximum_detectors_must_be_positive(self):
+        self.assertRaisesRegex(ValueError, 'maximum_detectors must be at least 1, not 0', DetectorCache, 0)
@@ -0,0 +1,61 @@
+import datetime
+from unittest import TestCase
+
+from chrono_lens.images.download_records import identical_image_marker_name, previous_download_record_if_adjacent, \
+    conditional_request_headers, is_identical_to_previous, create_download_record, create_identical_image_marker, \
+    identical_image_date_time_of, content_hash_of
+
+
+class TestDownloadRecords(TestCase):
+
+    def setUp(self):
+        self.date_time = datetime.datetime(2020, 5, 1, 0, 50)
+        self.previous_download_record = {
+            'content_hash': content_hash_of(b'image'),
+            'image_date_time': '20200501 0030',
+            'date_time': '20200501 0040',
+            'etag': '"abc"',
+            'last_modified': 'Fri, 01 May 2020 00:30:00 GMT'
+        }
+
+    def test_identical_image_marker_name_replaces_extension(self):
+        self.assertEqual('source/20200501/0040/00001.08859.identical.json',
+                         identical_image_marker_name('source/20200501/0040/00001.08859.jpg'))
+        self.assertEqual('source/20200501/0040/camera.identical.json',
+                         identical_image_marker_name('source/20200501/0040/camera'))
+
+    def test_previous_download_record_only_used_for_next_slot(self):
+        self.assertIs(self.previous_download_record,
+                      previous_download_record_if_adjacent(self.previous_download_record, self.date_time))
+        self.assertIsNone(previous_download_record_if_adjacent(
+            self.previous_download_record, self.date_time + datetime.timedelta(minutes=10)))
+        self.assertIsNone(previous_download_record_if_adjacent({}, self.date_time))
+        self.assertIsNone(previous_download_record_if_adjacent(None, self.date_time))
+
+    def test_conditional_request_headers_from_validators(self):
+        self.assertEqual({'If-None-Match': '"abc"', 'If-Modified-Since': 'Fri, 01 May 2020 00:30:00 GMT'},
+                         conditional_request_headers(self.previous_download_record))
+        self.assertEqual({}, conditional_request_headers({'content_hash': 'abc'}))
+        self.assertEqual({}, conditional_request_headers(None))
+
+    def test_identical_if_not_modified_or_content_unchanged(self):
+        self.assertTrue(is_identical_to_previous(304, b'', self.previous_download_record))
+        self.assertTrue(is_identical_to_previous(200, b'image', self.previous_download_record))
+        self.assertFalse(is_identical_to_previous(200, b'other image', self.previous_download_record))
+        self.assertFalse(is_identical_to_previous(404, b'image', self.previous_download_record))
+        self.assertFalse(is_identical_to_previous(200, b'image', None))
+
+    def test_download_record_of_new_image(self):
+        download_record = create_download_record(self.date_time, {'ETag': '"def"'}, b'other image',
+                                                 self.previous_download_record)
+
+        self.assertEqual({'content_hash': content_hash_of(b'other image'), 'image_date_time': '20200501 0050',
+                          'date_time': '20200501 0050', 'etag': '"def"'}, download_record)
+
+    def test_download_record_of_identical_image_refers_to_stored_image(self):
+        download_record = create_download_record(self.date_time, {},
+                                                 previous_download_record=self.previous_download_record)
+
+        self.assertEqual(dict(self.previous_download_record, date_time='20200501 0050'), download_record)
+        self.assertEqual(datetime.datetime(2020, 5, 1, 0, 30),
+                         identical_image_date_time_of(create_identical_image_marker(download_record)))
@@ -1,7 +1,75 @@
 from unittest import TestCase
 
+import numpy as np
+
 from chrono_lens.images.fault_detection import FaultyImageDetector
-from tests.chrono_lens.images.image_reader import read_test_image
+from chrono_lens.images.image_frame import ImageFrame
+from tests.chrono_lens.images.image_reader import read_test_image, read_test_image_as_raw_bytes
+
+# Previous, current and next images (file name, sub folder), covering each outcome of the faulty image checks
+FAULT_DETECTION_TIME_SERIES = [
+    (('TfL-images_20200620_2010_00001.01251.jpg', 'time_series'),
+     ('TfL-images_20200620_2020_00001.01251.jpg', 'time_series'),
+     ('TfL-images_20200620_2030_00001.01251.jpg', 'time_series')),
+    (('TfL-images-20200501-0040-00001.08859.jpg', 'time_series'),
+     ('TfL-images-20200501-0050-00001.08859.jpg', 'time_series'),
+     ('TfL-images-20200501-0050-00001.08859.jpg', 'time_series')),
+    (('TfL-images_20200502_0510_00001.06592.jpg', 'time_series'),
+     ('TfL-images_20200501_0520_00001.06592.jpg', 'failing_images'),
+     ('TfL-images_20200502_0530_00001.06592.jpg', 'time_series')),
+    (('TfL-images_20200504_0240_00001.08859.jpg', 'failing_images'),
+     ('TfL-images_20200504_0250_00001.08859.jpg', 'time_series'),
+     ('TfL-images-20200501-0100-00001.08859.jpg', 'time_series')),
+    (('NETravelData-images_20200508_1050_CM_A69A1-View_02.jpg', 'time_series'),
+     ('TfL-images-20200501-0050-00001.08859.jpg', 'time_series'),
+     ('NETravelData-images_20200508_1100_CM_A69A1-View_02.jpg', 'time_series')),
+    (('NETravelData-images_20200508_1050_NT_A191E1.jpg', 'time_series'),
+     ('NETravelData-images_20200508_1800_NT_A193H1.jpg', 'failing_images'),
+     ('NETravelData-images_20200508_1110_NT_A191E1.jpg', 'time_series')),
+]
+
+
+def reference_maximum_number_of_consecutive_matching_rows(current_rgb_image, row_similarity_threshold=0.8):
+    """ Original row-by-row implementation, retained to pin equivalence of the vectorised version """
+
+    def rows_match(row1, row2):
+        row_diff = row1 - row2
+        number_of_same_component = np.sum(row_diff == 0)
+        return number_of_same_component > row1.shape[0] * 3 * row_similarity_threshold
+
+    max_consecutive_row_match_count = 0
+    current_row_match_count = 0
+    for y in range(current_rgb_image.shape[0] - 1):
+        if rows_match(current_rgb_image[y], current_rgb_image[y + 1]):
+            current_row_match_count += 1
+        else:
+            if current_row_match_count > max_consecutive_row_match_count:
+                max_consecutive_row_match_count = current_row_match_count
+            current_row_match_count = 0
+    if current_row_match_count > max_consecutive_row_match_count:
+        max_consecutive_row_match_count = current_row_match_count
+
+    return max_consecutive_row_match_count
+
+
+def reference_largest_proportion_of_a_single_colour(img):
+    """ Original per-pixel implementation, retained to pin equivalence of the vectorised version """
+    quantised_range = 32
+    quantised_fraction = 256 / quantised_range
+
+    quantised_colours = np.zeros((quantised_range, quantised_range, quantised_range))
+    for y in range(0, img.shape[0], 4):
+        for x in range(0, img.shape[1], 4):
+            r, g, b = img[y, x, :]
+            quantised_r = int(r / quantised_fraction)
+            quantised_g = int(r / quantised_fraction)
+            quantised_b = int(r / quantised_fraction)
+            quantised_colours[quantised_r, quantised_g, quantised_b] += 16
+
+    highest_quantised_count = np.amax(quantised_colours)
+    largest_proportion = highest_quantised_count / (img.shape[0] * img.shape[1])
+
+    return largest_proportion
 
 
 class TestFaultyImageDetector(TestCase):
@@ -308,3 +376,124 @@ class TestFaultyImageDetector(TestCase):
         self.assertTrue(previous_is_comparable)
         self.assertFalse(current_is_faulty)
         self.assertFalse(next_is_comparable)
+
+    def test_maximum_number_of_consecutive_matching_rows_matches_reference_on_test_images(self):
+        faulty_image_filter = FaultyImageDetector()
+        test_images = [
+            read_test_image('TfL-images-20200501-0040-00001.08859.jpg'),
+            read_test_image('NETravelData-images_20200508_1050_CM_A69A1-View_02.jpg'),
+            read_test_image('TfL-images_20200504_0240_00001.08859.jpg', 'failing_images'),
+            read_test_image('TfL-images_20200501_0520_00001.06592.jpg', 'failing_images'),
+            read_test_image('NETravelData-images_20200508_1800_NT_A193H1.jpg', 'failing_images')
+        ]
+
+        for test_image in test_images:
+            self.assertEqual(reference_maximum_number_of_consecutive_matching_rows(test_image),
+                             faulty_image_filter.maximum_number_of_consecutive_matching_rows(test_image))
+
+    def test_maximum_number_of_consecutive_matching_rows_matches_reference_on_synthetic_images(self):
+        random_generator = np.random.default_rng(42)
+        for row_similarity_threshold in [0.0, 0.5, 0.8, 1.0]:
+            faulty_image_filter = FaultyImageDetector(row_similarity_threshold=row_similarity_threshold)
+
+            for height in [1, 2, 3, 17]:
+                test_image = random_generator.integers(0, 2, size=(height, 8, 3), dtype=np.uint8)
+                # Force some runs of repeated rows, including at the start and end of the image
+                test_image[height // 2:] = test_image[-1]
+                test_image[:height // 3] = test_image[0]
+
+                self.assertEqual(
+                    reference_maximum_number_of_consecutive_matching_rows(test_image, row_similarity_threshold),
+                    faulty_image_filter.maximum_number_of_consecutive_matching_rows(test_image),
+                    f'Mismatch with threshold={row_similarity_threshold}, height={height}')
+
+    def test_maximum_number_of_consecutive_matching_rows_all_rows_identical(self):
+        test_image = np.full((10, 4, 3), 128, dtype=np.uint8)
+        faulty_image_filter = FaultyImageDetector()
+
+        self.assertEqual(9, faulty_image_filter.maximum_number_of_consecutive_matching_rows(test_image))
+
+    def test_largest_proportion_of_a_single_colour_matches_reference_on_test_images(self):
+        faulty_image_filter = FaultyImageDetector()
+        test_images = [
+            read_test_image('TfL-images-20200501-0040-00001.08859.jpg'),
+            read_test_image('NETravelData-images_20200508_1050_CM_A69A1-View_02.jpg'),
+            read_test_image('TfL-images_20200504_0240_00001.08859.jpg', 'failing_images'),
+            read_test_image('TfL-images_20200501_0520_00001.06592.jpg', 'failing_images'),
+            read_test_image('NETravelData-images_20200508_1800_NT_A193H1.jpg', 'failing_images'),
+            np.zeros((7, 5, 3), dtype=np.uint8)
+        ]
+
+        for test_image in test_images:
+            self.assertAlmostEqual(reference_largest_proportion_of_a_single_colour(test_image),
+                                   faulty_image_filter.largest_proportion_of_a_single_colour(test_image))
+
+    def test_largest_proportion_of_a_single_colour_quantises_all_channels_when_requested(self):
+        # Left half green, right half blue: identical (zero) R components, so historically seen as a single colour
+        test_image = np.zeros((8, 8, 3), dtype=np.uint8)
+        test_image[:, :4, 1] = 255
+        test_image[:, 4:, 2] = 255
+
+        historical_faulty_image_filter = FaultyImageDetector()
+        corrected_faulty_image_filter = FaultyImageDetector(quantise_all_colour_channels=True)
+
+        self.assertAlmostEqual(1.0, historical_faulty_image_filter.largest_proportion_of_a_single_colour(test_image))
+        self.assertAlmostEqual(0.5, corrected_faulty_image_filter.largest_proportion_of_a_single_colour(test_image))
+
+    def test_largest_proportion_of_a_single_colour_with_configured_stride_and_quantisation(self):
+        test_image = np.zeros((4, 4, 3), dtype=np.uint8)
+        test_image[:, :, :] = [[[0, 0, 0], [1, 1, 1], [2, 2, 2], [3, 3, 3]]]
+
+        faulty_image_filter = FaultyImageDetector.from_configuration({
+            'identical_area_proportion_threshold': 0.33,
+            'row_similarity_threshold': 0.8,
+            'consecutive_matching_rows_threshold': 0.2,
+            'colour_sampling_stride': 1,
+            'colour_quantisation_levels': 256,
+            'quantise_all_colour_channels': True
+        })
+
+        self.assertAlmostEqual(0.25, faulty_image_filter.largest_proportion_of_a_single_colour(test_image))
+
+    def test_invalid_colour_quantisation_levels_rejected(self):
+        with self.assertRaises(ValueError):
+            FaultyImageDetector(colour_quantisation_levels=30)
+
+        with self.assertRaises(ValueError):
+            FaultyImageDetector(colour_quantisation_levels=512)
+
+    def test_invalid_colour_sampling_stride_rejected(self):
+        with self.assertRaises(ValueError):
+            FaultyImageDetector(colour_sampling_stride=0)
+
+    def test_invalid_comparison_image_reduction_rejected(self):
+        with self.assertRaises(ValueError):
+            FaultyImageDetector(comparison_image_reduction=3)
+
+    def test_constructed_from_configuration_with_comparison_image_reduction(self):
+        faulty_image_filter = FaultyImageDetector.from_configuration({
+            'identical_area_proportion_threshold': 0.33,
+            'row_similarity_threshold': 0.8,
+            'consecutive_matching_rows_threshold': 0.2,
+            'comparison_image_reduction': 2
+        })
+
+        self.assertEqual(2, faulty_image_filter.comparison_image_reduction)
+
+    def test_reduced_comparison_images_give_same_results_on_test_images(self):
+        expected_faulty_image_filter = FaultyImageDetector()
+
+        for time_series in FAULT_DETECTION_TIME_SERIES:
+            expected_result = expected_faulty_image_filter.check_current_faulty_and_next_previous_comparable(
+                *[read_test_image(filename, sub_folder_name) for filename, sub_folder_name in time_series])
+
+            for comparison_image_reduction in [2, 4]:
+                with self.subTest(time_series=time_series, comparison_image_reduction=comparison_image_reduction):
+                    image_frames = [ImageFrame.decode(read_test_image_as_raw_bytes(filename, sub_folder_name))
+                                    for filename, sub_folder_name in time_series]
+                    faulty_image_filter = FaultyImageDetector(comparison_image_reduction=comparison_image_reduction)
+
+                    actual_result = faulty_image_filter.check_current_faulty_and_next_previous_comparable(
+                        *image_frames)
+
+                    self.assertEqual(expected_result, actual_result)
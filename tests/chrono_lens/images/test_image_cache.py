@@ -0,0 +1,105 @@
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+import numpy as np
+
+from chrono_lens.images.fault_detection import FaultyImageDetector
+from chrono_lens.images.image_cache import ImageCache
+from chrono_lens.images.image_frame import ImageFrame
+from tests.chrono_lens.images.image_reader import read_test_image
+
+
+def create_image(height=10, width=10, value=0):
+    return np.full((height, width, 3), value, dtype=np.uint8)
+
+
+def create_image_frame():
+    return ImageFrame.from_rgb(create_image())
+
+
+class TestImageCache(TestCase):
+
+    def test_image_loaded_once(self):
+        image_cache = ImageCache()
+        load_image_frame = MagicMock(return_value=create_image_frame())
+        image_key = ('TfL-images', '00001.08859', datetime(2020, 5, 1, 0, 40))
+
+        first_cached_image = image_cache.get_or_load(image_key, load_image_frame)
+        second_cached_image = image_cache.get_or_load(image_key, load_image_frame)
+
+        self.assertIs(first_cached_image, second_cached_image)
+        load_image_frame.assert_called_once()
+
+    def test_missing_image_not_cached(self):
+        image_cache = ImageCache()
+        load_image_frame = MagicMock(return_value=None)
+        image_key = ('TfL-images', '00001.08859', datetime(2020, 5, 1, 0, 40))
+
+        self.assertIsNone(image_cache.get_or_load(image_key, load_image_frame))
+        self.assertIsNone(image_cache.get_or_load(image_key, load_image_frame))
+
+        self.assertEqual(2, load_image_frame.call_count)
+        self.assertNotIn(image_key, image_cache)
+
+    def test_least_recently_used_image_evicted_when_over_budget(self):
+        image_size_in_bytes = create_image_frame().nbytes
+        image_cache = ImageCache(maximum_bytes=2 * image_size_in_bytes)
+
+        image_cache.get_or_load('a', create_image_frame)
+        image_cache.get_or_load('b', create_image_frame)
+        image_cache.get_or_load('a', create_image_frame)  # 'a' now most recently used
+        image_cache.get_or_load('c', create_image_frame)
+
+        self.assertIn('a', image_cache)
+        self.assertNotIn('b', image_cache)
+        self.assertIn('c', image_cache)
+        self.assertEqual(2 * image_size_in_bytes, image_cache.current_bytes)
+
+    def test_zero_sized_cache_still_returns_images(self):
+        image_cache = ImageCache(maximum_bytes=0)
+
+        image_frame = image_cache.get_or_load('a', create_image_frame)
+
+        self.assertIsNotNone(image_frame)
+        self.assertEqual(0, len(image_cache))
+        self.assertEqual(0, image_cache.current_bytes)
+
+    def test_clear_empties_cache(self):
+        image_cache = ImageCache()
+        image_cache.get_or_load('a', create_image_frame)
+
+        image_cache.clear()
+
+        self.assertEqual(0, len(image_cache))
+        self.assertEqual(0, image_cache.current_bytes)
+
+    def test_faulty_image_detector_results_unchanged_when_using_image_frames(self):
+        test_image_previous = read_test_image('TfL-images-20200501-0040-00001.08859.jpg')
+        test_image_current = read_test_image('TfL-images_20200504_0240_00001.08859.jpg', 'failing_images')
+        test_image_next = read_test_image('TfL-images_20200504_0250_00001.08859.jpg')
+        faulty_image_filter = FaultyImageDetector()
+
+        expected_result = faulty_image_filter.check_current_faulty_and_next_previous_comparable(
+            test_image_previous, test_image_current, test_image_next)
+
+        image_frames = [ImageFrame.from_rgb(test_image) for test_image in
+                        (test_image_previous, test_image_current, test_image_next)]
+        for _ in range(2):
+            actual_result = faulty_image_filter.check_current_faulty_and_next_previous_comparable(*image_frames)
+
+            self.assertEqual(expected_result, actual_result)
+
+    def test_faulty_image_detectors_with_different_configurations_do_not_share_features(self):
+        test_image = read_test_image('TfL-images_20200504_0240_00001.08859.jpg', 'failing_images')
+        image_frame = ImageFrame.from_rgb(test_image)
+
+        strict_faulty_image_filter = FaultyImageDetector(row_similarity_threshold=1.0)
+        lenient_faulty_image_filter = FaultyImageDetector(row_similarity_threshold=0.0)
+
+        self.assertEqual(
+            strict_faulty_image_filter.maximum_number_of_consecutive_matching_rows(test_image),
+            strict_faulty_image_filter._cached_maximum_number_of_consecutive_matching_rows(image_frame))
+        self.assertEqual(
+            lenient_faulty_image_filter.maximum_number_of_consecutive_matching_rows(test_image),
+            lenient_faulty_image_filter._cached_maximum_number_of_consecutive_matching_rows(image_frame))
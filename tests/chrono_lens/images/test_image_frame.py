@@ -0,0 +1,131 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+import cv2
+import numpy as np
+
+from chrono_lens.images.image_frame import ImageFrame, image_frame_of
+from tests.chrono_lens.images.image_reader import read_test_image, read_test_image_as_raw_bytes
+
+
+class TestImageFrame(TestCase):
+
+    def test_greyscale_generated_once(self):
+        image_frame = ImageFrame.from_rgb(np.full((10, 10, 3), 128, dtype=np.uint8))
+
+        first_greyscale = image_frame.image_greyscale
+        second_greyscale = image_frame.image_greyscale
+
+        self.assertIs(first_greyscale, second_greyscale)
+        self.assertEqual((10, 10), first_greyscale.shape)
+
+    def test_rgb_generated_once(self):
+        image_frame = ImageFrame.from_bgr(read_test_image('TfL-images-20200501-0040-00001.08859.jpg'))
+
+        self.assertIs(image_frame.image_rgb, image_frame.image_rgb)
+
+    def test_feature_computed_once(self):
+        image_frame = ImageFrame.from_rgb(np.zeros((10, 10, 3), dtype=np.uint8))
+        compute_feature = MagicMock(return_value=42)
+
+        self.assertEqual(42, image_frame.feature('answer', compute_feature))
+        self.assertEqual(42, image_frame.feature('answer', compute_feature))
+
+        compute_feature.assert_called_once_with(image_frame.image_rgb)
+
+    def test_greyscale_matches_historical_conversion_from_bgr_or_rgb(self):
+        image_bgr = read_test_image('TfL-images-20200501-0040-00001.08859.jpg')
+        image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+        expected_greyscale = cv2.cvtColor(image_rgb, cv2.COLOR_BGR2GRAY)
+
+        np.testing.assert_array_equal(expected_greyscale, ImageFrame.from_bgr(image_bgr).image_greyscale)
+        np.testing.assert_array_equal(expected_greyscale, ImageFrame.from_rgb(image_rgb).image_greyscale)
+        np.testing.assert_array_equal(expected_greyscale, image_frame_of(image_rgb).image_greyscale)
+
+    def test_decode_matches_opencv_colour_decoding(self):
+        raw_image = read_test_image_as_raw_bytes('TfL-images-20200501-0040-00001.08859.jpg')
+        expected_image_bgr = read_test_image('TfL-images-20200501-0040-00001.08859.jpg')
+
+        image_frame = ImageFrame.decode(raw_image)
+
+        self.assertFalse(image_frame.is_empty)
+        self.assertEqual(expected_image_bgr.shape[:2], image_frame.shape)
+        np.testing.assert_array_equal(expected_image_bgr, image_frame.image_bgr)
+        np.testing.assert_array_equal(cv2.cvtColor(expected_image_bgr, cv2.COLOR_BGR2RGB), image_frame.image_rgb)
+
+    def test_greyscale_decoding_decodes_colour_only_when_asked(self):
+        raw_image = read_test_image_as_raw_bytes('TfL-images-20200501-0040-00001.08859.jpg')
+        expected_image_bgr = read_test_image('TfL-images-20200501-0040-00001.08859.jpg')
+        expected_greyscale = cv2.imdecode(np.frombuffer(raw_image, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+
+        image_frame = ImageFrame.decode(raw_image, greyscale_decoding=True)
+
+        np.testing.assert_array_equal(expected_greyscale, image_frame.image_greyscale)
+        self.assertIsNone(image_frame._image_bgr)
+        np.testing.assert_array_equal(expected_image_bgr, image_frame.image_bgr)
+
+    def test_empty_or_corrupt_image_decodes_to_empty_frame(self):
+        for greyscale_decoding in (False, True):
+            with self.subTest(greyscale_decoding=greyscale_decoding):
+                self.assertTrue(ImageFrame.decode(b'', greyscale_decoding).is_empty)
+                self.assertTrue(ImageFrame.decode(b'not a JPEG', greyscale_decoding).is_empty)
+
+    def test_image_frame_of_wraps_arrays_and_passes_through_frames_and_none(self):
+        image_rgb = np.zeros((10, 10, 3), dtype=np.uint8)
+        image_frame = ImageFrame.from_rgb(image_rgb)
+
+        self.assertIs(image_rgb, image_frame_of(image_rgb).image_rgb)
+        self.assertIs(image_frame, image_frame_of(image_frame))
+        self.assertIsNone(image_frame_of(None))
+        self.assertIsNone(image_frame_of(None, 2))
+
+    def test_decoded_frame_reduced_by_decoding_at_reduced_size(self):
+        raw_image = read_test_image_as_raw_bytes('TfL-images-20200501-0040-00001.08859.jpg')
+        raw_image_bytes = np.frombuffer(raw_image, dtype=np.uint8)
+        image_frame = ImageFrame.decode(raw_image)
+
+        for reduction, colour_flag, greyscale_flag in [(2, cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+                                                       (4, cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_GRAYSCALE_4)]:
+            with self.subTest(reduction=reduction):
+                reduced_image_frame = image_frame.reduced(reduction)
+
+                self.assertIs(reduced_image_frame, image_frame.reduced(reduction))
+                np.testing.assert_array_equal(cv2.imdecode(raw_image_bytes, colour_flag), reduced_image_frame.image_bgr)
+
+                greyscale_reduced_image_frame = ImageFrame.decode(raw_image, greyscale_decoding=True).reduced(reduction)
+                np.testing.assert_array_equal(cv2.imdecode(raw_image_bytes, greyscale_flag),
+                                              greyscale_reduced_image_frame.image_greyscale)
+
+    def test_array_frame_reduced_by_resizing_rounding_up(self):
+        image_rgb = np.full((287, 353, 3), 64, dtype=np.uint8)
+
+        reduced_image_frame = ImageFrame.from_rgb(image_rgb).reduced(4)
+
+        self.assertEqual((72, 89), reduced_image_frame.shape)
+        np.testing.assert_array_equal(np.full((72, 89, 3), 64, dtype=np.uint8), reduced_image_frame.image_rgb)
+
+    def test_reduced_frame_of_same_size_and_empty_frame_are_the_frame(self):
+        image_frame = ImageFrame.from_rgb(np.zeros((10, 10, 3), dtype=np.uint8))
+        empty_image_frame = ImageFrame.empty()
+
+        self.assertIs(image_frame, image_frame.reduced(1))
+        self.assertIs(empty_image_frame, empty_image_frame.reduced(2))
+
+    def test_initially_reduced_decoding_defers_full_size_decoding(self):
+        raw_image = read_test_image_as_raw_bytes('TfL-images-20200501-0040-00001.08859.jpg')
+        expected_image_bgr = read_test_image('TfL-images-20200501-0040-00001.08859.jpg')
+
+        image_frame = ImageFrame.decode(raw_image, initial_reduction=2)
+        reduced_image_frame = image_frame.reduced(2)
+
+        self.assertFalse(image_frame.is_empty)
+        self.assertGreater(image_frame.nbytes, expected_image_bgr.nbytes)
+        self.assertIsNone(image_frame._image_bgr)
+        np.testing.assert_array_equal(ImageFrame.decode(raw_image).reduced(2).image_bgr, reduced_image_frame.image_bgr)
+
+        self.assertEqual(expected_image_bgr.shape[:2], image_frame.shape)
+        np.testing.assert_array_equal(expected_image_bgr, image_frame.image_bgr)
+        self.assertIs(reduced_image_frame, image_frame.reduced(2))
+
+    def test_initially_reduced_decoding_of_corrupt_image_is_empty(self):
+        self.assertTrue(ImageFrame.decode(b'not a JPEG', initial_reduction=2).is_empty)
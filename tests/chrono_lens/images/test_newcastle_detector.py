@@ -2,8 +2,9 @@ import os
 from unittest import TestCase
 
 import cv2
+import tensorflow as tf
 
-from chrono_lens.images.newcastle_detector import NewcastleDetector
+from chrono_lens.images.newcastle_detector import NewcastleDetector, DETECTION_DTYPE, create_session_config
 
 
 class TestNewcastleDetector(TestCase):
@@ -99,3 +100,73 @@ class TestNewcastleDetector(TestCase):
         self.assertEqual(0, object_counts['motorcyclist'])  # correct
         self.assertTrue('van' in object_counts)
         self.assertEqual(0, object_counts['van'])  # correct
+
+    def test_detect_batch_matches_detect_per_image(self):
+
+        object_detector = NewcastleDetector(serialized_graph=self.rcnn_serialised_model, minimum_confidence=0.33)
+
+        images_rgb = [self.raw_small_sample_image_rgb, self.raw_large_sample_image_rgb,
+                      self.raw_small_sample_image_rgb[:, ::-1].copy(), self.raw_small_sample_image_rgb]
+
+        expected_detections = [object_detector.detect(image_rgb) for image_rgb in images_rgb]
+
+        self.assertEqual(expected_detections, object_detector.detect_batch(images_rgb))
+        self.assertEqual(expected_detections, object_detector.detect_batch(images_rgb, maximum_batch_size=2))
+        self.assertEqual([], object_detector.detect_batch([]))
+
+    def test_detect_as_structured_array_matches_detect(self):
+
+        object_detector = NewcastleDetector(serialized_graph=self.rcnn_serialised_model, minimum_confidence=0.33)
+
+        expected_detections = object_detector.detect(self.raw_small_sample_image_rgb)
+
+        structured_detections = object_detector.detect(self.raw_small_sample_image_rgb, as_structured_array=True)
+
+        self.assertEqual(DETECTION_DTYPE, structured_detections.dtype)
+        self.assertEqual(expected_detections, [
+            [str(detection['label']), [int(detection['y0']), int(detection['x0']), int(detection['y1']),
+                                       int(detection['x1']), float(detection['score'])]]
+            for detection in structured_detections
+        ])
+
+    def test_detector_with_session_configuration_matches_default_detector(self):
+
+        default_object_detector = NewcastleDetector(serialized_graph=self.rcnn_serialised_model,
+                                                    minimum_confidence=0.33)
+
+        configured_object_detector = NewcastleDetector.from_configuration(
+            {
+                'minimum_confidence': 0.33,
+                'session_configuration': {
+                    'intra_op_parallelism_threads': 1,
+                    'inter_op_parallelism_threads': 1,
+                    'strip_unused_nodes': True
+                }
+            },
+            self.rcnn_serialised_model
+        )
+
+        self.assertEqual(default_object_detector.detect(self.raw_small_sample_image_rgb),
+                         configured_object_detector.detect(self.raw_small_sample_image_rgb))
+
+
+class TestCreateSessionConfig(TestCase):
+    def test_defaults_to_tensorflow_defaults(self):
+        self.assertEqual(tf.compat.v1.ConfigProto(), create_session_config({}))
+
+    def test_settings_applied(self):
+        session_config = create_session_config({
+            'intra_op_parallelism_threads': 2,
+            'inter_op_parallelism_threads': 3,
+            'optimiser_level': 'L0',
+            'grappler_optimisation': False
+        })
+
+        self.assertEqual(2, session_config.intra_op_parallelism_threads)
+        self.assertEqual(3, session_config.inter_op_parallelism_threads)
+        self.assertEqual(tf.compat.v1.OptimizerOptions.L0, session_config.graph_options.optimizer_options.opt_level)
+        self.assertTrue(session_config.graph_options.rewrite_options.disable_meta_optimizer)
+
+    def test_unknown_optimiser_level_rejected(self):
+        self.assertRaisesRegex(ValueError, 'optimiser_level must be one of', create_session_config,
+                               {'optimiser_level': 'L2'})
@@ -0,0 +1,163 @@
+import datetime
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from chrono_lens.images.fault_detection import FaultyImageDetector
+from chrono_lens.images.image_cache import ImageCache
+from chrono_lens.images.pipeline import split_model_stages, ModelStages, InMemoryImageStore, CountingPipeline
+from chrono_lens.images.static_filter import StaticObjectFilter
+from tests.chrono_lens.images.image_reader import create_jpeg
+
+image_date_time = datetime.datetime(2020, 5, 1, 0, 10)
+
+
+def create_mock_detector():
+    mock_object_detector = MagicMock()
+    mock_object_detector.detected_object_types.return_value = ['car', 'person']
+    mock_object_detector.detect.return_value = [['car', [1, 1, 5, 5, 0.9]], ['Car ', [10, 10, 15, 15, 0.8]],
+                                                ['person', [20, 20, 25, 25, 0.7]]]
+    return mock_object_detector
+
+
+class CountingImageStore(InMemoryImageStore):
+    def __init__(self, raw_images=None, identical_image_date_times=None):
+        super().__init__(raw_images, identical_image_date_times)
+        self.loaded_image_keys = []
+
+    def load_image_frame(self, image_source, image_date_time, camera_id, greyscale_decoding=False,
+                         initial_reduction=1):
+        self.loaded_image_keys.append((image_source, image_date_time, camera_id))
+        return super().load_image_frame(image_source, image_date_time, camera_id, greyscale_decoding,
+                                        initial_reduction)
+
+
+class TestSplitModelStages(TestCase):
+
+    def test_stages_split_around_object_detector(self):
+        self.assertEqual((['FaultyImageFilterV0'], 'NewcastleV0', ['StaticObjectFilterV0']),
+                         split_model_stages('FaultyImageFilterV0_NewcastleV0_StaticObjectFilterV0'))
+        self.assertEqual(([], 'NewcastleV0', []), split_model_stages('NewcastleV0'))
+
+    def test_unknown_post_process_stage_raises_error(self):
+        with self.assertRaisesRegex(ValueError, 'Model post-process stage is unknown: "rhubarb"'):
+            split_model_stages('NewcastleV0_rhubarb')
+
+
+class TestModelStages(TestCase):
+
+    def test_stages_built_from_configurations(self):
+        mock_object_detector = create_mock_detector()
+        stage_configurations = {
+            'FaultyImageFilterV0': {'identical_area_proportion_threshold': 0.33, 'row_similarity_threshold': 0.8,
+                                    'consecutive_matching_rows_threshold': 0.2, 'comparison_image_reduction': 2},
+            'StaticObjectFilterV0': {'scenecut_threshold': 0.4, 'minimum_mask_proportion': 0.25,
+                                     'minimum_mask_proportion_person': 0.10, 'confidence_person': 0.80,
+                                     'contour_area_threshold': 50}
+        }
+        load_stage_configuration = MagicMock(side_effect=stage_configurations.get)
+        create_object_detector = MagicMock(return_value=mock_object_detector)
+
+        model_stages = ModelStages.from_model_name('FaultyImageFilterV0_NewcastleV0_StaticObjectFilterV0',
+                                                   load_stage_configuration, create_object_detector)
+
+        self.assertIsInstance(model_stages.faulty_image_filters[0], FaultyImageDetector)
+        self.assertEqual(2, model_stages.faulty_image_filters[0].comparison_image_reduction)
+        self.assertIs(mock_object_detector, model_stages.object_detector)
+        self.assertIsInstance(model_stages.static_object_filters[0], StaticObjectFilter)
+        self.assertEqual(['car', 'person'], model_stages.detected_object_types())
+        create_object_detector.assert_called_once_with('NewcastleV0')
+
+
+class TestCountingPipeline(TestCase):
+
+    def setUp(self):
+        self.mock_object_detector = create_mock_detector()
+
+    def create_pipeline(self, image_store, faulty_image_filters=(), static_object_filters=(), image_cache=None):
+        return CountingPipeline(ModelStages(list(faulty_image_filters), self.mock_object_detector,
+                                            list(static_object_filters)), image_store, image_cache)
+
+    def test_objects_counted_by_type(self):
+        pipeline = self.create_pipeline(InMemoryImageStore({('source', image_date_time, 'camera'): create_jpeg()}))
+
+        self.assertEqual({'car': 2, 'person': 1, 'faulty': False, 'missing': False},
+                         pipeline.count_objects('source', image_date_time, 'camera'))
+
+    def test_missing_and_faulty_images_not_detected(self):
+        pipeline = self.create_pipeline(InMemoryImageStore({('source', image_date_time, 'camera'): b''}))
+
+        self.assertEqual({'car': 0, 'person': 0, 'faulty': True, 'missing': False},
+                         pipeline.count_objects('source', image_date_time, 'camera'))
+        self.assertEqual({'car': 0, 'person': 0, 'faulty': False, 'missing': True},
+                         pipeline.count_objects('other-source', image_date_time, 'camera'))
+        self.mock_object_detector.detect.assert_not_called()
+
+    def test_identical_image_counted_without_pre_filter_and_faulty_with_pre_filter(self):
+        previous_date_time = image_date_time - datetime.timedelta(minutes=10)
+        image_store = InMemoryImageStore({('source', previous_date_time, 'camera'): create_jpeg()},
+                                         {('source', image_date_time, 'camera'): previous_date_time})
+
+        self.assertEqual({'car': 2, 'person': 1, 'faulty': False, 'missing': False},
+                         self.create_pipeline(image_store).count_objects('source', image_date_time, 'camera'))
+        self.assertEqual({'car': 0, 'person': 0, 'faulty': True, 'missing': False},
+                         self.create_pipeline(image_store, [FaultyImageDetector()]).count_objects(
+                             'source', image_date_time, 'camera'))
+
+    def test_identical_neighbouring_images_found_faulty(self):
+        image_store = InMemoryImageStore({
+            ('source', image_date_time + datetime.timedelta(minutes=minutes), 'camera'): create_jpeg()
+            for minutes in [-10, 0, 10]})
+
+        self.assertEqual({'car': 0, 'person': 0, 'faulty': True, 'missing': False},
+                         self.create_pipeline(image_store, [FaultyImageDetector()]).count_objects(
+                             'source', image_date_time, 'camera'))
+
+    def test_batch_processes_cameras_in_time_order_and_returns_results_in_request_order(self):
+        raw_images = {}
+        image_keys = []
+        for camera_id in ['camera-b', 'camera-a']:
+            for minutes in [20, 0, 10]:
+                image_key = ('source', image_date_time + datetime.timedelta(minutes=minutes), camera_id)
+                raw_images[image_key] = create_jpeg(grey_level=minutes)
+                image_keys.append(image_key)
+        image_keys.append(('source', image_date_time, 'camera-missing'))
+        image_store = CountingImageStore(raw_images)
+        image_cache = ImageCache()
+
+        pipeline = self.create_pipeline(image_store, [FaultyImageDetector()], [StaticObjectFilter()], image_cache)
+        object_results_per_image = pipeline.count_objects_in_batch(image_keys)
+
+        # Each image read once, camera by camera in time order; earlier slots discarded from the cache as processed
+        self.assertEqual(sorted(raw_images, key=lambda image_key: (image_key[2], image_key[1])),
+                         [image_key for image_key in image_store.loaded_image_keys if image_key in raw_images])
+        self.assertNotIn(('source', image_date_time, 'camera-a'), image_cache)
+
+        expected_object_results = [pipeline.count_objects(*image_key) for image_key in image_keys]
+        self.assertEqual(expected_object_results, object_results_per_image)
+        self.assertTrue(object_results_per_image[-1]['missing'])
+
+    def test_batch_detection_matches_individual_detection(self):
+        image_store = InMemoryImageStore()
+        image_keys = []
+        for minutes in range(0, 50, 10):
+            image_key = ('source', image_date_time + datetime.timedelta(minutes=minutes), 'camera')
+            image_store.raw_images[image_key] = create_jpeg(grey_level=minutes * 4)
+            image_keys.append(image_key)
+        # Faulty image is not detected, so does not take a place in a batch
+        image_store.raw_images[image_keys[1]] = b''
+        self.mock_object_detector.detect_batch.side_effect = \
+            lambda images_rgb, maximum_batch_size: [self.mock_object_detector.detect(image_rgb)
+                                                    for image_rgb in images_rgb]
+
+        individually_detected_object_results = self.create_pipeline(image_store).count_objects_in_batch(image_keys)
+
+        pipeline = CountingPipeline(ModelStages([], self.mock_object_detector, []), image_store,
+                                    detection_batch_size=3)
+        self.assertEqual(individually_detected_object_results, pipeline.count_objects_in_batch(image_keys))
+        self.assertEqual([2, 2], [len(call_args[0][0])
+                                  for call_args in self.mock_object_detector.detect_batch.call_args_list])
+
+    def test_detection_batch_size_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            CountingPipeline(ModelStages([], self.mock_object_detector, []), InMemoryImageStore(),
+                             detection_batch_size=0)
@@ -1,7 +1,14 @@
 from unittest import TestCase
 
-from chrono_lens.images.static_filter import StaticObjectFilter
-from tests.chrono_lens.images.image_reader import read_test_image
+import cv2
+import numpy as np
+from skimage.metrics import structural_similarity
+
+from chrono_lens.images.image_frame import ImageFrame
+from chrono_lens.images.static_filter import StaticObjectFilter, COMPARISON_IMAGE_REDUCTION_TOLERANCES
+from tests.chrono_lens.images.image_reader import read_test_image, read_test_image_as_raw_bytes
+from tests.chrono_lens.images.test_structural_similarity import FILTERED_REFERENCE_TIME_SERIES, \
+    create_tiled_detected_objects
 
 SCENECUT_THRESHOLD = 0.4
 MINIMUM_MASK_PROPORTION = 0.25
@@ -33,6 +40,110 @@ class TestStaticFilter(TestCase):
         self.assertEqual(expected_minimum_mask_proportion_person, static_object_filter.minimum_mask_proportion_person)
         self.assertEqual(expected_confidence_person, static_object_filter.confidence_person)
         self.assertEqual(expected_contour_areas_threshold, static_object_filter.contour_area_threshold)
+        self.assertEqual('skimage', static_object_filter.structural_similarity_backend)
+        self.assertFalse(static_object_filter.restrict_mask_to_detections)
+        self.assertEqual('sequential', static_object_filter.duplicate_removal_backend)
+        self.assertEqual(1, static_object_filter.comparison_image_reduction)
+
+    def test_constructed_from_configuration_with_structural_similarity_backend(self):
+        static_object_filter = StaticObjectFilter.from_configuration({
+            'scenecut_threshold': SCENECUT_THRESHOLD,
+            'minimum_mask_proportion': MINIMUM_MASK_PROPORTION,
+            'minimum_mask_proportion_person': MINIMUM_MASK_PROPORTION_PERSON,
+            'confidence_person': CONFIDENCE_PERSON,
+            'contour_area_threshold': CONTOUR_AREA_THRESHOLD,
+            'structural_similarity_backend': 'opencv'
+        })
+
+        self.assertEqual('opencv', static_object_filter.structural_similarity_backend)
+
+    def test_constructed_from_configuration_with_mask_restricted_to_detections(self):
+        static_object_filter = StaticObjectFilter.from_configuration({
+            'scenecut_threshold': SCENECUT_THRESHOLD,
+            'minimum_mask_proportion': MINIMUM_MASK_PROPORTION,
+            'minimum_mask_proportion_person': MINIMUM_MASK_PROPORTION_PERSON,
+            'confidence_person': CONFIDENCE_PERSON,
+            'contour_area_threshold': CONTOUR_AREA_THRESHOLD,
+            'restrict_mask_to_detections': True
+        })
+
+        self.assertTrue(static_object_filter.restrict_mask_to_detections)
+
+    def test_constructed_from_configuration_with_duplicate_removal_backend(self):
+        static_object_filter = StaticObjectFilter.from_configuration({
+            'scenecut_threshold': SCENECUT_THRESHOLD,
+            'minimum_mask_proportion': MINIMUM_MASK_PROPORTION,
+            'minimum_mask_proportion_person': MINIMUM_MASK_PROPORTION_PERSON,
+            'confidence_person': CONFIDENCE_PERSON,
+            'contour_area_threshold': CONTOUR_AREA_THRESHOLD,
+            'duplicate_removal_backend': 'opencv'
+        })
+
+        self.assertEqual('opencv', static_object_filter.duplicate_removal_backend)
+
+    def test_constructed_from_configuration_with_comparison_image_reduction(self):
+        static_object_filter = StaticObjectFilter.from_configuration({
+            'scenecut_threshold': SCENECUT_THRESHOLD,
+            'minimum_mask_proportion': MINIMUM_MASK_PROPORTION,
+            'minimum_mask_proportion_person': MINIMUM_MASK_PROPORTION_PERSON,
+            'confidence_person': CONFIDENCE_PERSON,
+            'contour_area_threshold': CONTOUR_AREA_THRESHOLD,
+            'comparison_image_reduction': 4
+        })
+
+        self.assertEqual(4, static_object_filter.comparison_image_reduction)
+
+    def test_invalid_comparison_image_reduction_rejected(self):
+        with self.assertRaises(ValueError):
+            StaticObjectFilter(comparison_image_reduction=3)
+
+    def test_unknown_duplicate_removal_backend_rejected(self):
+        self.assertRaisesRegex(ValueError, 'duplicate_removal_backend must be one of',
+                               StaticObjectFilter, duplicate_removal_backend='rhubarb')
+
+    def test_remove_duplicated_labels_retains_higher_score_without_modifying_detected_objects(self):
+        detected_objects = [
+            # [label name, [y0, x0, y1, x1, confidence]]
+            ['car', [10, 10, 50, 50, 0.6]],
+            ['van', [10, 10, 50, 51, 0.9]],
+            ['car', [100, 100, 120, 130, 0.8]],
+            ['car', [101, 100, 120, 130, 0.7]]
+        ]
+        original_detected_objects = [[label, list(box)] for label, box in detected_objects]
+
+        expected_detected_objects = [
+            ['van', [10, 10, 50, 51, 0.9]],
+            ['car', [100, 100, 120, 130, 0.8]]
+        ]
+
+        for duplicate_removal_backend in ['sequential', 'opencv']:
+            with self.subTest(duplicate_removal_backend=duplicate_removal_backend):
+                static_object_filter = StaticObjectFilter(duplicate_removal_backend=duplicate_removal_backend)
+
+                self.assertListEqual(expected_detected_objects,
+                                     static_object_filter._remove_duplicated_labels(detected_objects))
+                self.assertListEqual(original_detected_objects, detected_objects)
+
+    def test_remove_duplicated_labels_sequential_depends_on_order(self):
+        # Once the first box is removed as a duplicate of the second, the third is not compared with the second
+        detected_objects = [
+            # [label name, [y0, x0, y1, x1, confidence]]
+            ['car', [10, 10, 50, 50, 0.5]],
+            ['car', [10, 10, 50, 50, 0.9]],
+            ['car', [10, 10, 50, 50, 0.7]]
+        ]
+
+        sequential_static_object_filter = StaticObjectFilter(duplicate_removal_backend='sequential')
+        self.assertListEqual(detected_objects[1:],
+                             sequential_static_object_filter._remove_duplicated_labels(detected_objects))
+
+        opencv_static_object_filter = StaticObjectFilter(duplicate_removal_backend='opencv')
+        self.assertListEqual(detected_objects[1:2],
+                             opencv_static_object_filter._remove_duplicated_labels(detected_objects))
+
+    def test_unknown_structural_similarity_backend_rejected(self):
+        self.assertRaisesRegex(ValueError, 'structural_similarity_backend must be one of',
+                               StaticObjectFilter, structural_similarity_backend='rhubarb')
 
     def test_reject_static(self):
         previous_image_rgb = read_test_image('TfL-images-20200501-0040-00001.08859.jpg')
@@ -109,6 +220,219 @@ class TestStaticFilter(TestCase):
 
         self.assertListEqual(expected_filtered_detected_objects, filtered_detected_objects)
 
+    def test_reject_static_with_mask_restricted_to_detections(self):
+        previous_image_rgb = read_test_image('TfL-images-20200501-0040-00001.08859.jpg')
+        current_image_rgb = read_test_image('TfL-images-20200501-0050-00001.08859.jpg')
+        next_image_rgb = read_test_image('TfL-images-20200501-0100-00001.08859.jpg')
+
+        detected_objects = [
+            # [label name, [y0, x0, y1, x1, confidence]]
+            ['van', [141, 241, 180, 285, 0.9964]],
+            ['car', [127, 190, 145, 212, 0.9381]],
+            ['van', [113, 169, 134, 188, 0.8928]],
+            ['van', [125, 214, 154, 243, 0.8576]],
+            ['person', [167, 105, 195, 114, 0.7773]],
+            ['car', [123, 206, 141, 229, 0.5541]]
+        ]
+
+        expected_filtered_detected_objects = [
+            # [label name, [y0, x0, y1, x1, confidence]]
+            ['person', [167, 105, 195, 114, 0.7773]]
+        ]
+
+        static_object_filter = StaticObjectFilter(scenecut_threshold=SCENECUT_THRESHOLD,
+                                                  minimum_mask_proportion=MINIMUM_MASK_PROPORTION,
+                                                  minimum_mask_proportion_person=MINIMUM_MASK_PROPORTION_PERSON,
+                                                  confidence_person=CONFIDENCE_PERSON,
+                                                  contour_area_threshold=CONTOUR_AREA_THRESHOLD,
+                                                  restrict_mask_to_detections=True)
+        filtered_detected_objects = static_object_filter.filter_static_objects(
+            detected_objects, previous_image_rgb, current_image_rgb, next_image_rgb)
+
+        self.assertListEqual(expected_filtered_detected_objects, filtered_detected_objects)
+
+    def test_reject_small_static_if_person_with_mask_restricted_to_detections(self):
+        previous_image_rgb = read_test_image('TfL-images-20200501-1320-00001.04542.jpg')
+        current_image_rgb = read_test_image('TfL-images-20200501-1330-00001.04542.jpg')
+        next_image_rgb = read_test_image('TfL-images-20200501-1340-00001.04542.jpg')
+
+        detected_objects = [
+            # [label name, [y0, x0, y1, x1, confidence]]
+            ['car', [111, 164, 132, 190, 0.9994]],
+            ['car', [128, 219, 163, 254, 0.9984]],
+            ['car', [99, 184, 118, 206, 0.9954]],
+            ['car', [91, 199, 109, 223, 0.9774]],
+            ['car', [80, 139, 96, 172, 0.9738]],
+            ['person', [122, 314, 151, 324, 0.9577]],
+            ['person', [148, 28, 179, 38, 0.9366]],
+            ['person', [117, 56, 142, 64, 0.9024]],
+            ['car', [60, 258, 70, 268, 0.7689]],
+            ['car', [77, 281, 93, 300, 0.7457]],
+            ['car', [84, 219, 103, 255, 0.7399]]
+        ]
+
+        expected_filtered_detected_objects = [
+            # [label name, [y0, x0, y1, x1, confidence]]
+            ['car', [111, 164, 132, 190, 0.9994]],
+            ['car', [128, 219, 163, 254, 0.9984]],
+            ['car', [99, 184, 118, 206, 0.9954]],
+            ['car', [91, 199, 109, 223, 0.9774]],
+            ['car', [80, 139, 96, 172, 0.9738]],
+            ['person', [122, 314, 151, 324, 0.9577]],
+            ['person', [148, 28, 179, 38, 0.9366]],
+            ['person', [117, 56, 142, 64, 0.9024]],
+            ['car', [60, 258, 70, 268, 0.7689]],
+            # ['car', [77, 281, 93, 300, 0.7457]],
+            ['car', [84, 219, 103, 255, 0.7399]]
+        ]
+
+        static_object_filter = StaticObjectFilter(scenecut_threshold=SCENECUT_THRESHOLD,
+                                                  minimum_mask_proportion=MINIMUM_MASK_PROPORTION,
+                                                  minimum_mask_proportion_person=MINIMUM_MASK_PROPORTION_PERSON,
+                                                  confidence_person=CONFIDENCE_PERSON,
+                                                  contour_area_threshold=CONTOUR_AREA_THRESHOLD,
+                                                  restrict_mask_to_detections=True)
+        filtered_detected_objects = static_object_filter.filter_static_objects(
+            detected_objects, previous_image_rgb, current_image_rgb, next_image_rgb)
+
+        self.assertListEqual(expected_filtered_detected_objects, filtered_detected_objects)
+
+    def test_reject_static_with_reduced_comparison_images(self):
+        image_frames = [ImageFrame.decode(read_test_image_as_raw_bytes(filename)) for filename in
+                        ('TfL-images-20200501-0040-00001.08859.jpg', 'TfL-images-20200501-0050-00001.08859.jpg',
+                         'TfL-images-20200501-0100-00001.08859.jpg')]
+
+        detected_objects = [
+            # [label name, [y0, x0, y1, x1, confidence]]
+            ['van', [141, 241, 180, 285, 0.9964]],
+            ['car', [127, 190, 145, 212, 0.9381]],
+            ['van', [113, 169, 134, 188, 0.8928]],
+            ['van', [125, 214, 154, 243, 0.8576]],
+            ['person', [167, 105, 195, 114, 0.7773]],
+            ['car', [123, 206, 141, 229, 0.5541]]
+        ]
+
+        expected_filtered_detected_objects = [
+            # [label name, [y0, x0, y1, x1, confidence]]
+            ['person', [167, 105, 195, 114, 0.7773]]
+        ]
+
+        for comparison_image_reduction in [2, 4]:
+            for restrict_mask_to_detections in [False, True]:
+                with self.subTest(comparison_image_reduction=comparison_image_reduction,
+                                  restrict_mask_to_detections=restrict_mask_to_detections):
+                    static_object_filter = StaticObjectFilter(
+                        scenecut_threshold=SCENECUT_THRESHOLD,
+                        minimum_mask_proportion=MINIMUM_MASK_PROPORTION,
+                        minimum_mask_proportion_person=MINIMUM_MASK_PROPORTION_PERSON,
+                        confidence_person=CONFIDENCE_PERSON,
+                        contour_area_threshold=CONTOUR_AREA_THRESHOLD,
+                        restrict_mask_to_detections=restrict_mask_to_detections,
+                        comparison_image_reduction=comparison_image_reduction)
+                    filtered_detected_objects = static_object_filter.filter_static_objects(
+                        detected_objects, *image_frames)
+
+                    self.assertListEqual(expected_filtered_detected_objects, filtered_detected_objects)
+
+    def test_reduced_comparison_images_within_tolerance_on_test_images(self):
+        time_series_to_compare = FILTERED_REFERENCE_TIME_SERIES + [
+            ('TfL-images_20200620_2010_00001.01251.jpg', 'TfL-images_20200620_2020_00001.01251.jpg',
+             'TfL-images_20200620_2030_00001.01251.jpg'),
+            ('NETravelData-images_20200508_1050_NT_A191E1.jpg', 'NETravelData-images_20200508_1100_NT_A191E1.jpg',
+             'NETravelData-images_20200508_1110_NT_A191E1.jpg')
+        ]
+        expected_static_object_filter = StaticObjectFilter()
+
+        for time_series in time_series_to_compare:
+            image_frames = [ImageFrame.decode(read_test_image_as_raw_bytes(filename)) for filename in time_series]
+            detected_objects = create_tiled_detected_objects(image_frames[1].shape)
+
+            expected_filtered_detected_objects = expected_static_object_filter.filter_static_objects(
+                detected_objects, *image_frames)
+
+            for comparison_image_reduction in [2, 4]:
+                with self.subTest(time_series=time_series, comparison_image_reduction=comparison_image_reduction):
+                    static_object_filter = StaticObjectFilter(comparison_image_reduction=comparison_image_reduction)
+
+                    actual_filtered_detected_objects = static_object_filter.filter_static_objects(
+                        detected_objects, *image_frames)
+
+                    number_of_changed_outcomes = len(
+                        {str(detected_object) for detected_object in expected_filtered_detected_objects} ^
+                        {str(detected_object) for detected_object in actual_filtered_detected_objects})
+                    self.assertLessEqual(number_of_changed_outcomes / len(detected_objects),
+                                         COMPARISON_IMAGE_REDUCTION_TOLERANCES[comparison_image_reduction])
+
+    def test_static_mask_restricted_to_region_matches_whole_image_within_region(self):
+        current_image_greyscale = cv2.cvtColor(read_test_image('TfL-images-20200501-1330-00001.04542.jpg'),
+                                               cv2.COLOR_BGR2GRAY)
+        next_image_greyscale = cv2.cvtColor(read_test_image('TfL-images-20200501-1340-00001.04542.jpg'),
+                                            cv2.COLOR_BGR2GRAY)
+        _, structural_similarity_image = structural_similarity(next_image_greyscale, current_image_greyscale,
+                                                               full=True)
+
+        static_object_filter = StaticObjectFilter(contour_area_threshold=CONTOUR_AREA_THRESHOLD)
+        whole_image_mask = static_object_filter._get_static_mask(structural_similarity_image)
+
+        image_height, image_width = current_image_greyscale.shape
+        for y0, x0, y1, x1 in [(77, 281, 93, 300), (60, 28, 179, 324), (0, 0, 20, 30),
+                               (image_height - 40, image_width - 50, image_height, image_width)]:
+            region_mask = static_object_filter._get_static_mask(structural_similarity_image, (y0, x0, y1, x1))
+
+            np.testing.assert_array_equal(whole_image_mask[y0:y1, x0:x1], region_mask[y0:y1, x0:x1])
+            region_mask[y0:y1, x0:x1] = 0
+            self.assertEqual(0, np.count_nonzero(region_mask))
+
+    def test_masked_proportions_match_pixels_counted_in_each_box(self):
+        mask = np.zeros((20, 30), np.uint8)
+        mask[5:10, 10:20] = 255
+        mask[15:, 25:] = 255
+
+        detected_objects = [
+            # [label name, [y0, x0, y1, x1, confidence]]
+            ['car', [5, 10, 10, 20, 0.9]],
+            ['car', [0, 0, 20, 30, 0.8]],
+            ['person', [7, 15, 17, 28, 0.7]],
+            ['van', [0, 0, 4, 4, 0.6]],
+            ['bus', [18, 28, 25, 35, 0.5]]
+        ]
+
+        expected_proportions = [np.count_nonzero(mask[y0:y1, x0:x1]) / ((y1 - y0 + 1) * (x1 - x0 + 1))
+                                for _, (y0, x0, y1, x1, _) in detected_objects]
+
+        proportions = StaticObjectFilter._get_masked_proportions(mask, detected_objects)
+
+        np.testing.assert_array_equal(expected_proportions, proportions)
+        self.assertAlmostEqual(50 / 66, proportions[0])
+        self.assertEqual(0, proportions[3])
+
+    def test_no_detected_objects_returns_empty_list(self):
+        previous_image_rgb = read_test_image('TfL-images-20200501-0040-00001.08859.jpg')
+        current_image_rgb = read_test_image('TfL-images-20200501-0050-00001.08859.jpg')
+        next_image_rgb = read_test_image('TfL-images-20200501-0100-00001.08859.jpg')
+
+        static_object_filter = StaticObjectFilter(scenecut_threshold=SCENECUT_THRESHOLD,
+                                                  minimum_mask_proportion=MINIMUM_MASK_PROPORTION,
+                                                  minimum_mask_proportion_person=MINIMUM_MASK_PROPORTION_PERSON,
+                                                  confidence_person=CONFIDENCE_PERSON,
+                                                  contour_area_threshold=CONTOUR_AREA_THRESHOLD)
+        filtered_detected_objects = static_object_filter.filter_static_objects(
+            [], previous_image_rgb, current_image_rgb, next_image_rgb)
+
+        self.assertListEqual([], filtered_detected_objects)
+
+    def test_no_detected_objects_and_previous_and_next_None_returns_faulty(self):
+        current_image_rgb = read_test_image('TfL-images-20200501-0050-00001.08859.jpg')
+
+        static_object_filter = StaticObjectFilter(scenecut_threshold=SCENECUT_THRESHOLD,
+                                                  minimum_mask_proportion=MINIMUM_MASK_PROPORTION,
+                                                  minimum_mask_proportion_person=MINIMUM_MASK_PROPORTION_PERSON,
+                                                  confidence_person=CONFIDENCE_PERSON,
+                                                  contour_area_threshold=CONTOUR_AREA_THRESHOLD)
+        filtered_detected_objects = static_object_filter.filter_static_objects([], None, current_image_rgb, None)
+
+        self.assertIsNone(filtered_detected_objects)
+
     # Scene discontinuity:
     #
     # 00001.08750 on 2020-05-01 at 14:40 to 00001.08750 on 2020-05-01 at 14:50
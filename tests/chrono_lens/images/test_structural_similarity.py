@@ -0,0 +1,98 @@
+from unittest import TestCase
+
+import cv2
+import numpy as np
+
+from chrono_lens.images.static_filter import StaticObjectFilter
+from chrono_lens.images.structural_similarity import SkimageStructuralSimilarity, OpenCVStructuralSimilarity, \
+    OPENCV_SSIM_IMAGE_TOLERANCE, OPENCV_SSIM_SCORE_TOLERANCE
+from tests.chrono_lens.images.image_reader import read_test_image
+
+# Previous, current and next images, where the current image has a "_filtered" reference image
+FILTERED_REFERENCE_TIME_SERIES = [
+    ('TfL-images-20200501-0040-00001.08859.jpg', 'TfL-images-20200501-0050-00001.08859.jpg',
+     'TfL-images-20200501-0100-00001.08859.jpg'),
+    ('TfL-images-20200501-1320-00001.04542.jpg', 'TfL-images-20200501-1330-00001.04542.jpg',
+     'TfL-images-20200501-1340-00001.04542.jpg'),
+    ('TfL-images-20200501-1330-00001.08750.jpg', 'TfL-images-20200501-1340-00001.08750.jpg',
+     'TfL-images-20200501-1350-00001.08750.jpg'),
+]
+
+
+def read_test_image_as_greyscale(filename):
+    return cv2.cvtColor(read_test_image(filename), cv2.COLOR_BGR2GRAY)
+
+
+def create_tiled_detected_objects(image_shape, tiles_per_axis=16):
+    image_height, image_width = image_shape[:2]
+    box_height = image_height // 8
+    box_width = image_width // 8
+
+    return [
+        ['car', [y0, x0, min(y0 + box_height, image_height - 1), min(x0 + box_width, image_width - 1), 0.9]]
+        for y0 in range(0, image_height, image_height // tiles_per_axis)
+        for x0 in range(0, image_width, image_width // tiles_per_axis)
+    ]
+
+
+class TestStructuralSimilarity(TestCase):
+
+    def test_opencv_matches_skimage_within_tolerance(self):
+        for time_series in FILTERED_REFERENCE_TIME_SERIES:
+            previous_image, current_image, next_image = [read_test_image_as_greyscale(filename)
+                                                         for filename in time_series]
+
+            current_image_prepared = OpenCVStructuralSimilarity.prepare(current_image)
+
+            for comparison_image in [previous_image, next_image]:
+                expected_score, expected_ssim_image = SkimageStructuralSimilarity.compare(comparison_image,
+                                                                                          current_image)
+
+                actual_score, actual_ssim_image = OpenCVStructuralSimilarity.compare(
+                    OpenCVStructuralSimilarity.prepare(comparison_image), current_image_prepared)
+
+                self.assertEqual(expected_ssim_image.shape, actual_ssim_image.shape)
+                self.assertLess(abs(expected_score - actual_score), OPENCV_SSIM_SCORE_TOLERANCE)
+                self.assertLess(np.max(np.abs(expected_ssim_image - actual_ssim_image)), OPENCV_SSIM_IMAGE_TOLERANCE)
+
+    def test_opencv_identical_images_fully_similar(self):
+        image = read_test_image_as_greyscale(FILTERED_REFERENCE_TIME_SERIES[0][1])
+        image_prepared = OpenCVStructuralSimilarity.prepare(image)
+
+        score, _ = OpenCVStructuralSimilarity.compare(image_prepared, image_prepared)
+
+        self.assertAlmostEqual(1.0, score, places=5)
+
+    def test_static_filter_masks_match_between_backends(self):
+        skimage_static_object_filter = StaticObjectFilter(structural_similarity_backend='skimage')
+        opencv_static_object_filter = StaticObjectFilter(structural_similarity_backend='opencv')
+
+        for time_series in FILTERED_REFERENCE_TIME_SERIES:
+            previous_image, current_image, next_image = [read_test_image_as_greyscale(filename)
+                                                         for filename in time_series]
+
+            for comparison_image in [previous_image, next_image]:
+                _, skimage_ssim_image = SkimageStructuralSimilarity.compare(comparison_image, current_image)
+                _, opencv_ssim_image = OpenCVStructuralSimilarity.compare(
+                    OpenCVStructuralSimilarity.prepare(comparison_image),
+                    OpenCVStructuralSimilarity.prepare(current_image))
+
+                np.testing.assert_array_equal(skimage_static_object_filter._get_static_mask(skimage_ssim_image),
+                                              opencv_static_object_filter._get_static_mask(opencv_ssim_image))
+
+    def test_static_filter_results_match_between_backends(self):
+        skimage_static_object_filter = StaticObjectFilter(structural_similarity_backend='skimage')
+        opencv_static_object_filter = StaticObjectFilter(structural_similarity_backend='opencv')
+
+        for time_series in FILTERED_REFERENCE_TIME_SERIES:
+            previous_image_rgb, current_image_rgb, next_image_rgb = [read_test_image(filename)
+                                                                     for filename in time_series]
+            detected_objects = create_tiled_detected_objects(current_image_rgb.shape)
+
+            expected_filtered_detected_objects = skimage_static_object_filter.filter_static_objects(
+                detected_objects, previous_image_rgb, current_image_rgb, next_image_rgb)
+
+            actual_filtered_detected_objects = opencv_static_object_filter.filter_static_objects(
+                detected_objects, previous_image_rgb, current_image_rgb, next_image_rgb)
+
+            self.assertListEqual(expected_filtered_detected_objects, actual_filtered_detected_objects)
@@ -1,6 +1,15 @@
 import datetime
+import json
 import os
-
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
 from mock import patch, MagicMock
 from pyfakefs.fake_filesystem_unittest import TestCase
 
@@ -38,6 +47,7 @@ class TestDownloadAllImages(TestCase):
         mock_request_response = MagicMock()
         mock_request_response.status_code = 200
         mock_request_response.content = small_image_raw_jpeg
+        mock_request_response.headers = {}
         mock_requests.get.return_value = mock_request_response
 
         mock_datetime.now.return_value = expected_now
@@ -74,6 +84,7 @@ class TestDownloadAllImages(TestCase):
         mock_request_response = MagicMock()
         mock_request_response.status_code = 200
         mock_request_response.content = small_image_raw_jpeg
+        mock_request_response.headers = {}
         mock_requests.get.return_value = mock_request_response
 
         mock_datetime.now.return_value = expected_now
@@ -111,6 +122,7 @@ class TestDownloadAllImages(TestCase):
         mock_request_response = MagicMock()
         mock_request_response.status_code = 200
         mock_request_response.content = small_image_raw_jpeg
+        mock_request_response.headers = {}
         mock_requests.get.return_value = mock_request_response
 
         mock_datetime.now.return_value = fake_now
@@ -123,3 +135,214 @@ class TestDownloadAllImages(TestCase):
             actual_small_image_raw_jpeg = actual_image_data.read()
 
         self.assertEqual(small_image_raw_jpeg, actual_small_image_raw_jpeg)
+
+
+class StubImageServerRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves `server.responses`, a dictionary of URL path to list of (status code, content) returned by successive
+    requests (the last repeated), recording the number of requests made to each path and at the same time.
+    Paths with an entry in `server.etags` are served with that ETag, replying 304 to requests for the same ETag.
+    """
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests_in_flight += 1
+            self.server.maximum_requests_in_flight = max(self.server.maximum_requests_in_flight,
+                                                         self.server.requests_in_flight)
+            request_number = self.server.request_counts.get(self.path, 0)
+            self.server.request_counts[self.path] = request_number + 1
+
+        # Give other downloads chance to be in flight at the same time
+        time.sleep(0.05)
+
+        responses = self.server.responses.get(self.path, [(404, b'')])
+        status_code, content = responses[min(request_number, len(responses) - 1)]
+
+        etag = self.server.etags.get(self.path)
+        if etag is not None and status_code == 200 and self.headers.get('If-None-Match') == etag:
+            status_code, content = 304, b''
+
+        self.send_response(status_code)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+        with self.server.lock:
+            self.server.requests_in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+@patch('chrono_lens.localhost.image_downloads.uniform', MagicMock(return_value=0))
+@patch('chrono_lens.localhost.DOWNLOAD_RETRY_SLEEP_MINIMUM', 0)
+class TestDownloadAllImagesConcurrently(unittest.TestCase):
+
+    def setUp(self):
+        small_image_filename = os.path.join('tests', 'test_data', 'time_series',
+                                            'TfL-images-20200501-0040-00001.08859.jpg')
+        with open(small_image_filename, 'rb') as image_data:
+            self.small_image_raw_jpeg = image_data.read()
+
+        _, large_image_encoded = cv2.imencode('.jpg', np.full((600, 880, 3), 128, dtype=np.uint8))
+        self.large_image_raw_jpeg = large_image_encoded.tobytes()
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubImageServerRequestHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests_in_flight = 0
+        self.server.maximum_requests_in_flight = 0
+        self.server.request_counts = {}
+        self.server.responses = {}
+        self.server.etags = {}
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.server_url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+        self.temporary_folder = tempfile.TemporaryDirectory()
+        self.config_folder_name = os.path.join(self.temporary_folder.name, 'config')
+        self.download_folder_name = os.path.join(self.temporary_folder.name, 'download')
+        self.now = datetime.datetime(2000, 1, 2, 12, 30, 00)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        self.temporary_folder.cleanup()
+
+    def download_all_images(self, image_paths, concurrency, maximum_number_of_download_attempts=5, now=None):
+        os.makedirs(os.path.join(self.config_folder_name, 'ingest'), exist_ok=True)
+        with open(os.path.join(self.config_folder_name, 'ingest', 'IMAGE_SUPPLIER.json'), 'w') as json_file:
+            json.dump([self.server_url + image_path for image_path in image_paths], json_file)
+
+        with patch('chrono_lens.localhost.image_downloads.datetime') as mock_datetime:
+            mock_datetime.now.return_value = self.now if now is None else now
+            download_all_images(self.config_folder_name, self.download_folder_name,
+                                maximum_number_of_download_attempts, concurrency)
+
+    def downloaded_file_name(self, base_file_name, now=None):
+        if now is None:
+            now = self.now
+        return os.path.join(self.download_folder_name, 'IMAGE_SUPPLIER', f'{now:%Y%m%d}', f'{now:%H%M}',
+                            base_file_name)
+
+    def test_images_downloaded_with_bounded_concurrency(self):
+        image_paths = [f'/images/image{image_number:02}.jpg' for image_number in range(20)]
+        for image_path in image_paths:
+            self.server.responses[image_path] = [(200, self.small_image_raw_jpeg)]
+
+        self.download_all_images(image_paths, concurrency=4)
+
+        for image_number in range(20):
+            with open(self.downloaded_file_name(f'image{image_number:02}.jpg'), 'rb') as actual_image_data:
+                self.assertEqual(self.small_image_raw_jpeg, actual_image_data.read())
+
+        self.assertLessEqual(self.server.maximum_requests_in_flight, 4)
+        self.assertGreater(self.server.maximum_requests_in_flight, 1)
+
+    def test_large_images_resized(self):
+        self.server.responses['/large.jpg'] = [(200, self.large_image_raw_jpeg)]
+
+        self.download_all_images(['/large.jpg'], concurrency=2)
+
+        downloaded_image = cv2.imread(self.downloaded_file_name('large.jpg'))
+        self.assertEqual((300, 440, 3), downloaded_image.shape)
+
+    def test_failed_downloads_retried(self):
+        self.server.responses['/flaky.jpg'] = [(503, b''), (504, b''), (200, self.small_image_raw_jpeg)]
+
+        self.download_all_images(['/flaky.jpg'], concurrency=2)
+
+        self.assertEqual(3, self.server.request_counts['/flaky.jpg'])
+        with open(self.downloaded_file_name('flaky.jpg'), 'rb') as actual_image_data:
+            self.assertEqual(self.small_image_raw_jpeg, actual_image_data.read())
+
+    def test_missing_and_failing_images_not_saved(self):
+        self.server.responses['/failing.jpg'] = [(500, b'')]
+        self.server.responses['/corrupt.jpg'] = [(200, b'not a JPEG')]
+
+        with self.assertLogs(level='WARNING') as logs:
+            self.download_all_images(['/missing.jpg', '/failing.jpg', '/corrupt.jpg'], concurrency=2,
+                                     maximum_number_of_download_attempts=3)
+
+        self.assertEqual(1, self.server.request_counts['/missing.jpg'])
+        self.assertEqual(3, self.server.request_counts['/failing.jpg'])
+        for base_file_name in ['missing.jpg', 'failing.jpg', 'corrupt.jpg']:
+            self.assertFalse(os.path.exists(self.downloaded_file_name(base_file_name)))
+        self.assertCountEqual(['WARNING', 'ERROR', 'ERROR'], [record.levelname for record in logs.records])
+
+    def test_concurrent_download_matches_serial_download(self):
+        image_paths = ['/small.jpg', '/large.jpg']
+        self.server.responses['/small.jpg'] = [(200, self.small_image_raw_jpeg)]
+        self.server.responses['/large.jpg'] = [(200, self.large_image_raw_jpeg)]
+
+        downloaded_images = {}
+        for concurrency in [1, 3]:
+            self.download_all_images(image_paths, concurrency)
+            for base_file_name in ['small.jpg', 'large.jpg']:
+                with open(self.downloaded_file_name(base_file_name), 'rb') as actual_image_data:
+                    downloaded_images[concurrency, base_file_name] = actual_image_data.read()
+                os.remove(self.downloaded_file_name(base_file_name))
+
+        for base_file_name in ['small.jpg', 'large.jpg']:
+            self.assertEqual(downloaded_images[1, base_file_name], downloaded_images[3, base_file_name])
+
+    def test_concurrency_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            self.download_all_images(['/small.jpg'], concurrency=0)
+
+    def test_unchanged_images_recorded_as_identical_to_previous_image(self):
+        ten_minutes_later = self.now + datetime.timedelta(minutes=10)
+        for concurrency in [1, 3]:
+            with self.subTest(concurrency=concurrency):
+                self.server.responses['/not-modified.jpg'] = [(200, self.small_image_raw_jpeg)]
+                self.server.etags['/not-modified.jpg'] = '"version-1"'
+                self.server.responses['/unchanged.jpg'] = [(200, self.large_image_raw_jpeg)]
+                self.server.responses['/changed.jpg'] = [(200, self.small_image_raw_jpeg),
+                                                         (200, self.large_image_raw_jpeg)]
+                self.server.request_counts = {}
+                image_paths = ['/not-modified.jpg', '/unchanged.jpg', '/changed.jpg']
+
+                self.download_all_images(image_paths, concurrency)
+                self.download_all_images(image_paths, concurrency, now=ten_minutes_later)
+
+                for base_file_name in ['not-modified', 'unchanged']:
+                    self.assertTrue(os.path.exists(self.downloaded_file_name(base_file_name + '.jpg')))
+                    self.assertFalse(os.path.exists(self.downloaded_file_name(base_file_name + '.jpg',
+                                                                              ten_minutes_later)))
+                    with open(self.downloaded_file_name(base_file_name + '.identical.json', ten_minutes_later),
+                              'r') as marker_file:
+                        self.assertEqual({'identical_to': '20000102 1230'}, json.load(marker_file))
+
+                with open(self.downloaded_file_name('changed.jpg', ten_minutes_later), 'rb') as image_file:
+                    self.assertEqual((300, 440, 3), cv2.imdecode(np.frombuffer(image_file.read(), np.uint8),
+                                                                 cv2.IMREAD_COLOR).shape)
+                self.assertFalse(os.path.exists(self.downloaded_file_name('changed.identical.json',
+                                                                          ten_minutes_later)))
+
+                shutil.rmtree(self.download_folder_name)
+
+    def test_chain_of_identical_images_refers_to_stored_image(self):
+        self.server.responses['/image.jpg'] = [(200, self.small_image_raw_jpeg)]
+        self.server.etags['/image.jpg'] = '"version-1"'
+
+        for slot_index in range(3):
+            self.download_all_images(['/image.jpg'], concurrency=2,
+                                     now=self.now + datetime.timedelta(minutes=10 * slot_index))
+
+        with open(self.downloaded_file_name('image.identical.json', self.now + datetime.timedelta(minutes=20)),
+                  'r') as marker_file:
+            self.assertEqual({'identical_to': '20000102 1230'}, json.load(marker_file))
+
+    def test_download_after_missed_slot_is_stored(self):
+        self.server.responses['/image.jpg'] = [(200, self.small_image_raw_jpeg)]
+        self.server.etags['/image.jpg'] = '"version-1"'
+        twenty_minutes_later = self.now + datetime.timedelta(minutes=20)
+
+        self.download_all_images(['/image.jpg'], concurrency=2)
+        self.download_all_images(['/image.jpg'], concurrency=2, now=twenty_minutes_later)
+
+        with open(self.downloaded_file_name('image.jpg', twenty_minutes_later), 'rb') as actual_image_data:
+            self.assertEqual(self.small_image_raw_jpeg, actual_image_data.read())
+        self.assertFalse(os.path.exists(self.downloaded_file_name('image.identical.json', twenty_minutes_later)))
@@ -2,10 +2,15 @@ import datetime
 import os
 
 import pytest
-from mock import patch
+from mock import patch, MagicMock
 from pyfakefs.fake_filesystem_unittest import Patcher
 
-from chrono_lens.localhost.process_images import process_scheduled
+from chrono_lens.images.download_records import identical_image_marker_name
+from chrono_lens.images.fault_detection import FaultyImageDetector
+from chrono_lens.images.pipeline import ModelStages
+from chrono_lens.images.static_filter import StaticObjectFilter
+from chrono_lens.localhost.process_images import process_scheduled, batch_process, initialise_worker, \
+    processed_times_of_camera
 
 
 @patch('chrono_lens.localhost.process_images.datetime')
@@ -191,6 +196,202 @@ def test_image_edge_cases(mock_datetime, _comment, model_name, image1_file_name,
                f'IMAGE_SUPPLIER,test-camera,{partial_results}\n' == other_lines[0]
 
 
+def create_mock_models(comparison_image_reduction=1):
+    mock_object_detector = MagicMock()
+    mock_object_detector.detected_object_types.return_value = ['car', 'person', 'van']
+    mock_object_detector.detect.side_effect = lambda image_rgb: [
+        ['van', [141, 241, 180, 285, 0.9964]],
+        ['car', [10, 10, 60, 80, 0.9]],
+        ['person', [100, 100, 150, 130, 0.85]]
+    ]
+    return ModelStages(
+        [FaultyImageDetector(comparison_image_reduction=comparison_image_reduction)],
+        mock_object_detector,
+        [StaticObjectFilter(comparison_image_reduction=comparison_image_reduction)]
+    )
+
+
+class InProcessWorkerPool:
+    """
+    Stands in for a process pool, so workers share the (mocked) models and fake file system
+    """
+
+    def __init__(self, _number_of_workers, model_blob_name, config_path, greyscale_decoding=False):
+        initialise_worker(model_blob_name, config_path, greyscale_decoding)
+
+    @staticmethod
+    def apply(function):
+        return function()
+
+    @staticmethod
+    def imap_unordered(function, iterable):
+        # Reverse order, as results are not guaranteed to be returned in order
+        return reversed([function(item) for item in iterable])
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+def batch_process_time_series_and_compare_with_time_major(**batch_process_kwargs):
+    time_series_folder = os.path.join('tests', 'test_data', 'time_series')
+    failing_images_folder = os.path.join('tests', 'test_data', 'failing_images')
+    image_date = datetime.datetime(2020, 5, 1)
+    camera_images = {
+        'camera-a': [
+            os.path.join(time_series_folder, 'TfL-images-20200501-0040-00001.08859.jpg'),
+            os.path.join(time_series_folder, 'TfL-images-20200501-0050-00001.08859.jpg'),
+            os.path.join(time_series_folder, 'TfL-images-20200501-0100-00001.08859.jpg'),
+            os.path.join(time_series_folder, 'TfL-images-20200501-0100-00001.08859.jpg'),
+            None,
+            os.path.join(failing_images_folder, 'TfL-images_20200504_0240_00001.08859.jpg')
+        ],
+        'camera-b': [
+            os.path.join(time_series_folder, 'TfL-images-20200501-1330-00001.08750.jpg'),
+            os.path.join(failing_images_folder, 'this_isnt_an_image.jpeg'),
+            os.path.join(time_series_folder, 'TfL-images-20200501-1340-00001.08750.jpg'),
+            os.path.join(time_series_folder, 'TfL-images-20200501-1350-00001.08750.jpg')
+        ],
+        'camera-c': [
+            os.path.join(time_series_folder, 'TfL-images-20200501-1320-00001.04542.jpg'),
+            os.path.join(time_series_folder, 'TfL-images-20200501-1330-00001.04542.jpg'),
+            os.path.join(time_series_folder, 'TfL-images-20200501-1340-00001.04542.jpg')
+        ]
+    }
+
+    with Patcher() as patcher:
+        config_path = 'test-config'
+        download_path = 'test-downloads'
+        image_supplier = 'IMAGE_SUPPLIER'
+
+        patcher.fs.create_file(os.path.join(config_path, 'analyse-configuration.json'),
+                               contents='{"model_blob_name": "FaultyImageFilterV0_NewcastleV0_StaticObjectFilterV0"}')
+        patcher.fs.create_file(os.path.join(config_path, 'analyse', image_supplier + '.json'),
+                               contents='["camera-a", "camera-b", "camera-c"]')
+
+        for camera_name, image_file_names in camera_images.items():
+            for slot_index, image_file_name in enumerate(image_file_names):
+                if image_file_name is None:
+                    continue
+                image_date_time = image_date + datetime.timedelta(minutes=10 * slot_index)
+                patcher.fs.add_real_file(source_path=image_file_name,
+                                         target_path=os.path.join(download_path, image_supplier,
+                                                                  f'{image_date_time:%Y%m%d}',
+                                                                  f'{image_date_time:%H%M}', camera_name + '.jpg'))
+
+        csv_path = os.path.join('FaultyImageFilterV0_NewcastleV0_StaticObjectFilterV0', f'{image_date:%Y%m%d}.csv')
+
+        # Part-processed day, to check rows are not duplicated
+        patcher.fs.create_file(os.path.join('other-counts', csv_path),
+                               contents='date,time,supplier,camera_id,car,faulty,missing,person,van\n'
+                                        '20200501,0010,IMAGE_SUPPLIER,camera-b,0,True,False,0,0\n')
+
+        batch_process(config_path, download_path, 'time-major-counts', image_date, image_date)
+        batch_process(config_path, download_path, 'other-counts', image_date, image_date, **batch_process_kwargs)
+
+        with open(os.path.join('time-major-counts', csv_path), 'r') as csv_file:
+            time_major_lines = csv_file.readlines()
+        with open(os.path.join('other-counts', csv_path), 'r') as csv_file:
+            other_lines = csv_file.readlines()
+
+    # header + 144 slots x 3 cameras
+    assert 1 + 144 * 3 == len(time_major_lines)
+    assert len(time_major_lines) == len(other_lines)
+    assert sorted(time_major_lines) == sorted(other_lines)
+
+    # Apart from the pre-existing row, rows are in the same order
+    pre_existing_row = '20200501,0010,IMAGE_SUPPLIER,camera-b,0,True,False,0,0\n'
+    assert [line for line in time_major_lines if line != pre_existing_row] == other_lines[:1] + other_lines[2:]
+
+
+@patch('chrono_lens.localhost.process_images.load_models', side_effect=lambda *_: create_mock_models())
+def test_camera_major_batch_process_matches_time_major(_mock_load_models):
+    batch_process_time_series_and_compare_with_time_major(camera_major=True)
+
+
+@patch('chrono_lens.localhost.process_images.load_models',
+       side_effect=lambda *_: create_mock_models(comparison_image_reduction=2))
+def test_camera_major_batch_process_matches_time_major_with_reduced_comparison_images(_mock_load_models):
+    # Images are first decoded as "next" or "current" image depending on processing order; results must not depend
+    # on which
+    batch_process_time_series_and_compare_with_time_major(camera_major=True)
+
+
+@patch('chrono_lens.localhost.process_images.create_worker_pool', side_effect=InProcessWorkerPool)
+@patch('chrono_lens.localhost.process_images.load_models', side_effect=lambda *_: create_mock_models())
+def test_batch_process_with_workers_matches_time_major(_mock_load_models, _mock_create_worker_pool):
+    batch_process_time_series_and_compare_with_time_major(workers=3)
+
+
+def test_processed_times_of_camera_only_include_that_camera():
+    cameras_per_time = {'0000': ['camera-a', 'camera-b'], '0010': ['camera-b'], '0020': []}
+
+    assert {'0000'} == processed_times_of_camera(cameras_per_time, 'camera-a')
+    assert {'0000', '0010'} == processed_times_of_camera(cameras_per_time, 'camera-b')
+    assert set() == processed_times_of_camera(cameras_per_time, 'camera-c')
+
+
+@pytest.mark.parametrize('camera_major', [False, True])
+@patch('chrono_lens.localhost.process_images.load_models', side_effect=lambda *_: create_mock_models())
+def test_batch_process_with_identical_image_markers_matches_stored_images(_mock_load_models, camera_major):
+    time_series_folder = os.path.join('tests', 'test_data', 'time_series')
+    image_0040_file_name = os.path.join(time_series_folder, 'TfL-images-20200501-0040-00001.08859.jpg')
+    image_0050_file_name = os.path.join(time_series_folder, 'TfL-images-20200501-0050-00001.08859.jpg')
+    image_0100_file_name = os.path.join(time_series_folder, 'TfL-images-20200501-0100-00001.08859.jpg')
+    image_date = datetime.datetime(2020, 5, 1)
+    image_file_names = [image_0040_file_name, image_0050_file_name, image_0050_file_name, image_0050_file_name,
+                        image_0100_file_name, image_0040_file_name, image_0040_file_name, None, image_0040_file_name,
+                        image_0050_file_name]
+
+    with Patcher() as patcher:
+        config_path = 'test-config'
+        image_supplier = 'IMAGE_SUPPLIER'
+
+        patcher.fs.create_file(os.path.join(config_path, 'analyse-configuration.json'),
+                               contents='{"model_blob_name": "FaultyImageFilterV0_NewcastleV0_StaticObjectFilterV0"}')
+        patcher.fs.create_file(os.path.join(config_path, 'analyse', image_supplier + '.json'),
+                               contents='["camera"]')
+
+        # Images identical to the previous slot's stored as they are, and as markers, as downloaded
+        stored_image_date_time = None
+        for slot_index, image_file_name in enumerate(image_file_names):
+            image_date_time = image_date + datetime.timedelta(minutes=10 * slot_index)
+            if image_file_name is None:
+                stored_image_date_time = None
+                continue
+
+            for download_path in ['stored-downloads', 'marked-downloads']:
+                target_path = os.path.join(download_path, image_supplier, f'{image_date_time:%Y%m%d}',
+                                           f'{image_date_time:%H%M}', 'camera.jpg')
+                if download_path == 'marked-downloads' and stored_image_date_time is not None \
+                        and image_file_names[slot_index - 1] == image_file_name:
+                    patcher.fs.create_file(
+                        identical_image_marker_name(target_path),
+                        contents=f'{{"identical_to": "{stored_image_date_time:%Y%m%d %H%M}"}}')
+                else:
+                    patcher.fs.add_real_file(source_path=image_file_name, target_path=target_path)
+
+            if stored_image_date_time is None or image_file_names[slot_index - 1] != image_file_name:
+                stored_image_date_time = image_date_time
+
+        batch_process(config_path, 'stored-downloads', 'stored-counts', image_date, image_date,
+                      camera_major=camera_major)
+        batch_process(config_path, 'marked-downloads', 'marked-counts', image_date, image_date,
+                      camera_major=camera_major)
+
+        csv_path = os.path.join('FaultyImageFilterV0_NewcastleV0_StaticObjectFilterV0', f'{image_date:%Y%m%d}.csv')
+        with open(os.path.join('stored-counts', csv_path), 'r') as csv_file:
+            stored_lines = csv_file.readlines()
+        with open(os.path.join('marked-counts', csv_path), 'r') as csv_file:
+            marked_lines = csv_file.readlines()
+
+    assert stored_lines == marked_lines
+    # Identical images are faulty rather than missing
+    assert '20200501,0030,IMAGE_SUPPLIER,camera,0,True,False,0,0\n' in marked_lines
+
+
 def set_up_models_in_fake_fs(config_path, model_name, fs):
     # Set up fake model config
     fs.create_file(os.path.join(config_path, 'analyse-configuration.json'),
@@ -88,5 +88,59 @@ class TestBatchProcessImages(unittest.TestCase):
             download_path=ANY,
             counts_path=ANY,
             start_date=yesterday,
-            end_date=yesterday
+            end_date=yesterday,
+            camera_major=False,
+            workers=1
         )
+
+    @patch('scripts.localhost.batch_process_images.batch_process')
+    @patch('scripts.localhost.batch_process_images.logging')
+    def test_camera_major_passed_through(self, _mock_logging, mock_batch_process_images):
+        command_line_args = [
+            '--start-date=20200601',
+            '--end-date=20200602',
+            '--camera-major'
+        ]
+
+        batch_process_images.main(command_line_args)
+
+        mock_batch_process_images.assert_called_once_with(
+            config_path=ANY,
+            download_path=ANY,
+            counts_path=ANY,
+            start_date=datetime.date(year=2020, month=6, day=1),
+            end_date=datetime.date(year=2020, month=6, day=2),
+            camera_major=True,
+            workers=1
+        )
+
+    @patch('scripts.localhost.batch_process_images.batch_process')
+    @patch('scripts.localhost.batch_process_images.logging')
+    def test_workers_passed_through(self, _mock_logging, mock_batch_process_images):
+        command_line_args = [
+            '--start-date=20200601',
+            '--end-date=20200601',
+            '--workers=32'
+        ]
+
+        batch_process_images.main(command_line_args)
+
+        mock_batch_process_images.assert_called_once_with(
+            config_path=ANY,
+            download_path=ANY,
+            counts_path=ANY,
+            start_date=datetime.date(year=2020, month=6, day=1),
+            end_date=datetime.date(year=2020, month=6, day=1),
+            camera_major=False,
+            workers=32
+        )
+
+    def test_workers_must_be_positive(self):
+        command_line_args = [
+            '--start-date=20200601',
+            '--end-date=20200601',
+            '--workers=0'
+        ]
+
+        self.assertRaisesRegex(ProcessImagesException, 'Number of workers must be at least 1',
+                               batch_process_images.main, command_line_args)